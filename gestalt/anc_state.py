@@ -5,7 +5,7 @@ from functools import reduce
 
 from allele_events import AlleleEvents
 from indel_sets import IndelSet, SingletonWC, Wildcard
-from target_status import TargetStatus, TargetTractTuple, TargetDeactTract
+from target_status import TargetStatus, TargetTractTuple, TargetDeactTract, get_deact_bitmask
 from barcode_metadata import BarcodeMetadata
 
 class AncState:
@@ -31,12 +31,10 @@ class AncState:
         if len(self.indel_set_list) == 0:
             return TargetStatus()
         else:
-            max_target = self.indel_set_list[-1].max_deact_target
-            binary_status = np.zeros(max_target + 1)
+            bitmask = 0
             for indel_set in self.indel_set_list:
-                binary_status[indel_set.min_deact_target:indel_set.max_deact_target + 1] = 1
-            targ_stat = TargetStatus._binary_status_to_target_status(binary_status.tolist())
-            return targ_stat
+                bitmask |= get_deact_bitmask(indel_set.min_deact_target, indel_set.max_deact_target)
+            return TargetStatus.from_bitmask(bitmask)
 
     def to_sg_max_target_status(self):
         """
@@ -45,13 +43,11 @@ class AncState:
         if len(self.indel_set_list) == 0:
             return TargetStatus()
         else:
-            max_target = self.indel_set_list[-1].max_deact_target
-            binary_status = np.zeros(max_target + 1)
+            bitmask = 0
             for indel_set in self.indel_set_list:
                 if indel_set.__class__ == SingletonWC:
-                    binary_status[indel_set.min_deact_target:indel_set.max_deact_target + 1] = 1
-            targ_stat = TargetStatus._binary_status_to_target_status(binary_status.tolist())
-            return targ_stat
+                    bitmask |= get_deact_bitmask(indel_set.min_deact_target, indel_set.max_deact_target)
+            return TargetStatus.from_bitmask(bitmask)
 
     @staticmethod
     def create_for_observed_allele(allele: AlleleEvents, bcode_meta: BarcodeMetadata):
@@ -0,0 +1,343 @@
+from typing import List
+import numpy as np
+
+from cell_lineage_tree import CellLineageTree
+from anc_state import AncState
+from indel_sets import Wildcard
+from target_status import TargetStatus, get_deact_bitmask
+from barcode_metadata import BarcodeMetadata
+
+"""
+Array-based engine for finding all possible events in the internal nodes.
+Gives the same ancestral states as `ancestral_events_finder.annotate_ancestral_states`
+but stores them as bitsets instead of AncState objects.
+
+The ancestral state of each barcode at a node is stored as:
+ * a wildcard mask: an integer where bit `t` is set iff target `t` is in a wildcard
+   (either a Wildcard or the inner wildcard of a SingletonWC) and bit `n_targets + t`
+   is set iff targets `t` and `t + 1` are in the same wildcard
+ * a singleton mask: a boolean vector over all the singleton-wildcards observed
+   in the leaves, which is true iff that singleton-wildcard is in the indel set list
+"""
+
+class SingletonWCUniverse:
+    """
+    Indexes all the singleton-wildcards observed in the leaves, across all barcodes,
+    and precomputes the bitmasks we need for intersecting ancestral states.
+
+    Each singleton-wildcard also has "element bits" that describe its ends, packed into a single integer:
+    the targets it occupies, its min target if it equals its min deact target, its max target if
+    it equals its max deact target, its min deact target if it doesn't equal its min target, and
+    its max deact target if it doesn't equal its max target. The singleton-wildcards in an indel
+    set list never share any targets so these bits are disjoint, which means we can sum the element
+    bits of an ancestral state with a matrix product.
+    """
+    NUM_ELEMENT_FIELDS = 5
+
+    def __init__(self, leaves: List[CellLineageTree], bcode_meta: BarcodeMetadata):
+        """
+        @param leaves: the leaves of the tree
+        """
+        assert SingletonWCUniverse.is_supported(bcode_meta)
+        num_barcodes = bcode_meta.num_barcodes
+        n_targets = bcode_meta.n_targets
+        self.num_barcodes = num_barcodes
+        self.n_targets = n_targets
+        # Maps the allele string of each leaf to its singleton-wildcards for each barcode
+        self.leaf_sgwcs = dict()
+        for leaf in leaves:
+            if leaf.allele_events_list_str not in self.leaf_sgwcs:
+                self.leaf_sgwcs[leaf.allele_events_list_str] = [
+                    AncState.create_for_observed_allele(evts, bcode_meta).indel_set_list
+                    for evts in leaf.allele_events_list]
+
+        self.sgwcs = []
+        self.sgwc_idxs = [dict() for _ in range(num_barcodes)]
+        col_bcodes = []
+        for leaf_bcode_sgwcs in self.leaf_sgwcs.values():
+            for bcode_idx, sgwcs in enumerate(leaf_bcode_sgwcs):
+                for sgwc in sgwcs:
+                    if sgwc not in self.sgwc_idxs[bcode_idx]:
+                        self.sgwc_idxs[bcode_idx][sgwc] = len(self.sgwcs)
+                        self.sgwcs.append(sgwc)
+                        col_bcodes.append(bcode_idx)
+        self.num_sgwcs = len(self.sgwcs)
+        self.col_bcodes = np.array(col_bcodes, dtype=int)
+
+        # Wildcard mask needed for the singleton to be contained in a wildcard
+        self.cover_masks = np.array([
+            self.get_wc_mask(sgwc.min_deact_target, sgwc.max_deact_target) for sgwc in self.sgwcs],
+            dtype=np.int64)
+        self.deact_masks = np.array([
+            get_deact_bitmask(sgwc.min_deact_target, sgwc.max_deact_target) for sgwc in self.sgwcs],
+            dtype=np.int64)
+        # Matrices mapping singletons to the wildcard mask of the inner wildcard and to the element bits
+        # for the barcode of that singleton
+        self.inner_masks = np.zeros((self.num_sgwcs, num_barcodes), dtype=np.int64)
+        self.element_bits = np.zeros((self.num_sgwcs, num_barcodes), dtype=np.int64)
+        for idx, (sgwc, bcode_idx) in enumerate(zip(self.sgwcs, col_bcodes)):
+            self.inner_masks[idx, bcode_idx] = self.get_wc_mask(sgwc.min_target + 1, sgwc.max_target - 1)
+            self.element_bits[idx, bcode_idx] = self._pack_fields(
+                get_deact_bitmask(sgwc.min_target, sgwc.max_target),
+                1 << sgwc.min_target if sgwc.min_target == sgwc.min_deact_target else 0,
+                1 << sgwc.max_target if sgwc.max_target == sgwc.max_deact_target else 0,
+                1 << sgwc.min_deact_target if sgwc.min_target != sgwc.min_deact_target else 0,
+                1 << sgwc.max_deact_target if sgwc.max_target != sgwc.max_deact_target else 0)
+        # The min deact target and max deact target (shifted by `n_targets`) of touching singleton-wildcards
+        self.touching_bits = np.sum(self.element_bits, axis=1) >> (3 * n_targets)
+
+        # Wildcard masks and singleton masks of each leaf
+        self.leaf_masks = dict()
+        for allele_str, leaf_bcode_sgwcs in self.leaf_sgwcs.items():
+            wc_masks = np.zeros(num_barcodes, dtype=np.int64)
+            sg_masks = np.zeros(self.num_sgwcs, dtype=bool)
+            for bcode_idx, sgwcs in enumerate(leaf_bcode_sgwcs):
+                for sgwc in sgwcs:
+                    wc_masks[bcode_idx] |= self.get_wc_mask(sgwc.min_target + 1, sgwc.max_target - 1)
+                    sg_masks[self.sgwc_idxs[bcode_idx][sgwc]] = True
+            self.leaf_masks[allele_str] = (wc_masks, sg_masks)
+
+    @staticmethod
+    def is_supported(bcode_meta: BarcodeMetadata):
+        """
+        @return whether the element bits for this barcode fit in an int64
+        """
+        return bcode_meta.n_targets * SingletonWCUniverse.NUM_ELEMENT_FIELDS < 64
+
+    def _pack_fields(self, *fields):
+        return sum([field << (i * self.n_targets) for i, field in enumerate(fields)])
+
+    def _unpack_field(self, element_bits, field_idx: int):
+        return (element_bits >> (field_idx * self.n_targets)) & ((1 << self.n_targets) - 1)
+
+    def get_wc_mask(self, min_target: int, max_target: int):
+        """
+        @return wildcard mask for a single Wildcard from `min_target` to `max_target`
+        """
+        if min_target > max_target:
+            return 0
+        return get_deact_bitmask(min_target, max_target) | (
+                get_deact_bitmask(min_target, max_target - 1) << self.n_targets if min_target < max_target else 0)
+
+    def get_targets(self, wc_masks):
+        return wc_masks & ((1 << self.n_targets) - 1)
+
+    def get_joins(self, wc_masks):
+        return wc_masks >> self.n_targets
+
+    def is_covered(self, wc_masks: np.ndarray):
+        """
+        @param wc_masks: matrix of wildcard masks, one row per state and one column per barcode
+        @return boolean matrix, entry (i, j) indicates whether singleton `j` is contained in a wildcard of state `i`
+        """
+        return (wc_masks[:, self.col_bcodes] & self.cover_masks) == self.cover_masks
+
+    def get_element_bits(self, sg_masks: np.ndarray):
+        return sg_masks.dot(self.element_bits)
+
+    def _get_starts_ends(self, wc_masks: np.ndarray, element_bits: np.ndarray):
+        """
+        @return targets where an indel set in the indel set list starts with the same min target and min deact target,
+                targets where an indel set ends with the same max target and max deact target
+        """
+        wc_targets = self.get_targets(wc_masks)
+        wc_joins = self.get_joins(wc_masks)
+        # Wildcards that are not the inner wildcard of some singleton-wildcard
+        solo_wcs = wc_targets & ~self._unpack_field(element_bits, 0)
+        return (
+            (solo_wcs & ~(wc_joins << 1)) | self._unpack_field(element_bits, 1),
+            (solo_wcs & ~wc_joins) | self._unpack_field(element_bits, 2))
+
+    def intersect(self, state1, state2):
+        """
+        Vectorized version of `AncState.intersect`
+        @param state1: tuple with the wildcard masks, singleton masks, element bits, and
+                       the singletons contained in each state (see `create_state`)
+        @param state2: same as `state1`
+        @return tuple for the intersected states
+        """
+        wc_masks1, _, element_bits1, contains1 = state1
+        wc_masks2, _, element_bits2, contains2 = state2
+        wc_masks = wc_masks1 & wc_masks2
+        covered = self.is_covered(wc_masks)
+        # Singletons inside a wildcard are not listed separately
+        sg_masks = contains1 & contains2 & ~covered
+        element_bits = self.get_element_bits(sg_masks)
+
+        # Post-processing only removes singleton-wildcards whose deactivated targets
+        # extend past their min or max target
+        if not np.any(element_bits >> (3 * self.n_targets)):
+            return wc_masks, sg_masks, element_bits, sg_masks | covered
+
+        # Post-process with each of the intersected states
+        removable = None
+        for other_wc_masks, other_element_bits in [(wc_masks1, element_bits1), (wc_masks2, element_bits2)]:
+            if removable is None:
+                removable = self._get_removable(wc_masks, element_bits)
+            other_starts, other_ends = self._get_starts_ends(other_wc_masks, other_element_bits)
+            remove_bits = (other_ends & removable[0]) | ((other_starts & removable[1]) << self.n_targets)
+            remove = sg_masks & ((remove_bits[:, self.col_bcodes] & self.touching_bits) != 0)
+            if np.any(remove):
+                # Removing a singleton-wildcard also removes its inner wildcard
+                wc_masks = wc_masks & ~remove.dot(self.inner_masks)
+                sg_masks = sg_masks & ~remove
+                element_bits = self.get_element_bits(sg_masks)
+                covered = self.is_covered(wc_masks)
+                removable = None
+        return wc_masks, sg_masks, element_bits, sg_masks | covered
+
+    def _get_removable(self, wc_masks: np.ndarray, element_bits: np.ndarray):
+        """
+        Vectorized version of `AncState._post_process`: a singleton-wildcard that deactivates a target
+        on its left is removed if that target is the end of an indel set in the other state but the previous
+        indel set in the intersection does not deactivate that target. Similarly for the right.
+
+        @return targets where the previous indel set in the intersection does not deactivate that target,
+                targets where the next indel set in the intersection does not deactivate that target
+        """
+        starts, ends = self._get_starts_ends(wc_masks, element_bits)
+        unoccupied = ~(self.get_targets(wc_masks) | self._unpack_field(element_bits, 0))
+        prev_ends = ends | (self._unpack_field(element_bits, 4) & unoccupied)
+        next_starts = starts | (self._unpack_field(element_bits, 3) & unoccupied)
+        return ~prev_ends, ~next_starts
+
+    def create_state(self, wc_masks: np.ndarray, sg_masks: np.ndarray):
+        """
+        @return the tuple representation of the ancestral states used in `intersect`
+        """
+        return wc_masks, sg_masks, self.get_element_bits(sg_masks), sg_masks | self.is_covered(wc_masks)
+
+    def get_max_target_bitmasks(self, wc_masks: np.ndarray, sg_masks: np.ndarray, bcode_idx: int):
+        """
+        @return array with the bitmask of `AncState.to_max_target_status` for each state
+        """
+        bcode_cols = self.col_bcodes == bcode_idx
+        sg_deacts = np.bitwise_or.reduce(
+                np.where(sg_masks[:, bcode_cols], self.deact_masks[bcode_cols], 0),
+                axis=1)
+        return self.get_targets(wc_masks[:, bcode_idx]) | sg_deacts
+
+    def to_indel_set_list(self, wc_mask: int, sg_mask: np.ndarray, bcode_idx: int):
+        """
+        @return the indel set list of the AncState for this barcode
+        """
+        sgwcs = [self.sgwcs[idx] for idx in np.flatnonzero(sg_mask & (self.col_bcodes == bcode_idx))]
+        wc_targets = int(self.get_targets(wc_mask))
+        wc_joins = int(self.get_joins(wc_mask))
+        for sgwc in sgwcs:
+            wc_targets &= ~get_deact_bitmask(sgwc.min_target, sgwc.max_target)
+        wcs = []
+        targ = 0
+        while targ < self.n_targets:
+            if wc_targets & (1 << targ):
+                min_targ = targ
+                while wc_joins & (1 << targ):
+                    targ += 1
+                wcs.append(Wildcard(min_targ, targ))
+            targ += 1
+        return sorted(sgwcs + wcs, key=lambda indel_set: indel_set.min_target)
+
+class AncStateArrays:
+    """
+    Ancestral states of all nodes in the tree, computed by intersecting the states of all nodes
+    at the same height in the tree at once
+    """
+    def __init__(self, tree: CellLineageTree, bcode_meta: BarcodeMetadata, universe: SingletonWCUniverse = None):
+        """
+        @param universe: the singleton-wildcards of the leaves, so we can skip processing the leaves
+                        when scoring many trees with the same leaves. Recreated if it is missing any of the leaves.
+        """
+        self.bcode_meta = bcode_meta
+        self.nodes = list(tree.traverse("postorder"))
+        self.num_nodes = len(self.nodes)
+        self.parents = -np.ones(self.num_nodes, dtype=int)
+
+        leaves = [node for node in self.nodes if node.is_leaf()]
+        if universe is None or any([leaf.allele_events_list_str not in universe.leaf_masks for leaf in leaves]):
+            universe = SingletonWCUniverse(leaves, bcode_meta)
+        self.universe = universe
+
+        self.wc_masks = np.zeros((self.num_nodes, bcode_meta.num_barcodes), dtype=np.int64)
+        self.sg_masks = np.zeros((self.num_nodes, self.universe.num_sgwcs), dtype=bool)
+        # The children of the internal nodes (except the root), grouped by the height of the node
+        levels = []
+        node_idxs = dict()
+        heights = []
+        for idx, node in enumerate(self.nodes):
+            node_idxs[node] = idx
+            if node.is_leaf():
+                heights.append(0)
+                self.wc_masks[idx], self.sg_masks[idx] = self.universe.leaf_masks[node.allele_events_list_str]
+            else:
+                child_idxs = [node_idxs[child] for child in node.children]
+                self.parents[child_idxs] = idx
+                height = 1 + max([heights[child_idx] for child_idx in child_idxs])
+                heights.append(height)
+                if node.up is not None:
+                    if len(levels) < height:
+                        levels += [[] for _ in range(height - len(levels))]
+                    levels[height - 1].append((idx, child_idxs))
+        self._annotate_internal(levels)
+
+        # The parsimony score is the sum of the number of times a new singleton is introduced
+        # in the ancestral state for each node (see `ancestral_events_finder.get_parsimony_score`)
+        self.branch_scores = np.zeros(self.num_nodes, dtype=int)
+        nonroot_idxs = np.flatnonzero(self.parents >= 0)
+        self.branch_scores[nonroot_idxs] = np.sum(
+                self.sg_masks[nonroot_idxs] & ~self.sg_masks[self.parents[nonroot_idxs]],
+                axis=1)
+        self.parsimony_score = int(np.sum(self.branch_scores))
+
+    def _annotate_internal(self, levels):
+        """
+        Fills in the ancestral states of the internal nodes, processing all nodes at the same height at once.
+        The root is left as the unmodified state.
+        @param levels: for each height, a list of internal node indices and their child indices
+        """
+        state = self.universe.create_state(self.wc_masks, self.sg_masks)
+        for level in levels:
+            if len(level) == 0:
+                continue
+            level_idxs = [idx for idx, _ in level]
+            # Matrix of child indices padded with -1
+            max_children = max([len(child_idxs) for _, child_idxs in level])
+            child_idxs = -np.ones((len(level), max_children), dtype=int)
+            for i, (_, node_child_idxs) in enumerate(level):
+                child_idxs[i, :len(node_child_idxs)] = node_child_idxs
+
+            level_state = [arr[child_idxs[:, 0]] for arr in state]
+            # Intersect with each additional child, in the same order as `get_possible_anc_states`
+            for child_num in range(1, max_children):
+                has_child = child_idxs[:, child_num] >= 0
+                other_state = [arr[child_idxs[has_child, child_num]] for arr in state]
+                if np.all(has_child):
+                    level_state = list(self.universe.intersect(level_state, other_state))
+                else:
+                    intersected = self.universe.intersect([arr[has_child] for arr in level_state], other_state)
+                    for arr, intersected_arr in zip(level_state, intersected):
+                        arr[has_child] = intersected_arr
+
+            for arr, level_arr in zip(state, level_state):
+                arr[level_idxs] = level_arr
+
+    def get_max_target_bitmasks(self, bcode_idx: int):
+        """
+        @return array with the bitmask of `AncState.to_max_target_status` for each node
+        """
+        return self.universe.get_max_target_bitmasks(self.wc_masks, self.sg_masks, bcode_idx)
+
+    def to_max_target_status(self, idx: int, bcode_idx: int):
+        """
+        @param idx: index of the node in `self.nodes`
+        @return same as `AncState.to_max_target_status`
+        """
+        return TargetStatus.from_bitmask(int(self.get_max_target_bitmasks(bcode_idx)[idx]))
+
+    def to_anc_state_list(self, idx: int):
+        """
+        @param idx: index of the node in `self.nodes`
+        @return List[AncState], same as the `anc_state_list` from `annotate_ancestral_states`
+        """
+        return [
+            AncState(self.universe.to_indel_set_list(self.wc_masks[idx, bcode_idx], self.sg_masks[idx], bcode_idx))
+            for bcode_idx in range(self.bcode_meta.num_barcodes)]
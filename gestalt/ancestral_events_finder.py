@@ -3,6 +3,7 @@ from functools import reduce
 
 from cell_lineage_tree import CellLineageTree
 from anc_state import AncState
+from anc_state_arrays import AncStateArrays, SingletonWCUniverse
 
 from barcode_metadata import BarcodeMetadata
 
@@ -76,6 +77,30 @@ def get_parsimony_score(tree: CellLineageTree, do_fast: bool=False):
         pars_score += branch_pars_score
     return pars_score
 
+def calculate_parsimony_score(tree: CellLineageTree, bcode_meta: BarcodeMetadata, universe: SingletonWCUniverse = None):
+    """
+    Same as calling `annotate_ancestral_states` and then `get_parsimony_score`, but uses the
+    array-based engine in `AncStateArrays` and does not annotate the nodes with ancestral states.
+    Use this when only the parsimony score is needed, e.g. when scoring many candidate trees.
+    Any ancestral states already on the nodes may be from a different topology, so they are set to None.
+    Falls back to `annotate_ancestral_states`, which does annotate the nodes, if the barcode has too many
+    targets for the array-based engine.
+    Assigns distance based on max parsimony
+    @param universe: singleton-wildcards of the leaves, to reuse across trees with the same leaves
+    @return parsimony score
+    """
+    if universe is None and not SingletonWCUniverse.is_supported(bcode_meta):
+        annotate_ancestral_states(tree, bcode_meta)
+        return get_parsimony_score(tree)
+
+    anc_state_arrays = AncStateArrays(tree, bcode_meta, universe)
+    for node, branch_pars_score in zip(anc_state_arrays.nodes, anc_state_arrays.branch_scores):
+        if not node.is_root():
+            node.dist = int(branch_pars_score)
+        node.add_feature("anc_state_list", None)
+        node.add_feature("anc_state_list_str", None)
+    return anc_state_arrays.parsimony_score
+
 def get_max_parsimony_anc_singletons(tree: CellLineageTree, bcode_meta: BarcodeMetadata):
     """
     Call this after calling `annotate_ancestral_states`
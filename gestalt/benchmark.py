@@ -0,0 +1,622 @@
+"""
+Benchmarks for the hot paths of fitting GAPML.
+
+Fixed synthetic datasets are generated by `generate_data.py` at several sizes (number of targets,
+barcodes, and leaves). For each dataset we time
+    * transition wrapper construction
+    * building the likelihood graph
+    * one session run of the penalized log likelihood and its gradient
+    * AncState.intersect (as used to find the possible ancestral states of the internal nodes)
+    * the parsimony annotation in `ancestral_events_finder`
+    * one iteration of tuning a hanging chad
+and record the wall time and peak RSS. The scaling exponent of each benchmark is the slope of
+log wall time against log problem size, where the problem size is the number of leaves times
+the number of barcodes. Results are compared to a baseline made by an earlier run with
+`--update-baseline` on the same machine. No baseline is shipped since timings depend on the machine.
+
+Each benchmark runs in a fresh process so that its peak RSS isn't polluted by other benchmarks.
+Use `--in-process` to run everything in this process instead, e.g. for line profiling via
+`kernprof -l benchmark.py --in-process` (functions decorated with `@profile` get profiled).
+Use `--profile-dir` to save cProfile stats of each benchmark.
+
+Example:
+python benchmark.py --sizes 6:1:10,6:1:20 --baseline-file benchmark_baseline.json
+"""
+import sys
+import os
+import argparse
+import logging
+import json
+import time
+import random
+import resource
+import cProfile
+import multiprocessing
+import queue
+import traceback
+import six
+import numpy as np
+from typing import Dict
+
+from common import create_directory
+
+BENCHMARKS = [
+    "transition_wrappers",
+    "likelihood_graph",
+    "log_lik_and_grad",
+    "anc_state_intersect",
+    "parsimony_annotation",
+    "parsimony_arrays",
+    "chad_tune_iter",
+]
+
+# Target cut rates for the synthetic datasets, repeated as needed to match the number of targets
+DEFAULT_TARGET_LAMBDAS = [0.4, 0.5, 0.1, 0.5, 0.3, 0.6]
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+            description='benchmark the hot paths of GAPML')
+    parser.add_argument(
+        '--sizes',
+        type=str,
+        default="6:1:10,6:1:20,6:2:20,6:2:40",
+        help="""
+        comma separated list of dataset sizes, each in the format num_targets:num_barcodes:num_leaves
+        (num_leaves is the minimum number of sampled leaves to simulate. The number of unique alleles may be smaller)
+        """)
+    parser.add_argument(
+        '--benchmarks',
+        type=str,
+        default=",".join(BENCHMARKS),
+        help="comma separated list of benchmarks to run, options: %s" % ",".join(BENCHMARKS))
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help="seed for generating the data and running the benchmarks")
+    parser.add_argument(
+        '--num-reps',
+        type=int,
+        default=3,
+        help="number of times to repeat each benchmark. we report the median wall time")
+    parser.add_argument(
+        '--data-dir',
+        type=str,
+        default="_output/benchmark",
+        help="""
+        folder for the synthetic datasets and scratch files.
+        datasets already in this folder are reused, so delete them if generate_data.py changes
+        """)
+    parser.add_argument(
+        '--out-file',
+        type=str,
+        default="_output/benchmark/benchmark_results.json",
+        help="json file to write the benchmark results to")
+    parser.add_argument(
+        '--log-file',
+        type=str,
+        default="_output/benchmark/benchmark_log.txt")
+    parser.add_argument(
+        '--baseline-file',
+        type=str,
+        default="benchmark_baseline.json",
+        help="json file with the benchmark results to compare against")
+    parser.add_argument(
+        '--update-baseline',
+        action='store_true',
+        help="overwrite the baseline file with the new results")
+    parser.add_argument(
+        '--max-slowdown',
+        type=float,
+        default=1.25,
+        help="report a regression if the wall time is more than this many times the baseline")
+    parser.add_argument(
+        '--fail-on-regression',
+        action='store_true',
+        help="exit with nonzero status if there are any regressions")
+    parser.add_argument(
+        '--max-extra-steps',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--max-sum-states',
+        type=int,
+        default=20)
+    parser.add_argument(
+        '--chad-max-iters',
+        type=int,
+        default=5,
+        help="number of training iterations per candidate when tuning the hanging chad")
+    parser.add_argument(
+        '--max-chad-tune-search',
+        type=int,
+        default=3,
+        help="number of candidate locations to consider when tuning the hanging chad")
+    parser.add_argument(
+        '--in-process',
+        action='store_true',
+        help="run the benchmarks in this process (peak RSS is then cumulative)")
+    parser.add_argument(
+        '--profile-dir',
+        type=str,
+        default=None,
+        help="if given, save cProfile stats for each benchmark in this folder")
+
+    args = parser.parse_args(args)
+    args.sizes = [
+        tuple(int(x) for x in size_str.split(":"))
+        for size_str in args.sizes.split(",")]
+    assert all([len(size) == 3 for size in args.sizes])
+    args.benchmarks = args.benchmarks.split(",")
+    assert all([b in BENCHMARKS for b in args.benchmarks])
+    assert args.num_reps >= 1
+
+    create_directory(args.out_file)
+    if not os.path.exists(args.data_dir):
+        os.makedirs(args.data_dir)
+    if args.profile_dir is not None and not os.path.exists(args.profile_dir):
+        os.makedirs(args.profile_dir)
+    return args
+
+
+def get_dataset_name(num_targets: int, num_barcodes: int, num_leaves: int):
+    return "t%d_b%d_l%d" % (num_targets, num_barcodes, num_leaves)
+
+
+def get_peak_rss_mb():
+    """
+    @return peak resident set size of this process and its reaped children in MB
+    """
+    # Linux reports ru_maxrss in kilobytes
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.
+
+
+def generate_dataset(args, num_targets: int, num_barcodes: int, num_leaves: int):
+    """
+    Simulate data using generate_data.py (if not already generated) and save the oracle tree topology
+
+    @return Dict with the file names of the dataset
+    """
+    name = get_dataset_name(num_targets, num_barcodes, num_leaves)
+    data_files = {
+        "name": name,
+        "obs_file": os.path.join(args.data_dir, name, "obs_data.pkl"),
+        "model_file": os.path.join(args.data_dir, name, "true_model.pkl"),
+        "topology_file": os.path.join(args.data_dir, name, "oracle_tree0.pkl"),
+        "scratch_dir": os.path.join(args.data_dir, name, "scratch"),
+    }
+    if os.path.exists(data_files["topology_file"]):
+        return data_files
+
+    target_lambdas = [DEFAULT_TARGET_LAMBDAS[i % len(DEFAULT_TARGET_LAMBDAS)] for i in range(num_targets)]
+    generate_args = [
+        '--out-obs-file', data_files["obs_file"],
+        '--out-model-file', data_files["model_file"],
+        '--log-file', os.path.join(args.data_dir, name, "generate_log.txt"),
+        '--num-barcodes', str(num_barcodes),
+        '--target-lambdas', ",".join(map(str, target_lambdas)),
+        '--double-cut-weight', '0.3',
+        '--model-seed', str(args.seed),
+        '--data-seed', str(args.seed),
+        '--min-uniq-alleles', str(num_leaves),
+        '--max-uniq-alleles', str(int(num_leaves * 1.5) + 1),
+        '--max-clt-leaves', str(num_leaves * 100),
+        '--max-tries', '50']
+    # Run in a separate process since generate_data.py sets up its own tensorflow session
+    _run_in_new_process(_generate_dataset, (generate_args, data_files))
+    return data_files
+
+
+def _generate_dataset(generate_args, data_files):
+    import generate_data
+    from cell_lineage_tree import CellLineageTree
+
+    generate_data.main(generate_args)
+
+    # The oracle tree has a single leaf per observed allele
+    with open(data_files["model_file"], "rb") as f:
+        true_model_dict = six.moves.cPickle.load(f)
+    with open(data_files["obs_file"], "rb") as f:
+        obs_data_dict = six.moves.cPickle.load(f)
+    true_subtree = true_model_dict["true_subtree"]
+    keep_leaf_ids = set([leaf_ids[0] for leaf_ids in true_model_dict["obs_idx_to_leaves"]])
+    oracle_tree = CellLineageTree.prune_tree(true_subtree, keep_leaf_ids)
+    leaf_abundances = {
+        leaf_ids[0]: obs.abundance
+        for leaf_ids, obs in zip(true_model_dict["obs_idx_to_leaves"], obs_data_dict["obs_leaves"])}
+    for leaf in oracle_tree:
+        leaf.abundance = leaf_abundances[leaf.node_id]
+    with open(data_files["topology_file"], "wb") as f:
+        six.moves.cPickle.dump({
+                "tree": oracle_tree,
+                "multifurc": False}, f, protocol=2)
+
+
+def _run_in_new_process(func, func_args, poll_secs: float = 10):
+    """
+    Runs `func` in a freshly spawned process
+    @return whatever `func` returns
+    """
+    ctx = multiprocessing.get_context("spawn")
+    result_queue = ctx.Queue()
+    proc = ctx.Process(target=_queue_result, args=(result_queue, func, func_args))
+    proc.start()
+    while True:
+        try:
+            is_success, result = result_queue.get(timeout=poll_secs)
+            break
+        except queue.Empty:
+            if not proc.is_alive():
+                raise RuntimeError("Benchmark process died with exit code %s" % proc.exitcode)
+    proc.join()
+    if not is_success:
+        raise RuntimeError("Benchmark process failed:\n%s" % result)
+    return result
+
+
+def _queue_result(result_queue, func, func_args):
+    # Pass back the traceback as a string since exceptions (e.g. from tensorflow) may not be picklable
+    try:
+        result_queue.put((True, func(*func_args)))
+    except Exception:
+        result_queue.put((False, traceback.format_exc()))
+
+
+def run_benchmark(bench_name: str, data_files: Dict, args):
+    """
+    Runs the benchmark `bench_name` on the given dataset `args.num_reps` times.
+    Setup needed for each repetition (e.g. copying trees) is not timed.
+
+    @return Dict with the wall times and peak RSS
+    """
+    np.random.seed(args.seed)
+    random.seed(args.seed)
+    bench_func = globals()["_bench_%s" % bench_name]
+    wall_times = []
+    for rep in range(args.num_reps):
+        profiler = None
+        if args.profile_dir is not None:
+            profiler = cProfile.Profile()
+        wall_time = bench_func(data_files, args, profiler)
+        if profiler is not None:
+            profiler.dump_stats(os.path.join(
+                args.profile_dir,
+                "%s_%s_rep%d.prof" % (data_files["name"], bench_name, rep)))
+        if wall_time is None:
+            # Benchmark does not apply to this dataset
+            return None
+        wall_times.append(wall_time)
+        logging.info("%s %s rep %d: %f sec", data_files["name"], bench_name, rep, wall_time)
+
+    return {
+        "wall_time": float(np.median(wall_times)),
+        "wall_times": wall_times,
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+
+
+class _Timer:
+    """
+    Context manager that times the enclosed code (and profiles it if a profiler is given)
+    """
+    def __init__(self, profiler: cProfile.Profile = None):
+        self.profiler = profiler
+        self.wall_time = None
+
+    def __enter__(self):
+        if self.profiler is not None:
+            self.profiler.enable()
+        self.st_time = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_time = time.time() - self.st_time
+        if self.profiler is not None:
+            self.profiler.disable()
+
+
+def _load_dataset(data_files: Dict):
+    """
+    @return bcode_meta, tree topology (with node ids), observed data dict
+    """
+    import file_readers
+    tree, obs_data_dict = file_readers.read_data(
+            data_files["obs_file"],
+            data_files["topology_file"])
+    return obs_data_dict["bcode_meta"], tree, obs_data_dict
+
+
+def _create_model(tree, bcode_meta, sess, data_files: Dict, obs_data_dict: Dict):
+    """
+    @return CLTLikelihoodModel with no likelihood graph yet
+    """
+    from clt_likelihood_model import CLTLikelihoodModel
+    from optim_settings import KnownModelParams
+    from common import get_init_target_lams
+
+    model = CLTLikelihoodModel(
+        tree,
+        bcode_meta,
+        sess,
+        KnownModelParams(tot_time=True),
+        scratch_dir=data_files["scratch_dir"],
+        use_poisson=False,
+        target_lams=get_init_target_lams(bcode_meta.n_targets),
+        tot_time=obs_data_dict["time"],
+        tot_time_extra=1e-10)
+    return model
+
+
+def _bench_transition_wrappers(data_files: Dict, args, profiler: cProfile.Profile = None):
+    from transition_wrapper_maker import TransitionWrapperMaker, CloseStatesCache
+
+    bcode_meta, tree, _ = _load_dataset(data_files)
+    # Use an empty cache so that we time the construction from scratch
+    trans_wrap_maker = TransitionWrapperMaker(
+            tree,
+            bcode_meta,
+            args.max_extra_steps,
+            args.max_sum_states,
+            close_states_cache=CloseStatesCache())
+    with _Timer(profiler) as timer:
+        trans_wrap_maker.create_transition_wrappers()
+    return timer.wall_time
+
+
+def _bench_likelihood_graph(data_files: Dict, args, profiler: cProfile.Profile = None):
+    import tensorflow as tf
+    from transition_wrapper_maker import TransitionWrapperMaker
+
+    bcode_meta, tree, obs_data_dict = _load_dataset(data_files)
+    transition_wrappers = TransitionWrapperMaker(
+            tree,
+            bcode_meta,
+            args.max_extra_steps,
+            args.max_sum_states).create_transition_wrappers()
+    with tf.Graph().as_default():
+        with tf.Session() as sess:
+            with _Timer(profiler) as timer:
+                model = _create_model(tree, bcode_meta, sess, data_files, obs_data_dict)
+                model.create_log_lik(transition_wrappers, create_gradient=True)
+    return timer.wall_time
+
+
+def _bench_log_lik_and_grad(data_files: Dict, args, profiler: cProfile.Profile = None):
+    import tensorflow as tf
+    from transition_wrapper_maker import TransitionWrapperMaker
+
+    bcode_meta, tree, obs_data_dict = _load_dataset(data_files)
+    transition_wrappers = TransitionWrapperMaker(
+            tree,
+            bcode_meta,
+            args.max_extra_steps,
+            args.max_sum_states).create_transition_wrappers()
+    with tf.Graph().as_default():
+        with tf.Session() as sess:
+            model = _create_model(tree, bcode_meta, sess, data_files, obs_data_dict)
+            model.create_log_lik(transition_wrappers, create_gradient=False)
+            grads = tf.gradients(model.smooth_log_lik, model.all_vars)
+            tf.variables_initializer([model.known_vars, model.all_vars]).run()
+            model.initialize_branch_lens(obs_data_dict["time"])
+            feed_dict = {
+                model.branch_pen_param_ph: 1,
+                model.crazy_pen_param_ph: 0.001,
+                model.target_lam_pen_param_ph: 1,
+            }
+            # The first run includes one-off setup costs in tensorflow, so don't time it
+            sess.run([model.smooth_log_lik, grads], feed_dict=feed_dict)
+            with _Timer(profiler) as timer:
+                sess.run([model.smooth_log_lik, grads], feed_dict=feed_dict)
+    return timer.wall_time
+
+
+def _bench_anc_state_intersect(data_files: Dict, args, profiler: cProfile.Profile = None):
+    import ancestral_events_finder
+
+    bcode_meta, tree, _ = _load_dataset(data_files)
+    ancestral_events_finder.annotate_ancestral_states(tree, bcode_meta)
+    internal_nodes = [node for node in tree.traverse("postorder") if not node.is_leaf() and not node.is_root()]
+    with _Timer(profiler) as timer:
+        for node in internal_nodes:
+            ancestral_events_finder.get_possible_anc_states(node)
+    return timer.wall_time
+
+
+def _bench_parsimony_annotation(data_files: Dict, args, profiler: cProfile.Profile = None):
+    import ancestral_events_finder
+
+    bcode_meta, tree, _ = _load_dataset(data_files)
+    with _Timer(profiler) as timer:
+        ancestral_events_finder.annotate_ancestral_states(tree, bcode_meta)
+        ancestral_events_finder.get_parsimony_score(tree)
+    return timer.wall_time
+
+
+def _bench_parsimony_arrays(data_files: Dict, args, profiler: cProfile.Profile = None):
+    import ancestral_events_finder
+
+    bcode_meta, tree, _ = _load_dataset(data_files)
+    with _Timer(profiler) as timer:
+        ancestral_events_finder.calculate_parsimony_score(tree, bcode_meta)
+    return timer.wall_time
+
+
+def _bench_chad_tune_iter(data_files: Dict, args, profiler: cProfile.Profile = None):
+    """
+    Times a single iteration of the topology tuning loop in tune_topology.py:
+    finding a random hanging chad and then tuning its location
+    """
+    import tune_topology
+    import hanging_chad_finder
+    import parallel_worker
+
+    tune_args = tune_topology.parse_args([
+        '--obs-file', data_files["obs_file"],
+        '--topology-file', data_files["topology_file"],
+        '--out-model-file', os.path.join(data_files["scratch_dir"], "tune_topology_fitted.pkl"),
+        '--log-file', os.path.join(data_files["scratch_dir"], "tune_topology_log.txt"),
+        '--scratch-dir', data_files["scratch_dir"],
+        '--seed', str(args.seed),
+        '--max-iters', str(args.chad_max_iters),
+        '--num-inits', '1',
+        '--num-processes', '1',
+        '--max-chad-tune-search', str(args.max_chad_tune_search),
+        '--max-extra-steps', str(args.max_extra_steps),
+        '--max-sum-states', str(args.max_sum_states)])
+    bcode_meta, tree, obs_data_dict = tune_topology.read_data(tune_args)
+    fit_params = tune_topology.read_fit_params_file(tune_args, bcode_meta, obs_data_dict, None)
+    fit_params["branch_pen_param"] = tune_args.branch_pen_params[0]
+    fit_params["target_lam_pen_param"] = tune_args.target_lam_pen_params[0]
+
+    np.random.seed(args.seed)
+    random.seed(args.seed)
+    with _Timer(profiler) as timer:
+        random_chad = hanging_chad_finder.get_random_chad(
+                tree,
+                bcode_meta,
+                masking_only=True)
+        if random_chad is None or random_chad.num_possible_trees <= 1:
+            # Nothing to tune
+            return None
+        hanging_chad_finder.tune(
+            random_chad,
+            tune_args.max_chad_tune_search,
+            tree,
+            bcode_meta,
+            tune_args,
+            fit_params)
+    # Shut down the worker pool so its memory usage is included in the peak RSS of the children
+    parallel_worker.close_pools()
+    return timer.wall_time
+
+
+def get_scaling_exponents(results: Dict, datasets: Dict):
+    """
+    Fits log wall time = exponent * log problem size + intercept for each benchmark
+    @return Dict mapping benchmark name to scaling exponent (None if fewer than two problem sizes)
+    """
+    exponents = {}
+    for bench_name, bench_results in results.items():
+        sizes = []
+        wall_times = []
+        for dataset_name, res in bench_results.items():
+            if res is None:
+                continue
+            sizes.append(datasets[dataset_name]["problem_size"])
+            wall_times.append(max(res["wall_time"], 1e-6))
+        if len(set(sizes)) < 2:
+            exponents[bench_name] = None
+        else:
+            exponents[bench_name] = float(np.polyfit(np.log(sizes), np.log(wall_times), 1)[0])
+    return exponents
+
+
+def compare_to_baseline(all_results: Dict, baseline: Dict, max_slowdown: float):
+    """
+    Logs and prints how the new results compare to the baseline
+    @return list of the regressions, each a tuple (benchmark name, dataset name, new time, baseline time)
+    """
+    regressions = []
+    row_format = "%-22s %-14s %10s %10s %8s %10s %10s"
+    lines = [row_format % ("benchmark", "dataset", "time", "base time", "ratio", "rss (MB)", "base rss")]
+    for bench_name, bench_results in all_results["results"].items():
+        base_bench_results = baseline["results"].get(bench_name, {})
+        for dataset_name, res in bench_results.items():
+            base_res = base_bench_results.get(dataset_name, None)
+            if res is None:
+                continue
+            if base_res is None:
+                lines.append(row_format % (
+                    bench_name, dataset_name, "%.4f" % res["wall_time"], "-", "-", "%.1f" % res["peak_rss_mb"], "-"))
+                continue
+            ratio = res["wall_time"] / max(base_res["wall_time"], 1e-6)
+            lines.append(row_format % (
+                bench_name,
+                dataset_name,
+                "%.4f" % res["wall_time"],
+                "%.4f" % base_res["wall_time"],
+                "%.2f" % ratio,
+                "%.1f" % res["peak_rss_mb"],
+                "%.1f" % base_res["peak_rss_mb"]))
+            if ratio > max_slowdown:
+                regressions.append((bench_name, dataset_name, res["wall_time"], base_res["wall_time"]))
+
+    lines.append("")
+    lines.append("%-22s %10s %10s" % ("benchmark", "exponent", "base exp"))
+    for bench_name, exponent in all_results["scaling_exponents"].items():
+        base_exponent = baseline["scaling_exponents"].get(bench_name, None)
+        lines.append("%-22s %10s %10s" % (
+            bench_name,
+            "%.2f" % exponent if exponent is not None else "-",
+            "%.2f" % base_exponent if base_exponent is not None else "-"))
+
+    for line in lines:
+        logging.info(line)
+        print(line)
+    for regression in regressions:
+        logging.info("REGRESSION: %s on %s took %f sec vs baseline %f sec", *regression)
+        print("REGRESSION: %s on %s took %f sec vs baseline %f sec" % regression)
+    return regressions
+
+
+def main(args=sys.argv[1:]):
+    args = parse_args(args)
+    logging.basicConfig(format="%(message)s", filename=args.log_file, level=logging.DEBUG)
+    logging.info(str(args))
+
+    datasets = {}
+    data_file_list = []
+    for num_targets, num_barcodes, num_leaves in args.sizes:
+        data_files = generate_dataset(args, num_targets, num_barcodes, num_leaves)
+        if not os.path.exists(data_files["scratch_dir"]):
+            os.makedirs(data_files["scratch_dir"])
+        with open(data_files["topology_file"], "rb") as f:
+            num_obs_leaves = len(six.moves.cPickle.load(f)["tree"])
+        datasets[data_files["name"]] = {
+            "num_targets": num_targets,
+            "num_barcodes": num_barcodes,
+            "num_leaves": num_obs_leaves,
+            "problem_size": num_obs_leaves * num_barcodes,
+        }
+        data_file_list.append(data_files)
+        logging.info("Dataset %s: %s", data_files["name"], datasets[data_files["name"]])
+
+    results = {}
+    for bench_name in args.benchmarks:
+        results[bench_name] = {}
+        for data_files in data_file_list:
+            print("Running %s on %s" % (bench_name, data_files["name"]))
+            if args.in_process:
+                res = run_benchmark(bench_name, data_files, args)
+            else:
+                res = _run_in_new_process(run_benchmark, (bench_name, data_files, args))
+            results[bench_name][data_files["name"]] = res
+
+    all_results = {
+        "datasets": datasets,
+        "results": results,
+        "scaling_exponents": get_scaling_exponents(results, datasets),
+    }
+    with open(args.out_file, "w") as f:
+        json.dump(all_results, f, indent=2, sort_keys=True)
+
+    regressions = []
+    if os.path.exists(args.baseline_file):
+        with open(args.baseline_file, "r") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(all_results, baseline, args.max_slowdown)
+    else:
+        print("No baseline file found at %s" % args.baseline_file)
+
+    if args.update_baseline:
+        with open(args.baseline_file, "w") as f:
+            json.dump(all_results, f, indent=2, sort_keys=True)
+
+    if args.fail_on_regression and len(regressions):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -35,8 +35,7 @@ class CLTChronosEstimator(CLTEstimator):
         _remove_single_child_unobs_nodes(tree)
         if len(tree.get_children()) == 1:
             tree.get_children()[0].delete()
-        ancestral_events_finder.annotate_ancestral_states(tree, self.bcode_meta)
-        ancestral_events_finder.get_parsimony_score(tree)
+        ancestral_events_finder.calculate_parsimony_score(tree, self.bcode_meta)
         logging.info(tree.get_ascii(attributes=["dist"]))
         print(tree.get_ascii(attributes=["dist"]))
         print(tree)
@@ -7,7 +7,7 @@ import random
 from ete3 import Tree, TreeNode
 
 from clt_observer import ObservedAlignedSeq
-from fastq_to_phylip import write_seqs_to_phy
+from fastq_to_phylip import write_seqs_to_phy, encode_event_matrix
 import phylip_parse
 import collapsed_tree
 from cell_lineage_tree import CellLineageTree
@@ -17,6 +17,8 @@ from cell_state import CellState
 from barcode_metadata import BarcodeMetadata
 from tree_distance import UnrootRFDistanceMeasurer
 import data_binarizer
+import parsimony_search
+from parsimony_search import CaminSokalTree
 
 from constants import MIX_CFG_FILE
 from constant_paths import MIX_PATH
@@ -135,37 +137,89 @@ class CLTParsimonyEstimator(CLTEstimator):
                 f.write(line)
         return new_mix_cfg_file
 
+    def to_tree_node(self,
+            tree: CaminSokalTree,
+            seq_ids: List[str],
+            event_encodings: List[str]):
+        """
+        Make a tree from our parsimony search into a TreeNode like the ones parsed from the MIX outfile
+
+        @param seq_ids: sequence id of each leaf in `tree`
+        @param event_encodings: the encoding of the events of each leaf in `tree`
+        """
+        states = tree.get_states()
+        num_events = len(event_encodings[0])
+        tree_nodes = {}
+        for node_idx in tree.get_preorder(tree.root):
+            tree_node = TreeNode()
+            if node_idx < tree.num_leaves:
+                tree_node.name = seq_ids[node_idx]
+                tree_node.add_feature("binary_allele", event_encodings[node_idx])
+            else:
+                # Bit i of the state is event i
+                tree_node.add_feature(
+                        "binary_allele",
+                        format(states[node_idx], "0%db" % num_events)[::-1][:num_events])
+            parent_idx = tree.parents[node_idx]
+            if parent_idx is None:
+                tree_node.dist = 0
+            else:
+                tree_node.dist = bin(states[node_idx] & ~states[parent_idx]).count("1")
+                tree_nodes[parent_idx].add_child(tree_node)
+            tree_nodes[node_idx] = tree_node
+        return tree_nodes[tree.root]
+
     def estimate(self,
             observations: List[ObservedAlignedSeq],
             encode_hidden: bool = True,
             use_cell_state: bool = False,
             mix_seed: int = 1,
             num_jumbles: int = 5,
-            max_trees: int = 4000):
+            max_trees: int = 4000,
+            use_mix: bool = False,
+            rearrangement: str = "spr",
+            max_equal_trees: int = 100,
+            num_processes: int = 1):
         """
         @param observations: the observations to run MIX on
         @param encode_hidden: indicate hidden states to MIX
         @param use_cell_state: ignored -- this is always false
+        @param mix_seed: seed passed to MIX, or the seed of the first of our parsimony searches
+        @param num_jumbles: number of random addition orders to try
+        @param use_mix: whether to call out to MIX rather than run our own parsimony search
+        @param rearrangement: "spr" or "tbr", the tree rearrangements for our own parsimony search
+        @param max_equal_trees: number of equally parsimonious trees to collect in our own parsimony search
+        @param num_processes: number of processes to run our own parsimony searches on
 
         @return a list of unique cell lineage tree estimates
-                calls out to mix on the command line
-                writes files: infile, test.abundance, outfile
+                if `use_mix`, calls out to mix on the command line
+                and writes files: infile, test.abundance, outfile
 
         """
         processed_seqs, event_dicts, event_list = data_binarizer.binarize_observations(
             self.bcode_meta,
             observations)
 
-        write_seqs_to_phy(
-                processed_seqs,
-                event_dicts,
-                self.infile,
-                self.abundance_file,
-                encode_hidden=encode_hidden,
-                use_cell_state=use_cell_state)
+        if use_mix:
+            write_seqs_to_phy(
+                    processed_seqs,
+                    event_dicts,
+                    self.infile,
+                    self.abundance_file,
+                    encode_hidden=encode_hidden,
+                    use_cell_state=use_cell_state)
 
-        new_mix_cfg_file = self._create_mix_cfg(mix_seed, num_jumbles)
-        bifurcating_trees = self.run_mix(new_mix_cfg_file)
+            new_mix_cfg_file = self._create_mix_cfg(mix_seed, num_jumbles)
+            bifurcating_trees = self.run_mix(new_mix_cfg_file)
+        else:
+            bifurcating_trees = self.run_parsimony_search(
+                    processed_seqs,
+                    event_dicts,
+                    encode_hidden,
+                    [mix_seed + i for i in range(num_jumbles)],
+                    rearrangement,
+                    max_equal_trees,
+                    num_processes)
 
         # Read out the results
         logging.info("num bifurcating trees %d", len(bifurcating_trees))
@@ -180,6 +234,34 @@ class CLTParsimonyEstimator(CLTEstimator):
             clts.append(clt_new)
         return clts
 
+    def run_parsimony_search(self,
+            processed_seqs: Dict[str, List],
+            event_dicts: List[Dict[Event, int]],
+            encode_hidden: bool,
+            seeds: List[int],
+            rearrangement: str,
+            max_equal_trees: int,
+            num_processes: int):
+        """
+        Run our own parsimony search on the binarized events, one search per seed
+        @return trees like the ones from mix
+        """
+        seq_ids, has_events, hidden_events = data_binarizer.get_event_matrix(
+                processed_seqs,
+                event_dicts,
+                encode_hidden)
+        parsimony_score, pars_trees = parsimony_search.search_parsimony_trees(
+                parsimony_search.get_packed_bitsets(has_events | hidden_events),
+                parsimony_search.get_packed_bitsets(has_events),
+                seeds,
+                rearrangement,
+                max_equal_trees,
+                num_processes,
+                self.out_folder)
+        logging.info("parsimony search score %d", parsimony_score)
+        event_encodings = encode_event_matrix(has_events, hidden_events)
+        return [self.to_tree_node(t, seq_ids, event_encodings) for t in pars_trees]
+
     def run_mix(self, new_mix_cfg_file):
         """
         Run mix once with the mix config file
@@ -1,14 +1,25 @@
+from typing import List, Dict
 import time
 import numpy as np
+import scipy.optimize
 import tensorflow as tf
 import logging
 
 from clt_estimator import CLTEstimator
 from clt_likelihood_model import CLTLikelihoodModel
 from transition_wrapper_maker import TransitionWrapperMaker
+from subtree_log_lik_cache import SubtreeLogLikCache
 from model_assessor import ModelAssessor
 
 
+# Maps the optimizer names to the scipy.optimize.minimize methods
+SCIPY_OPTIMIZERS = {
+    "lbfgs": "L-BFGS-B",
+    "trust-ncg": "trust-ncg",
+}
+OPTIMIZERS = ["adam"] + sorted(SCIPY_OPTIMIZERS.keys())
+
+
 class CLTPenalizedEstimator(CLTEstimator):
     """
     Likelihood estimator
@@ -20,11 +31,14 @@ class CLTPenalizedEstimator(CLTEstimator):
             model: CLTLikelihoodModel,
             transition_wrapper_maker: TransitionWrapperMaker,
             max_iters: int,
-            min_iters: int = 20):
+            min_iters: int = 20,
+            subtree_cache: SubtreeLogLikCache = None):
         """
         @param model: initial CLT model params
         @param transition_wrapper_maker: TransitionWrapperMaker
         @param max_iters: maximum number of training iterations
+        @param subtree_cache: partial likelihoods of subtrees from a previous fit to plug into the likelihood graph.
+                            Only allowed if we aren't training (max_iters = 0).
         """
         self.model = model
         self.max_iters = max_iters
@@ -35,9 +49,15 @@ class CLTPenalizedEstimator(CLTEstimator):
         logging.info("Done creating transition wrappers")
         self.model.create_log_lik(
                 transition_wrappers,
-                create_gradient=max_iters > 0)
+                create_gradient=max_iters > 0,
+                subtree_cache=subtree_cache)
         logging.info("Done creating tensorflow graph")
-        tf.global_variables_initializer().run()
+        # Only initialize the variables for this model. Other models may share the same graph
+        # (e.g. when many trees are scored in one session) and don't need to be re-initialized.
+        model_vars = [self.model.known_vars, self.model.all_vars]
+        if max_iters > 0:
+            model_vars += self.model.adam_opt.variables()
+        tf.variables_initializer(model_vars).run()
 
         # Anything after this is just for testing
         #self.create_logger()
@@ -55,7 +75,9 @@ class CLTPenalizedEstimator(CLTEstimator):
             print_iter: int = 1,
             save_iter: int = 40,
             assessor: ModelAssessor = None,
-            conv_thres: float = 1e-4):
+            conv_thres: float = 1e-4,
+            optimizer: str = "adam",
+            max_iters: int = None):
         """
         Finds the best model parameters
         @param branch_pen_param: penalty parameter for branch lengths
@@ -65,7 +87,18 @@ class CLTPenalizedEstimator(CLTEstimator):
         @param assessor: if available, this is use to measure how close current tree is to the true tree
                             useful to see how progress is being made
         @param conv_thres: threshold for declaring convergence
+        @param optimizer: one of OPTIMIZERS. "adam" takes gradient steps with a fixed step size.
+                        "lbfgs" is the quasi-Newton method L-BFGS-B and "trust-ncg" is a trust-region Newton
+                        method that uses finite differences of the gradient for the hessian vector products.
+                        Both use the gradient from the likelihood graph. All the model parameters are transformed
+                        to be unconstrained (e.g. branch lengths are on the log scale), so the optimizers don't
+                        need to handle constraints.
+        @param max_iters: maximum number of training iterations for this call, defaults to the one given to the
+                        constructor. Calling fit again continues from the current model parameters (and adam moments).
         """
+        assert optimizer in OPTIMIZERS
+        if max_iters is None:
+            max_iters = self.max_iters
         print("conv_thres", conv_thres)
         feed_dict = {
             self.model.branch_pen_param_ph: branch_pen_param,
@@ -107,25 +140,71 @@ class CLTPenalizedEstimator(CLTEstimator):
             logging.info("initial tree dists: %s", train_history[0]["performance"])
 
         st_time = time.time()
-        prev_pen_log_lik = pen_log_lik[0]
-        logging.info("max iters %d", self.max_iters)
-        for i in range(self.max_iters):
-            var_dict = self.model.get_vars_as_dict()
-            sorted_keys = sorted(list(var_dict.keys()))
-            for k in sorted_keys:
-                if k not in ["branch_len_offsets_proportion", "branch_len_inners"]:
-                    v = var_dict[k]
-                    logging.info("%s: %s", k, v)
-
-            _, pen_log_lik, log_lik, branch_pen, target_lam_pen, dist_to_roots, spine_lens, all_param_pen = self.model.sess.run(
+        logging.info("max iters %d", max_iters)
+        if max_iters > 0:
+            if optimizer == "adam":
+                self._fit_adam(max_iters, feed_dict, train_history, print_iter, save_iter, assessor, conv_thres)
+            else:
+                self._fit_scipy(
+                        SCIPY_OPTIMIZERS[optimizer],
+                        max_iters,
+                        feed_dict,
+                        train_history,
+                        print_iter,
+                        save_iter,
+                        assessor,
+                        conv_thres)
+
+            # Pull the model parameters after the last step
+            var_dict = self._log_vars()
+            dist_to_roots, spine_lens = self.model.sess.run(
+                [self.model.dist_to_root, self.model.spine_lens],
+                feed_dict=feed_dict)
+        train_history[-1]["var_dict"] = var_dict
+        train_history[-1]["target_rates"] = var_dict["target_lams"]
+        train_history[-1]["dist_to_roots"] = dist_to_roots
+        train_history[-1]["spine_lens"] = spine_lens
+        if assessor is not None:
+            bifurc_tree = self.model.get_fitted_bifurcating_tree()
+            performance_dict = assessor.assess(bifurc_tree, var_dict)
+            train_history[-1]["performance"] = performance_dict
+            logging.info("last_iter tree dists: %s", performance_dict)
+
+        logging.info("total train time %f", time.time() - st_time)
+        return train_history
+
+    def _fit_adam(
+            self,
+            max_iters: int,
+            feed_dict: Dict,
+            train_history: List[Dict],
+            print_iter: int,
+            save_iter: int,
+            assessor: ModelAssessor,
+            conv_thres: float):
+        """
+        Runs adam until convergence, appending the progress at each iteration to `train_history`.
+        If the penalized log likelihood becomes nan, stops and goes back to the model parameters
+        of the last entry in `train_history`.
+        """
+        st_time = time.time()
+        prev_pen_log_lik = train_history[-1]["pen_log_lik"][0]
+        # The adam state (model parameters and moments) before the iterations at the last two multiples of save_iter.
+        # We only need these if we hit nan, so we don't want to fetch the parameters at each iteration.
+        adam_vars = [self.model.all_vars] + self.model.adam_opt.variables()
+        snapshots = []
+        for i in range(max_iters):
+            if i % save_iter == 0:
+                snapshots = snapshots[-1:] + [(i, self.model.sess.run(adam_vars))]
+            # Only fetch the scalar summaries at each iteration.
+            # These are evaluated before taking this iteration's step.
+            _, pen_log_lik, log_lik, branch_pen, target_lam_pen, all_param_pen = self.model.sess.run(
                     [
                         self.model.adam_train_op,
                         self.model.smooth_log_lik,
                         self.model.log_lik,
                         self.model.branch_pen,
                         self.model.target_lam_pen,
-                        self.model.dist_to_root,
-                        self.model.spine_lens,
                         self.model.all_param_pen],
                     feed_dict=feed_dict)
 
@@ -135,7 +214,6 @@ class CLTPenalizedEstimator(CLTEstimator):
                     "target_lam_pen": target_lam_pen,
                     "log_lik": log_lik,
                     "pen_log_lik": pen_log_lik,
-                    "target_rates": var_dict["target_lams"],
             }
             if i % print_iter == (print_iter - 1):
                 logging.info(
@@ -144,18 +222,13 @@ class CLTPenalizedEstimator(CLTEstimator):
 
             if np.isnan(pen_log_lik):
                 logging.info("ERROR: pen log like is nan. branch lengths are negative?")
-                break
+                # The last entry of the train history was evaluated before the previous iteration
+                self._restore_adam_state(adam_vars, snapshots, max(i - 1, 0), feed_dict)
+                return
 
             if i % save_iter == (save_iter - 1):
-                iter_info["var_dict"] = var_dict
-                iter_info["dist_to_roots"] = dist_to_roots
-                logging.info("iter %d, train time %f", i, time.time() - st_time)
-                bifurc_tree = self.model.get_fitted_bifurcating_tree()
-                logging.info("leaf lens %f", np.mean([leaf.dist for leaf in bifurc_tree]))
-                if assessor is not None:
-                    performance_dict = assessor.assess(bifurc_tree, var_dict)
-                    logging.info("iter %d assess: %s", i, performance_dict)
-                    iter_info["performance"] = performance_dict
+                # Note that these are the parameters after taking this iteration's step
+                self._save_iter(iter_info, assessor, st_time)
 
             train_history.append(iter_info)
             if i > self.min_iters and (pen_log_lik[0] - prev_pen_log_lik)/np.abs(prev_pen_log_lik) < conv_thres:
@@ -164,14 +237,220 @@ class CLTPenalizedEstimator(CLTEstimator):
                 break
             prev_pen_log_lik = pen_log_lik[0]
 
-        train_history[-1]["var_dict"] = var_dict
-        train_history[-1]["dist_to_roots"] = dist_to_roots
-        train_history[-1]["spine_lens"] = spine_lens
+        # The log likelihoods above are calculated before taking each step,
+        # so also record the log likelihood at the final model parameters
+        pen_log_lik, log_lik, branch_pen, target_lam_pen = self.model.sess.run(
+            [
+                self.model.smooth_log_lik,
+                self.model.log_lik,
+                self.model.branch_pen,
+                self.model.target_lam_pen,
+            ],
+            feed_dict=feed_dict)
+        if not np.isnan(pen_log_lik):
+            train_history.append({
+                    "iter": train_history[-1]["iter"] + 1,
+                    "branch_pen": branch_pen,
+                    "target_lam_pen": target_lam_pen,
+                    "log_lik": log_lik,
+                    "pen_log_lik": pen_log_lik})
+        elif snapshots:
+            logging.info("ERROR: pen log like is nan after the last step")
+            # The last entry of the train history was evaluated before the last iteration
+            self._restore_adam_state(adam_vars, snapshots, i, feed_dict)
+
+    def _restore_adam_state(self, adam_vars: List, snapshots: List, iter_idx: int, feed_dict: Dict):
+        """
+        Sets the adam state to what it was before iteration `iter_idx` by loading the latest snapshot
+        from before then and redoing the adam steps since the snapshot
+
+        @param adam_vars: the model parameters and adam moment variables
+        @param snapshots: list of tuples (iteration, values of `adam_vars` before that iteration)
+        """
+        snapshot_iter, snapshot_vals = [
+            snapshot for snapshot in snapshots if snapshot[0] <= iter_idx][-1]
+        self.model.sess.run(self.model.assign_op, feed_dict={self.model.all_vars_ph: snapshot_vals[0]})
+        for var, val in zip(adam_vars[1:], snapshot_vals[1:]):
+            var.load(val, self.model.sess)
+        for _ in range(iter_idx - snapshot_iter):
+            self.model.sess.run(self.model.adam_train_op, feed_dict=feed_dict)
+
+    def _fit_scipy(
+            self,
+            method: str,
+            max_iters: int,
+            feed_dict: Dict,
+            train_history: List[Dict],
+            print_iter: int,
+            save_iter: int,
+            assessor: ModelAssessor,
+            conv_thres: float):
+        """
+        Minimizes the negative penalized log likelihood using scipy.optimize.minimize,
+        appending the progress at each iteration to `train_history`.
+        At the end, the model parameters are set to the last iterate.
+
+        @param method: the scipy method
+        """
+        st_time = time.time()
+        init_x = self.model.sess.run(self.model.all_vars)
+        # Zero branch lengths are -inf on the log scale. Adam never moves them since their gradient is zero,
+        # so we also keep them fixed here.
+        is_free = np.isfinite(init_x)
+
+        # Cache the last evaluation since scipy asks for the objective and the gradient separately
+        # and then again at the new iterate in the callback
+        last_eval = {"x": None}
+
+        def evaluate(free_x):
+            if last_eval["x"] is not None and np.array_equal(last_eval["x"], free_x):
+                return last_eval
+            x = np.copy(init_x)
+            x[is_free] = free_x
+            self.model.sess.run(self.model.assign_op, feed_dict={self.model.all_vars_ph: x})
+            try:
+                pen_log_lik, log_lik, branch_pen, target_lam_pen, neg_grad = self.model.sess.run(
+                    [
+                        self.model.smooth_log_lik,
+                        self.model.log_lik,
+                        self.model.branch_pen,
+                        self.model.target_lam_pen,
+                        self.model.neg_smooth_log_lik_grad,
+                    ],
+                    feed_dict=feed_dict)
+                neg_grad = neg_grad[is_free]
+                is_valid = np.isfinite(pen_log_lik[0]) and np.all(np.isfinite(neg_grad))
+            except tf.errors.InvalidArgumentError as e:
+                # The numerical checks in the likelihood graph failed
+                logging.info("Invalid params: %s", e.message.split("\n")[0])
+                is_valid = False
+            if is_valid:
+                last_eval.update({
+                    "objective": -pen_log_lik[0],
+                    "neg_grad": neg_grad,
+                    "iter_info": {
+                        "branch_pen": branch_pen,
+                        "target_lam_pen": target_lam_pen,
+                        "log_lik": log_lik,
+                        "pen_log_lik": pen_log_lik,
+                    }})
+            else:
+                # The line search/trust region steps back from parameter values where the likelihood graph fails.
+                # The gradient is not used there.
+                num_invalid["count"] += 1
+                last_eval.update({
+                    "objective": np.inf,
+                    "neg_grad": np.zeros(free_x.size),
+                    "iter_info": None})
+            last_eval["x"] = np.copy(free_x)
+            return last_eval
+
+        num_invalid = {"count": 0}
+
+        # The gradient at the current iterate, for the hessian vector products
+        hessp_base = {"x": None}
+
+        def get_hessp(free_x, p):
+            # Hessian vector product by finite differences of the gradient.
+            # Difference in the other direction if the step leaves the region where the likelihood is valid.
+            if hessp_base["x"] is None or not np.array_equal(hessp_base["x"], free_x):
+                hessp_base["x"] = np.copy(free_x)
+                hessp_base["neg_grad"] = evaluate(free_x)["neg_grad"]
+            eps = 1e-6 * max(1, np.linalg.norm(free_x)) / max(np.linalg.norm(p), 1e-30)
+            for step in [eps, -eps]:
+                step_eval = evaluate(free_x + step * p)
+                if step_eval["iter_info"] is not None:
+                    return (step_eval["neg_grad"] - hessp_base["neg_grad"])/step
+            return np.zeros(free_x.size)
+
+        last_free_x = {"x": init_x[is_free]}
+
+        class Converged(Exception):
+            pass
+
+        def callback(free_xk, *args):
+            if np.array_equal(free_xk, last_free_x["x"]):
+                # The trust region method rejected the step
+                return
+            iter_info = evaluate(free_xk)["iter_info"]
+            if iter_info is None:
+                return
+            i = len(train_history) - 1
+            iter_info = dict(iter_info, iter=i)
+            if i % print_iter == (print_iter - 1):
+                logging.info(
+                    "iter %d pen log lik %f log lik %f branch pen %f, lambda pen %f",
+                    i, iter_info["pen_log_lik"], iter_info["log_lik"],
+                    iter_info["branch_pen"], iter_info["target_lam_pen"])
+            if i % save_iter == (save_iter - 1):
+                self._save_iter(iter_info, assessor, st_time)
+            prev_pen_log_lik = train_history[-1]["pen_log_lik"][0]
+            train_history.append(iter_info)
+            last_free_x["x"] = np.copy(free_xk)
+            if method != "L-BFGS-B":
+                # Same as the ftol criterion of L-BFGS-B, which is the relative change in the objective like adam
+                pen_log_lik = iter_info["pen_log_lik"][0]
+                if (pen_log_lik - prev_pen_log_lik)/max(np.abs(prev_pen_log_lik), np.abs(pen_log_lik), 1) <= conv_thres:
+                    raise Converged()
+
+        if method == "L-BFGS-B":
+            options = {"ftol": conv_thres, "gtol": 0}
+            hessp = None
+        else:
+            options = {"gtol": 0}
+            hessp = get_hessp
+        num_iters_left = max_iters
+        while num_iters_left > 0:
+            num_invalid["count"] = 0
+            num_history = len(train_history)
+            try:
+                result = scipy.optimize.minimize(
+                        lambda free_x: evaluate(free_x)["objective"],
+                        last_free_x["x"],
+                        method=method,
+                        jac=lambda free_x: evaluate(free_x)["neg_grad"],
+                        hessp=hessp,
+                        callback=callback,
+                        options=dict(options, maxiter=num_iters_left))
+                logging.info("scipy %s: %s, num evals %d", method, result.message, result.nfev)
+            except Converged:
+                logging.info("scipy %s: Convergence reached %f", method, conv_thres)
+                break
+            num_iters_left -= len(train_history) - num_history
+            # The line search of L-BFGS-B gives up once it hits invalid parameter values.
+            # If it was still making progress, restart it from the last iterate with a fresh line search.
+            if method != "L-BFGS-B" or num_invalid["count"] == 0 or len(train_history) == num_history:
+                break
+            logging.info("Restarting %s after %d invalid evaluations", method, num_invalid["count"])
+
+        # Scipy may have stopped at a trial point
+        x = np.copy(init_x)
+        x[is_free] = last_free_x["x"]
+        self.model.sess.run(self.model.assign_op, feed_dict={self.model.all_vars_ph: x})
+
+    def _save_iter(self, iter_info: Dict, assessor: ModelAssessor, st_time: float):
+        """
+        Stores the current model parameters in `iter_info` and assesses the current tree
+        """
+        var_dict = self._log_vars()
+        iter_info["var_dict"] = var_dict
+        iter_info["target_rates"] = var_dict["target_lams"]
+        iter_info["dist_to_roots"] = self.model.sess.run(self.model.dist_to_root)
+        logging.info("iter %d, train time %f", iter_info["iter"], time.time() - st_time)
         if assessor is not None:
             bifurc_tree = self.model.get_fitted_bifurcating_tree()
+            logging.info("leaf lens %f", np.mean([leaf.dist for leaf in bifurc_tree]))
             performance_dict = assessor.assess(bifurc_tree, var_dict)
-            train_history[-1]["performance"] = performance_dict
-            logging.info("last_iter tree dists: %s", performance_dict)
+            logging.info("iter %d assess: %s", iter_info["iter"], performance_dict)
+            iter_info["performance"] = performance_dict
 
-        logging.info("total train time %f", time.time() - st_time)
-        return train_history
+    def _log_vars(self):
+        """
+        Pulls the current model parameters from the session and logs them (except the branch lengths)
+        @return Dict with the model parameters
+        """
+        var_dict = self.model.get_vars_as_dict()
+        for k in sorted(var_dict.keys()):
+            if k not in ["branch_len_offsets_proportion", "branch_len_inners"]:
+                logging.info("%s: %s", k, var_dict[k])
+        return var_dict
@@ -16,6 +16,8 @@ from barcode_metadata import BarcodeMetadata
 from indel_sets import Singleton
 from target_status import TargetStatus
 from transition_wrapper_maker import TransitionWrapper
+from transition_matrix_indexer import TransitionMatrixIndexer
+from subtree_log_lik_cache import SubtreeLogLikCache
 import tf_common
 from common import inv_sigmoid, assign_rand_tree_lengths
 from constants import PERTURB_ZERO
@@ -137,11 +139,16 @@ class CLTLikelihoodModel:
             self.targ_stat_transitions_dict, _ = TargetStatus.get_all_transitions(self.bcode_meta)
             # Calculcate the hazards for all the target tracts beforehand. Speeds up computation in the future.
             self.target_tract_hazards, self.target_tract_dict = self._create_all_target_tract_hazards()
-            # Dictionary for storing hazards between target statuses -- assuming all moves are possible
-            self.targ_stat_transition_hazards_dict = {
-                start_target_status: {} for start_target_status in self.targ_stat_transitions_dict.keys()}
             # Calculate hazard for transitioning away from all target statuses beforehand. Speeds up future computation.
+            self.all_target_statuses = list(self.targ_stat_transitions_dict.keys())
+            self.hazard_aways = self._create_hazard_away_target_statuses(self.all_target_statuses)
             self.hazard_away_dict = self._create_hazard_away_dict()
+            # The transition rate matrices are assembled by gathering from this vector
+            self.transition_rate_params = tf.concat([self.target_tract_hazards, -self.hazard_aways], axis=0)
+            self.transition_matrix_indexer = TransitionMatrixIndexer(
+                    self.targ_stat_transitions_dict,
+                    self.all_target_statuses,
+                    self.target_tract_dict)
 
         if self.topology:
             assert not self.topology.is_leaf()
@@ -759,19 +766,11 @@ class CLTLikelihoodModel:
 
     def _create_hazard_away_dict(self):
         """
-        @return (
-            Dictionary mapping all possible TargetStatus to tensorflow tensor for the hazard away,
-            Dictionary mapping all possible TargetStatus to tensorflow tensors of hazards of introducing focal and double cuts)
+        @return Dictionary mapping all possible TargetStatus to tensorflow tensor for the hazard away
         """
-        target_statuses = list(self.targ_stat_transitions_dict.keys())
-
-        # Gets hazards (by tensorflow)
-        hazard_away_nodes = self._create_hazard_away_target_statuses(target_statuses)
-        hazard_away_dict = {
-                targ_stat: hazard_away_nodes[i]
-                for i, targ_stat in enumerate(target_statuses)}
-
-        return hazard_away_dict
+        return {
+                targ_stat: self.hazard_aways[i]
+                for i, targ_stat in enumerate(self.all_target_statuses)}
 
     def _create_hazard_away_target_statuses(self, target_statuses: List[TargetStatus]):
         """
@@ -780,7 +779,7 @@ class CLTLikelihoodModel:
         @return tensorflow tensor with the hazards for transitioning away from each of the target statuses
         """
         active_masks = tf.constant(
-                [(1 - targ_stat.get_binary_status(self.num_targets)).tolist() for targ_stat in target_statuses],
+                1 - TargetStatus.get_binary_statuses(target_statuses, self.num_targets),
                 dtype=tf.float64)
         active_targ_hazards = self.target_lams * active_masks
 
@@ -969,12 +968,20 @@ class CLTLikelihoodModel:
     LOG LIKELIHOOD CALCULATION section
     """
     @profile
-    def create_log_lik(self, transition_wrappers: Dict, create_gradient: bool = True):
+    def create_log_lik(
+            self,
+            transition_wrappers: Dict,
+            create_gradient: bool = True,
+            subtree_cache: SubtreeLogLikCache = None):
         """
         Creates tensorflow nodes that calculate the log likelihood of the observed data
+        @param subtree_cache: if given, plug in partial likelihoods of subtrees from a previous fit.
+                            This is only valid when evaluating the tree at the same parameters as
+                            the previous fit so we cannot create the gradient.
         """
+        assert subtree_cache is None or not create_gradient
         st_time = time.time()
-        self.create_topology_log_lik(transition_wrappers)
+        self.create_topology_log_lik(transition_wrappers, subtree_cache)
         logging.info("Done creating topology log likelihood, time: %d", time.time() - st_time)
         self.log_lik = self.log_lik_alleles
 
@@ -995,7 +1002,10 @@ class CLTLikelihoodModel:
         if create_gradient:
             logging.info("Computing gradients....")
             st_time = time.time()
-            self.adam_train_op = self.adam_opt.minimize(-self.smooth_log_lik, var_list=self.all_vars)
+            grads_and_vars = self.adam_opt.compute_gradients(-self.smooth_log_lik, var_list=[self.all_vars])
+            # The gradient is also used by the optimizers in scipy (see CLTPenalizedEstimator)
+            self.neg_smooth_log_lik_grad = grads_and_vars[0][0]
+            self.adam_train_op = self.adam_opt.apply_gradients(grads_and_vars)
             logging.info("Finished making me an optimizer, time: %d", time.time() - st_time)
 
     def _init_singleton_probs(self, singletons: List[Singleton]):
@@ -1005,69 +1015,103 @@ class CLTLikelihoodModel:
         self._create_trim_insert_distributions(len(singletons))
         self.singleton_log_cond_prob = self._create_log_indel_probs(singletons)
         self.singleton_cond_prob = tf.exp(self.singleton_log_cond_prob)
+        # The trim probability matrices are assembled by gathering from this vector.
+        # The last element is for transitions that would introduce more than one singleton.
+        self.trim_prob_params = tf.constant([-1.0], dtype=tf.float64)
+        if singletons:
+            self.trim_prob_params = tf.concat([self.singleton_cond_prob - 1.0, self.trim_prob_params], axis=0)
 
     """
     Section for creating the log likelihood of the allele data
     """
     @profile
-    def create_topology_log_lik(self, transition_wrappers: Dict[int, List[TransitionWrapper]]):
+    def create_topology_log_lik(
+            self,
+            transition_wrappers: Dict[int, List[TransitionWrapper]],
+            subtree_cache: SubtreeLogLikCache = None):
         """
         Create a tensorflow graph of the likelihood calculation
+        @param subtree_cache: if given, plug in partial likelihoods of subtrees from a previous fit
         """
         singletons = CLTLikelihoodModel.get_all_singletons(self.topology)
         self._init_singleton_probs(singletons)
 
         # Actually create the nodes for calculating the log likelihoods of the alleles
-        self.log_lik_alleles_list = []
-        self.Ddiags_list = []
-        for bcode_idx in range(self.bcode_meta.num_barcodes):
-            print("likelihood bcode", bcode_idx)
-            log_lik_alleles, Ddiags = self._create_topology_log_lik_barcode(transition_wrappers, bcode_idx)
-            self.log_lik_alleles_list.append(log_lik_alleles)
-            self.Ddiags_list.append(Ddiags)
-        self.log_lik_alleles = tf.add_n(self.log_lik_alleles_list)
-
-    def _initialize_lower_log_prob(
+        self.transition_wrappers = transition_wrappers
+        # Distance to root of the nodes whose subtrees were plugged in from `subtree_cache`
+        self.cached_dist_to_root = dict()
+        cached_subtrees = dict()
+        if subtree_cache is not None:
+            cached_subtrees = subtree_cache.get_cached_subtrees(self.topology, transition_wrappers)
+            logging.info("Reusing %d cached subtrees", len(cached_subtrees))
+            for node_id, (_, _, dist_to_root) in cached_subtrees.items():
+                self.cached_dist_to_root[node_id] = dist_to_root
+        self.log_lik_bcodes, self.Ddiags_list = self._create_topology_log_lik_barcodes(
+                transition_wrappers,
+                cached_subtrees)
+        self.log_lik_alleles = tf.reduce_sum(self.log_lik_bcodes, keepdims=True)
+
+    def _initialize_lower_log_probs(
             self,
-            transition_wrapper: TransitionWrapper,
-            node: CellLineageTree):
+            nodes: List[CellLineageTree],
+            transition_wrappers: Dict[int, List[TransitionWrapper]],
+            padded_len: int):
         """
-        Initialize the Lprob element with the first part of the product
+        Initialize the Lprob elements of `nodes` with the first part of the product
             For unresolved multifurcs, this is the probability of staying in this same ancestral state (the spine's probability)
-                for root nodes, this returns a scalar.
-                for non-root nodes, this returns a vector with the initial value for all ancestral states under consideration.
+                for root nodes, this is only needed for the unmodified state.
             For resolved multifurcs, this is one
+
+        @return tensor of shape (len(nodes), num barcodes, padded_len) with the log of the initial values
+                for all ancestral states under consideration for each barcode (ordered according to the
+                node's transition wrapper for that barcode), or a scalar if this is the same for all states
         """
-        if not node.is_resolved_multifurcation():
-            # Then we need to multiply the probability of the "spine" -- assuming constant ancestral state along the entire spine
-            time_stays_constant = tf.reduce_max(tf.stack([
-                self.branch_len_offsets[child.node_id]
-                for child in node.children]))
-            if not node.is_root():
-                decay_factor = self._get_decay_factor(
-                    self.dist_to_root[node.up.node_id],
-                    time_stays_constant)
-                # When making this probability, order the elements per the transition matrix of this node
-                index_vals = [[
-                        [transition_wrapper.key_dict[state], 0],
-                        self.hazard_away_dict[state]]
-                    for state in transition_wrapper.states]
-                haz_aways = tf_common.scatter_nd(
-                        index_vals,
-                        output_shape=[transition_wrapper.num_possible_states + 1, 1],
-                        name="haz_away.multifurc")
-                haz_stay_scaled = -haz_aways * decay_factor
-                return haz_stay_scaled
-            else:
-                root_haz_away = self.hazard_away_dict[TargetStatus()]
-                decay_factor = self._get_decay_factor(
-                    tf.constant(0, dtype=tf.float64),
-                    time_stays_constant)
-                haz_stay_scaled = -root_haz_away * decay_factor
-                return haz_stay_scaled
-        else:
+        num_barcodes = self.bcode_meta.num_barcodes
+        unresolved_idxs = [i for i, node in enumerate(nodes) if not node.is_resolved_multifurcation()]
+        if len(unresolved_idxs) == 0:
             return tf.constant(0, dtype=tf.float64)
 
+        # Then we need to multiply the probability of the "spine" -- assuming constant ancestral state along the entire spine
+        unresolved_nodes = [nodes[i] for i in unresolved_idxs]
+        spine_child_ids = []
+        spine_segment_ids = []
+        for i, node in enumerate(unresolved_nodes):
+            for child in node.children:
+                spine_child_ids.append(child.node_id)
+                spine_segment_ids.append(i)
+        time_stays_constant = tf.unsorted_segment_max(
+                tf.gather(self.branch_len_offsets, spine_child_ids),
+                spine_segment_ids,
+                num_segments=len(unresolved_nodes))
+        decay_factor = self._get_decay_factor(
+                tf.stack([
+                    self.dist_to_root[node.up.node_id] if not node.is_root() else tf.constant(0, dtype=tf.float64)
+                    for node in unresolved_nodes]),
+                time_stays_constant)
+
+        # When making this probability, order the elements per the transition matrix of this node.
+        # The sink state and the padding get the hazard at the very end, which is zero.
+        haz_away_idxs = np.full(
+                (len(unresolved_nodes), num_barcodes, padded_len),
+                len(self.all_target_statuses),
+                dtype=np.int64)
+        for i, node in enumerate(unresolved_nodes):
+            if node.is_root():
+                haz_away_idxs[i, :, 0] = self.transition_matrix_indexer.targ_stat_idx_dict[TargetStatus()]
+            else:
+                for bcode_idx, transition_wrapper in enumerate(transition_wrappers[node.node_id]):
+                    state_idxs = self.transition_matrix_indexer.get_state_idxs(transition_wrapper)
+                    haz_away_idxs[i, bcode_idx, :state_idxs.size] = state_idxs
+        haz_aways = tf.gather(
+                tf.concat([self.hazard_aways, tf.zeros([1], dtype=tf.float64)], axis=0),
+                haz_away_idxs,
+                name="haz_away.multifurc")
+        haz_stay_scaled = -haz_aways * tf.reshape(decay_factor, [-1, 1, 1])
+        return tf.scatter_nd(
+                np.array(unresolved_idxs).reshape((-1, 1)),
+                haz_stay_scaled,
+                [len(nodes), num_barcodes, padded_len])
+
     def _get_decay_factor(self, a, delta):
         """
         We suppose a linear decay rate of the instantaneous rate matrix (so a linear decay in the target lam values).
@@ -1122,109 +1166,270 @@ class CLTLikelihoodModel:
         return tf.reduce_mean(tf.pow(log_br - tf.reduce_mean(log_br), 2))
 
     @profile
-    def _create_topology_log_lik_barcode(
+    def _create_topology_log_lik_barcodes(
             self,
             transition_wrappers: Dict[int, List[TransitionWrapper]],
-            bcode_idx: int,
-            eps: float = 1e-30):
+            cached_subtrees: Dict[int, tuple] = None):
         """
+        The partial likelihoods of all the barcodes are computed together: for each node, the partial likelihood
+        vectors of the barcodes (each ordered according to the node's transition wrapper for that barcode)
+        are zero-padded to a common length. So the number of ops in the graph does not grow with the number of barcodes.
+
+        Moreover, the nodes are processed level by level, where the level of a node is its height in the tree
+        (leaves and cached subtrees are at level zero). All the nodes in the same level are combined using
+        a few batched ops, so the depth of the graph is proportional to the height of the tree rather than
+        the number of nodes.
+        The partial likelihoods of the nodes in each level are stored in a flattened tensor of shape
+        (num nodes in level * num barcodes * padded length of the level) -- see `self.Lprob_locs`.
+
         @param transition_wrappers: dictionary mapping node id to list of TransitionWrapper -- carries useful information
                                     for deciding how to calculate the transition probabilities
-        @param bcode_idx: the index of the allele we are calculating the likelihood for
+        @param cached_subtrees: maps node id to the partial likelihoods and total log scaling terms of its subtree
+                                (see SubtreeLogLikCache.get_cached_subtrees). We use these values instead of
+                                creating the graph for the nodes below.
 
-        @return tensorflow tensor with the log likelihood of the allele with index `bcode_idx` for the given tree topology
+        @return tuple with
+                    tensorflow tensor with the log likelihood of each allele for the given tree topology
+                    list with a dictionary for each barcode with the eigenvalues of the transition matrix for each node
         """
-        # Store the tensorflow objects that calculate the prob of a node being in each state given the leaves
-        Lprob = dict()
-        Ddiags = dict()
-        pt_matrix = dict()
+        num_barcodes = self.bcode_meta.num_barcodes
         trans_mats = dict()
         trim_probs = dict()
-        down_probs_dict = dict()
-        # Store all the scaling terms addressing numerical underflow
-        log_scaling_terms = dict()
-        # Tree traversal order should be postorder
+
+        if cached_subtrees is None:
+            cached_subtrees = dict()
+        # Nodes that are below a cached subtree don't need to be part of the graph
+        skip_node_ids = set()
+        for node in self.topology.traverse("preorder"):
+            if not node.is_root() and (node.up.node_id in cached_subtrees or node.up.node_id in skip_node_ids):
+                skip_node_ids.add(node.node_id)
+
+        # The length of the padded partial likelihood vectors for each node
+        # (this must match the size of the padded probability matrices)
+        padded_lens = {self.root_node_id: 1}
+        for node in self.topology.traverse("preorder"):
+            if not node.is_root() and node.node_id not in skip_node_ids:
+                padded_lens[node.node_id] = tf_common.get_padded_size(max([
+                    wrapper.num_possible_states + 1 for wrapper in transition_wrappers[node.node_id]]))
+
+        # Group the internal nodes by height
+        node_heights = dict()
+        levels = []
         for node in self.topology.traverse("postorder"):
-            if node.is_leaf():
-                node_wrapper = transition_wrappers[node.node_id][bcode_idx]
-                prob_array = np.zeros((node_wrapper.num_possible_states + 1, 1))
-                observed_key = node_wrapper.key_dict[node_wrapper.leaf_state]
-                prob_array[observed_key] = 1
-                Lprob[node.node_id] = tf.constant(prob_array, dtype=tf.float64)
+            if node.node_id in skip_node_ids:
+                continue
+            if node.is_leaf() or node.node_id in cached_subtrees:
+                node_heights[node.node_id] = 0
             else:
-                transition_wrapper = transition_wrappers[node.node_id][bcode_idx]
-                log_Lprob_node = self._initialize_lower_log_prob(transition_wrapper, node)
-                has_pos_prob = tf.constant(1, dtype=tf.float64)
+                node_heights[node.node_id] = 1 + max([node_heights[child.node_id] for child in node.children])
+                if len(levels) < node_heights[node.node_id]:
+                    levels.append([])
+                levels[node_heights[node.node_id] - 1].append(node)
+
+        # Within each level, group the branches by the padded length of the child
+        # Each branch is a tuple (index of parent node in the level, child node)
+        level_branch_groups = []
+        for level_nodes in levels:
+            branch_groups = dict()
+            for parent_idx, node in enumerate(level_nodes):
                 for child in node.children:
-                    child_wrapper = transition_wrappers[child.node_id][bcode_idx]
-                    with tf.name_scope("Transition_matrix%d" % node.node_id):
-                        trans_mats[child.node_id], trim_probs[child.node_id] = self._create_transition_matrix(
-                                child_wrapper)
-
-                    # Create the probability matrix exp(Qt)
-                    with tf.name_scope("expm_ops%d" % node.node_id):
-                        tr_mat = tf.verify_tensor_all_finite(trans_mats[child.node_id], "transmat %d problem" % child.node_id)
-                        #decay_factor = self._get_decay_factor(
-                        #    self.dist_to_root[child.node_id] - self.branch_lens[child.node_id],
-                        #    self.branch_lens[child.node_id])
-                        pt_matrix[child.node_id], _, _, Ddiags[child.node_id] = tf_common.myexpm(
-                                tr_mat,
-                                self.branch_lens[child.node_id])
-
-                    # Get the probability for the data descended from the child node, assuming that the node
-                    # has a particular target tract repr.
-                    # These down probs are ordered according to the child node's numbering of the TTs states
-                    with tf.name_scope("recurse%d" % node.node_id):
-                        ch_ordered_down_probs = tf.matmul(
-                                pt_matrix[child.node_id],
-                                Lprob[child.node_id])
-
-                    with tf.name_scope("rearrange%d" % node.node_id):
+                    if padded_lens[child.node_id] not in branch_groups:
+                        branch_groups[padded_lens[child.node_id]] = []
+                    branch_groups[padded_lens[child.node_id]].append((parent_idx, child))
+            level_branch_groups.append(list(branch_groups.values()))
+
+        # Create the instantaneous transition matrices for all the branches and barcodes first
+        # so that we can compute the probability matrices exp(Qt) in a few batched calls.
+        # Branches with the same states and singletons have the same transition matrix,
+        # so we only create (and decompose) one matrix for all of them.
+        child_ids = []
+        tr_mat_list = []
+        trim_prob_list = []
+        tr_mat_idxs = []
+        tr_mat_idx_dict = dict()
+        # Target statuses can only transition to statuses with more inactive targets, so a transition matrix
+        # with at most two states (besides the sink) has a closed form and doesn't need the eigendecomposition
+        closed_form_idxs = set()
+        for branch_groups in level_branch_groups:
+            for branch_group in branch_groups:
+                for _, child in branch_group:
+                    trans_mats[child.node_id] = []
+                    trim_probs[child.node_id] = []
+                    for child_wrapper in transition_wrappers[child.node_id]:
+                        tr_mat_key = self.transition_matrix_indexer.get_key(child_wrapper)
+                        if tr_mat_key not in tr_mat_idx_dict:
+                            with tf.name_scope("Transition_matrix%d" % child.up.node_id):
+                                tr_mat, trim_prob = self._create_transition_matrix(child_wrapper)
+                            if child_wrapper.num_possible_states <= 2:
+                                closed_form_idxs.add(len(tr_mat_list))
+                            tr_mat_idx_dict[tr_mat_key] = len(tr_mat_list)
+                            tr_mat_list.append(tf.verify_tensor_all_finite(tr_mat, "transmat %d problem" % child.node_id))
+                            trim_prob_list.append(trim_prob)
+                        tr_mat_idx = tr_mat_idx_dict[tr_mat_key]
+                        trans_mats[child.node_id].append(tr_mat_list[tr_mat_idx])
+                        trim_probs[child.node_id].append(trim_prob_list[tr_mat_idx])
+                        tr_mat_idxs.append(tr_mat_idx)
+                    child_ids.append(child.node_id)
+
+        # Create the probability matrices exp(Qt), stacked over the barcodes and the branches in each group
+        with tf.name_scope("expm_ops"):
+            t_groups = []
+            num_times = 0
+            for branch_groups in level_branch_groups:
+                for branch_group in branch_groups:
+                    t_groups.append(list(range(num_times, num_times + len(branch_group) * num_barcodes)))
+                    num_times += len(branch_group) * num_barcodes
+            pt_matrix_list, Ddiag_list = tf_common.myexpm_grouped(
+                    tr_mat_list,
+                    [self.branch_lens[child_id] for child_id in child_ids for _ in range(num_barcodes)],
+                    tr_mat_idxs,
+                    t_groups,
+                    closed_form_idxs)
+            Ddiags = [dict() for _ in range(num_barcodes)]
+            for i, child_id in enumerate(child_ids):
+                for bcode_idx in range(num_barcodes):
+                    Ddiags[bcode_idx][child_id] = Ddiag_list[tr_mat_idxs[i * num_barcodes + bcode_idx]]
+
+        # Store the tensorflow objects that calculate the prob of a node being in each state given the leaves.
+        # Maps node id to the index of the flattened tensor, the offset, and the stride between barcodes
+        Lprob_locs = dict()
+        # Store all the scaling terms addressing numerical underflow.
+        # Maps node id to the index of the scaling term tensor and the row
+        log_scaling_locs = dict()
+
+        # Level zero: the leaves and the cached subtrees
+        base_probs = []
+        base_len = 0
+        cached_log_scalings = []
+        for node in self.topology.traverse("postorder"):
+            if node.node_id in skip_node_ids or node_heights[node.node_id] > 0:
+                continue
+            prob_array = np.zeros((num_barcodes, padded_lens[node.node_id]))
+            if node.node_id in cached_subtrees:
+                cached_Lprobs, cached_log_scaling, _ = cached_subtrees[node.node_id]
+                for bcode_idx, cached_Lprob in enumerate(cached_Lprobs):
+                    prob_array[bcode_idx, :cached_Lprob.size] = cached_Lprob.flatten()
+                log_scaling_locs[node.node_id] = (0, len(cached_log_scalings))
+                cached_log_scalings.append(cached_log_scaling)
+            else:
+                for bcode_idx, node_wrapper in enumerate(transition_wrappers[node.node_id]):
+                    observed_key = node_wrapper.key_dict[node_wrapper.leaf_state]
+                    prob_array[bcode_idx, observed_key] = 1
+            Lprob_locs[node.node_id] = (0, base_len, padded_lens[node.node_id])
+            base_probs.append(prob_array.flatten())
+            base_len += prob_array.size
+        Lprob_flats = [tf.constant(np.concatenate(base_probs), dtype=tf.float64)]
+        log_scaling_terms = [tf.constant(
+            np.array(cached_log_scalings).reshape((-1, num_barcodes)),
+            dtype=tf.float64)]
+
+        expm_group_idx = 0
+        for level_idx, (level_nodes, branch_groups) in enumerate(zip(levels, level_branch_groups)):
+            padded_len = max([padded_lens[node.node_id] for node in level_nodes])
+            with tf.name_scope("level%d" % level_idx):
+                # Gather the partial likelihoods of the children from the levels below
+                source_idxs = sorted(set([
+                    Lprob_locs[child.node_id][0]
+                    for branch_group in branch_groups
+                    for _, child in branch_group]))
+                source_offsets = dict()
+                source_len = 0
+                for source_idx in source_idxs:
+                    source_offsets[source_idx] = source_len
+                    source_len += int(Lprob_flats[source_idx].shape[0])
+                source_Lprobs = tf.concat([Lprob_flats[source_idx] for source_idx in source_idxs], axis=0)
+
+                # Get the probability for the data descended from the child node, assuming that the node
+                # has a particular target tract repr.
+                # These down probs are ordered according to the child node's numbering of the TTs states
+                ch_ordered_down_probs = []
+                down_offset = 0
+                reorder_idxs = []
+                branch_parent_idxs = []
+                branch_weights = []
+                for branch_group in branch_groups:
+                    child_padded_len = padded_lens[branch_group[0][1].node_id]
+                    gather_idxs = np.zeros((len(branch_group), num_barcodes, child_padded_len), dtype=np.int64)
+                    for branch_idx, (parent_idx, child) in enumerate(branch_group):
+                        source_idx, offset, stride = Lprob_locs[child.node_id]
+                        gather_idxs[branch_idx] = (
+                                source_offsets[source_idx] + offset
+                                + stride * np.arange(num_barcodes).reshape((-1, 1))
+                                + np.arange(child_padded_len).reshape((1, -1)))
+                    with tf.name_scope("recurse"):
+                        ch_Lprobs = tf.reshape(
+                                tf.gather(source_Lprobs, gather_idxs),
+                                [len(branch_group) * num_barcodes, child_padded_len, 1])
+                        ch_ordered_down_probs.append(tf.reshape(
+                            tf.matmul(pt_matrix_list[expm_group_idx], ch_Lprobs),
+                            [-1]))
+                    expm_group_idx += 1
+
+                    for branch_idx, (parent_idx, child) in enumerate(branch_group):
+                        node = level_nodes[parent_idx]
                         if not node.is_root():
                             # Reorder summands according to node's numbering of tract_repr states
-                            node_wrapper = transition_wrappers[node.node_id][bcode_idx]
-
-                            down_probs = CLTLikelihoodModel._reorder_likelihoods(
-                                    ch_ordered_down_probs,
-                                    node_wrapper,
-                                    child_wrapper)
+                            node_states_list = [node_wrapper.states for node_wrapper in transition_wrappers[node.node_id]]
                         else:
                             # For the root node, we just want the probability where the root node is unmodified
-                            # No need to reorder
-                            ch_id = child_wrapper.key_dict[TargetStatus()]
-                            down_probs = ch_ordered_down_probs[ch_id]
-                        down_probs = tf.maximum(tf.constant(0, dtype=tf.float64), down_probs)
-
-                        down_probs_dict[child.node_id] = down_probs
-                        if child.is_leaf():
-                            leaf_abundance_weight = tf.constant(
-                                1 + (child.abundance - 1) * self.abundance_weight,
-                                dtype=tf.float64)
-                        else:
-                            leaf_abundance_weight = tf.constant(1, dtype=tf.float64)
-
-                        # Add protection against states with zero probability for the given set of transitions
-                        has_pos_prob *= tf_common.greater_equal_float(down_probs, 0)
-                        log_Lprob_node = log_Lprob_node + tf.log(down_probs + (1 - has_pos_prob) * eps) * leaf_abundance_weight
+                            node_states_list = [[TargetStatus()] for _ in range(num_barcodes)]
+                        reorder_idxs.append(CLTLikelihoodModel._get_reorder_idxs(
+                            node_states_list,
+                            transition_wrappers[child.node_id],
+                            padded_len,
+                            [down_offset + (branch_idx * num_barcodes + bcode_idx) * child_padded_len
+                                for bcode_idx in range(num_barcodes)]))
+                        branch_parent_idxs.append(parent_idx)
+                        branch_weights.append(1 + (child.abundance - 1) * self.abundance_weight if child.is_leaf() else 1)
+                    down_offset += len(branch_group) * num_barcodes * child_padded_len
+
+                with tf.name_scope("rearrange"):
+                    # Anything that is not in the child's transition wrapper gets the zero at the very end
+                    reorder_idxs = np.stack(reorder_idxs)
+                    reorder_idxs[reorder_idxs < 0] = down_offset
+                    down_probs = tf.gather(
+                            tf.concat(ch_ordered_down_probs + [tf.zeros([1], dtype=tf.float64)], axis=0),
+                            reorder_idxs,
+                            name="top.down_probs")
+                    down_probs = tf.maximum(tf.constant(0, dtype=tf.float64), down_probs)
+
+                    leaf_abundance_weights = tf.constant(
+                            np.array(branch_weights).reshape((-1, 1, 1)),
+                            dtype=tf.float64)
+                    log_Lprob_nodes = self._initialize_lower_log_probs(
+                            level_nodes,
+                            transition_wrappers,
+                            padded_len) + tf.unsorted_segment_sum(
+                                    tf.log(down_probs) * leaf_abundance_weights,
+                                    branch_parent_idxs,
+                                    num_segments=len(level_nodes))
 
                 # Handle numerical underflow
-                log_scaling_term = tf.reduce_max(log_Lprob_node)
-                Lprob[node.node_id] = tf.verify_tensor_all_finite(
-                        tf.exp(log_Lprob_node - log_scaling_term, name="scaled_down_prob"),
-                        "lprob%d has problem" % node.node_id) * has_pos_prob
-                log_scaling_terms[node.node_id] = log_scaling_term
+                log_scaling_term = tf.reduce_max(log_Lprob_nodes, axis=2)
+                Lprob_nodes = tf.verify_tensor_all_finite(
+                        tf.exp(log_Lprob_nodes - tf.expand_dims(log_scaling_term, 2), name="scaled_down_prob"),
+                        "lprob level %d has problem" % level_idx)
+                for node_idx, node in enumerate(level_nodes):
+                    Lprob_locs[node.node_id] = (level_idx + 1, node_idx * num_barcodes * padded_len, padded_len)
+                    log_scaling_locs[node.node_id] = (level_idx + 1, node_idx)
+                Lprob_flats.append(tf.reshape(Lprob_nodes, [-1]))
+                log_scaling_terms.append(log_scaling_term)
 
         with tf.name_scope("alleles_log_lik"):
             # Account for the scaling terms we used for handling numerical underflow
-            log_scaling_terms_all = tf.stack(list(log_scaling_terms.values()))
+            _, root_offset, _ = Lprob_locs[self.root_node_id]
             log_lik_alleles = tf.add(
-                tf.reduce_sum(log_scaling_terms_all, name="add_normalizer"),
-                tf.log(Lprob[self.root_node_id]),
+                tf.add_n([tf.reduce_sum(log_scaling_term, axis=0) for log_scaling_term in log_scaling_terms],
+                    name="add_normalizer"),
+                tf.log(tf.gather(Lprob_flats[-1], root_offset + np.arange(num_barcodes))),
                 name="alleles_log_lik")
 
-        self.Lprob = Lprob
-        self.down_probs_dict = down_probs_dict
-        self.pt_matrix = pt_matrix
+        self.padded_lens = padded_lens
+        self.Lprob_flats = Lprob_flats
+        self.Lprob_locs = Lprob_locs
+        self.log_scaling_terms = log_scaling_terms
+        self.log_scaling_locs = log_scaling_locs
+        self.pt_matrix_list = pt_matrix_list
         self.trans_mats = trans_mats
         self.trim_probs = trim_probs
         return log_lik_alleles, Ddiags
@@ -1265,79 +1470,14 @@ class CLTLikelihoodModel:
                 and target tracts. The last row corresponds to the sink state.
                 We omit the last column since its parent function will handle its creation
         """
-        # Get the target tracts of the singletons -- this is important
-        # since the transition matrix excludes the impossible target tracts
-        special_tts = set([
-                sgwc.get_singleton().get_target_tract()
-                for sgwc in transition_wrapper.anc_state.get_singleton_wcs()])
-
-        possible_states = set(transition_wrapper.states)
-
-        single_tt_sparse_indices = []
-        single_tt_gather_indices = []
-        sparse_indices = []
-        sparse_vals = []
-        for start_state in transition_wrapper.states:
-            start_key = transition_wrapper.key_dict[start_state]
-            haz_away = self.hazard_away_dict[start_state]
-
-            # Hazard of staying is negative of hazard away
-            sparse_indices.append([start_key, start_key])
-            sparse_vals.append(-haz_away)
-
-            all_end_states = set(self.targ_stat_transitions_dict[start_state].keys())
-            possible_end_states = all_end_states.intersection(possible_states)
-            for end_state in possible_end_states:
-                end_key = transition_wrapper.key_dict[end_state]
-
-                # Figure out if this is a special transition involving only a particular target tract
-                # Or if it a general any-target-tract transition
-                target_tracts_for_transition = self.targ_stat_transitions_dict[start_state][end_state]
-                matching_tts = special_tts.intersection(target_tracts_for_transition)
-                if matching_tts:
-                    assert len(matching_tts) == 1
-                    matching_tt = list(matching_tts)[0]
-                    single_tt_gather_indices.append(int(self.target_tract_dict[matching_tt]))
-                    single_tt_sparse_indices.append([start_key, end_key])
-                else:
-                    # if we already calculated the hazard of the transition between these target statuses,
-                    # use the same node
-                    if end_state in self.targ_stat_transition_hazards_dict[start_state]:
-                        hazard = self.targ_stat_transition_hazards_dict[start_state][end_state]
-                    else:
-                        hazard_idxs = [self.target_tract_dict[tt] for tt in target_tracts_for_transition]
-                        hazard = tf.reduce_sum(tf.gather(
-                            params=self.target_tract_hazards,
-                            indices=hazard_idxs))
-
-                        # Store this hazard if we need it in the future
-                        self.targ_stat_transition_hazards_dict[start_state][end_state] = hazard
-
-                    sparse_indices.append([start_key, end_key])
-                    sparse_vals.append(hazard)
-
         matrix_len = transition_wrapper.num_possible_states + 1
-        if single_tt_gather_indices:
-            single_tt_sparse_vals = tf.gather(
-                params=self.target_tract_hazards,
-                indices=single_tt_gather_indices)
-            q_single_tt_matrix = tf.scatter_nd(
-                single_tt_sparse_indices,
-                single_tt_sparse_vals,
-                [matrix_len, matrix_len - 1],
-                name="top.q_matrix")
-        else:
-            q_single_tt_matrix = 0
-
-        # TODO: We might be able to construct this faster using matrix multiplication (or element-wise)
-        # rather than this reduce_sum(gather) strategy.
-        q_all_tt_matrix = tf.scatter_nd(
-            sparse_indices,
-            sparse_vals,
+        indices = self.transition_matrix_indexer.get_indices(transition_wrapper)
+        # Rates for the same transition via different target tracts get summed up by scatter_nd
+        q_matrix_left = tf.scatter_nd(
+            indices.rate_indices,
+            tf.gather(self.transition_rate_params, indices.rate_param_idxs),
             [matrix_len, matrix_len - 1],
             name="top.q_matrix")
-
-        q_matrix_left = q_all_tt_matrix + q_single_tt_matrix
         return q_matrix_left
 
     @profile
@@ -1357,54 +1497,28 @@ class CLTLikelihoodModel:
                 note: this is used to generate the matrix for a specific branch in the tree
                 If the transition is not possible, we fill in with trim prob 1.0 since it doesnt matter
         """
-        child_singletons = child_transition_wrapper.anc_state.get_singletons()
-        target_to_singleton = [None] * self.bcode_meta.n_targets
-        for sg in child_singletons:
-            assert target_to_singleton[sg.min_target] is None
-            target_to_singleton[sg.min_target] = sg
-            target_to_singleton[sg.max_target] = sg
-
-        possible_states = set(child_transition_wrapper.states)
-        sparse_indices = []
-        sparse_vals = []
-        for start_target_status in child_transition_wrapper.states:
-            all_end_states = set(self.targ_stat_transitions_dict[start_target_status].keys())
-            possible_end_states = all_end_states.intersection(possible_states)
-            for end_target_status in possible_end_states:
-                new_deact_targs = end_target_status.minus(start_target_status)
-                singleton_set = set([
-                    target_to_singleton[deact_targ] for deact_targ in new_deact_targs
-                    if target_to_singleton[deact_targ] is not None])
-                start_key = child_transition_wrapper.key_dict[start_target_status]
-                end_key = child_transition_wrapper.key_dict[end_target_status]
-                if len(singleton_set) == 1:
-                    sparse_indices.append([start_key, end_key])
-                    sg = list(singleton_set)[0]
-                    trim_prob_val = self.singleton_cond_prob[int(self.singleton_index_dict[sg])]
-                    # HACK: We cannot have the trim probabilities too too small. otherwise
-                    # the gradient calculations break (because the values get way to crazy
-                    # and then tensorflow, after casting things to float32 in expm gradient,
-                    # will set things to infinity). We lower bound trim probabilities here
-                    # to 1e-13
-                    sparse_vals.append(trim_prob_val - 1.0)
-                elif len(singleton_set) > 1:
-                    # Can't possibly introduce the correct indel tract -- need more than one
-                    sparse_indices.append([start_key, end_key])
-                    sparse_vals.append(tf.constant(-1.0, dtype=tf.float64))
-
         output_length = child_transition_wrapper.num_possible_states + 1
         output_shape = [output_length, output_length - 1]
 
-        if sparse_vals:
-            return tf.maximum(tf.constant(1, dtype=tf.float64) + tf.scatter_nd(
-                sparse_indices,
-                sparse_vals,
-                output_shape,
-                name="top.trim_probs"),
-                tf.constant(0, dtype=tf.float64))
-        else:
+        indices = self.transition_matrix_indexer.get_indices(child_transition_wrapper)
+        if indices.trim_indices.shape[0] == 0:
             return tf.ones(output_shape, dtype=tf.float64)
 
+        # Map the singletons of this ancestral state to the index of their trim probability
+        child_singletons = child_transition_wrapper.anc_state.get_singletons()
+        # (the singleton index -1 picks out the last element, which is for introducing more than one singleton)
+        param_idxs = np.array(
+                [self.singleton_index_dict[sg] for sg in child_singletons] + [len(self.singleton_index_dict)],
+                dtype=np.int64)[indices.trim_singleton_idxs]
+        # The trim probabilities are stored as an offset from 1 (the default for impossible transitions).
+        # Clamp at zero since the offset can round to slightly less than -1.
+        return tf.maximum(tf.constant(1, dtype=tf.float64) + tf.scatter_nd(
+            indices.trim_indices,
+            tf.gather(self.trim_prob_params, param_idxs),
+            output_shape,
+            name="top.trim_probs"),
+            tf.constant(0, dtype=tf.float64))
+
     def get_fitted_bifurcating_tree(self):
         """
         Recall the model was parameterized as a continuous formulation for a multifurcating tree.
@@ -1493,31 +1607,31 @@ class CLTLikelihoodModel:
         return singletons
 
     @staticmethod
-    def _reorder_likelihoods(
-            ordered_down_probs: Tensor,
-            new_wrapper: TransitionWrapper,
-            old_wrapper: TransitionWrapper):
-        """
-        @param ch_ordered_down_probs: the Tensorflow array to be re-ordered
-        @param tract_repr_list: list of target tract reprs to include in the vector
-                        rest can be set to zero
-        @param node_trans_mat: provides the desired ordering
-        @param ch_trans_mat: provides the ordering used in vec_lik
-
-        @return the reordered version of vec_lik according to the order in node_trans_mat
-        """
-        # TDOO: think about if this is correct -- to filter out states not in the
-        # wrapper (the if statement)
-        index_vals = [[
-                [new_wrapper.key_dict[targ_stat], 0],
-                ordered_down_probs[old_wrapper.key_dict[targ_stat]][0]]
-            for targ_stat in new_wrapper.states
-            if targ_stat in old_wrapper.key_dict]
-        down_probs = tf_common.scatter_nd(
-                index_vals,
-                output_shape=[new_wrapper.num_possible_states + 1, 1],
-                name="top.down_probs")
-        return down_probs
+    def _get_reorder_idxs(
+            node_states_list: List[List[TargetStatus]],
+            child_wrappers: List[TransitionWrapper],
+            padded_len: int,
+            child_offsets: List[int]):
+        """
+        @param node_states_list: for each barcode, the states of the node in the desired order
+        @param child_wrappers: for each barcode, the transition wrapper of the child node, which provides
+                        the ordering of the child's values
+        @param padded_len: padded length of the node's partial likelihoods
+        @param child_offsets: for each barcode, the index of the child's first value in the flattened tensor
+
+        @return numpy array of shape (num barcodes, padded_len) with indices into the flattened tensor
+                with the child's values. States that are not in the child's transition wrapper
+                (as well as the sink state and padding) get the index -1.
+        """
+        num_barcodes = len(child_wrappers)
+        reorder_idxs = -np.ones((num_barcodes, padded_len), dtype=np.int64)
+        for bcode_idx, (node_states, child_wrapper) in enumerate(zip(node_states_list, child_wrappers)):
+            for i, targ_stat in enumerate(node_states):
+                # TDOO: think about if this is correct -- to filter out states not in the
+                # wrapper (the if statement)
+                if targ_stat in child_wrapper.key_dict:
+                    reorder_idxs[bcode_idx, i] = child_offsets[bcode_idx] + child_wrapper.key_dict[targ_stat]
+        return reorder_idxs
 
     """
     Logger creating/closing functions for debugging
@@ -1578,6 +1692,50 @@ class CLTLikelihoodModel:
         else:
             return self.sess.run(self.log_lik), None
 
+    def get_subtree_log_lik_cache(self, id_attr: str = "nochad_id"):
+        """
+        Evaluates the partial likelihoods of all the subtrees at the current model parameters
+        so they can be reused when evaluating trees that share most of this tree
+
+        @param id_attr: the attribute of the nodes in the other trees that stores the node id in this tree
+        @return SubtreeLogLikCache
+        """
+        Lprob_flat_vals, log_scaling_vals, dist_to_root_vals = self.sess.run(
+                [self.Lprob_flats, self.log_scaling_terms, self.dist_to_root])
+        num_barcodes = self.bcode_meta.num_barcodes
+        Lprob_vals = [dict() for _ in range(num_barcodes)]
+        for node_id, (flat_idx, offset, stride) in self.Lprob_locs.items():
+            for bcode_idx in range(num_barcodes):
+                start_idx = offset + bcode_idx * stride
+                Lprob_vals[bcode_idx][node_id] = Lprob_flat_vals[flat_idx][start_idx: start_idx + self.padded_lens[node_id]]
+        node_log_scaling_vals = [
+            {node_id: log_scaling_vals[level_idx][row, bcode_idx]
+                for node_id, (level_idx, row) in self.log_scaling_locs.items()}
+            for bcode_idx in range(num_barcodes)]
+        return SubtreeLogLikCache.create(
+                self.topology,
+                self.transition_wrappers,
+                Lprob_vals,
+                node_log_scaling_vals,
+                dist_to_root_vals,
+                id_attr)
+
+    def is_subtree_cache_consistent(self, atol: float = 1e-8):
+        """
+        The cached partial likelihoods are only valid if the current branch lengths place the
+        cached subtrees at the same location as the tree they were computed from
+
+        @return whether the distances to the root of the cached subtrees match
+        """
+        if len(self.cached_dist_to_root) == 0:
+            return True
+        node_ids = list(self.cached_dist_to_root.keys())
+        dist_to_root_vals = self.sess.run([self.dist_to_root[node_id] for node_id in node_ids])
+        return np.allclose(
+                dist_to_root_vals,
+                [self.cached_dist_to_root[node_id] for node_id in node_ids],
+                atol=atol)
+
     def check_grad(self, transition_matrices, epsilon=PERTURB_ZERO):
         """
         Function just for checking the gradient
@@ -1,6 +1,5 @@
-import copy
-from scipy.stats import expon
 import numpy as np
+from numpy import ndarray
 import logging
 
 from cell_lineage_tree import CellLineageTree
@@ -122,125 +121,113 @@ class BirthDeathTreeSimulator:
         self._simulate_tree(tree, time)
         return tree
 
-    def _run_race(self, birth_scale, death_scale):
+    def _run_race(self, birth_scale: ndarray, death_scale: float):
         """
-        Run the race to determine branch length and event at end of branch
+        Run the race to determine branch length and event at end of branch for many cells at once
         Does not take into account the maximum observation time!
+        @param birth_scale: the scale param for the time til cell division for each cell
         @return race_winner: True means cell division happens, False means cell doesn't (hence dies)
                 branch_length: time til the next event
         """
         # Birth rate very high initially?
-        t_birth = expon.rvs(scale=birth_scale)
-        t_death = expon.rvs(scale=death_scale)
+        t_birth = np.random.exponential(scale=birth_scale)
+        t_death = np.random.exponential(scale=death_scale, size=birth_scale.size)
         division_happens = t_birth < t_death
-        branch_length = np.min([t_birth, t_death])
+        branch_length = np.minimum(t_birth, t_death)
         return division_happens, branch_length
 
     def _simulate_tree(self, tree: CellLineageTree, remain_time: float):
         """
-        The recursive function that actually makes the tree
+        Makes the tree generation by generation. All the cells alive at the start of a generation
+        draw their branch lengths and events at the end of the branch in a single batch.
+        The tree is stored as arrays of parent indices, branch lengths, and cell fates and we only
+        create the CellLineageTree nodes at the very end.
 
         @param tree: the root node to create a tree from
         @param time: the max amount of time to simulate from this node
         """
-        self.curr_nodes += 1
-        if self.curr_nodes > 2 * self.max_leaves:
-            raise ValueError("too many nodes %d", self.curr_nodes)
-            return
+        # The cells that still need to be simulated. Parent index -1 means the parent is `tree`
+        curr_parents = np.array([-1])
+        curr_remain_times = np.array([remain_time], dtype=float)
 
-        if remain_time == 0:
-            print("CLT Simulator time out")
-            return
+        parent_idxs = []
+        branch_lens = []
+        is_dead = []
+        num_branches = 0
+        while curr_parents.size:
+            self.curr_nodes += curr_parents.size
+            if self.curr_nodes > 2 * self.max_leaves:
+                raise ValueError("too many nodes %d", self.curr_nodes)
 
-        # Determine branch length and event at end of branch
-        if self.tot_time - remain_time < self.birth_async_start_time:
-            division_happens = True
-            branch_length = self.birth_sync_time
-        else:
-            time_since_decay_begin = (self.tot_time - remain_time) - self.birth_async_start_time
-            curr_birth_scale = 1.0/max(
-                self.birth_min,
-                self.start_birth_rate * np.exp(self.birth_decay * time_since_decay_begin))
-            division_happens, branch_length = self._run_race(curr_birth_scale, self.death_scale)
-        obs_branch_length = min(branch_length, remain_time)
-        remain_time = remain_time - obs_branch_length
+            if np.any(curr_remain_times == 0):
+                print("CLT Simulator time out")
+                keep_mask = curr_remain_times > 0
+                curr_parents = curr_parents[keep_mask]
+                curr_remain_times = curr_remain_times[keep_mask]
+                if curr_parents.size == 0:
+                    break
 
-        if remain_time <= 0:
-            assert remain_time == 0
-            # Time of event is past observation time
-            self._process_observe_end(
-                tree,
-                obs_branch_length,
-                tree.allele_list)
-        elif division_happens:
-            # Cell division
-            self._process_cell_birth(
-                tree,
-                obs_branch_length,
-                tree.allele_list,
-                remain_time)
-        else:
-            # Cell died
-            self._process_cell_death(
-                tree,
-                obs_branch_length,
-                tree.allele_list)
+            # Determine branch length and event at end of branch
+            curr_times = self.tot_time - curr_remain_times
+            is_sync = curr_times < self.birth_async_start_time
+            division_happens = np.ones(curr_parents.size, dtype=bool)
+            branch_length = np.ones(curr_parents.size) * self.birth_sync_time
+            if not np.all(is_sync):
+                time_since_decay_begin = curr_times[~is_sync] - self.birth_async_start_time
+                curr_birth_scale = 1.0/np.maximum(
+                    self.birth_min,
+                    self.start_birth_rate * np.exp(self.birth_decay * time_since_decay_begin))
+                division_happens[~is_sync], branch_length[~is_sync] = self._run_race(
+                        curr_birth_scale,
+                        self.death_scale)
+            obs_branch_length = np.minimum(branch_length, curr_remain_times)
+            new_remain_times = curr_remain_times - obs_branch_length
+            is_observed_end = new_remain_times <= 0
+            assert np.all(new_remain_times[is_observed_end] == 0)
+            is_birth = division_happens & ~is_observed_end
 
-    def _process_observe_end(
-        self,
-        tree: CellLineageTree,
-        branch_length: float,
-        branch_end_allele_list: AlleleList):
-        """
-        Observation time is up. Stop observing cell.
-        """
-        child1 = CellLineageTree(
-            allele_list=branch_end_allele_list,
-            dist=branch_length)
-        tree.add_child(child1)
+            branch_idxs = num_branches + np.arange(curr_parents.size)
+            parent_idxs.append(curr_parents)
+            branch_lens.append(obs_branch_length)
+            is_dead.append(~division_happens & ~is_observed_end)
+            num_branches += curr_parents.size
 
-    def _process_cell_birth(
-        self,
-        tree: CellLineageTree,
-        branch_length: float,
-        branch_end_allele_list: AlleleList,
-        remain_time: float):
-        """
-        Cell division
+            # Cell division makes two cells that start at the end of this branch
+            curr_parents = np.repeat(branch_idxs[is_birth], 2)
+            curr_remain_times = np.repeat(new_remain_times[is_birth], 2)
 
-        Make two cells with identical allele_lists and cell states
-        """
-        child0 = CellLineageTree(
-            allele_list=branch_end_allele_list,
-            dist=branch_length)
-        child1 = CellLineageTree(
-            allele_list=branch_end_allele_list,
-            dist=0)
-        branch_end_allele_list2 = copy.deepcopy(branch_end_allele_list)
-        child2 = CellLineageTree(
-            allele_list=branch_end_allele_list2,
-            dist=0)
-        child0.add_child(child1)
-        child0.add_child(child2)
-        tree.add_child(child0)
-        self._simulate_tree(child1, remain_time)
-        self._simulate_tree(child2, remain_time)
-        child1.delete()
-        child2.delete()
+        if num_branches:
+            self._create_tree_nodes(
+                tree,
+                np.concatenate(parent_idxs),
+                np.concatenate(branch_lens),
+                np.concatenate(is_dead))
 
-    def _process_cell_death(
-        self,
-        tree: CellLineageTree,
-        branch_length: float,
-        branch_end_allele_list: AlleleList):
+    def _create_tree_nodes(
+            self,
+            tree: CellLineageTree,
+            parent_idxs: ndarray,
+            branch_lens: ndarray,
+            is_dead: ndarray):
         """
-        Cell has died. Add a dead child cell to `tree`.
+        Create the CellLineageTree nodes from the simulated tree arrays
+        Every node shares the allele list of `tree` since the alleles are simulated later.
+
+        @param tree: the node to attach the simulated tree to
+        @param parent_idxs: the parent index of each branch, -1 means the parent is `tree`.
+                            Parents must come before their children.
+        @param branch_lens: the length of each branch
+        @param is_dead: whether the cell at the end of each branch died
         """
-        child1 = CellLineageTree(
-            allele_list=branch_end_allele_list,
-            dist=branch_length,
-            dead=True)
-        tree.add_child(child1)
+        nodes = []
+        for parent_idx, branch_len, dead in zip(parent_idxs, branch_lens, is_dead):
+            node = CellLineageTree(
+                allele_list=tree.allele_list,
+                dist=float(branch_len),
+                dead=bool(dead))
+            parent = tree if parent_idx < 0 else nodes[parent_idx]
+            parent.add_child(node)
+            nodes.append(node)
 
 class CLTSimulatorBifurcating(CLTSimulator, BirthDeathTreeSimulator):
     """
@@ -1,8 +1,10 @@
 import logging
-from typing import List
+from typing import List, Dict
+import numpy as np
 
 from clt_observer import ObservedAlignedSeq
 from barcode_metadata import BarcodeMetadata
+from allele_events import Event
 
 def binarize_observations(bcode_meta: BarcodeMetadata, observations: List[ObservedAlignedSeq]):
     """
@@ -41,3 +43,44 @@ def binarize_observations(bcode_meta: BarcodeMetadata, observations: List[Observ
         event_dicts.append(event_bcode_dict)
 
     return processed_seqs, event_dicts, event_list
+
+def get_event_matrix(
+        processed_seqs: Dict[str, List],
+        event_dicts: List[Dict[Event, int]],
+        encode_hidden: bool = True):
+    """
+    Makes the binary character matrix of the sequences
+
+    An event hides the events strictly within its targets (see `Event.hides`), i.e. the events with target span
+    (i, j) where min_target < i <= j < max_target. So instead of comparing all pairs of events,
+    we mark the hidden target spans of each sequence and look up the span of each event.
+
+    @param processed_seqs: dict key = sequence id, dict val = [abundance, list of events]
+    @param event_dicts: list for dicts, one for each barcode, key = event, dict val = event number
+    @param encode_hidden: whether or not to find the hidden events
+
+    @return seq_ids: the sequence ids, in the order of the rows
+            has_events: boolean matrix, entry (i, j) is whether sequence i has event j
+            hidden_events: boolean matrix, entry (i, j) is whether event j is hidden by an event in sequence i
+    """
+    seq_ids = list(processed_seqs.keys())
+    num_events = sum([len(evt_dict) for evt_dict in event_dicts])
+    has_events = np.zeros((len(seq_ids), num_events), dtype=bool)
+    hidden_events = np.zeros((len(seq_ids), num_events), dtype=bool)
+    for bcode_idx, evt_dict in enumerate(event_dicts):
+        if len(evt_dict) == 0:
+            continue
+        bcode_evt_idxs = np.array(list(evt_dict.values()))
+        min_targets = np.array([evt.min_target for evt in evt_dict.keys()])
+        max_targets = np.array([evt.max_target for evt in evt_dict.keys()])
+        num_targets = np.max(max_targets) + 1
+        for seq_idx, seq_id in enumerate(seq_ids):
+            seq_evts = processed_seqs[seq_id][1][bcode_idx]
+            has_events[seq_idx, [evt_dict[evt] for evt in seq_evts]] = True
+            if encode_hidden and seq_evts:
+                hidden_spans = np.zeros((num_targets, num_targets), dtype=bool)
+                for evt in seq_evts:
+                    hidden_spans[evt.min_target + 1:evt.max_target, evt.min_target + 1:evt.max_target] = True
+                hidden_events[seq_idx, bcode_evt_idxs] = hidden_spans[min_targets, max_targets]
+    assert not np.any(has_events & hidden_events)
+    return seq_ids, has_events, hidden_events
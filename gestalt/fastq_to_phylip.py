@@ -9,9 +9,11 @@ import argparse
 import re
 from Bio import SeqIO
 import numpy as np
+from numpy import ndarray
 import warnings
 from allele_events import Event
 from cell_state import CellState
+from data_binarizer import get_event_matrix
 
 
 def write_seqs_to_phy(processed_seqs: Dict[str, List],
@@ -28,17 +30,9 @@ def write_seqs_to_phy(processed_seqs: Dict[str, List],
     @param abundance_file: name of file with abundance values
     @param mark_hidden: whether or not to encode hidden states as "?"
     """
+    event_encodings = get_event_encodings(processed_seqs, event_dicts, encode_hidden)
     num_events = sum([len(evt_dict) for evt_dict in event_dicts])
 
-    # Some events hide others, so we build a dictionary mapping event ids to the
-    # ids of the events they hide. We will use this to encode indeterminate states.
-    if encode_hidden:
-        hidden_events_dict = {}
-        for evt_dict in event_dicts:
-            for evt, evt_idx in evt_dict.items():
-                hidden_evts = [evt2_idx for evt2, evt2_idx in evt_dict.items() if evt2 is not evt and evt.hides(evt2)]
-                hidden_events_dict[evt_idx] = hidden_evts
-
     # Output file for PHYLIP
     # species name must be 10 characters long, followed by a sequence of 0s and
     # 1s indicating unique event absence and presence, respectively, with the
@@ -48,24 +42,40 @@ def write_seqs_to_phy(processed_seqs: Dict[str, List],
         f2.write('id\tabundance\n')
         for seq_id, seq_data in processed_seqs.items():
             seq_abundance = seq_data[0]
-            all_seq_events = seq_data[1]
-            event_idxs = [event_dicts[bcode_idx][evt] for bcode_idx, bcode_evts in enumerate(all_seq_events) for evt in bcode_evts]
-            event_arr = np.array(['0' for _ in range(num_events)])
-            event_arr[event_idxs] = '1'
-            if encode_hidden:
-                indeterminate_idxs = set([
-                    hidden_idx
-                    for evt_idx in event_idxs
-                    for hidden_idx in hidden_events_dict[evt_idx]])
-                assert(indeterminate_idxs.isdisjoint(set(event_idxs)))
-                event_arr[list(indeterminate_idxs)] = "?"
-            event_encoding = "".join(event_arr)
             seq_name = seq_id
             seq_name += " " * (10 - len(seq_name))
-            f1.write("%s%s\n" % (seq_name, event_encoding))
+            f1.write("%s%s\n" % (seq_name, event_encodings[seq_id]))
             f2.write('{}\t{}\n'.format(seq_name, seq_abundance))
 
 
+def get_event_encodings(processed_seqs: Dict[str, List],
+                        event_dicts: List[Dict[Event, int]],
+                        encode_hidden: bool =True):
+    """
+    @param processed_seqs: dict key = sequence id, dict val = [abundance, list of events]
+    @param event_dicts: list for dicts, one for each barcode, key = event, dict val = event phylip id
+    @param encode_hidden: whether or not to encode hidden states as "?"
+
+    @return dict key = sequence id, dict val = string with one character per event:
+            "1" if the sequence has the event, "?" if the event is hidden by one of its events, "0" otherwise
+    """
+    seq_ids, has_events, hidden_events = get_event_matrix(processed_seqs, event_dicts, encode_hidden)
+    return dict(zip(seq_ids, encode_event_matrix(has_events, hidden_events)))
+
+
+def encode_event_matrix(has_events: ndarray, hidden_events: ndarray):
+    """
+    @param has_events: boolean matrix from `data_binarizer.get_event_matrix`
+    @param hidden_events: boolean matrix from `data_binarizer.get_event_matrix`
+
+    @return list with the string encoding of each row
+    """
+    event_chars = np.full(has_events.shape, ord("0"), dtype=np.uint8)
+    event_chars[hidden_events] = ord("?")
+    event_chars[has_events] = ord("1")
+    return [row.tobytes().decode() for row in event_chars]
+
+
 def main():
     parser = argparse.ArgumentParser(description='convert to MIX')
     parser.add_argument('fastq', type=str, help='fastq input')
@@ -29,7 +29,7 @@ from common import create_directory
 from constants import NUM_BARCODE_V7_TARGETS, BARCODE_V7
 
 
-def parse_args():
+def parse_args(args):
     parser = argparse.ArgumentParser(description='simulate GESTALT')
     parser.add_argument(
         '--out-obs-file',
@@ -181,7 +181,7 @@ def parse_args():
         help="short trims follow poisson")
 
     parser.set_defaults()
-    args = parser.parse_args()
+    args = parser.parse_args(args)
 
     create_directory(args.out_obs_file)
 
@@ -300,7 +300,7 @@ def create_cell_lineage_tree(
     return obs_leaves, true_subtree, obs_idx_to_leaves
 
 def main(args=sys.argv[1:]):
-    args = parse_args()
+    args = parse_args(args)
     logging.basicConfig(format="%(message)s", filename=args.log_file, level=logging.DEBUG)
     np.random.seed(args.model_seed)
     random.seed(args.model_seed)
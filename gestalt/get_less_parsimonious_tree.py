@@ -5,6 +5,7 @@ import six
 import numpy as np
 
 import ancestral_events_finder
+from anc_state_arrays import SingletonWCUniverse
 from barcode_metadata import BarcodeMetadata
 from cell_lineage_tree import CellLineageTree
 
@@ -38,17 +39,18 @@ def parse_args(args):
     args = parser.parse_args(args)
     return args
 
-def get_tree_parsimony_score(tree: CellLineageTree, bcode_meta: BarcodeMetadata):
+def get_tree_parsimony_score(tree: CellLineageTree, bcode_meta: BarcodeMetadata, universe: SingletonWCUniverse = None):
     """
+    @param universe: singleton-wildcards of the leaves, shared across the SPR moves
     @return the parsimony score for the given tree
     """
-    ancestral_events_finder.annotate_ancestral_states(tree, bcode_meta)
-    return ancestral_events_finder.get_parsimony_score(tree)
+    return ancestral_events_finder.calculate_parsimony_score(tree, bcode_meta, universe)
 
 def do_spr_move(tree: CellLineageTree, bcode_meta: BarcodeMetadata):
     num_leaves = len(tree)
     max_node_id = tree.label_node_ids()
-    orig_pars_score = get_tree_parsimony_score(tree, bcode_meta)
+    universe = SingletonWCUniverse(tree.get_leaves(), bcode_meta) if SingletonWCUniverse.is_supported(bcode_meta) else None
+    orig_pars_score = get_tree_parsimony_score(tree, bcode_meta, universe)
     while True:
         max_node_id = tree.label_node_ids()
         rand_node_source, rand_node_target = np.random.choice(np.arange(2, max_node_id), size=2, replace=False)
@@ -57,7 +59,7 @@ def do_spr_move(tree: CellLineageTree, bcode_meta: BarcodeMetadata):
         source_node.detach()
         target_node.up.add_child(source_node)
         assert len(tree) == num_leaves
-        new_pars_score = get_tree_parsimony_score(tree, bcode_meta)
+        new_pars_score = get_tree_parsimony_score(tree, bcode_meta, universe)
         if new_pars_score != orig_pars_score:
             break
 
@@ -76,6 +78,8 @@ def main(args=sys.argv[1:]):
 
     for i in range(args.num_spr_moves):
         do_spr_move(tree, bcode_meta)
+    # Scoring the SPR moves does not annotate the nodes, so annotate the final topology once
+    ancestral_events_finder.annotate_ancestral_states(tree, bcode_meta)
 
     with open(args.out_tree_file, "wb") as f:
         six.moves.cPickle.dump(tree_topology_info, f, protocol=2)
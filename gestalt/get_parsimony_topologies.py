@@ -20,12 +20,13 @@ from clt_observer import ObservedAlignedSeq
 from barcode_metadata import BarcodeMetadata
 from tree_distance import TreeDistanceMeasurer, UnrootRFDistanceMeasurer
 from clt_estimator import CLTParsimonyEstimator
+from parsimony_search import REARRANGEMENTS
 from collapsed_tree import collapse_zero_lens
 from constants import *
 from constant_paths import *
 
 def parse_args():
-    parser = argparse.ArgumentParser(description='generate possible tree topologies using MIX')
+    parser = argparse.ArgumentParser(description='generate possible tree topologies using parsimony')
     parser.add_argument(
         '--obs-file',
         type=str,
@@ -49,16 +50,31 @@ def parse_args():
         '--seed',
         type=int,
         default=5,
-        help="Random number generator seed. Also used as seed for MIX. Must be odd")
+        help="Random number generator seed. Also used as seed for the parsimony search. Must be odd if using MIX")
     parser.add_argument(
         '--num-jumbles',
         type=int,
         default=1,
-        help="Number of times to jumble. (This is an input to MIX)")
+        help="Number of times to jumble, i.e. number of random addition orders to search from")
+    parser.add_argument(
+        '--use-mix',
+        action='store_true',
+        help="Call out to PHYLIP MIX instead of running our own parsimony search")
     parser.add_argument(
         '--mix-path',
         type=str,
         default=MIX_PATH)
+    parser.add_argument(
+        '--rearrangement',
+        type=str,
+        default="spr",
+        choices=REARRANGEMENTS,
+        help="Tree rearrangements for our own parsimony search")
+    parser.add_argument(
+        '--num-processes',
+        type=int,
+        default=1,
+        help="Number of processes to run the parsimony searches from the different jumbles on")
     parser.add_argument('--max-random',
         type=int,
         default=0,
@@ -92,9 +108,14 @@ def parse_args():
         type=int,
         default=5000,
         help="maximum number of trees to read from MIX")
+    parser.add_argument('--max-equal-trees',
+        type=int,
+        default=100,
+        help="maximum number of equally parsimonious trees to collect in our own parsimony search")
 
     args = parser.parse_args()
-    assert args.seed % 2 == 1
+    if args.use_mix:
+        assert args.seed % 2 == 1
     if args.max_best_multifurc or args.max_best:
         # Require having true tree to know what is a "best" tree
         assert args.model_file is not None
@@ -102,10 +123,11 @@ def parse_args():
     args.out_folder = os.path.dirname(args.out_template_file)
     assert os.path.join(args.out_folder, "parsimony_tree0.pkl") == args.out_template_file
 
-    # check that there is no infile in the current folder -- this will
-    # screw up mix because it will use the wrong input file
-    my_file = Path("infile")
-    assert not my_file.exists()
+    if args.use_mix:
+        # check that there is no infile in the current folder -- this will
+        # screw up mix because it will use the wrong input file
+        my_file = Path("infile")
+        assert not my_file.exists()
 
     args.scratch_dir = os.path.join(args.out_folder, "scratch")
     if not os.path.exists(args.scratch_dir):
@@ -117,7 +139,7 @@ def get_sorted_parsimony_trees(
         parsimony_trees: List[CellLineageTree],
         oracle_measurer: TreeDistanceMeasurer):
     """
-    @param parsimony_trees: trees from MIX
+    @param parsimony_trees: trees from parsimony
     @param oracle_measurer: distance measurer to the oracle tree
 
     @return a sorted list of tree tuples (tree, tree dist) based on
@@ -204,7 +226,7 @@ def get_parsimony_trees(
         args,
         bcode_meta: BarcodeMetadata):
     """
-    Run MIX to get maximum parsimony trees
+    Run MIX or our own parsimony search to get maximum parsimony trees
     """
     parsimony_estimator = CLTParsimonyEstimator(
             bcode_meta,
@@ -214,7 +236,11 @@ def get_parsimony_trees(
             obs_leaves,
             mix_seed=args.seed,
             num_jumbles=args.num_jumbles,
-            max_trees=args.max_trees)
+            max_trees=args.max_trees,
+            use_mix=args.use_mix,
+            rearrangement=args.rearrangement,
+            max_equal_trees=args.max_equal_trees,
+            num_processes=args.num_processes)
     logging.info("Total parsimony trees %d", len(parsimony_trees))
 
     parsimony_score = parsimony_trees[0].get_parsimony_score()
@@ -6,14 +6,15 @@ import random
 import copy
 import time
 
-from allele_events import AlleleEvents
 from cell_lineage_tree import CellLineageTree
 from barcode_metadata import BarcodeMetadata
 from transition_wrapper_maker import TransitionWrapperMaker
-from parallel_worker import SubprocessManager
+from parallel_worker import PoolManager, ActorPool
 from likelihood_scorer import LikelihoodScorer, LikelihoodScorerResult
 from common import get_randint
 from model_assessor import ModelAssessor
+from tuning_checkpoint import TuningCheckpoint, run_worker, get_hash
+from tree_snapshot import TreeSnapshot, Regraft
 import collapsed_tree
 import ancestral_events_finder
 from common import assign_rand_tree_lengths
@@ -175,11 +176,14 @@ class HangingChad:
             self,
             node: CellLineageTree,
             nochad_tree: CellLineageTree,
-            possible_full_trees: List[CellLineageTree],
+            orig_tree: CellLineageTree,
+            regrafts: List[Regraft],
+            bcode_meta: BarcodeMetadata,
             node_mapping: Dict[int, int] = None):
         """
         @param node: the hanging chad
-        @param possible_full_trees: first tree is the original tree
+        @param orig_tree: the original tree, annotated with ancestral states
+        @param regrafts: the other possible trees, stored as regrafts of the hanging chad in `orig_tree`
         @param node_mapping: a dict mapping the node id in the `nochad_tree` to the node_id in the original tree
                         that the nochad_tree was constructed from. This is useful if the original tree was already
                         fitted via max pen log likelihood and has good model parameter values. We need this mapping
@@ -187,8 +191,10 @@ class HangingChad:
         """
         self.node = node
         self.nochad_tree = nochad_tree
-        self.possible_full_trees = possible_full_trees
-        self.num_possible_trees = len(possible_full_trees)
+        self.orig_tree = orig_tree
+        self.regrafts = regrafts
+        self.bcode_meta = bcode_meta
+        self.num_possible_trees = 1 + len(regrafts)
         self.node_mapping = node_mapping
 
         self.chad_ids = set([node.node_id for node in self.node.traverse()])
@@ -199,8 +205,25 @@ class HangingChad:
             self.nochad_leaf[node.node_id] = node.is_leaf()
             self.nochad_unresolved_multifurc[node.node_id] = not node.is_resolved_multifurcation()
 
-    def make_single_leaf_rand_trees(self):
+    def get_possible_full_tree(self, idx: int):
         """
+        The possible trees other than the original tree are only created when they are requested,
+        so this creates a new copy of the tree every time (except for the original tree).
+
+        @param idx: index of the possible tree, where index 0 is the original tree
+        @return CellLineageTree with the hanging chad regrafted, annotated with ancestral states and parsimony scores
+        """
+        if idx == 0:
+            return self.orig_tree
+        tree = self.orig_tree.copy()
+        _mark_nodes_for_recalc(self.regrafts[idx - 1].apply(tree))
+        ancestral_events_finder.annotate_ancestral_states(tree, self.bcode_meta, do_fast=True)
+        ancestral_events_finder.get_parsimony_score(tree, do_fast=True)
+        return tree
+
+    def make_single_leaf_rand_trees(self, max_trees: int = None):
+        """
+        @param max_trees: only make the first `max_trees` possible trees
         @return List[HangingChadSingleFullTree] -- For each possible tree, only keeps a random leaf of the hanging chad.
                     (same random leaf across all trees). Also returns the original tree.
                     This marks the tree appropriately for the estimation method -- it will mark the
@@ -215,7 +238,9 @@ class HangingChad:
         random_leaf_id = random.choice(chad_leaf_ids)
         num_chad_leaves = len(chad_leaf_ids)
         single_leaf_rand_trees = []
-        for idx, full_tree in enumerate(self.possible_full_trees):
+        num_trees = self.num_possible_trees if max_trees is None else min(max_trees, self.num_possible_trees)
+        for idx in range(num_trees):
+            full_tree = self.get_possible_full_tree(idx)
             single_leaf_tree = full_tree.copy()
             chad_in_tree = single_leaf_tree.search_nodes(node_id=self.node.node_id)[0]
             implicit_nodes = single_leaf_tree.search_nodes(node_id=None)
@@ -277,12 +302,18 @@ class HangingChad:
         return single_leaf_rand_trees
 
     def __str__(self):
-        chad_parent_strs = []
-        for full_tree in self.possible_full_trees:
-            chad_in_tree = full_tree.search_nodes(node_id=self.node.node_id)[0]
-            chad_parent_strs.append("%d,%s" % (
-                chad_in_tree.up.node_id if chad_in_tree.up.is_root() else chad_in_tree.up.up.node_id,
-                chad_in_tree.up.anc_state_list_str))
+        orig_nodes = {node.node_id: node for node in self.orig_tree.traverse()}
+        chad_in_tree = orig_nodes[self.node.node_id]
+        chad_parent_strs = ["%d,%s" % (
+            chad_in_tree.up.node_id if chad_in_tree.up.is_root() else chad_in_tree.up.up.node_id,
+            chad_in_tree.up.anc_state_list_str)]
+        for regraft in self.regrafts:
+            attach_node = orig_nodes[regraft.attach_id]
+            parent_id = None if regraft.in_branch else attach_node.node_id
+            chad_parent_strs.append("%d,%s:%s" % (
+                attach_node.node_id if parent_id is not None and attach_node.is_root() else attach_node.up.node_id,
+                str(parent_id),
+                [str(k) for k in regraft.parent_anc_state_list]))
         return "%s: %d leaves, %d possibilities: %s" % (
             self.node.anc_state_list_str,
             len(self.node),
@@ -315,16 +346,14 @@ def _mark_nodes_for_recalc(changed_nodes: List[CellLineageTree]):
 def _get_chad_possibilities(
         chad_id: int,
         tree: CellLineageTree,
+        regrafts: List[Regraft],
         parsimony_score: int,
-        bcode_meta: BarcodeMetadata,
-        max_possible_trees: int = None,
-        branch_len_attaches: bool = True):
+        bcode_meta: BarcodeMetadata):
     """
     @param chad_id: the node_id of the hanging chad to perform SPR on
-    @param tree: the tree to consider performing SPR on
+    @param tree: the tree to consider performing SPR on (this is modified)
+    @param regrafts: the equally parsimonious regrafts of the chad in `tree` (see TreeSnapshot.get_regrafts)
     @param parsimony_score: the original parsimony score of the tree
-    @param max_possible_trees: maximum number of trees to list out when we are finding hanging chad positions
-    @param branch_len_attaches: whether or not to consider hanging chads that can be regrafted on the middle of a branch
 
     @return HangingChad containing equally (or more) parsimonious trees after regrafting chad on various
                 branches and nodes
@@ -337,7 +366,6 @@ def _get_chad_possibilities(
     # Create no chad tree -- by detaching chad
     chad_orig_parent = chad.up
     chad.detach()
-    chad_orig_parent_unifurc = len(chad_orig_parent.get_children()) == 1
 
     # Mark the nodes so we remember what the node_id was in the full_tree
     # (We need this later for mapping parameters to warm-start.)
@@ -355,13 +383,17 @@ def _get_chad_possibilities(
 
     for idx, node in enumerate(chad.traverse()):
         node.node_id = num_nochad_nodes + idx
-    num_labelled_nodes = num_nochad_nodes + idx + 1
     chad_copy = chad.copy()
     nochad_tree = tree.copy()
 
-    # First create original tree
+    # Relabel the regrafts with the new node ids
+    relabel_mapping = {full_tree_node_id: node_id for node_id, full_tree_node_id in node_mapping.items()}
+    relabel_mapping[chad_id] = chad.node_id
+    regrafts = [regraft.relabel(relabel_mapping) for regraft in regrafts]
+
+    # Put the chad back to create the original tree
     chad_orig_parent.add_child(chad)
-    orig_tree = tree.copy()
+    orig_tree = tree
 
     # sanity check that original tree is equally parsimonious
     ancestral_events_finder.annotate_ancestral_states(orig_tree, bcode_meta)
@@ -372,88 +404,13 @@ def _get_chad_possibilities(
         logging.info(tree.get_ascii(attributes=['dist']))
     assert new_pars_score == parsimony_score
 
-    # Now find all the possible trees we can make by hanging the chad elsewhere
-    possible_trees = []
-    # Only consider nodes that are not descendnats of the chad
-    all_nodes = [node for node in tree.traverse() if node.node_id < num_nochad_nodes]
-    # First consider adding chad to existing nodes
-    for node in all_nodes:
-        if max_possible_trees is not None and len(possible_trees) >= max_possible_trees - 1:
-            break
-        if node.is_leaf() or node.node_id == chad_orig_parent.node_id:
-            continue
-
-        # The nodes with potentially different ancestral states are the chad and where it was detached
-        nodes_to_update = [chad] + chad.up.get_children()
-        chad.detach()
-        node.add_child(chad)
-
-        # mark which nodes need to recalc so we can get the new parsimony score
-        _mark_nodes_for_recalc(nodes_to_update)
-        ancestral_events_finder.annotate_ancestral_states(tree, bcode_meta, do_fast=True)
-        new_pars_score = ancestral_events_finder.get_parsimony_score(tree, do_fast=True)
-        if new_pars_score < parsimony_score:
-            logging.info("We beat MIX (attach to multifurc): %d< %d", new_pars_score, parsimony_score)
-            logging.info(tree.get_ascii(attributes=['anc_state_list_str']))
-            logging.info(tree.get_ascii(attributes=['dist']))
-
-        can_collapse_tree = any([other_node.dist == 0 for other_node in tree.get_descendants() if not other_node.is_leaf()])
-        if new_pars_score == parsimony_score and not can_collapse_tree:
-            tree_copy = tree.copy()
-            possible_trees.append(tree_copy)
-
-    if branch_len_attaches:
-        # Consider adding chad to the middle of the existing edges
-        for node in all_nodes:
-            if max_possible_trees is not None and len(possible_trees) >= max_possible_trees - 1:
-                break
-            if node.is_root() or (chad_orig_parent_unifurc and node.node_id == chad_orig_parent.node_id):
-                continue
-
-            # The nodes with potentially different ancestral states are the chad and where it was detached
-            nodes_to_update = [chad] + chad.up.get_children()
-            chad.detach()
-
-            # Consider adding chad to an edge, so parent -- new_node -- node, chad
-            new_node = CellLineageTree(
-                    allele_events_list=[
-                        AlleleEvents([], allele_evts.num_targets)
-                        for allele_evts in node.allele_events_list])
-            # new node will have the biggest node id
-            new_node.add_features(node_id=None)
-            node.up.add_child(new_node)
-            node.detach()
-            new_node.add_child(node)
-            new_node.add_child(chad)
-
-            # mark which nodes need to recalc so we can get the new parsimony score
-            _mark_nodes_for_recalc(nodes_to_update)
-            ancestral_events_finder.annotate_ancestral_states(tree, bcode_meta, do_fast=True)
-            new_pars_score = ancestral_events_finder.get_parsimony_score(tree, do_fast=True)
-            if new_pars_score < parsimony_score:
-                logging.info("we beat MIX (attach in middle): %d< %d", new_pars_score, parsimony_score)
-                logging.info(tree.get_ascii(attributes=['anc_state_list_str']))
-                logging.info(tree.get_ascii(attributes=['dist']))
-
-            # Then this can be further collapsed and we might as well add the node to
-            # a multif/bifurcation. Should have been accomplished previously.
-            can_collapse_tree = any([other_node.dist == 0 for other_node in tree.get_descendants() if not other_node.is_leaf()])
-            if not can_collapse_tree and new_pars_score == parsimony_score:
-                all_node_ids = set([node.node_id for node in tree.traverse() if node.node_id is not None])
-                assert all_node_ids == set(list(range(num_labelled_nodes)))
-                num_new_nodes = len([node for node in tree.traverse() if node.node_id is None])
-                assert num_new_nodes == 1
-
-                possible_trees.append(tree.copy())
-
-            # Now undo all the things we just did to the tree
-            new_node.delete()
-
-    random.shuffle(possible_trees)
+    random.shuffle(regrafts)
     hanging_chad = HangingChad(
         chad_copy,
         nochad_tree,
-        [orig_tree] + possible_trees,
+        orig_tree,
+        regrafts,
+        bcode_meta,
         node_mapping)
     return hanging_chad
 
@@ -488,6 +445,7 @@ def get_random_chad(
     """
     st_time = time.time()
     tree, parsimony_score = _preprocess_tree_for_chad_finding(tree, bcode_meta)
+    snapshot = TreeSnapshot(tree, bcode_meta)
 
     descendants = tree.get_descendants()
     random.shuffle(descendants)
@@ -503,14 +461,17 @@ def get_random_chad(
             # We're assuming that a tree with no parsimony score probably can't be placed anywhere in the tree
             continue
 
-        tree_copy = tree.copy()
-        hanging_chad = _get_chad_possibilities(
+        # Only copy the tree if the chad can be placed elsewhere
+        regrafts = snapshot.get_regrafts(
                 node.node_id,
-                tree_copy,
-                parsimony_score,
-                bcode_meta,
                 branch_len_attaches=branch_len_attaches)
-        if hanging_chad.num_possible_trees > 1:
+        if len(regrafts):
+            hanging_chad = _get_chad_possibilities(
+                    node.node_id,
+                    tree.copy(),
+                    regrafts,
+                    parsimony_score,
+                    bcode_meta)
             logging.info("random chad %s", str(hanging_chad))
 
             #possible_trees = hanging_chad.possible_full_trees
@@ -558,6 +519,7 @@ def get_all_chads(
     """
     st_time = time.time()
     tree, parsimony_score = _preprocess_tree_for_chad_finding(tree, bcode_meta)
+    snapshot = TreeSnapshot(tree, bcode_meta)
 
     hanging_chads = []
     print("get all chads... num descen", len(tree.get_descendants()))
@@ -570,15 +532,16 @@ def get_all_chads(
             # We're assuming a tree with no parsimony score contribution probably can't be placed anywhere else in tree
             continue
 
-        tree_copy = tree.copy()
-        hanging_chad = _get_chad_possibilities(
+        regrafts = snapshot.get_regrafts(
                 node.node_id,
-                tree_copy,
-                parsimony_score,
-                bcode_meta,
-                max_possible_trees=max_possible_trees)
-        if hanging_chad.num_possible_trees > 1:
-            hanging_chads.append(hanging_chad)
+                max_regrafts=max_possible_trees - 1 if max_possible_trees is not None else None)
+        if len(regrafts):
+            hanging_chads.append(_get_chad_possibilities(
+                    node.node_id,
+                    tree.copy(),
+                    regrafts,
+                    parsimony_score,
+                    bcode_meta))
     return hanging_chads
 
 
@@ -590,10 +553,14 @@ def _fit_nochad_result(
         node_mapping: Dict[int, int] = None,
         assessor: ModelAssessor = None,
         max_iters: int = 0,
-        conv_thres: float = 1e-4):
+        conv_thres: float = 1e-4,
+        export_subtree_cache: bool = False,
+        checkpoint: TuningCheckpoint = None):
     """
     @param hanging_chad: the hanging chad to remove from the tree
     @param tree: the original tree
+    @param export_subtree_cache: whether to store the partial likelihoods of the nochad tree in the result
+                    (used for screening candidate locations of the hanging chad)
     @param conv_thres: the convergence threshold for maximizing the penalized log like of the nochad tree
                     (we typically use a higher threshold since
                     this is just used for warm starting)
@@ -634,7 +601,7 @@ def _fit_nochad_result(
         args.max_extra_steps,
         args.max_sum_states)
 
-    no_chad_res = LikelihoodScorer(
+    no_chad_res = run_worker(LikelihoodScorer(
         get_randint(),
         nochad_tree,
         bcode_meta,
@@ -645,7 +612,9 @@ def _fit_nochad_result(
         known_params=args.known_params,
         scratch_dir=args.scratch_dir,
         use_poisson=args.use_poisson,
-        assessor=assessor).run_worker(None)[0]
+        assessor=assessor,
+        export_subtree_cache=export_subtree_cache,
+        optimizer=args.optimizer), checkpoint)[0]
     assert no_chad_res is not None
     return no_chad_res
 
@@ -700,73 +669,95 @@ def tune(
         args,
         full_tree_fit_params: Dict,
         assessor: ModelAssessor = None,
-        print_assess_metric: str = "full_bhv"):
+        print_assess_metric: str = "full_bhv",
+        checkpoint: TuningCheckpoint = None):
     """
     Tune the given hanging chad
     @param max_chad_tune_search: maximum number of hanging chad locations to consider
     @param full_tree_fit_params: the fitted params for the full_tree. The full_tree is what hanging_chad
                 was created from
     @param node_mapping: maps nochad_tree node_id to the full_tree node_id
+    @param checkpoint: if not None, skip the fits that are already in this checkpoint and add the new fits to it
     @return HangingChadTuneResult
     """
     assert hanging_chad.num_possible_trees > 1
     # If we have valid branch length estimates, then there isn't really a need to train a no chad tree.
     # Hence zero iterations
     nochad_max_iters = 0 if 'branch_len_inners' in full_tree_fit_params else args.max_iters
+    max_chad_full_fits = args.max_chad_full_fits
     no_chad_res = _fit_nochad_result(
         hanging_chad,
         bcode_meta,
         args,
         full_tree_fit_params,
         assessor=assessor,
-        max_iters=nochad_max_iters)
+        max_iters=nochad_max_iters,
+        export_subtree_cache=max_chad_full_fits is not None,
+        checkpoint=checkpoint)
 
-    worker_list = []
     # Pick a random leaf from the hanging chad -- do not use the entire hanging chad
     # This is because the entire hanging chad might have multiple leaves and their
     # branch length assignment is ambigious.
-    single_full_chad_trees = hanging_chad.make_single_leaf_rand_trees()[:max_chad_tune_search]
-    for parent_idx, single_full_chad_tree in enumerate(single_full_chad_trees):
-        new_chad_tree = single_full_chad_tree.single_leaf_tree
-
-        warm_start_fit_params = _create_warm_start_fit_params(
+    single_full_chad_trees = hanging_chad.make_single_leaf_rand_trees(max_chad_tune_search)
+    warm_start_fit_param_list = [
+        _create_warm_start_fit_params(
             hanging_chad,
             no_chad_res,
-            new_chad_tree)
-
-        trans_wrap_maker = TransitionWrapperMaker(
-            new_chad_tree,
-            bcode_meta,
-            args.max_extra_steps,
-            args.max_sum_states)
-        worker = LikelihoodScorer(
-            get_randint(),
-            new_chad_tree,
+            single_full_chad_tree.single_leaf_tree)
+        for single_full_chad_tree in single_full_chad_trees]
+    orig_chad_tree = single_full_chad_trees[0]
+
+    if max_chad_full_fits is not None and max_chad_full_fits < len(single_full_chad_trees):
+        keep_idxs = _screen_chad_candidates(
+            single_full_chad_trees,
+            warm_start_fit_param_list,
+            no_chad_res,
+            max_chad_full_fits,
             bcode_meta,
+            args,
+            checkpoint)
+        single_full_chad_trees = [single_full_chad_trees[idx] for idx in keep_idxs]
+        warm_start_fit_param_list = [warm_start_fit_param_list[idx] for idx in keep_idxs]
+
+    if args.chad_rung_iters is not None and len(single_full_chad_trees) > 1:
+        # Race the candidates rather than fully fitting all of them
+        keep_idxs, worker_results = _race_chad_candidates(
+            single_full_chad_trees,
+            warm_start_fit_param_list,
             args.max_iters,
-            args.num_inits,
-            trans_wrap_maker,
-            fit_param_list=[warm_start_fit_params],
-            known_params=args.known_params,
-            scratch_dir=args.scratch_dir,
-            use_poisson=args.use_poisson,
-            assessor=assessor,
-            name="chad-tuning%d" % parent_idx)
-        worker_list.append(worker)
-
-    # Actually fit the results
-    logging.info("CHAD TUNING")
-    job_manager = SubprocessManager(
-            worker_list,
-            None,
-            args.scratch_dir,
-            args.num_processes)
-    all_worker_results = job_manager.run()
-    worker_results = [r[0] for (r,_) in all_worker_results if r is not None]
-    filtered_chad_trees = [tree for tree, (r,_) in zip(single_full_chad_trees, all_worker_results) if r is not None]
+            args.chad_rung_iters,
+            bcode_meta,
+            args,
+            assessor,
+            checkpoint)
+        filtered_chad_trees = [single_full_chad_trees[idx] for idx in keep_idxs]
+    else:
+        worker_list = [
+            _create_chad_scorer(
+                single_full_chad_tree,
+                warm_start_fit_params,
+                args.max_iters,
+                bcode_meta,
+                args,
+                assessor,
+                "chad-tuning%d" % parent_idx)
+            for parent_idx, (single_full_chad_tree, warm_start_fit_params) in enumerate(
+                zip(single_full_chad_trees, warm_start_fit_param_list))]
+
+        # Actually fit the results
+        logging.info("CHAD TUNING")
+        job_manager = PoolManager(
+                worker_list,
+                None,
+                args.scratch_dir,
+                args.num_processes,
+                checkpoint=checkpoint)
+        all_worker_results = job_manager.run()
+        worker_results = [r[0] for (r,_) in all_worker_results if r is not None]
+        filtered_chad_trees = [tree for tree, (r,_) in zip(single_full_chad_trees, all_worker_results) if r is not None]
+        if len(filtered_chad_trees) != len(single_full_chad_trees):
+            print("WARNING: some of the chad tuners failed")
     assert len(worker_results) > 0
-    if len(filtered_chad_trees) != len(single_full_chad_trees):
-        print("WARNING: some of the chad tuners failed")
 
     # Aggregate the results
     chad_tune_res = _create_chad_results(
@@ -804,7 +795,256 @@ def tune(
         logging.info("scores = %s", scores)
         logging.info("scores vs. %ss %s", print_assess_metric, scipy.stats.spearmanr(scores, all_tree_dists))
 
-    return chad_tune_res, selected_idx == 0
+    # The first candidate is the original location of the hanging chad
+    return chad_tune_res, selected_chad.single_full_chad_tree is orig_chad_tree
+
+
+def _create_chad_scorer(
+        single_full_chad_tree: HangingChadSingleFullTree,
+        fit_params: Dict,
+        max_iters: int,
+        bcode_meta: BarcodeMetadata,
+        args,
+        assessor: ModelAssessor,
+        name: str):
+    """
+    @return LikelihoodScorer for fitting the tree with the hanging chad at this candidate location
+    """
+    new_chad_tree = single_full_chad_tree.single_leaf_tree
+    trans_wrap_maker = TransitionWrapperMaker(
+        new_chad_tree,
+        bcode_meta,
+        args.max_extra_steps,
+        args.max_sum_states)
+    return LikelihoodScorer(
+        get_randint(),
+        new_chad_tree,
+        bcode_meta,
+        max_iters,
+        args.num_inits,
+        trans_wrap_maker,
+        fit_param_list=[fit_params],
+        known_params=args.known_params,
+        scratch_dir=args.scratch_dir,
+        use_poisson=args.use_poisson,
+        assessor=assessor,
+        optimizer=args.optimizer,
+        name=name)
+
+
+def _race_chad_candidates(
+        single_full_chad_trees: List[HangingChadSingleFullTree],
+        warm_start_fit_param_list: List[Dict],
+        max_iters: int,
+        rung_iters: int,
+        bcode_meta: BarcodeMetadata,
+        args,
+        assessor: ModelAssessor = None,
+        checkpoint: TuningCheckpoint = None):
+    """
+    Races the candidate locations of the hanging chad (see `race_scorers`).
+    Each candidate keeps its graph and session in one of `args.num_processes` processes for the whole race.
+
+    @param max_iters: total number of training iterations for each surviving candidate
+    @param rung_iters: number of training iterations per rung
+    @param checkpoint: if not None, the outcome of the whole race is stored in/loaded from here
+    @return the indices of the surviving candidates and their LikelihoodScorerResults.
+            The train history of each result covers all of its rungs.
+    """
+    scorers = [
+        _create_chad_scorer(
+            single_full_chad_tree,
+            warm_start_fit_params,
+            max_iters,
+            bcode_meta,
+            args,
+            assessor,
+            "chad-racing%d" % parent_idx)
+        for parent_idx, (single_full_chad_tree, warm_start_fit_params) in enumerate(
+            zip(single_full_chad_trees, warm_start_fit_param_list))]
+
+    if checkpoint is not None:
+        task_hash = get_hash(["chad-racing", rung_iters] + [scorer.get_task_hash() for scorer in scorers])
+        race_res = checkpoint.get_result(task_hash)
+        if race_res is not None:
+            logging.info("Loaded chad race from checkpoint")
+            return race_res
+
+    actor_pool = ActorPool(args.num_processes, "%s/pool_logs" % args.scratch_dir)
+    try:
+        race_res = race_scorers(scorers, max_iters, rung_iters, actor_pool)
+    finally:
+        actor_pool.close()
+
+    if checkpoint is not None:
+        checkpoint.add_result(task_hash, race_res)
+    return race_res
+
+
+def race_scorers(
+        scorers: List[LikelihoodScorer],
+        max_iters: int,
+        rung_iters: int,
+        actor_pool: ActorPool,
+        noise_z: float = 2):
+    """
+    Races the scorers against each other.
+    In each rung, every remaining scorer continues its fit for `rung_iters` more iterations,
+    with the same graph and optimizer state as in the previous rung.
+    After each rung, we drop the scorers that are statistically behind the best one (see `get_race_survivors`).
+    The remaining iterations in the budget are spent on the scorers that survive.
+
+    @param scorers: the objects to race, must implement start_fit, continue_fit and close_fit like LikelihoodScorer
+    @param actor_pool: where to keep the scorers while racing them
+    @param noise_z: number of standard deviations of slack to give the scorers that are behind
+    @return the indices of the surviving scorers and their LikelihoodScorerResults
+    """
+    assert rung_iters > 0
+    for idx, scorer in enumerate(scorers):
+        actor_pool.add(idx, scorer)
+    actor_pool.call([(idx, "start_fit", ()) for idx in range(len(scorers))])
+
+    results = [None] * len(scorers)
+    alive_idxs = list(range(len(scorers)))
+    iters_done = 0
+    rung_idx = 0
+    while alive_idxs:
+        is_final_rung = len(alive_idxs) == 1 or iters_done + rung_iters >= max_iters
+        num_iters = max_iters - iters_done if is_final_rung else rung_iters
+        logging.info("CHAD RACING rung %d: %d iters for candidates %s", rung_idx, num_iters, alive_idxs)
+        rung_results = actor_pool.call([(idx, "continue_fit", (num_iters,)) for idx in alive_idxs])
+        rung_pen_log_liks = dict()
+        for idx, res in zip(alive_idxs, rung_results):
+            if res is None:
+                # Training failed, drop this candidate
+                logging.info("Chad racing candidate %d failed", idx)
+                results[idx] = None
+                continue
+            prev_num_history = len(results[idx].train_history) if results[idx] is not None else 1
+            rung_pen_log_liks[idx] = [
+                    iter_info["pen_log_lik"][0] for iter_info in res.train_history[prev_num_history - 1:]]
+            results[idx] = res
+        iters_done += num_iters
+        rung_idx += 1
+
+        if is_final_rung or not rung_pen_log_liks:
+            survivor_idxs = sorted(rung_pen_log_liks.keys())
+        else:
+            survivor_idxs = get_race_survivors(
+                {idx: results[idx].pen_log_lik[0] for idx in rung_pen_log_liks},
+                rung_pen_log_liks,
+                max_iters - iters_done,
+                noise_z)
+            logging.info(
+                "chad racing scores = %s, keeping %s",
+                {idx: results[idx].pen_log_lik[0] for idx in rung_pen_log_liks},
+                survivor_idxs)
+        drop_idxs = [idx for idx in alive_idxs if idx not in survivor_idxs]
+        actor_pool.call([(idx, "close_fit", ()) for idx in drop_idxs])
+        actor_pool.remove(drop_idxs)
+        alive_idxs = survivor_idxs
+        if is_final_rung:
+            break
+
+    actor_pool.call([(idx, "close_fit", ()) for idx in alive_idxs])
+    actor_pool.remove(alive_idxs)
+    return alive_idxs, [results[idx] for idx in alive_idxs]
+
+
+def get_race_survivors(
+        scores: Dict[int, float],
+        rung_pen_log_liks: Dict[int, List[float]],
+        remaining_iters: int,
+        noise_z: float = 2):
+    """
+    Treats the per-iteration changes in the penalized log likelihood of each candidate during the last rung
+    as noisy draws of how much it will improve per iteration for the rest of the budget.
+    A candidate survives unless it is statistically behind the best candidate, i.e. even an optimistic guess
+    of its final score (its current score plus the remaining iterations times its mean improvement,
+    plus `noise_z` standard deviations of the sum of the remaining improvements) is below the best current score.
+    The best candidate always survives.
+
+    @param scores: the penalized log likelihood of each candidate at the end of the last rung
+    @param rung_pen_log_liks: the penalized log likelihoods of each candidate at each iteration of the last rung,
+                    including the value at the start of the rung
+    @param remaining_iters: number of iterations left in the budget
+    @return sorted indices of the surviving candidates
+    """
+    best_score = max(scores.values())
+    survivor_idxs = []
+    for idx, score in scores.items():
+        improvements = np.diff(rung_pen_log_liks[idx])
+        if improvements.size:
+            mean_improvement = max(np.mean(improvements), 0)
+            sd_improvement = np.std(improvements)
+        else:
+            mean_improvement = 0
+            sd_improvement = 0
+        optimistic_score = (
+                score
+                + remaining_iters * mean_improvement
+                + noise_z * sd_improvement * np.sqrt(remaining_iters))
+        if optimistic_score >= best_score:
+            survivor_idxs.append(idx)
+    return sorted(survivor_idxs)
+
+
+def _screen_chad_candidates(
+        single_full_chad_trees: List[HangingChadSingleFullTree],
+        warm_start_fit_param_list: List[Dict],
+        no_chad_res: LikelihoodScorerResult,
+        max_chad_full_fits: int,
+        bcode_meta: BarcodeMetadata,
+        args,
+        checkpoint: TuningCheckpoint = None):
+    """
+    Scores each candidate location of the hanging chad by its penalized log likelihood at the
+    warm-start parameters, i.e. the fitted parameters of the nochad tree. The partial likelihoods of the
+    subtrees that are not affected by the regraft are plugged in from the nochad fit, so we only
+    recompute the partial likelihoods along the paths from the old and new attachment points to the root.
+
+    @param max_chad_full_fits: number of candidates to keep
+    @return the indices of the candidates to keep, sorted by screening score. Always keeps the first candidate
+            since that is the original location of the hanging chad.
+    """
+    worker_list = []
+    for parent_idx, (single_full_chad_tree, warm_start_fit_params) in enumerate(
+            zip(single_full_chad_trees, warm_start_fit_param_list)):
+        new_chad_tree = single_full_chad_tree.single_leaf_tree
+        trans_wrap_maker = TransitionWrapperMaker(
+            new_chad_tree,
+            bcode_meta,
+            args.max_extra_steps,
+            args.max_sum_states)
+        worker = LikelihoodScorer(
+            get_randint(),
+            new_chad_tree,
+            bcode_meta,
+            0,
+            1,
+            trans_wrap_maker,
+            fit_param_list=[warm_start_fit_params],
+            known_params=args.known_params,
+            scratch_dir=args.scratch_dir,
+            use_poisson=args.use_poisson,
+            subtree_cache=no_chad_res.subtree_cache,
+            name="chad-screening%d" % parent_idx)
+        worker_list.append(worker)
+
+    logging.info("CHAD SCREENING")
+    job_manager = PoolManager(
+            worker_list,
+            None,
+            args.scratch_dir,
+            args.num_processes,
+            checkpoint=checkpoint)
+    screen_scores = [
+        r[0].pen_log_lik[0] if r is not None and r[0] is not None else -np.inf
+        for (r, _) in job_manager.run()]
+    logging.info("chad screening scores = %s", screen_scores)
+
+    sorted_idxs = [idx for idx in np.argsort(screen_scores)[::-1] if idx != 0]
+    return [0] + sorted_idxs[:max_chad_full_fits - 1]
 
 
 def _create_chad_results(
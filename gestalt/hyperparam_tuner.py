@@ -8,10 +8,11 @@ from barcode_metadata import BarcodeMetadata
 from transition_wrapper_maker import TransitionWrapperMaker
 from split_data import create_kfold_trees, create_kfold_barcode_trees, TreeDataSplit
 from likelihood_scorer import LikelihoodScorer, LikelihoodScorerResult
-from parallel_worker import SubprocessManager
+from parallel_worker import PoolManager
 from common import get_randint
 from model_assessor import ModelAssessor
 from optim_settings import KnownModelParams
+from tuning_checkpoint import TuningCheckpoint, run_worker
 
 
 class PenaltyScorerResult:
@@ -81,71 +82,139 @@ def tune(
         args,
         fit_params: Dict,
         assessor: ModelAssessor,
-        conv_thres: float = 1e-6):
+        conv_thres: float = 1e-6,
+        checkpoint: TuningCheckpoint = None):
     """
     Tunes the `branch_pen_param`, `target_lam_pen_param` penalty parameters
+    @param checkpoint: if not None, skip the fits that are already in this checkpoint and add the new fits to it
 
     @return PenaltyTuneResult
     """
     assert len(args.branch_pen_params) > 1 or len(args.target_lam_pen_params) > 1
 
-    # First create the initialization/optimization settings under consideration
+    # First create the optimization settings under consideration
     fit_param_list = []
     for branch_pen_param in args.branch_pen_params:
         for target_lam_pen_param in args.target_lam_pen_params:
-            if len(fit_param_list) == 0:
-                new_fit_params = fit_params.copy()
-            else:
-                new_fit_params = {}
-            new_fit_params["branch_pen_param"] = branch_pen_param
-            new_fit_params["target_lam_pen_param"] = target_lam_pen_param
-            new_fit_params["conv_thres"] = conv_thres
-            fit_param_list.append(new_fit_params)
+            fit_param_list.append({
+                "branch_pen_param": branch_pen_param,
+                "target_lam_pen_param": target_lam_pen_param,
+                "conv_thres": conv_thres})
+    grid_shape = (len(args.branch_pen_params), len(args.target_lam_pen_params))
 
     if bcode_meta.num_barcodes > 1:
         # For many barcodes, we split by barcode
         return _tune_hyperparams(
             fit_param_list,
+            grid_shape,
             tree,
             bcode_meta,
             args,
             fit_params,
             create_kfold_barcode_trees,
+            _create_many_bcode_val_scorers,
             _get_many_bcode_hyperparam_score,
-            assessor)
+            assessor,
+            checkpoint)
     else:
+        fit_params = fit_params.copy()
         fit_params.pop('branch_len_inners', None)
         fit_params.pop('branch_len_offsets_proportion', None)
         # For single barcode, we split into subtrees
         return _tune_hyperparams(
             fit_param_list,
+            grid_shape,
             tree,
             bcode_meta,
             args,
             fit_params,
             create_kfold_trees,
+            _create_one_bcode_val_scorers,
             _get_one_bcode_hyperparam_score,
-            assessor)
+            assessor,
+            checkpoint)
+
+
+def _get_grid_warm_starts(grid_shape: Tuple[int, int]):
+    """
+    Schedules the fits over the grid of penalty parameters so that each grid point is warm started
+    from a neighboring grid point. We start from the center of the grid and work outwards.
+
+    @param grid_shape: number of branch penalty params and number of target lambda penalty params
+    @return List of waves of fits. Each wave is a list of (grid idx, grid idx to warm start from)
+            for grid points that only depend on the grid points in previous waves.
+            The center of the grid has no grid point to warm start from (None).
+    """
+    center = ((grid_shape[0] - 1) // 2, (grid_shape[1] - 1) // 2)
+    num_waves = max(grid_shape[0] - center[0], grid_shape[1] - center[1])
+    waves = [[] for _ in range(num_waves)]
+    for i in range(grid_shape[0]):
+        for j in range(grid_shape[1]):
+            dist = max(abs(i - center[0]), abs(j - center[1]))
+            if dist == 0:
+                warm_idx = None
+            else:
+                # Take one step towards the center
+                warm_i = i - int(np.sign(i - center[0]))
+                warm_j = j - int(np.sign(j - center[1]))
+                warm_idx = warm_i * grid_shape[1] + warm_j
+            waves[dist].append((i * grid_shape[1] + j, warm_idx))
+    return waves
+
+
+def _get_grid_path(grid_shape: Tuple[int, int]):
+    """
+    @return List of grid idxs that visits the grid of penalty parameters row by row, going back and forth,
+            so consecutive grid points are neighbors
+    """
+    grid_path = []
+    for i in range(grid_shape[0]):
+        row = [i * grid_shape[1] + j for j in range(grid_shape[1])]
+        grid_path += row if i % 2 == 0 else row[::-1]
+    return grid_path
+
+
+def _get_warm_start_fit_params(
+        pen_fit_params: Dict,
+        fit_params: Dict,
+        warm_res: LikelihoodScorerResult = None):
+    """
+    @param pen_fit_params: the penalty parameters to fit with
+    @param fit_params: the initial model params
+    @param warm_res: the fitted result to warm start from, if any
+    @return Dict with model/optimization params
+    """
+    new_fit_params = pen_fit_params.copy()
+    init_params = warm_res.model_params_dict if warm_res is not None else fit_params
+    for k, v in init_params.items():
+        if k not in new_fit_params:
+            new_fit_params[k] = v
+    return new_fit_params
 
 
 def _tune_hyperparams(
         fit_param_list: List[Dict],
+        grid_shape: Tuple[int, int],
         tree: CellLineageTree,
         bcode_meta: BarcodeMetadata,
         args,
         fit_params: Dict,
         kfold_fnc,
+        val_scorer_fnc,
         hyperparam_score_fnc,
-        assessor: ModelAssessor = None):
+        assessor: ModelAssessor = None,
+        checkpoint: TuningCheckpoint = None):
     """
-    @param max_num_chad_parents: max number of chad parents to consider
-    @param conv_thres: the convergence threshold for training the model
-                        (should probably pick something similar to the one being used
-                        for the hanging chads)
+    @param fit_param_list: the penalty parameters for each grid point, the grid is in row-major order
+    @param grid_shape: number of branch penalty params and number of target lambda penalty params
+    @param fit_params: the initial model params
+    @param val_scorer_fnc: creates the workers that evaluate the fitted models on the validation data
+    @param hyperparam_score_fnc: calculates the score for the penalty params from the validation results
 
     @return List[PenaltyScorerResult] -- corresponding to each hyperparam
                 being tuned
     """
+    assert len(fit_param_list) == grid_shape[0] * grid_shape[1]
     # First split the barcode into kfold groups
     n_splits = args.num_penalty_tune_splits if bcode_meta.num_barcodes == 1 else min(args.num_penalty_tune_splits, bcode_meta.num_barcodes)
     logging.info("Hyperparam tuning %d splits", n_splits)
@@ -162,32 +231,57 @@ def _tune_hyperparams(
             args.max_sum_states) for tree_split in tree_splits]
 
     # Actually fit the trees using the kfold barcodes
-    worker_list = [LikelihoodScorer(
-        get_randint(),
-        tree_split.train_clt,
-        tree_split.train_bcode_meta,
-        args.max_iters,
-        args.num_inits,
-        transition_wrap_maker,
-        fit_param_list=fit_param_list,
-        known_params=args.known_params,
-        scratch_dir=args.scratch_dir,
-        use_poisson=args.use_poisson,
-        assessor=assessor)
-        for tree_split, transition_wrap_maker in zip(tree_splits, trans_wrap_makers)]
-
+    if args.num_processes > 1:
+        train_results = _fit_grid_parallel(
+                fit_param_list,
+                grid_shape,
+                tree_splits,
+                trans_wrap_makers,
+                args,
+                fit_params,
+                assessor,
+                checkpoint)
+    else:
+        train_results = _fit_grid_serial(
+                fit_param_list,
+                grid_shape,
+                tree_splits,
+                trans_wrap_makers,
+                args,
+                fit_params,
+                assessor,
+                checkpoint)
     # Only need the successful results
-    if args.num_processes > 1 and len(worker_list) > 1:
-        job_manager = SubprocessManager(
-                worker_list,
+    train_results = [
+            (res, tree_split) for res, tree_split in zip(train_results, tree_splits)
+            if any([r is not None for r in res])]
+    assert len(train_results) >= 1
+
+    # Evaluate all the fitted models on the validation data at once
+    val_worker_idxs = []
+    val_worker_list = []
+    for idx in range(len(fit_param_list)):
+        res_folds = [(train_res[idx], tree_split) for train_res, tree_split in train_results]
+        if any([res is None for res, _ in res_folds]):
+            # This pen param setting is not stable
+            val_worker_idxs.append(None)
+            continue
+        val_workers = val_scorer_fnc(
+            res_folds,
+            args.max_extra_steps,
+            args.max_sum_states,
+            args.scratch_dir,
+            args.use_poisson)
+        val_worker_idxs.append(range(len(val_worker_list), len(val_worker_list) + len(val_workers)))
+        val_worker_list += val_workers
+    if len(val_worker_list):
+        job_manager = PoolManager(
+                val_worker_list,
                 None,
                 args.scratch_dir,
-                args.num_processes)
-        train_results = [r for r, _ in job_manager.run()]
-    else:
-        train_results = [w.run_worker(None) for w in worker_list]
-    train_results = [(res, tree_split) for res, tree_split in zip(train_results, tree_splits) if res is not None]
-    assert len(train_results) >= 1
+                args.num_processes,
+                checkpoint=checkpoint)
+        val_results = [w[0][0] for w in job_manager.run()]
 
     # Now find the best penalty param by finding the most stable one
     # Stability is defined as the least variable target lambda estimates and branch length estimates
@@ -201,13 +295,12 @@ def _tune_hyperparams(
                 fit_param['branch_pen_param'],
                 fit_param['target_lam_pen_param'])
         res_folds = [(train_res[idx], tree_split) for train_res, tree_split in train_results]
-        hyperparam_score = hyperparam_score_fnc(
-            res_folds,
-            args.max_extra_steps,
-            args.max_sum_states,
-            args.scratch_dir,
-            args.use_poisson,
-            args.num_processes)
+        if val_worker_idxs[idx] is None:
+            hyperparam_score = -np.inf
+        else:
+            hyperparam_score = hyperparam_score_fnc(
+                res_folds,
+                [val_results[i] for i in val_worker_idxs[idx]])
 
         # Create our summary of tuning
         tune_result = PenaltyScorerResult(
@@ -226,21 +319,126 @@ def _tune_hyperparams(
                 tune_results)
 
 
-def _get_many_bcode_hyperparam_score(
+def _create_train_scorer(
+        tree_split: TreeDataSplit,
+        transition_wrap_maker: TransitionWrapperMaker,
+        fit_param_list: List[Dict],
+        args,
+        assessor: ModelAssessor,
+        name: str):
+    return LikelihoodScorer(
+        get_randint(),
+        tree_split.train_clt,
+        tree_split.train_bcode_meta,
+        args.max_iters,
+        args.num_inits,
+        transition_wrap_maker,
+        fit_param_list=fit_param_list,
+        known_params=args.known_params,
+        scratch_dir=args.scratch_dir,
+        use_poisson=args.use_poisson,
+        assessor=assessor,
+        optimizer=args.optimizer,
+        name=name)
+
+
+def _fit_grid_serial(
+        fit_param_list: List[Dict],
+        grid_shape: Tuple[int, int],
+        tree_splits: List[TreeDataSplit],
+        trans_wrap_makers: List[TransitionWrapperMaker],
+        args,
+        fit_params: Dict,
+        assessor: ModelAssessor = None,
+        checkpoint: TuningCheckpoint = None):
+    """
+    Fits all the grid points for each data split in a single worker, which reuses the likelihood graph.
+    The grid points are visited so that each grid point is warm started from its neighbor.
+
+    @return List[List[LikelihoodScorerResult]] -- fitted results for each data split and each grid point,
+                None if the fit failed
+    """
+    grid_path = _get_grid_path(grid_shape)
+    path_fit_param_list = [
+        _get_warm_start_fit_params(fit_param_list[grid_path[0]], fit_params)
+    ] + [fit_param_list[idx] for idx in grid_path[1:]]
+
+    worker_list = [
+        _create_train_scorer(
+            tree_split,
+            transition_wrap_maker,
+            path_fit_param_list,
+            args,
+            assessor,
+            "hyperparam-fold%d" % fold_idx)
+        for fold_idx, (tree_split, transition_wrap_maker) in enumerate(zip(tree_splits, trans_wrap_makers))]
+
+    train_results = []
+    for worker in worker_list:
+        path_results = run_worker(worker, checkpoint)
+        fold_results = [None] * len(fit_param_list)
+        if path_results is not None:
+            for idx, res in zip(grid_path, path_results):
+                fold_results[idx] = res
+        train_results.append(fold_results)
+    return train_results
+
+
+def _fit_grid_parallel(
+        fit_param_list: List[Dict],
+        grid_shape: Tuple[int, int],
+        tree_splits: List[TreeDataSplit],
+        trans_wrap_makers: List[TransitionWrapperMaker],
+        args,
+        fit_params: Dict,
+        assessor: ModelAssessor = None,
+        checkpoint: TuningCheckpoint = None):
+    """
+    Fits each grid point for each data split as a separate task, so all the local processes are used.
+    We fit the grid in waves starting from the center of the grid. Each grid point is warm started
+    from the fitted result of its neighbor from the previous wave.
+
+    @return List[List[LikelihoodScorerResult]] -- fitted results for each data split and each grid point,
+                None if the fit failed
+    """
+    train_results = [[None] * len(fit_param_list) for _ in tree_splits]
+    for wave_idx, wave in enumerate(_get_grid_warm_starts(grid_shape)):
+        logging.info("Hyperparam tuning wave %d: %d fits", wave_idx, len(wave) * len(tree_splits))
+        task_idxs = []
+        worker_list = []
+        for fold_idx, (tree_split, transition_wrap_maker) in enumerate(zip(tree_splits, trans_wrap_makers)):
+            for idx, warm_idx in wave:
+                # If the neighbor failed, start over from the initial model params
+                warm_res = train_results[fold_idx][warm_idx] if warm_idx is not None else None
+                task_idxs.append((fold_idx, idx))
+                worker_list.append(_create_train_scorer(
+                        tree_split,
+                        transition_wrap_maker,
+                        [_get_warm_start_fit_params(fit_param_list[idx], fit_params, warm_res)],
+                        args,
+                        assessor,
+                        "hyperparam-fold%d-pen%d" % (fold_idx, idx)))
+
+        job_manager = PoolManager(
+                worker_list,
+                None,
+                args.scratch_dir,
+                args.num_processes,
+                checkpoint=checkpoint)
+        for (fold_idx, idx), (res, _) in zip(task_idxs, job_manager.run()):
+            train_results[fold_idx][idx] = res[0] if res is not None else None
+    return train_results
+
+
+def _create_many_bcode_val_scorers(
         pen_param_results: List[Tuple[LikelihoodScorerResult, TreeDataSplit]],
         max_extra_steps: int,
         max_sum_states: int,
         scratch_dir: str,
-        use_poisson: bool,
-        num_processes: int):
+        use_poisson: bool):
     """
-    @return score = the validation log likelihood
+    @return List[LikelihoodScorer] that evaluate the log likelihood of the validation data for each data split
     """
-    for pen_param_res, _ in pen_param_results:
-        if pen_param_res is None:
-            # This pen param setting is not stable
-            return -np.inf
-
     worker_list = []
     for pen_param_res, tree_split in pen_param_results:
         # Use all the fitted params from the training data since we have the
@@ -268,35 +466,32 @@ def _get_many_bcode_hyperparam_score(
             scratch_dir=scratch_dir,
             use_poisson=use_poisson)
         worker_list.append(scorer)
+    return worker_list
 
-    job_manager = SubprocessManager(
-            worker_list,
-            None,
-            scratch_dir,
-            num_processes)
-    worker_results = [w[0][0] for w in job_manager.run()]
-    val_log_liks = [res.log_lik for res in worker_results]
+
+def _get_many_bcode_hyperparam_score(
+        pen_param_results: List[Tuple[LikelihoodScorerResult, TreeDataSplit]],
+        val_results: List[LikelihoodScorerResult]):
+    """
+    @param val_results: results from the workers made by `_create_many_bcode_val_scorers`
+    @return score = the validation log likelihood
+    """
+    val_log_liks = [res.log_lik for res in val_results]
 
     tot_val_log_lik = np.sum(val_log_liks)
     logging.info("all hyperparam split-scores %s, (sum %f)", val_log_liks, tot_val_log_lik)
     return tot_val_log_lik
 
 
-def _get_one_bcode_hyperparam_score(
+def _create_one_bcode_val_scorers(
         pen_param_results: List[Tuple[LikelihoodScorerResult, TreeDataSplit]],
         max_extra_steps: int,
         max_sum_states: int,
         scratch_dir: str,
-        use_poisson: bool,
-        num_processes: int):
+        use_poisson: bool):
     """
-    @return score = Pr(validation data | train data)
+    @return List[LikelihoodScorer] that evaluate the log likelihood of the full tree for each data split
     """
-    for pen_param_res, _ in pen_param_results:
-        if pen_param_res is None:
-            # This pen param setting is not stable
-            return -np.inf
-
     worker_list = []
     for pen_param_res, tree_split in pen_param_results:
         # Need to create model parameters for the full tree since
@@ -359,18 +554,20 @@ def _get_one_bcode_hyperparam_score(
             use_poisson=use_poisson,
             scratch_dir=scratch_dir)
         worker_list.append(scorer)
+    return worker_list
 
-    job_manager = SubprocessManager(
-            worker_list,
-            None,
-            scratch_dir,
-            num_processes)
-    worker_results = [w[0][0] for w in job_manager.run()]
 
+def _get_one_bcode_hyperparam_score(
+        pen_param_results: List[Tuple[LikelihoodScorerResult, TreeDataSplit]],
+        val_results: List[LikelihoodScorerResult]):
+    """
+    @param val_results: results from the workers made by `_create_one_bcode_val_scorers`
+    @return score = Pr(validation data | train data)
+    """
     # Get Pr(V|T)
     hyperparam_scores = [
             res.log_lik - pen_param_res.log_lik
-            for res, (pen_param_res, _) in zip(worker_results, pen_param_results)]
+            for res, (pen_param_res, _) in zip(val_results, pen_param_results)]
     tot_hyperparam_score = np.mean(hyperparam_scores)
     logging.info("all Pr(Val given T) %s (sum %f)", hyperparam_scores, tot_hyperparam_score)
     return tot_hyperparam_score
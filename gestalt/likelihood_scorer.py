@@ -8,10 +8,12 @@ from cell_lineage_tree import CellLineageTree
 from barcode_metadata import BarcodeMetadata
 from parallel_worker import ParallelWorker
 from transition_wrapper_maker import TransitionWrapperMaker
+from subtree_log_lik_cache import SubtreeLogLikCache
 from clt_likelihood_model import CLTLikelihoodModel
 from clt_likelihood_estimator import CLTPenalizedEstimator
 from model_assessor import ModelAssessor
 from optim_settings import KnownModelParams
+from tuning_checkpoint import get_hash
 
 
 class LikelihoodScorerResult:
@@ -24,9 +26,11 @@ class LikelihoodScorerResult:
             model_params_dict: Dict,
             orig_tree: CellLineageTree,
             fitted_bifurc_tree: CellLineageTree,
-            train_history: List):
+            train_history: List,
+            subtree_cache: SubtreeLogLikCache = None):
         """
         @param fit_params: the fitting parameters used for warm-start
+        @param subtree_cache: the partial likelihoods of the subtrees at the fitted params, if requested
         """
         self.fit_params = fit_params
         self.branch_pen_param = fit_params['branch_pen_param']
@@ -38,6 +42,7 @@ class LikelihoodScorerResult:
         self.train_history = train_history
         self.pen_log_lik = train_history[-1]["pen_log_lik"]
         self.log_lik = train_history[-1]["log_lik"]
+        self.subtree_cache = subtree_cache
 
     def get_fit_params(self):
         fit_params = copy.deepcopy(self.model_params_dict)
@@ -71,6 +76,9 @@ class LikelihoodScorer(ParallelWorker):
             use_poisson: str,
             assessor: ModelAssessor = None,
             max_try_per_init: int = 2,
+            subtree_cache: SubtreeLogLikCache = None,
+            export_subtree_cache: bool = False,
+            optimizer: str = "adam",
             name: str = "likelihoodscorer"):
         """
         @param seed: required to set the seed of each parallel worker
@@ -86,7 +94,13 @@ class LikelihoodScorer(ParallelWorker):
                                     serves as a way to warm start.
         @param assessor: if not None, ModelAssessor is used to measure the distance between the estimated
                                 tree and the oracle tree at each iteration
+        @param subtree_cache: partial likelihoods of subtrees from a previous fit. If given, we only recompute the
+                                partial likelihoods of the subtrees that changed. Only valid if we evaluate the
+                                tree at the same parameters as the previous fit, so max_iters must be zero.
+        @param export_subtree_cache: whether to store the partial likelihoods of the subtrees in the result
+        @param optimizer: which optimizer to use (see CLTPenalizedEstimator.fit)
         """
+        assert subtree_cache is None or max_iters == 0
         self.seed = seed
         self.tree = tree
         self.bcode_meta = bcode_meta
@@ -98,17 +112,47 @@ class LikelihoodScorer(ParallelWorker):
         self.scratch_dir = scratch_dir
         self.use_poisson = use_poisson
         self.assessor = assessor
+        self.subtree_cache = subtree_cache
+        self.export_subtree_cache = export_subtree_cache
+        self.optimizer = optimizer
         self.max_tries = max_try_per_init * num_inits
         self.name = name
 
+    def get_task_hash(self):
+        """
+        @return deterministic hash of the inputs of this fit, used to look up the result in a TuningCheckpoint.
+                The assessor only affects the logging and the scratch directory only holds temporary files,
+                so they are not part of the hash.
+        """
+        return get_hash([
+            self.seed,
+            self.tree,
+            self.bcode_meta,
+            self.max_iters,
+            self.num_inits,
+            # Skip the cache of the transition wrapper maker
+            self.transition_wrap_maker.tree,
+            self.transition_wrap_maker.max_extra_steps,
+            self.transition_wrap_maker.max_sum_states,
+            self.fit_param_list,
+            self.known_params,
+            self.use_poisson,
+            self.max_tries,
+            self.subtree_cache,
+            self.export_subtree_cache,
+            self.optimizer,
+            self.name])
+
     def run_worker(self, shared_obj=None):
         """
+        Builds the likelihood graph for this tree in its own tensorflow graph,
+        so the default graph doesn't keep growing with every tree scored in this process.
+
         @param shared_obj: ignored
         """
-        sess = tf.Session()
-        with sess.as_default():
-            tf.global_variables_initializer().run()
-            return self.do_work_directly(sess)
+        with tf.Graph().as_default():
+            with tf.Session() as sess:
+                return self.do_work_directly(sess)
 
     def _fit_one_init(
             self,
@@ -119,6 +163,21 @@ class LikelihoodScorer(ParallelWorker):
         """
         Fit single initialization
         """
+        self._init_model_params(res_model, fit_params)
+
+        # Actually fit the model
+        train_history = estimator.fit(
+                branch_pen_param=fit_params["branch_pen_param"],
+                target_lam_pen_param=fit_params["target_lam_pen_param"],
+                conv_thres=fit_params["conv_thres"] if "conv_thres" in fit_params else conv_thres_default,
+                assessor=self.assessor,
+                optimizer=self.optimizer)
+        return self._create_result(res_model, fit_params, train_history)
+
+    def _init_model_params(self, res_model: CLTLikelihoodModel, fit_params: Dict):
+        """
+        Sets the model parameters to the initialization given in `fit_params`
+        """
         # Initialize branch lengths if not provided
         if 'branch_len_inners' not in fit_params or 'branch_len_offsets_proportion' not in fit_params:
             res_model.initialize_branch_lens(fit_params["tot_time"])
@@ -136,19 +195,16 @@ class LikelihoodScorer(ParallelWorker):
                             (key, val.shape, full_fit_params[key].shape))
                 full_fit_params[key] = val
         res_model.set_params_from_dict(full_fit_params)
+        assert res_model.is_subtree_cache_consistent()
 
-        # Actually fit the model
-        train_history = estimator.fit(
-                branch_pen_param=fit_params["branch_pen_param"],
-                target_lam_pen_param=fit_params["target_lam_pen_param"],
-                conv_thres=fit_params["conv_thres"] if "conv_thres" in fit_params else conv_thres_default,
-                assessor=self.assessor)
+    def _create_result(self, res_model: CLTLikelihoodModel, fit_params: Dict, train_history: List[Dict]):
         result = LikelihoodScorerResult(
             fit_params,
             res_model.get_vars_as_dict(),
             res_model.topology,
             res_model.get_fitted_bifurcating_tree(),
-            train_history)
+            train_history,
+            res_model.get_subtree_log_lik_cache() if self.export_subtree_cache else None)
         #logging.info(result.fitted_bifurc_tree.get_ascii(attributes=["node_id"], show_internal=True))
         #logging.info(result.fitted_bifurc_tree.get_ascii(attributes=["dist"], show_internal=True))
         #logging.info(result.fitted_bifurc_tree.get_ascii(attributes=["allele_events_list_str"], show_internal=True))
@@ -194,6 +250,74 @@ class LikelihoodScorer(ParallelWorker):
             logging.info("No training attempt worked")
             return None
 
+    def start_fit(self):
+        """
+        Sets up the first fit param setting in its own graph and session that stay open until `close_fit`,
+        so the fit can be continued a few iterations at a time by `continue_fit`.
+        Unlike `run_worker`, only does a single initialization.
+        """
+        np.random.seed(self.seed)
+        self._fit_graph = tf.Graph()
+        with self._fit_graph.as_default():
+            self._fit_sess = tf.Session()
+            with self._fit_sess.as_default():
+                self._fit_model = CLTLikelihoodModel(
+                    self.tree,
+                    self.bcode_meta,
+                    self._fit_sess,
+                    self.known_params,
+                    scratch_dir=self.scratch_dir,
+                    use_poisson=self.use_poisson,
+                    target_lams=self.fit_param_list[0]['target_lams'])
+                self._fit_estimator = CLTPenalizedEstimator(
+                    self._fit_model,
+                    self.transition_wrap_maker,
+                    self.max_iters,
+                    min_iters = int(min(100, (self.max_iters + 2)/2)),
+                    subtree_cache=self.subtree_cache)
+                self._init_model_params(self._fit_model, self.fit_param_list[0])
+        self._fit_train_history = None
+
+    def continue_fit(self, num_iters: int):
+        """
+        Continues the fit from `start_fit` for at most `num_iters` more iterations.
+        The optimizer picks up where the last call left off.
+
+        @return LikelihoodScorerResult whose train history covers all the calls so far,
+                None if the likelihood graph failed
+        """
+        fit_params = self.fit_param_list[0]
+        with self._fit_graph.as_default(), self._fit_sess.as_default():
+            try:
+                train_history = self._fit_estimator.fit(
+                        branch_pen_param=fit_params["branch_pen_param"],
+                        target_lam_pen_param=fit_params["target_lam_pen_param"],
+                        conv_thres=fit_params.get("conv_thres", 1e-6),
+                        assessor=self.assessor,
+                        optimizer=self.optimizer,
+                        max_iters=num_iters)
+            except tf.errors.InvalidArgumentError as e:
+                logging.info(e)
+                return None
+            if self._fit_train_history is not None:
+                # The first entry is the evaluation at the end of the previous call
+                iter_offset = self._fit_train_history[-1]["iter"] + 1
+                train_history = self._fit_train_history + [
+                        dict(iter_info, iter=iter_info["iter"] + iter_offset) for iter_info in train_history[1:]]
+            self._fit_train_history = train_history
+            return self._create_result(self._fit_model, fit_params, train_history)
+
+    def close_fit(self):
+        """
+        Frees the graph and session from `start_fit`
+        """
+        self._fit_sess.close()
+        self._fit_graph = None
+        self._fit_sess = None
+        self._fit_model = None
+        self._fit_estimator = None
+        self._fit_train_history = None
+
     def do_work_directly(self, sess):
         """
         Bypasses all the other code for a ParallelWorker
@@ -218,7 +342,8 @@ class LikelihoodScorer(ParallelWorker):
             res_model,
             self.transition_wrap_maker,
             self.max_iters,
-            min_iters = int(min(100, (self.max_iters + 2)/2)))
+            min_iters = int(min(100, (self.max_iters + 2)/2)),
+            subtree_cache=self.subtree_cache)
 
         # Fit for each fit-param setting
         result_list = []
@@ -5,6 +5,8 @@ import traceback
 import six
 import time
 import logging
+import atexit
+import multiprocessing
 import custom_utils
 from custom_utils import CustomCommand, run_cmd, finish_process
 import numpy as np
@@ -229,3 +231,254 @@ class SubprocessManager(ParallelWorkerManager):
             return self._get_successful_jobs(res, self.worker_list)
         else:
             return [(r, w) for r, w in zip(res, self.worker_list)]
+
+
+def _init_pool_process(log_folder, preload_tensorflow):
+    """
+    Runs once when a process in the pool starts up.
+    Does the expensive imports now so that tasks don't pay for them.
+    """
+    logging.basicConfig(
+            format="%(message)s",
+            filename="%s/pool_process_%d.txt" % (log_folder, os.getpid()),
+            level=logging.DEBUG)
+    if preload_tensorflow:
+        import tensorflow
+
+
+def _run_pool_task(worker_and_shared_obj):
+    """
+    Runs a single ParallelWorker inside a pool process
+
+    @return the result of the worker and the close states it added to the cache of this process,
+            so they can be merged into the cache of the parent process
+    """
+    from transition_wrapper_maker import get_process_close_states_cache
+    worker, shared_obj = worker_and_shared_obj
+    logging.info("Starting worker %s", getattr(worker, "name", ""))
+    close_states_cache = get_process_close_states_cache()
+    close_states_cache.start_recording()
+    try:
+        result = worker.run(shared_obj)
+    finally:
+        new_close_states = close_states_cache.stop_recording()
+    return result, new_close_states
+
+
+# Maps the arguments of _get_pool to the long-lived pool made with them
+_POOLS = dict()
+
+def _get_pool(num_processes, log_folder, preload_tensorflow, max_tasks_per_process):
+    """
+    @param preload_tensorflow: whether the pool processes import tensorflow when they start up
+    @param max_tasks_per_process: if not None, pool processes are replaced after this many tasks
+    @return a multiprocessing pool that stays alive for the rest of this process
+            so that later batches of workers with the same log folder reuse the already warmed-up processes
+    """
+    pool_key = (num_processes, log_folder, preload_tensorflow, max_tasks_per_process)
+    if pool_key not in _POOLS:
+        if not os.path.exists(log_folder):
+            os.makedirs(log_folder)
+        # Use spawn rather than fork since the parent may already have a tensorflow session open
+        ctx = multiprocessing.get_context("spawn")
+        _POOLS[pool_key] = ctx.Pool(
+                num_processes,
+                initializer=_init_pool_process,
+                initargs=(log_folder, preload_tensorflow),
+                maxtasksperchild=max_tasks_per_process)
+    return _POOLS[pool_key]
+
+@atexit.register
+def close_pools():
+    for pool in _POOLS.values():
+        pool.terminate()
+    _POOLS.clear()
+
+
+class PoolManager(ParallelWorkerManager):
+    """
+    Runs the workers in a long-lived pool of local processes.
+    Workers and results are sent over pipes instead of pickle files and each process
+    only imports tensorflow once, no matter how many workers it runs.
+    """
+    def __init__(
+            self,
+            worker_list,
+            shared_obj,
+            worker_folder,
+            num_processes,
+            retry=False,
+            checkpoint=None,
+            preload_tensorflow=True,
+            max_tasks_per_process=None):
+        """
+        @param checkpoint: if not None, a TuningCheckpoint. Workers that already have a result in the checkpoint
+                        are not rerun and the results of the other workers are added to the checkpoint.
+        @param preload_tensorflow: whether the pool processes import tensorflow when they start up.
+                        Turn this off for workers that don't use tensorflow.
+        @param max_tasks_per_process: if not None, pool processes are replaced after this many tasks.
+                        This bounds the memory of the process-global caches but throws away the warmed-up state.
+        """
+        self.retry = retry
+        self.worker_list = worker_list
+        self.worker_folder = worker_folder
+        self.num_processes = num_processes
+        self.shared_obj = shared_obj
+        self.checkpoint = checkpoint
+        self.preload_tensorflow = preload_tensorflow
+        self.max_tasks_per_process = max_tasks_per_process
+
+    def run(self, successful_only=False):
+        """
+        @param successful_only: whether to return successful jobs only
+                                unsuccessful jobs have None as their result
+        @return list of tuples (result, worker)
+        """
+        res = [None] * len(self.worker_list)
+        if self.checkpoint is not None:
+            task_hashes = [worker.get_task_hash() for worker in self.worker_list]
+            res = [self.checkpoint.get_result(task_hash) for task_hash in task_hashes]
+        run_idxs = [i for i, r in enumerate(res) if r is None]
+        if self.checkpoint is not None:
+            logging.info("Loaded %d of %d workers from checkpoint", len(res) - len(run_idxs), len(res))
+
+        if run_idxs:
+            pool = _get_pool(
+                    self.num_processes,
+                    "%s/pool_logs" % self.worker_folder,
+                    self.preload_tensorflow,
+                    self.max_tasks_per_process)
+            run_res = pool.map(
+                    _run_pool_task,
+                    [(self.worker_list[i], self.shared_obj) for i in run_idxs],
+                    chunksize=1)
+            from transition_wrapper_maker import get_process_close_states_cache
+            for i, (r, new_close_states) in zip(run_idxs, run_res):
+                res[i] = r
+                get_process_close_states_cache().update(new_close_states)
+
+        for i in run_idxs:
+            if res[i] is None:
+                logging.info("WARNING: pool manager, worker failed %s" % self.worker_list[i].name)
+                if self.retry:
+                    logging.info("Rerunning locally")
+                    res[i] = self.worker_list[i].run(self.shared_obj)
+            if self.checkpoint is not None:
+                self.checkpoint.add_result(task_hashes[i], res[i])
+
+        if successful_only:
+            return self._get_successful_jobs(res, self.worker_list)
+        else:
+            return [(r, w) for r, w in zip(res, self.worker_list)]
+
+
+def _run_actor_process(conn, log_folder):
+    """
+    Main loop of a process in an ActorPool.
+    Holds on to the objects sent to it and calls their methods when asked to.
+    """
+    _init_pool_process(log_folder)
+    actors = dict()
+    while True:
+        calls = conn.recv()
+        if calls is None:
+            break
+        results = []
+        for key, method_name, method_args in calls:
+            result = None
+            try:
+                if method_name == "__add__":
+                    actors[key] = method_args[0]
+                elif method_name == "__remove__":
+                    del actors[key]
+                else:
+                    result = getattr(actors[key], method_name)(*method_args)
+            except Exception as e:
+                print("Exception caught in actor process: %s" % e)
+                traceback.print_exc()
+            results.append(result)
+        conn.send(results)
+    conn.close()
+
+
+class ActorPool:
+    """
+    Keeps objects alive in long-lived local processes so that we can call their methods over multiple rounds,
+    e.g. to keep training the same model for a few more iterations at a time.
+    Each object stays in the process it was added to, so its state (like an open tensorflow session)
+    never needs to be pickled.
+    With a single process, the objects are kept in this process instead.
+    """
+    def __init__(self, num_processes: int, log_folder: str):
+        self.num_processes = num_processes
+        self.actor_procs = dict()
+        self.local_actors = dict()
+        self.conns = []
+        self.procs = []
+        if num_processes > 1:
+            if not os.path.exists(log_folder):
+                os.makedirs(log_folder)
+            ctx = multiprocessing.get_context("spawn")
+            for _ in range(num_processes):
+                parent_conn, child_conn = ctx.Pipe()
+                proc = ctx.Process(target=_run_actor_process, args=(child_conn, log_folder))
+                proc.start()
+                self.conns.append(parent_conn)
+                self.procs.append(proc)
+
+    def add(self, key, actor):
+        """
+        Sends `actor` to a process. Actors are spread over the processes in the order they are added.
+        """
+        assert key not in self.actor_procs
+        self.actor_procs[key] = len(self.actor_procs) % self.num_processes
+        self.call([(key, "__add__", (actor,))])
+
+    def remove(self, keys):
+        self.call([(key, "__remove__", ()) for key in keys])
+        for key in keys:
+            del self.actor_procs[key]
+
+    def call(self, calls):
+        """
+        Calls the actor methods, running the calls on different processes in parallel
+
+        @param calls: list of (key, method name, method args)
+        @return list of the return values of the calls, None for the calls that raised an exception
+        """
+        if self.num_processes <= 1:
+            return [self._call_local(*c) for c in calls]
+
+        proc_calls = [[] for _ in range(self.num_processes)]
+        for call_idx, c in enumerate(calls):
+            proc_calls[self.actor_procs[c[0]]].append((call_idx, c))
+        for conn, my_calls in zip(self.conns, proc_calls):
+            if my_calls:
+                conn.send([c for _, c in my_calls])
+        results = [None] * len(calls)
+        for conn, my_calls in zip(self.conns, proc_calls):
+            if my_calls:
+                for (call_idx, _), result in zip(my_calls, conn.recv()):
+                    results[call_idx] = result
+        return results
+
+    def _call_local(self, key, method_name, method_args):
+        try:
+            if method_name == "__add__":
+                self.local_actors[key] = method_args[0]
+            elif method_name == "__remove__":
+                del self.local_actors[key]
+            else:
+                return getattr(self.local_actors[key], method_name)(*method_args)
+        except Exception as e:
+            print("Exception caught in actor: %s" % e)
+            traceback.print_exc()
+        return None
+
+    def close(self):
+        for conn, proc in zip(self.conns, self.procs):
+            conn.send(None)
+            proc.join()
+        self.conns = []
+        self.procs = []
+        self.local_actors.clear()
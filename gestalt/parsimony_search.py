@@ -0,0 +1,484 @@
+"""
+Camin-Sokal parsimony search over the binarized event matrix, run in-process instead of PHYLIP MIX.
+
+Every event is a character that is absent at the unedited root and can be gained but never lost.
+Events hidden by other events in a leaf are indeterminate ("?"), so they can be either.
+A clade is summarized by two bitsets over the characters:
+    `ok`: characters that are "1" or "?" in every leaf of the clade
+    `has_one`: characters that are "1" in some leaf of the clade
+A node gains the characters in its `gain = ok & has_one` that are not in the `ok` of its parent,
+where the root has no characters. So the parsimony score of a tree is the number of gained characters.
+
+Trees are built by stepwise addition of the leaves in a random order and then improved by SPR or TBR
+moves until no move lowers the score. All the regrafts of a pruned subtree are scored in a single pass
+over the rest of the tree. Finally, we collect the equally parsimonious trees that are reachable by
+moves that do not change the score.
+"""
+from typing import List
+import logging
+import numpy as np
+from numpy import ndarray
+
+from parallel_worker import ParallelWorker, PoolManager
+
+REARRANGEMENTS = ["spr", "tbr"]
+
+
+def _popcount(bits: int):
+    return bin(bits).count("1")
+
+
+class CaminSokalTree:
+    """
+    A rooted bifurcating tree over the leaves of the binarized event matrix.
+    The leaves are nodes 0 to `num_leaves - 1` and the internal nodes are the remaining ones.
+    """
+    def __init__(self, leaf_oks: List[int], leaf_has_ones: List[int]):
+        """
+        @param leaf_oks: bitset per leaf of the characters that are "1" or "?"
+        @param leaf_has_ones: bitset per leaf of the characters that are "1"
+        """
+        self.num_leaves = len(leaf_oks)
+        self.num_nodes = max(2 * self.num_leaves - 1, 1)
+        num_internal = self.num_nodes - self.num_leaves
+        self.parents = [None] * self.num_nodes
+        self.children = [[] for _ in range(self.num_nodes)]
+        self.oks = list(leaf_oks) + [0] * num_internal
+        self.has_ones = list(leaf_has_ones) + [0] * num_internal
+        self.gains = [ok & has_one for ok, has_one in zip(self.oks, self.has_ones)]
+        # Bitset over the leaves in each clade, used to tell trees apart
+        self.clades = [1 << i for i in range(self.num_leaves)] + [0] * num_internal
+        self.root = 0
+
+    def copy(self):
+        tree = CaminSokalTree.__new__(CaminSokalTree)
+        tree.num_leaves = self.num_leaves
+        tree.num_nodes = self.num_nodes
+        tree.parents = list(self.parents)
+        tree.children = [list(c) for c in self.children]
+        tree.oks = list(self.oks)
+        tree.has_ones = list(self.has_ones)
+        tree.gains = list(self.gains)
+        tree.clades = list(self.clades)
+        tree.root = self.root
+        return tree
+
+    def get_clade_key(self):
+        """
+        @return a key that is the same for two trees iff they have the same topology
+        """
+        return frozenset([self.clades[node] for node in self.get_preorder(self.root)])
+
+    def get_preorder(self, node: int):
+        """
+        @return nodes in the subtree at `node` in preorder
+        """
+        nodes = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack += self.children[node]
+        return nodes
+
+    def _set_clade(self, node: int):
+        left, right = self.children[node]
+        self.oks[node] = self.oks[left] & self.oks[right]
+        self.has_ones[node] = self.has_ones[left] | self.has_ones[right]
+        self.gains[node] = self.oks[node] & self.has_ones[node]
+        self.clades[node] = self.clades[left] | self.clades[right]
+
+    def _update_clades(self, node: int):
+        """
+        Update the clades from `node` up to the root
+        """
+        while node is not None:
+            self._set_clade(node)
+            node = self.parents[node]
+
+    def _get_parent_ok(self, node: int):
+        parent = self.parents[node]
+        return 0 if parent == self.root else self.oks[parent]
+
+    def get_score(self):
+        """
+        @return the parsimony score, i.e. the number of characters gained in the tree
+        """
+        return sum([
+            _popcount(self.gains[node] & ~self._get_parent_ok(node))
+            for node in self.get_preorder(self.root) if node != self.root])
+
+    def get_subtree_score(self, node: int):
+        """
+        @return the number of characters gained within the subtree at `node` (not counting `node`)
+        """
+        return sum([
+            _popcount(self.gains[desc] & ~self.oks[self.parents[desc]])
+            for desc in self.get_preorder(node) if desc != node])
+
+    def get_states(self):
+        """
+        @return bitset per node of the characters that are "1" in its parsimonious ancestral state
+                (an indeterminate leaf character is "1" if it is below a node that gained it)
+        """
+        states = [0] * self.num_nodes
+        for node in self.get_preorder(self.root):
+            if node != self.root:
+                parent_ok = self._get_parent_ok(node)
+                states[node] = states[self.parents[node]] | (self.gains[node] & ~parent_ok)
+        return states
+
+    def prune(self, node: int):
+        """
+        Detach the subtree at `node` together with the parent of `node`
+
+        @return the parent of `node`, which is now free to be used for regrafting,
+                and the sibling of `node`, which is where to regraft to undo the prune
+        """
+        parent = self.parents[node]
+        sibling = [c for c in self.children[parent] if c != node][0]
+        grandparent = self.parents[parent]
+        self.parents[sibling] = grandparent
+        if grandparent is None:
+            self.root = sibling
+        else:
+            grandparent_children = self.children[grandparent]
+            grandparent_children[grandparent_children.index(parent)] = sibling
+            self._update_clades(grandparent)
+        self.parents[node] = None
+        self.parents[parent] = None
+        self.children[parent] = []
+        return parent, sibling
+
+    def regraft(self, node: int, free_node: int, attach_node: int):
+        """
+        Attach the subtree at `node` to the branch above `attach_node` (or above the root)
+        by inserting `free_node` in the branch
+        """
+        parent = self.parents[attach_node]
+        self.parents[free_node] = parent
+        if parent is None:
+            self.root = free_node
+        else:
+            parent_children = self.children[parent]
+            parent_children[parent_children.index(attach_node)] = free_node
+        self.children[free_node] = [attach_node, node]
+        self.parents[attach_node] = free_node
+        self.parents[node] = free_node
+        self._update_clades(free_node)
+
+    def get_regraft_deltas(self, node: int):
+        """
+        Scores every branch where the detached subtree at `node` can be regrafted.
+        Adding the subtree below a node only shrinks `ok` and grows `has_one` of the node, so the change
+        in the score is the sum of the changes at the ancestors of the regraft branch, which we accumulate
+        in a single preorder pass.
+
+        @return list of tuples (change in the score of the tree, node above which we regraft).
+                The change does not include the gains within the subtree.
+        """
+        ok_node = self.oks[node]
+        has_one_node = self.has_ones[node]
+        gain_node = self.gains[node]
+        root = self.root
+
+        # Regraft above the root: the old root is no longer the root, so its children can now inherit from it
+        root_delta = _popcount(self.gains[root]) + _popcount(gain_node)
+        for child in self.children[root]:
+            root_delta += _popcount(self.gains[child] & ~self.oks[root]) - _popcount(self.gains[child])
+        deltas = [(root_delta, root)]
+
+        stack = [(root, 0)] if self.children[root] else []
+        while stack:
+            parent, ancestor_delta = stack.pop()
+            old_ok = 0 if parent == root else self.oks[parent]
+            new_ok = old_ok & ok_node
+            left, right = self.children[parent]
+            for child, sibling in [(left, right), (right, left)]:
+                sibling_gain = self.gains[sibling]
+                child_gain = self.gains[child]
+                # Clade of the new node between `parent` and `child`, which is also the clade of `child` when
+                # the subtree is regrafted further below
+                ok_new_node = self.oks[child] & ok_node
+                gain_new_node = ok_new_node & (self.has_ones[child] | has_one_node)
+                child_delta = (ancestor_delta
+                        + _popcount(sibling_gain & ~new_ok) - _popcount(sibling_gain & ~old_ok)
+                        + _popcount(gain_new_node & ~new_ok) - _popcount(child_gain & ~old_ok))
+                deltas.append((
+                    child_delta + _popcount(child_gain & ~ok_new_node) + _popcount(gain_node & ~ok_new_node),
+                    child))
+                if self.children[child]:
+                    stack.append((child, child_delta))
+        return deltas
+
+    def get_reroot_scores(self, node: int):
+        """
+        Scores every way of rerooting the detached subtree at `node`, where `node` is moved to a branch
+        within the subtree. The leaves of the subtree do not change so neither does its regraft score.
+
+        @return list of tuples (score within the rerooted subtree, node that is a child of `node` after rerooting).
+                The first tuple is the current rooting.
+        """
+        subtree_nodes = self.get_preorder(node)
+        if len(subtree_nodes) == 1:
+            return [(0, None)]
+
+        down_scores = {}
+        for desc in reversed(subtree_nodes):
+            down_scores[desc] = sum([
+                down_scores[child] + _popcount(self.gains[child] & ~self.oks[desc])
+                for child in self.children[desc]])
+
+        # Summarize the complement of each clade in the subtree as it hangs off the rerooted branch
+        left, right = self.children[node]
+        up_clades = {
+            left: (self.oks[right], self.has_ones[right], down_scores[right]),
+            right: (self.oks[left], self.has_ones[left], down_scores[left])}
+        ok_node = self.oks[node]
+        reroot_scores = [(down_scores[node], left)]
+        for desc in subtree_nodes[1:]:
+            up_ok, up_has_one, up_score = up_clades[desc]
+            up_gain = up_ok & up_has_one
+            if desc != left and desc != right:
+                reroot_scores.append((
+                    down_scores[desc] + up_score
+                    + _popcount(self.gains[desc] & ~ok_node) + _popcount(up_gain & ~ok_node),
+                    desc))
+            if self.children[desc]:
+                desc_left, desc_right = self.children[desc]
+                for child, sibling in [(desc_left, desc_right), (desc_right, desc_left)]:
+                    child_up_ok = self.oks[sibling] & up_ok
+                    up_clades[child] = (
+                        child_up_ok,
+                        self.has_ones[sibling] | up_has_one,
+                        down_scores[sibling] + _popcount(self.gains[sibling] & ~child_up_ok)
+                        + up_score + _popcount(up_gain & ~child_up_ok))
+        return reroot_scores
+
+    def reroot(self, node: int, new_child: int):
+        """
+        Reroot the subtree at `node` by moving `node` to the branch above `new_child`
+        """
+        path = [new_child]
+        while self.parents[path[-1]] != node:
+            path.append(self.parents[path[-1]])
+        if len(path) == 1:
+            return
+
+        # Reverse the branches on the path from `new_child` up to `node`.
+        # The top of the path takes over the other child of `node`.
+        other_child = [c for c in self.children[node] if c != path[-1]][0]
+        new_children = {node: [path[0], path[1]]}
+        for idx in range(1, len(path)):
+            off_path_child = [c for c in self.children[path[idx]] if c != path[idx - 1]][0]
+            new_children[path[idx]] = [
+                off_path_child,
+                path[idx + 1] if idx + 1 < len(path) else other_child]
+        for parent, children in new_children.items():
+            self.children[parent] = children
+            for child in children:
+                self.parents[child] = parent
+        for parent in reversed(path[1:]):
+            self._set_clade(parent)
+
+
+def _prune_and_score(tree: CaminSokalTree, node: int, rearrangement: str):
+    """
+    Prune the subtree at `node` and score all the ways of putting it back
+
+    @return the free node and the sibling from `CaminSokalTree.prune`,
+            list of tuples (score of the tree without the subtree gains, node to regraft above), and
+            list of tuples (score within the subtree, node to reroot at)
+    """
+    free_node, sibling = tree.prune(node)
+    pruned_score = tree.get_score()
+    regraft_scores = [(pruned_score + delta, attach_node) for delta, attach_node in tree.get_regraft_deltas(node)]
+    if rearrangement == "tbr":
+        reroot_scores = tree.get_reroot_scores(node)
+    else:
+        reroot_scores = [(tree.get_subtree_score(node), None)]
+    return free_node, sibling, regraft_scores, reroot_scores
+
+
+def _rearrange(tree: CaminSokalTree, node: int, free_node: int, reroot_node: int, attach_node: int):
+    if reroot_node is not None:
+        tree.reroot(node, reroot_node)
+    tree.regraft(node, free_node, attach_node)
+
+
+def build_stepwise_tree(leaf_oks: List[int], leaf_has_ones: List[int], leaf_order: List[int]):
+    """
+    Build a tree by adding the leaves in the given order, each to the branch that adds the fewest gains.
+    Ties are broken at random.
+
+    @return CaminSokalTree
+    """
+    tree = CaminSokalTree(leaf_oks, leaf_has_ones)
+    tree.root = leaf_order[0]
+    for free_node, leaf in enumerate(leaf_order[1:], start=tree.num_leaves):
+        regraft_deltas = tree.get_regraft_deltas(leaf)
+        min_delta = min([delta for delta, _ in regraft_deltas])
+        attach_nodes = [attach_node for delta, attach_node in regraft_deltas if delta == min_delta]
+        tree.regraft(leaf, free_node, attach_nodes[np.random.randint(len(attach_nodes))])
+    return tree
+
+
+def hill_climb(tree: CaminSokalTree, rearrangement: str = "spr"):
+    """
+    Apply the best rearrangement of each pruned subtree, visited in a random order, if it lowers the score.
+    Stops once a full pass over the subtrees does not lower the score.
+
+    @return the parsimony score of the modified `tree`
+    """
+    assert rearrangement in REARRANGEMENTS
+    score = tree.get_score()
+    did_improve = True
+    while did_improve:
+        did_improve = False
+        for node in np.random.permutation(tree.num_nodes):
+            if node == tree.root:
+                continue
+            free_node, sibling, regraft_scores, reroot_scores = _prune_and_score(tree, node, rearrangement)
+            best_regraft_score, attach_node = min(regraft_scores)
+            best_reroot_score, reroot_node = min(reroot_scores)
+            if best_regraft_score + best_reroot_score < score:
+                _rearrange(tree, node, free_node, reroot_node, attach_node)
+                score = best_regraft_score + best_reroot_score
+                did_improve = True
+            else:
+                tree.regraft(node, free_node, sibling)
+    return score
+
+
+def get_equally_parsimonious_trees(tree: CaminSokalTree, rearrangement: str = "spr", max_trees: int = 100):
+    """
+    Explore the trees reachable from `tree` by rearrangements that keep the score, breadth first.
+    If a rearrangement lowers the score, we hill climb from there and start over.
+
+    @return tuple with the parsimony score and a list of at most `max_trees` trees with that score
+    """
+    score = hill_climb(tree, rearrangement)
+    trees = {tree.get_clade_key(): tree}
+    queue = [tree]
+    while queue and len(trees) < max_trees:
+        curr_tree = queue.pop(0)
+        for node in range(curr_tree.num_nodes):
+            if node == curr_tree.root or len(trees) >= max_trees:
+                continue
+            free_node, sibling, regraft_scores, reroot_scores = _prune_and_score(curr_tree, node, rearrangement)
+            best_score = min(regraft_scores)[0] + min(reroot_scores)[0]
+            if best_score < score:
+                # Found a better tree, so the trees so far are no longer the most parsimonious
+                new_tree = curr_tree.copy()
+                _rearrange(new_tree, node, free_node, min(reroot_scores)[1], min(regraft_scores)[1])
+                curr_tree.regraft(node, free_node, sibling)
+                return get_equally_parsimonious_trees(new_tree, rearrangement, max_trees)
+
+            for regraft_score, attach_node in regraft_scores:
+                for reroot_score, reroot_node in reroot_scores:
+                    if regraft_score + reroot_score != score or len(trees) >= max_trees:
+                        continue
+                    new_tree = curr_tree.copy()
+                    _rearrange(new_tree, node, free_node, reroot_node, attach_node)
+                    clade_key = new_tree.get_clade_key()
+                    if clade_key not in trees:
+                        trees[clade_key] = new_tree
+                        queue.append(new_tree)
+            curr_tree.regraft(node, free_node, sibling)
+    return score, list(trees.values())
+
+
+def get_leaf_bitsets(encodings: List[str]):
+    """
+    @param encodings: one string per leaf with a "0", "1", or "?" for each character
+
+    @return the `ok` and `has_one` bitsets of the leaves, where bit i is the i-th character
+    """
+    leaf_oks = [int(encoding[::-1].replace("?", "1"), 2) if encoding else 0 for encoding in encodings]
+    leaf_has_ones = [int(encoding[::-1].replace("?", "0"), 2) if encoding else 0 for encoding in encodings]
+    return leaf_oks, leaf_has_ones
+
+
+def get_packed_bitsets(event_matrix: ndarray):
+    """
+    @param event_matrix: boolean matrix with a row per leaf and a column per character
+
+    @return the bitset of each row, where bit i is the i-th column
+    """
+    # Pack the reversed rows so the first column ends up in the lowest bit, then drop the padding bits
+    num_pad_bits = -event_matrix.shape[1] % 8
+    packed_matrix = np.packbits(event_matrix[:, ::-1], axis=1)
+    return [int.from_bytes(row.tobytes(), "big") >> num_pad_bits for row in packed_matrix]
+
+
+class ParsimonySearchWorker(ParallelWorker):
+    """
+    Runs a parsimony search from one random addition order
+    """
+    def __init__(self,
+            seed: int,
+            leaf_oks: List[int],
+            leaf_has_ones: List[int],
+            rearrangement: str,
+            max_trees: int):
+        """
+        @param seed: seed for the random addition order and breaking ties
+        @param rearrangement: "spr" or "tbr"
+        @param max_trees: maximum number of equally parsimonious trees to collect
+        """
+        self.seed = seed
+        self.leaf_oks = leaf_oks
+        self.leaf_has_ones = leaf_has_ones
+        self.rearrangement = rearrangement
+        self.max_trees = max_trees
+        self.name = "parsimony search seed %d" % seed
+
+    def run_worker(self, shared_obj):
+        """
+        @return tuple with the parsimony score and a list of CaminSokalTrees with that score
+        """
+        leaf_order = np.random.permutation(len(self.leaf_oks))
+        tree = build_stepwise_tree(self.leaf_oks, self.leaf_has_ones, leaf_order)
+        return get_equally_parsimonious_trees(tree, self.rearrangement, self.max_trees)
+
+
+def search_parsimony_trees(
+        leaf_oks: List[int],
+        leaf_has_ones: List[int],
+        seeds: List[int],
+        rearrangement: str = "spr",
+        max_trees: int = 100,
+        num_processes: int = 1,
+        worker_folder: str = None):
+    """
+    Search for the most parsimonious trees starting from a random addition order for each seed
+
+    @param leaf_oks: bitset per leaf of the characters that are "1" or "?"
+    @param leaf_has_ones: bitset per leaf of the characters that are "1"
+    @param seeds: one search is run per seed
+    @param num_processes: number of processes to run the searches on
+    @param worker_folder: folder for the logs of the processes, needed if `num_processes > 1`
+
+    @return tuple with the parsimony score and a list of at most `max_trees` CaminSokalTrees with that score,
+            pooled over the searches
+    """
+    assert rearrangement in REARRANGEMENTS
+    workers = [
+        ParsimonySearchWorker(seed, leaf_oks, leaf_has_ones, rearrangement, max_trees)
+        for seed in seeds]
+    if num_processes > 1:
+        job_manager = PoolManager(workers, None, worker_folder, num_processes, preload_tensorflow=False)
+        results = [res for res, _ in job_manager.run(successful_only=True)]
+    else:
+        results = [worker.run(None) for worker in workers]
+    results = [res for res in results if res is not None]
+    assert len(results) >= 1
+
+    best_score = min([score for score, _ in results])
+    trees = {}
+    for score, search_trees in results:
+        logging.info("parsimony search score %d, num trees %d", score, len(search_trees))
+        if score == best_score:
+            for tree in search_trees:
+                trees.setdefault(tree.get_clade_key(), tree)
+    return best_score, list(trees.values())[:max_trees]
@@ -65,8 +65,7 @@ def get_tree_parsimony_score(tree: CellLineageTree, bcode_meta: BarcodeMetadata)
     """
     @return the parsimony score for the given tree
     """
-    ancestral_events_finder.annotate_ancestral_states(tree, bcode_meta)
-    return ancestral_events_finder.get_parsimony_score(tree)
+    return ancestral_events_finder.calculate_parsimony_score(tree, bcode_meta)
 
 
 def main(args=sys.argv[1:]):
@@ -1,9 +1,11 @@
 """
 Read data from GESTALT and convert to pickle file with List[ObservedAlignedSeq]
 """
-from typing import List
+from typing import List, Dict, Tuple
 import random
 import csv
+import itertools
+import collections
 import numpy as np
 import argparse
 import time
@@ -93,6 +95,29 @@ def process_observed_seq_format7B(
     @param cell_state: the cell type associated with this allele
     @return ObservedAlignedSeq
     """
+    events = process_events_format7B(
+            target_str_list,
+            bcode_meta,
+            min_pos,
+            merge_thres)
+    obs = ObservedAlignedSeq(
+            None,
+            [AlleleEvents(events)],
+            cell_state,
+            abundance=abundance)
+    return obs
+
+def process_events_format7B(
+        target_str_list: List[str],
+        bcode_meta: BarcodeMetadata,
+        min_pos: int,
+        merge_thres: int = 1):
+    """
+    Converts new format allele to the cleaned list of events
+
+    @param target_str_list: targets with events encoded in 7B format
+    @return List[Event] sorted by start position
+    """
     # Find list of targets for each event
     evt_target_dict = {}
     for targ_idx, targ_str in enumerate(target_str_list):
@@ -194,13 +219,88 @@ def process_observed_seq_format7B(
                     last_evt.max_target,
                     last_evt.insert_str)
 
-    #print("allelle", non_clashing_events)
-    obs = ObservedAlignedSeq(
-            None,
-            [AlleleEvents(non_clashing_events)],
-            cell_state,
-            abundance=abundance)
-    return obs
+    return non_clashing_events
+
+def _stream_read_counts(
+        file_name: str,
+        make_read_key_func,
+        max_read: int = None,
+        chunk_size: int = 100000):
+    """
+    Tallies up the identical reads in the file. We read the file in chunks of `chunk_size` rows
+    so we only ever hold one chunk of rows in memory along with the counts of the unique reads.
+    Raw reads are highly redundant so this is much cheaper than parsing every row into an allele.
+
+    @param make_read_key_func: takes the header row and returns a function that maps a row to a tuple with
+                            the read key (organ str, tuple of target strs) and the abundance of the row.
+                            This function returns None if the row should be skipped.
+    @param max_read: maximum number of reads to read (for debugging purposes)
+
+    @return collections.Counter mapping read key to total abundance, in order of first appearance
+    """
+    read_counts = collections.Counter()
+    num_reads = 0
+    with open(file_name, "r") as f:
+        reader = csv.reader(f, delimiter='\t')
+        header = next(reader)
+        get_read_key = make_read_key_func(header)
+        while max_read is None or num_reads < max_read:
+            chunk_size_to_read = chunk_size if max_read is None else min(chunk_size, max_read - num_reads)
+            chunk = list(itertools.islice(reader, chunk_size_to_read))
+            if len(chunk) == 0:
+                break
+            for row in chunk:
+                read_key_abundance = get_read_key(row)
+                if read_key_abundance is not None:
+                    read_key, abundance = read_key_abundance
+                    read_counts[read_key] += abundance
+            num_reads += len(chunk)
+            logging.info("Read %d rows, %d unique reads", num_reads, len(read_counts))
+    return read_counts
+
+def _create_obs_from_read_counts(
+        read_counts: Dict[Tuple, int],
+        cell_states_dict: Dict[str, CellState],
+        bcode_meta: BarcodeMetadata,
+        bcode_min_pos: int,
+        merge_thres: int = 1):
+    """
+    Converts the unique reads into ObservedAlignedSeq, merging reads with the same cleaned events
+    and organ. Each unique set of target strings is only parsed once.
+
+    @param read_counts: output from `_stream_read_counts`
+    @param cell_states_dict: maps organ str to cell state. New organs are added to this dictionary.
+
+    @return List[ObservedAlignedSeq]
+    """
+    events_cache = dict()
+    observed_alleles = dict()
+    for (organ_str, target_strs), abundance in read_counts.items():
+        if organ_str not in cell_states_dict:
+            cell_states_dict[organ_str] = CellState(categorical=CellTypeTree(len(cell_states_dict), rate=None))
+
+        if target_strs not in events_cache:
+            events_cache[target_strs] = tuple(process_events_format7B(
+                target_strs,
+                bcode_meta,
+                bcode_min_pos,
+                merge_thres=merge_thres))
+        obs_key = (organ_str, events_cache[target_strs])
+        if obs_key not in observed_alleles:
+            observed_alleles[obs_key] = ObservedAlignedSeq(
+                None,
+                [AlleleEvents(list(events_cache[target_strs]))],
+                cell_states_dict[organ_str],
+                abundance=abundance)
+        else:
+            observed_alleles[obs_key].abundance += abundance
+    return list(observed_alleles.values())
+
+def _make_organ_dict(cell_states_dict: Dict[str, CellState]):
+    organ_dict = {}
+    for organ_str, cell_type in cell_states_dict.items():
+        organ_dict[str(cell_type)] = organ_str
+    return organ_dict
 
 def parse_reads_file_format_GSE17(file_name,
                               bcode_meta: BarcodeMetadata,
@@ -214,44 +314,23 @@ def parse_reads_file_format_GSE17(file_name,
     This means for inter-target events, it will appear multiple times on that row.
     e.g. target1 33D+234, target2 33E+234
     """
-    num_organs = 0
-    cell_states_dict = dict()
-    all_alleles = []
-    observed_alleles = dict()
-    with open(file_name, "r") as f:
-        reader = csv.reader(f, delimiter='\t')
-        header = next(reader)
-        for i, row in enumerate(reader):
+    def make_read_key_func(header):
+        def get_read_key(row):
             organ_str = row[1].replace("17_", "")
-            if organ_str not in CONTROL_ORGANS:
-                # First process the organ
-                if organ_str not in cell_states_dict:
-                    cell_state = CellState(categorical=CellTypeTree(num_organs, rate=None))
-                    cell_states_dict[organ_str] = cell_state
-                    num_organs += 1
-                cell_state = cell_states_dict[organ_str]
-                abundance = int(row[2])
-                obs_aligned_seq = process_observed_seq_format7B(
-                    row[-1].split("_"),
-                    cell_state,
-                    bcode_meta,
-                    bcode_min_pos,
-                    abundance=abundance,
-                    merge_thres=merge_thres)
-                obs_key = str(obs_aligned_seq)
-                if obs_key not in observed_alleles:
-                    observed_alleles[obs_key] = obs_aligned_seq
-                else:
-                    obs = observed_alleles[obs_key]
-                    obs.abundance += abundance
-                if max_read is not None and len(all_alleles) == max_read:
-                    break
+            if organ_str in CONTROL_ORGANS:
+                return None
+            return (organ_str, tuple(row[-1].split("_"))), int(row[2])
+        return get_read_key
 
-    obs_alleles_list = list(observed_alleles.values())
-    organ_dict = {}
-    for organ_str, cell_type in cell_states_dict.items():
-        organ_dict[str(cell_type)] = organ_str
-    return obs_alleles_list, organ_dict
+    read_counts = _stream_read_counts(file_name, make_read_key_func, max_read=max_read)
+    cell_states_dict = dict()
+    obs_alleles_list = _create_obs_from_read_counts(
+            read_counts,
+            cell_states_dict,
+            bcode_meta,
+            bcode_min_pos,
+            merge_thres=merge_thres)
+    return obs_alleles_list, _make_organ_dict(cell_states_dict)
 
 def parse_reads_file_format_GSM(file_name,
                               bcode_meta: BarcodeMetadata,
@@ -266,42 +345,23 @@ def parse_reads_file_format_GSM(file_name,
     This means for inter-target events, it will appear multiple times on that row.
     e.g. target1 33D+234, target2 33E+234
     """
-    cell_state = CellState(categorical=CellTypeTree(0, rate=None))
-    cell_states_dict = {"single_state": cell_state}
-    all_alleles = []
-    observed_alleles = dict()
-    with open(file_name, "r") as f:
-        reader = csv.reader(f, delimiter='\t')
-        header = next(reader)
+    def make_read_key_func(header):
         target_start_idx = header.index(target_hdr_fmt % 1)
-        for i, row in enumerate(reader):
+        def get_read_key(row):
             if row[1] != "PASS":
-                continue
-
-            # Now create allele representation
-            obs_aligned_seq = process_observed_seq_format7B(
-                [
-                    row[target_start_idx + i]
-                    for i in range(NUM_BARCODE_V6_TARGETS)
-                ],
-                cell_state,
-                bcode_meta,
-                bcode_min_pos,
-                merge_thres=merge_thres)
-            obs_key = str(obs_aligned_seq)
-            if obs_key not in observed_alleles:
-                observed_alleles[obs_key] = obs_aligned_seq
-            else:
-                obs = observed_alleles[obs_key]
-                obs.abundance += 1
-            if max_read is not None and len(all_alleles) == max_read:
-                break
+                return None
+            return ("single_state", tuple(row[target_start_idx: target_start_idx + NUM_BARCODE_V6_TARGETS])), 1
+        return get_read_key
 
-    obs_alleles_list = list(observed_alleles.values())
-    organ_dict = {}
-    for organ_str, cell_type in cell_states_dict.items():
-        organ_dict[str(cell_type)] = organ_str
-    return obs_alleles_list, organ_dict
+    read_counts = _stream_read_counts(file_name, make_read_key_func, max_read=max_read)
+    cell_states_dict = {"single_state": CellState(categorical=CellTypeTree(0, rate=None))}
+    obs_alleles_list = _create_obs_from_read_counts(
+            read_counts,
+            cell_states_dict,
+            bcode_meta,
+            bcode_min_pos,
+            merge_thres=merge_thres)
+    return obs_alleles_list, _make_organ_dict(cell_states_dict)
 
 def parse_reads_file_format7B(file_name,
                               bcode_meta: BarcodeMetadata,
@@ -316,49 +376,24 @@ def parse_reads_file_format7B(file_name,
     This means for inter-target events, it will appear multiple times on that row.
     e.g. target1 33D+234, target2 33E+234
     """
-    num_organs = 0
-    cell_states_dict = dict()
-    all_alleles = []
-    observed_alleles = dict()
-    with open(file_name, "r") as f:
-        reader = csv.reader(f, delimiter='\t')
-        header = next(reader)
+    def make_read_key_func(header):
         target_start_idx = header.index(target_hdr_fmt % 1)
-        for i, row in enumerate(reader):
+        def get_read_key(row):
             organ_str = row[0]
-            if organ_str not in CONTROL_ORGANS:
-                # First process the organ
-                if organ_str not in cell_states_dict:
-                    cell_state = CellState(categorical=CellTypeTree(num_organs, rate=None))
-                    cell_states_dict[organ_str] = cell_state
-                    num_organs += 1
-                cell_state = cell_states_dict[organ_str]
-
-                # Now create allele representation
-                obs_aligned_seq = process_observed_seq_format7B(
-                    [
-                        row[target_start_idx + i]
-                        for i in range(NUM_BARCODE_V6_TARGETS)
-                    ],
-                    cell_state,
-                    bcode_meta,
-                    bcode_min_pos,
-                    merge_thres=merge_thres)
-                obs_key = str(obs_aligned_seq)
-                if obs_key not in observed_alleles:
-                    observed_alleles[obs_key] = obs_aligned_seq
-                else:
-                    obs = observed_alleles[obs_key]
-                    obs.abundance += 1
-                if max_read is not None and len(all_alleles) == max_read:
-                    break
-
-    obs_alleles_list = list(observed_alleles.values())
+            if organ_str in CONTROL_ORGANS:
+                return None
+            return (organ_str, tuple(row[target_start_idx: target_start_idx + NUM_BARCODE_V6_TARGETS])), 1
+        return get_read_key
 
-    organ_dict = {}
-    for organ_str, cell_type in cell_states_dict.items():
-        organ_dict[str(cell_type)] = organ_str
-    return obs_alleles_list, organ_dict
+    read_counts = _stream_read_counts(file_name, make_read_key_func, max_read=max_read)
+    cell_states_dict = dict()
+    obs_alleles_list = _create_obs_from_read_counts(
+            read_counts,
+            cell_states_dict,
+            bcode_meta,
+            bcode_min_pos,
+            merge_thres=merge_thres)
+    return obs_alleles_list, _make_organ_dict(cell_states_dict)
 
 def merge_by_allele(obs_leaves: List[ObservedAlignedSeq]):
     """
@@ -367,7 +402,7 @@ def merge_by_allele(obs_leaves: List[ObservedAlignedSeq]):
     """
     observed_alleles = dict()
     for obs in obs_leaves:
-        obs_allele_key = obs.get_allele_str()
+        obs_allele_key = tuple(obs.allele_events_list)
         if obs_allele_key not in observed_alleles:
             observed_alleles[obs_allele_key] = ObservedAlignedSeq(
                     obs.allele_list,
@@ -439,15 +474,19 @@ def main():
 
     # Check trim length assignments
     # Check all indels are disjoin in terms of what targets they deactivate
+    # Store the indel sets of each allele as a set so the irreversibility checks are constant-time lookups
+    anc_states = [
+        AncState.create_for_observed_allele(obs.allele_events_list[0], bcode_meta)
+        for obs in obs_leaves]
     evt_to_obs = {}
-    for obs in obs_leaves:
-        anc_state = AncState.create_for_observed_allele(obs.allele_events_list[0], bcode_meta)
+    for anc_state in anc_states:
+        indel_sets = set(anc_state.indel_set_list)
         for evt in anc_state.indel_set_list:
             if evt not in evt_to_obs:
-                evt_to_obs[evt] = [anc_state]
+                evt_to_obs[evt] = [indel_sets]
             else:
-                evt_to_obs[evt].append(anc_state)
-    for obs in obs_leaves:
+                evt_to_obs[evt].append(indel_sets)
+    for obs, anc_state in zip(obs_leaves, anc_states):
         try:
             for evt in obs.allele_events_list[0].events:
                 evt.get_trim_lens(bcode_meta)
@@ -457,7 +496,6 @@ def main():
             print(bcode_meta.right_max_trim)
             for evt in obs.allele_events_list[0].events:
                 print(evt.get_trim_lens(bcode_meta))
-        anc_state = AncState.create_for_observed_allele(obs.allele_events_list[0], bcode_meta)
         for i, evt in enumerate(anc_state.indel_set_list):
             if i == 0:
                 continue
@@ -467,9 +505,9 @@ def main():
                     "There are clashing events in the allele with ancstate %s. Distance between clashing events: %d."
                     % (anc_state, evt.start_pos - prev_evt.del_end))
                 if evt.min_deact_target != evt.min_target:
-                    irreversibility_checks = [prev_evt in a.indel_set_list for a in evt_to_obs[evt]]
+                    irreversibility_checks = [prev_evt in indel_sets for indel_sets in evt_to_obs[evt]]
                 else:
-                    irreversibility_checks = [evt in a.indel_set_list for a in evt_to_obs[prev_evt]]
+                    irreversibility_checks = [evt in indel_sets for indel_sets in evt_to_obs[prev_evt]]
                 if len(irreversibility_checks) > 2 and not all(irreversibility_checks):
                     raise ValueError("nope. clashing events not preserving irreversibility (though crazy homoplasy could also be occurring), %s" % irreversibility_checks)
 
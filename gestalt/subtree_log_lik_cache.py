@@ -0,0 +1,138 @@
+from typing import List, Dict
+import numpy as np
+from numpy import ndarray
+
+from cell_lineage_tree import CellLineageTree
+from transition_wrapper_maker import TransitionWrapper
+
+
+class SubtreeLogLikCache:
+    """
+    Stores the partial likelihoods (the probability of the data below a node given the state at that node)
+    of a fitted tree, along with the scaling terms for numerical underflow accumulated in each subtree.
+
+    A tree that only differs from the fitted tree by a regrafted subtree shares all the subtrees off of
+    the paths from the old and new attachment points to the root. When the tree is evaluated at the
+    same model parameters (e.g. the warm-start parameters of a hanging chad candidate), the likelihood
+    graph can plug in the cached values for the shared subtrees and only recompute the partial likelihoods
+    along the affected paths.
+
+    Nodes in the new tree are matched to nodes in the fitted tree via the attribute `id_attr`.
+    """
+    def __init__(self, id_attr: str = "nochad_id"):
+        """
+        @param id_attr: the attribute of the nodes in the new tree that stores the node id in the fitted tree
+        """
+        self.id_attr = id_attr
+        # Maps node id in the fitted tree to the cached values for that subtree
+        self.entries = dict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def get_subtree_signature(node: CellLineageTree, id_attr: str = "node_id"):
+        """
+        @return a hashable description of the subtree below `node` in terms of the ids stored in `id_attr`,
+                None if a node in the subtree has no such id (e.g. it was added by the regraft)
+        """
+        signature = []
+        for desc in node.traverse("preorder"):
+            desc_id = getattr(desc, id_attr, None)
+            if desc_id is None:
+                return None
+            parent_id = getattr(desc.up, id_attr, None) if desc is not node else None
+            signature.append((desc_id, parent_id, desc.is_resolved_multifurcation()))
+        return frozenset(signature)
+
+    @staticmethod
+    def create(
+            topology: CellLineageTree,
+            transition_wrappers: Dict[int, List[TransitionWrapper]],
+            Lprob_vals: List[Dict[int, ndarray]],
+            log_scaling_vals: List[Dict[int, float]],
+            dist_to_root_vals: Dict[int, float],
+            id_attr: str = "nochad_id"):
+        """
+        @param topology: the fitted tree
+        @param transition_wrappers: the transition wrappers used to create the likelihood graph of the fitted tree
+        @param Lprob_vals: for each barcode, the evaluated partial likelihoods for each node
+                        (ordered according to the node's transition wrapper, possibly zero-padded at the end)
+        @param log_scaling_vals: for each barcode, the evaluated log scaling term for each internal node
+        @param dist_to_root_vals: the evaluated distance to root for each node
+
+        @return SubtreeLogLikCache with an entry for every internal non-root node in `topology`
+        """
+        cache = SubtreeLogLikCache(id_attr)
+        num_barcodes = len(Lprob_vals)
+        subtree_log_scaling = [dict() for _ in range(num_barcodes)]
+        for node in topology.traverse("postorder"):
+            if node.is_leaf():
+                continue
+            for bcode_idx in range(num_barcodes):
+                subtree_log_scaling[bcode_idx][node.node_id] = log_scaling_vals[bcode_idx][node.node_id] + sum([
+                    subtree_log_scaling[bcode_idx][child.node_id]
+                    for child in node.children if not child.is_leaf()])
+            if node.is_root():
+                continue
+
+            bcode_entries = []
+            for bcode_idx in range(num_barcodes):
+                wrapper = transition_wrappers[node.node_id][bcode_idx]
+                node_Lprob = Lprob_vals[bcode_idx][node.node_id].flatten()
+                bcode_entries.append({
+                    "target_tract_tuples": frozenset(wrapper.target_tract_tuples),
+                    "Lprob": {state: node_Lprob[wrapper.key_dict[state]] for state in wrapper.states},
+                    "sink_Lprob": node_Lprob[wrapper.num_possible_states],
+                    "log_scaling": subtree_log_scaling[bcode_idx][node.node_id]})
+            cache.entries[node.node_id] = {
+                "signature": SubtreeLogLikCache.get_subtree_signature(node),
+                "dist_to_root": dist_to_root_vals[node.node_id],
+                "barcodes": bcode_entries}
+        return cache
+
+    def get_cached_subtrees(
+            self,
+            topology: CellLineageTree,
+            transition_wrappers: Dict[int, List[TransitionWrapper]]):
+        """
+        Finds the maximal subtrees of `topology` that can be plugged in from the cache.
+        A subtree can be reused if it is identical to a subtree in the fitted tree and its root node
+        considers exactly the same set of target tract tuples (and hence the same states) as before
+        for every barcode.
+
+        @return Dict mapping node id in `topology` to a tuple with the partial likelihood vectors for each
+                barcode (ordered according to the node's transition wrapper for that barcode), the total
+                log scaling terms in the subtree for each barcode, and the expected distance to root of the node
+        """
+        cached_subtrees = dict()
+        for node in topology.traverse("preorder"):
+            if node.is_root() or node.is_leaf():
+                continue
+            if any([anc.node_id in cached_subtrees for anc in node.get_ancestors()]):
+                continue
+
+            orig_id = getattr(node, self.id_attr, None)
+            if orig_id is None or orig_id not in self.entries:
+                continue
+            entry = self.entries[orig_id]
+            wrappers = transition_wrappers[node.node_id]
+            if any([
+                    frozenset(wrapper.target_tract_tuples) != bcode_entry["target_tract_tuples"]
+                    for wrapper, bcode_entry in zip(wrappers, entry["barcodes"])]):
+                continue
+            if SubtreeLogLikCache.get_subtree_signature(node, self.id_attr) != entry["signature"]:
+                continue
+
+            Lprobs = []
+            for wrapper, bcode_entry in zip(wrappers, entry["barcodes"]):
+                Lprob = np.zeros((wrapper.num_possible_states + 1, 1))
+                for state in wrapper.states:
+                    Lprob[wrapper.key_dict[state]] = bcode_entry["Lprob"][state]
+                Lprob[wrapper.num_possible_states] = bcode_entry["sink_Lprob"]
+                Lprobs.append(Lprob)
+            cached_subtrees[node.node_id] = (
+                    Lprobs,
+                    [bcode_entry["log_scaling"] for bcode_entry in entry["barcodes"]],
+                    entry["dist_to_root"])
+        return cached_subtrees
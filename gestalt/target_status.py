@@ -5,6 +5,17 @@ from typing import List
 from barcode_metadata import BarcodeMetadata
 from indel_sets import TargetTract, TargetTractTuple
 
+# Maps number of targets to the output of TargetStatus.get_all_transitions
+_ALL_TRANSITIONS_CACHE = dict()
+# Maps bitmasks to TargetStatus so each target status is only constructed once
+_BITMASK_TO_TARGET_STATUS = dict()
+
+def get_deact_bitmask(min_deact_target: int, max_deact_target: int):
+    """
+    @return integer with bits `min_deact_target` to `max_deact_target` (inclusive) set to 1
+    """
+    return ((1 << (max_deact_target + 1)) - 1) & ~((1 << min_deact_target) - 1)
+
 class TargetDeactTract(tuple):
     def __new__(cls, min_deact_target, max_deact_target):
         return tuple.__new__(cls, (min_deact_target, max_deact_target))
@@ -62,11 +73,31 @@ class TargetStatus(tuple):
         for i in range(len(target_deact_tracts) - 1):
             assert target_deact_tracts[i].max_deact_target != target_deact_tracts[i + 1].min_deact_target - 1
 
-        return tuple.__new__(cls, target_deact_tracts)
+        targ_stat = tuple.__new__(cls, target_deact_tracts)
+        # Target statuses are immutable, so compute the bitmask and hash once.
+        # Set operations and equality between target statuses work on the bitmask.
+        # The hash is the tuple hash so that target statuses and equal plain tuples find each other in dicts.
+        bitmask = 0
+        for deact_tract in target_deact_tracts:
+            bitmask |= get_deact_bitmask(deact_tract.min_deact_target, deact_tract.max_deact_target)
+        targ_stat._bitmask = bitmask
+        targ_stat._hash = tuple.__hash__(targ_stat)
+        return targ_stat
 
     def __getnewargs__(self):
         return self
 
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, TargetStatus):
+            return self._bitmask == other._bitmask
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
     def __str__(self):
         return "TargetStatus%s" % super(TargetStatus, self).__str__()
 
@@ -79,7 +110,36 @@ class TargetStatus(tuple):
 
     @property
     def num_deact_targets(self):
-        return len(self.deact_targets)
+        return bin(self.bitmask).count("1")
+
+    @property
+    def bitmask(self):
+        """
+        @return integer where the i-th bit is 1 iff the i-th target is deactivated
+        """
+        return self._bitmask
+
+    @staticmethod
+    def from_bitmask(bitmask: int):
+        """
+        @param bitmask: integer where the i-th bit is 1 iff the i-th target is deactivated
+        @return TargetStatus
+        """
+        if bitmask in _BITMASK_TO_TARGET_STATUS:
+            return _BITMASK_TO_TARGET_STATUS[bitmask]
+
+        deact_tracts = []
+        remaining = bitmask
+        while remaining:
+            # Find the lowest deactivated target and the length of the run of deactivated targets after it
+            start = (remaining & -remaining).bit_length() - 1
+            shifted = remaining >> start
+            run_len = (~shifted & (shifted + 1)).bit_length() - 1
+            deact_tracts.append(TargetDeactTract(start, start + run_len - 1))
+            remaining &= ~get_deact_bitmask(start, start + run_len - 1)
+        targ_stat = TargetStatus(*deact_tracts)
+        _BITMASK_TO_TARGET_STATUS[bitmask] = targ_stat
+        return targ_stat
 
     def merge(self, other_targ_stat):
         """
@@ -90,14 +150,7 @@ class TargetStatus(tuple):
         if len(other_targ_stat) == 0:
             return self
 
-        max_targets = max(other_targ_stat[-1].max_deact_target + 1, self[-1].max_deact_target + 1)
-        binary_status = self.get_binary_status(max_targets)
-        for deact_tract in other_targ_stat:
-            #assert binary_status[deact_tract.min_deact_target] == 0
-            #assert binary_status[deact_tract.max_deact_target] == 0
-            binary_status[deact_tract.min_deact_target: deact_tract.max_deact_target + 1] = 1
-
-        return TargetStatus._binary_status_to_target_status(binary_status.tolist())
+        return TargetStatus.from_bitmask(self._bitmask | other_targ_stat._bitmask)
 
     def add_target_tract(self, target_tract: TargetTract):
         """
@@ -105,18 +158,15 @@ class TargetStatus(tuple):
         the ordering that they are introduced makes no sense)
         @return TargetStatus that results after adding this `target_tract`
         """
-        if len(self) == 0:
-            deact_tract = TargetDeactTract(
-                    target_tract.min_deact_target,
-                    target_tract.max_deact_target)
-            return TargetStatus(deact_tract)
-
-        max_targets = max(target_tract.max_deact_target + 1, self[-1].max_deact_target + 1)
-        binary_status = self.get_binary_status(max_targets)
-        #assert binary_status[target_tract.min_target] == 0
-        #assert binary_status[target_tract.max_target] == 0
-        binary_status[target_tract.min_deact_target: target_tract.max_deact_target + 1] = 1
-        return TargetStatus._binary_status_to_target_status(binary_status.tolist())
+        return TargetStatus.from_bitmask(self._bitmask | get_deact_bitmask(
+                target_tract.min_deact_target,
+                target_tract.max_deact_target))
+
+    def is_contained_in(self, other_targ_stat):
+        """
+        @return whether all the targets deactivated in this target status are also deactivated in `other_targ_stat`
+        """
+        return self._bitmask & ~other_targ_stat._bitmask == 0
 
     def minus(self, orig_targ_stat):
         """
@@ -124,10 +174,10 @@ class TargetStatus(tuple):
         @return the list of targets that were deactivated by this target status,
                 where the `orig_targ_stat` was the original target status.
         """
-        orig_targs = set(orig_targ_stat.deact_targets)
-        self_targs = set(self.deact_targets)
-        if self_targs >= orig_targs:
-            return self_targs - orig_targs
+        orig_bitmask = orig_targ_stat._bitmask
+        self_bitmask = self._bitmask
+        if orig_bitmask & ~self_bitmask == 0:
+            return set(TargetStatus.bitmask_to_targets(self_bitmask & ~orig_bitmask))
         else:
             return set()
 
@@ -135,24 +185,44 @@ class TargetStatus(tuple):
         """
         @return numpy array with 1 where the target is no longer active
         """
-        binary_status = np.zeros(n_targets, dtype=int)
-        for deact_tract in self:
-            binary_status[deact_tract.min_deact_target: deact_tract.max_deact_target + 1] = 1
-        return binary_status
+        return (self.bitmask >> np.arange(n_targets)) & 1
+
+    @staticmethod
+    def get_binary_statuses(target_statuses: List, n_targets: int):
+        """
+        Vectorized version of get_binary_status
+
+        @return numpy array with one row per target status, with 1 where the target is no longer active
+        """
+        bitmasks = np.array([targ_stat.bitmask for targ_stat in target_statuses], dtype=np.int64)
+        return (bitmasks.reshape((-1, 1)) >> np.arange(n_targets)) & 1
+
+    @staticmethod
+    def bitmask_to_targets(bitmask: int):
+        """
+        @return List[int] of the targets whose bits are set in `bitmask`, in increasing order
+        """
+        targets = []
+        idx = 0
+        while bitmask:
+            if bitmask & 1:
+                targets.append(idx)
+            bitmask >>= 1
+            idx += 1
+        return targets
 
     def get_inactive_targets(self, bcode_meta: BarcodeMetadata):
         """
-        @return List[int] of active targets
+        @return List[int] of inactive targets
         """
-        inactive_status = self.get_binary_status(bcode_meta.n_targets)
-        return np.where(inactive_status == 1)[0].tolist()
+        return TargetStatus.bitmask_to_targets(self.bitmask)
 
     def get_active_targets(self, bcode_meta: BarcodeMetadata):
         """
         @return List[int] of active targets
         """
-        inactive_status = self.get_binary_status(bcode_meta.n_targets)
-        return np.where(inactive_status == 0)[0].tolist()
+        all_targets = (1 << bcode_meta.n_targets) - 1
+        return TargetStatus.bitmask_to_targets(all_targets & ~self.bitmask)
 
     def get_possible_target_tracts(self, bcode_meta: BarcodeMetadata, active_any_targs: List[int] = None):
         """
@@ -201,41 +271,42 @@ class TargetStatus(tuple):
         @param binary_status: 1 means inactive, 0 means active in this numpy array
         @return TargetStatus
         """
-        deact_targs = []
-        curr_deact_start_targ = None
+        bitmask = 0
         for idx, val in enumerate(binary_status):
             if val == 1:
-                if curr_deact_start_targ is None:
-                    curr_deact_start_targ = idx
-            else:
-                if curr_deact_start_targ is not None:
-                    deact_targs.append(TargetDeactTract(
-                        curr_deact_start_targ,
-                        idx - 1))
-                    curr_deact_start_targ = None
-        if curr_deact_start_targ is not None:
-            deact_targs.append(TargetDeactTract(
-                curr_deact_start_targ,
-                len(binary_status) - 1))
-        return TargetStatus(*deact_targs)
+                bitmask |= 1 << idx
+        return TargetStatus.from_bitmask(bitmask)
 
     @staticmethod
     def from_target_tract_tuple(target_tract_tuple: TargetTractTuple):
         """
         Create target status from target tract tuple
         """
-        raw_targ_stat = TargetStatus()
+        bitmask = 0
         for tt in target_tract_tuple:
-            raw_targ_stat = raw_targ_stat.add_target_tract(tt)
-        return raw_targ_stat
+            bitmask |= get_deact_bitmask(tt.min_deact_target, tt.max_deact_target)
+        return TargetStatus.from_bitmask(bitmask)
 
     @staticmethod
     def get_all_transitions(bcode_meta: BarcodeMetadata):
         """
+        The transitions only depend on the number of targets in the barcode, so the
+        result is computed once per number of targets and shared by all callers in this process.
+        Callers must not modify the returned dictionaries.
+
         @return tuple of two Dicts:
             1. Dict[start TargetStatus, Dict[end TargetStatus, List[TargetTract] that can be introduced to the start TargetStatus to create the end TargetStatus]
             2. Dict[end TargetStatus, Set[start TargetStatus]]: maps each end target status to all the possible start target statuses (within one step)
         """
+        if bcode_meta.n_targets not in _ALL_TRANSITIONS_CACHE:
+            _ALL_TRANSITIONS_CACHE[bcode_meta.n_targets] = TargetStatus._create_all_transitions(bcode_meta)
+        return _ALL_TRANSITIONS_CACHE[bcode_meta.n_targets]
+
+    @staticmethod
+    def _create_all_transitions(bcode_meta: BarcodeMetadata):
+        """
+        See get_all_transitions
+        """
         target_status_transition_dict = dict()
         target_status_inverse_transition_dict = dict()
         deact_targs = TargetDeactTract(0, bcode_meta.n_targets - 1)
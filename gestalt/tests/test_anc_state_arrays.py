@@ -0,0 +1,121 @@
+import unittest
+
+import numpy as np
+
+from cell_lineage_tree import CellLineageTree
+from allele_events import AlleleEvents, Event
+from barcode_metadata import BarcodeMetadata
+from constants import BARCODE_V7
+from anc_state_arrays import AncStateArrays, SingletonWCUniverse
+import ancestral_events_finder
+
+class AncStateArraysTestCase(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.bcode_meta = BarcodeMetadata(num_barcodes=2)
+        self.num_targets = self.bcode_meta.n_targets
+
+    def _create_event(self, min_target: int, max_target: int, long_left: bool, long_right: bool):
+        """
+        @param long_left: whether the deletion deactivates the target to the left
+        @param long_right: whether the deletion deactivates the target to the right
+        """
+        pos_sites = self.bcode_meta.pos_sites
+        cut_sites = self.bcode_meta.abs_cut_sites
+        start_pos = pos_sites[min_target - 1][1] if long_left else cut_sites[min_target] - 1
+        del_end = pos_sites[max_target + 1][0] + 1 if long_right else cut_sites[max_target] + 1
+        return Event(
+                start_pos = start_pos,
+                del_len = del_end - start_pos,
+                min_target = min_target,
+                max_target = max_target,
+                insert_str = "")
+
+    def _create_rand_allele(self):
+        """
+        @return AlleleEvents with random events drawn from a small set so that leaves share events.
+                Adjacent events can deactivate the same target, which is when `AncState._post_process` matters.
+        """
+        events = []
+        targ = 0
+        while targ < self.num_targets:
+            if np.random.rand() < 0.5:
+                max_targ = min(targ + int(np.random.choice([0, 0, 1, 3])), self.num_targets - 1)
+                long_left = targ > 0 and np.random.rand() < 0.4
+                long_right = max_targ < self.num_targets - 1 and np.random.rand() < 0.3
+                events.append(self._create_event(targ, max_targ, long_left, long_right))
+                targ = max_targ + long_right
+            targ += 1
+        return AlleleEvents(events, num_targets=self.num_targets)
+
+    def _create_rand_tree(self, num_leaves: int):
+        """
+        @return random tree with multifurcations
+        """
+        nodes = [
+            CellLineageTree(allele_events_list=[self._create_rand_allele() for _ in range(self.bcode_meta.num_barcodes)])
+            for _ in range(num_leaves)]
+        while len(nodes) > 1:
+            num_children = min(np.random.choice([2, 2, 3]), len(nodes))
+            child_idxs = np.random.choice(len(nodes), size=num_children, replace=False)
+            parent = CellLineageTree(allele_events_list=[
+                AlleleEvents(num_targets=self.num_targets) for _ in range(self.bcode_meta.num_barcodes)])
+            for idx in child_idxs:
+                parent.add_child(nodes[idx])
+            nodes = [node for idx, node in enumerate(nodes) if idx not in child_idxs] + [parent]
+        tree = nodes[0]
+        tree.label_node_ids()
+        return tree
+
+    def test_matches_anc_states(self):
+        for _ in range(20):
+            tree = self._create_rand_tree(12)
+            anc_state_arrays = AncStateArrays(tree, self.bcode_meta)
+            ancestral_events_finder.annotate_ancestral_states(tree, self.bcode_meta)
+            parsimony_score = ancestral_events_finder.get_parsimony_score(tree)
+            self.assertEqual(anc_state_arrays.parsimony_score, parsimony_score)
+
+            for idx, node in enumerate(anc_state_arrays.nodes):
+                if not node.is_root():
+                    self.assertEqual(anc_state_arrays.branch_scores[idx], node.dist)
+                for bcode_idx, (anc_state, arr_anc_state) in enumerate(zip(
+                        node.anc_state_list,
+                        anc_state_arrays.to_anc_state_list(idx))):
+                    self.assertEqual(anc_state.indel_set_list, arr_anc_state.indel_set_list)
+                    self.assertEqual(
+                            anc_state.to_max_target_status(),
+                            anc_state_arrays.to_max_target_status(idx, bcode_idx))
+
+    def test_reuse_universe(self):
+        tree = self._create_rand_tree(12)
+        universe = AncStateArrays(tree, self.bcode_meta).universe
+
+        # Regraft a leaf and score the new tree with the same leaves
+        leaf = tree.get_leaves()[0]
+        leaf.detach()
+        tree.add_child(leaf)
+        anc_state_arrays = AncStateArrays(tree, self.bcode_meta, universe)
+        self.assertIs(anc_state_arrays.universe, universe)
+        ancestral_events_finder.annotate_ancestral_states(tree, self.bcode_meta)
+        self.assertEqual(anc_state_arrays.parsimony_score, ancestral_events_finder.get_parsimony_score(tree))
+
+    def test_calculate_parsimony_score(self):
+        tree = self._create_rand_tree(12)
+        ancestral_events_finder.annotate_ancestral_states(tree, self.bcode_meta)
+        parsimony_score = ancestral_events_finder.get_parsimony_score(tree)
+        self.assertEqual(ancestral_events_finder.calculate_parsimony_score(tree, self.bcode_meta), parsimony_score)
+        # The ancestral states from before are cleared since the topology may have changed
+        for node in tree.traverse():
+            self.assertIsNone(node.anc_state_list)
+            self.assertIsNone(node.anc_state_list_str)
+
+    def test_too_many_targets(self):
+        # Add three more targets
+        self.bcode_meta = BarcodeMetadata(
+                unedited_barcode=BARCODE_V7[:-1] + BARCODE_V7[1:7] + BARCODE_V7[-1:])
+        self.num_targets = self.bcode_meta.n_targets
+        self.assertFalse(SingletonWCUniverse.is_supported(self.bcode_meta))
+        tree = self._create_rand_tree(12)
+        parsimony_score = ancestral_events_finder.calculate_parsimony_score(tree, self.bcode_meta)
+        ancestral_events_finder.annotate_ancestral_states(tree, self.bcode_meta)
+        self.assertEqual(parsimony_score, ancestral_events_finder.get_parsimony_score(tree))
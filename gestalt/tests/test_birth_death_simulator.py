@@ -24,49 +24,56 @@ class BirthDeathSimulatorTestCase(unittest.TestCase):
         farthest_node, farthest_dist = tree.get_farthest_node()
         self.assertTrue(np.isclose(farthest_dist, simulation_time))
 
-    def test_process_birth(self):
+    def test_create_tree_nodes(self):
         tree = self.birth_death_simulator.simulate(
                 AlleleList([], BarcodeMetadata()),
                 0)
-        leaf = tree.get_leaves()[0]
-        self.birth_death_simulator._process_cell_birth(
-            leaf,
-            branch_length=1,
-            branch_end_allele_list=AlleleList([], BarcodeMetadata()),
-            remain_time=0.5)
-        children = leaf.get_children()
+        self.assertTrue(tree.is_leaf())
+        # A cell division followed by an observed cell and a dead cell
+        self.birth_death_simulator._create_tree_nodes(
+            tree,
+            parent_idxs=np.array([-1, 0, 0]),
+            branch_lens=np.array([1, 0.5, 0.2]),
+            is_dead=np.array([False, False, True]))
+        children = tree.get_children()
         self.assertEqual(len(children), 1)
-        for c in children:
-            self.assertEqual(len(c.children), 2)
-            self.assertEqual(c.dist, 1)
-            self.assertEqual(c.dead, False)
+        self.assertEqual(children[0].dist, 1)
+        self.assertEqual(children[0].dead, False)
+        self.assertEqual(
+            [(c.dist, c.dead) for c in children[0].get_children()],
+            [(0.5, False), (0.2, True)])
+        for node in tree.traverse():
+            self.assertTrue(node.allele_list is tree.allele_list)
 
-    def test_process_end(self):
+    def test_simulate_tree_sync(self):
+        # The synchronous cell divisions all happen at the same time and the alive cells are observed at the end
         tree = self.birth_death_simulator.simulate(
                 AlleleList([], BarcodeMetadata()),
-                0)
-        leaf = tree.get_leaves()[0]
-        self.birth_death_simulator._process_observe_end(
-            leaf,
-            branch_length=1,
-            branch_end_allele_list=AlleleList([], BarcodeMetadata()))
-        children = leaf.get_children()
-        self.assertEqual(len(children), 1)
-        for c in children:
-            self.assertEqual(c.dist, 1)
-            self.assertEqual(c.dead, False)
+                2.5)
+        self.assertEqual(len(tree.get_children()), 1)
+        self.assertEqual(tree.get_children()[0].dist, 1)
+        leaves = tree.get_leaves()
+        self.assertEqual(len(leaves), 4)
+        for leaf in leaves:
+            self.assertEqual(leaf.dist, 0.5)
+            self.assertEqual(leaf.dead, False)
+            self.assertTrue(np.isclose(leaf.get_distance(tree), 2.5))
 
-    def test_process_death(self):
+    def test_simulated_tree_structure(self):
+        # All alive leaves are observed at the end of the simulation and all internal nodes
+        # (except the root) are cell divisions
+        simulation_time = 7
+        np.random.seed(1)
         tree = self.birth_death_simulator.simulate(
                 AlleleList([], BarcodeMetadata()),
-                0)
-        leaf = tree.get_leaves()[0]
-        self.birth_death_simulator._process_cell_death(
-            leaf,
-            branch_length=1,
-            branch_end_allele_list=AlleleList([], BarcodeMetadata()))
-        children = leaf.get_children()
-        self.assertEqual(len(children), 1)
-        for c in children:
-            self.assertEqual(c.dist, 1)
-            self.assertEqual(c.dead, True)
+                simulation_time,
+                max_leaves=1000)
+        self.assertEqual(len(tree.get_children()), 1)
+        for node in tree.get_descendants():
+            if node.is_leaf():
+                if not node.dead:
+                    self.assertTrue(np.isclose(node.get_distance(tree), simulation_time))
+                else:
+                    self.assertTrue(node.get_distance(tree) < simulation_time)
+            else:
+                self.assertEqual(len(node.get_children()), 2)
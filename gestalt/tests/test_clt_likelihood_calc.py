@@ -567,3 +567,90 @@ class LikelihoodCalculationTestCase(unittest.TestCase):
 
         # Check the two are equal
         self.assertTrue(np.isclose(log_lik[0], manual_log_prob))
+
+    def _create_subtree_cache_topology(self, add_new_leaf: bool):
+        """
+        @param add_new_leaf: whether to attach a new leaf to the root (i.e. a regraft)
+        @return tree where every node has a `nochad_id`, except the new leaf
+        """
+        event2 = Event(
+                start_pos = 6,
+                del_len = 3,
+                min_target = 0,
+                max_target = 0,
+                insert_str = "")
+        event3 = Event(
+                start_pos = 6,
+                del_len = 10,
+                min_target = 0,
+                max_target = 0,
+                insert_str = "")
+        event_new = Event(
+                start_pos = 16,
+                del_len = 3,
+                min_target = 1,
+                max_target = 1,
+                insert_str = "")
+        topology = CellLineageTree(allele_events_list = [AlleleEvents(num_targets=self.num_targets)])
+        topology_ext1 = CellLineageTree(allele_events_list = [AlleleEvents(num_targets=self.num_targets)])
+        topology.add_child(topology_ext1)
+        topology_ext2 = CellLineageTree(allele_events_list = [AlleleEvents([event2], num_targets=self.num_targets)])
+        topology_ext1.add_child(topology_ext2)
+        child1 = CellLineageTree(allele_events_list=[AlleleEvents([event2], num_targets=self.num_targets)])
+        topology_ext1.add_child(child1)
+        child2 = CellLineageTree(allele_events_list=[AlleleEvents([event2], num_targets=self.num_targets)])
+        topology_ext2.add_child(child2)
+        child3 = CellLineageTree(allele_events_list=[AlleleEvents([event2, event_new], num_targets=self.num_targets)])
+        topology_ext2.add_child(child3)
+        child4 = CellLineageTree(allele_events_list=[AlleleEvents([event3], num_targets=self.num_targets)])
+        topology.add_child(child4)
+        topology.label_node_ids()
+        for node in topology.traverse():
+            node.add_feature("nochad_id", node.node_id)
+
+        if add_new_leaf:
+            new_leaf = CellLineageTree(allele_events_list=[AlleleEvents([event_new], num_targets=self.num_targets)])
+            topology.add_child(new_leaf)
+            new_leaf.add_feature("node_id", topology.get_num_nodes() - 1)
+            new_leaf.add_feature("nochad_id", None)
+        return topology
+
+    def test_subtree_log_lik_cache(self):
+        """
+        Check that plugging in the partial likelihoods of unchanged subtrees from a previous fit
+        gives the same log likelihood as recomputing everything
+        """
+        target_lams = np.ones(self.num_targets) + np.random.uniform(size=self.num_targets) * 0.1
+        base_tree = self._create_subtree_cache_topology(add_new_leaf=False)
+        base_model = self._create_bifurc_model(
+                base_tree,
+                self.bcode_metadata,
+                branch_len=0,
+                branch_lens=[1, 1, 2, 2, 2, 3],
+                target_lams=target_lams)
+        base_model.create_log_lik(
+                TransitionWrapperMaker(base_tree, self.bcode_metadata).create_transition_wrappers(),
+                create_gradient=False)
+        subtree_cache = base_model.get_subtree_log_lik_cache()
+        # Only the two internal non-root nodes are cached
+        self.assertEqual(len(subtree_cache), 2)
+
+        log_liks = []
+        for use_cache in [False, True]:
+            new_tree = self._create_subtree_cache_topology(add_new_leaf=True)
+            new_model = self._create_bifurc_model(
+                    new_tree,
+                    self.bcode_metadata,
+                    branch_len=0,
+                    branch_lens=[1, 1, 2, 2, 2, 3, 3],
+                    target_lams=target_lams)
+            new_model.create_log_lik(
+                    TransitionWrapperMaker(new_tree, self.bcode_metadata).create_transition_wrappers(),
+                    create_gradient=False,
+                    subtree_cache=subtree_cache if use_cache else None)
+            if use_cache:
+                self.assertTrue(len(new_model.cached_dist_to_root) > 0)
+                self.assertTrue(new_model.is_subtree_cache_consistent())
+            log_lik, _ = new_model.get_log_lik()
+            log_liks.append(log_lik)
+        self.assertTrue(np.isclose(log_liks[0], log_liks[1]))
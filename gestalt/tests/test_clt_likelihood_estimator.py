@@ -0,0 +1,135 @@
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from allele_events import AlleleEvents, Event
+from clt_likelihood_model import CLTLikelihoodModel
+from clt_likelihood_estimator import CLTPenalizedEstimator, OPTIMIZERS
+from cell_lineage_tree import CellLineageTree
+from barcode_metadata import BarcodeMetadata
+from transition_wrapper_maker import TransitionWrapperMaker
+from optim_settings import KnownModelParams
+
+class NanAfterItersSession:
+    """
+    Wraps a session so that the penalized log likelihood fetched along with
+    each adam step is nan after `num_iters` steps
+    """
+    def __init__(self, sess, model: CLTLikelihoodModel, num_iters: int):
+        self.sess = sess
+        self.model = model
+        self.num_iters = num_iters
+        self.num_steps = 0
+
+    def run(self, fetches, feed_dict=None):
+        res = self.sess.run(fetches, feed_dict=feed_dict)
+        if isinstance(fetches, list) and fetches[0] is self.model.adam_train_op:
+            self.num_steps += 1
+            if self.num_steps > self.num_iters:
+                res[1] = res[1] * np.nan
+        return res
+
+class CLTPenalizedEstimatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bcode_metadata = BarcodeMetadata(
+            unedited_barcode = ("AA", "ATCGATCG", "ACTG", "ATCGATCG", "ACTG", "TGACTAGC", "TT"),
+            cut_site = 3,
+            crucial_pos_len = [3,3])
+        self.num_targets = self.bcode_metadata.n_targets
+        self.known_params = KnownModelParams(tot_time=True)
+
+        # Root with three leaves, two of which share an event
+        event0 = Event(
+                start_pos = 6,
+                del_len = 3,
+                min_target = 0,
+                max_target = 0,
+                insert_str = "")
+        event1 = Event(
+                start_pos = 24,
+                del_len = 2,
+                min_target = 1,
+                max_target = 1,
+                insert_str = "A")
+        self.topology = CellLineageTree(allele_events_list = [AlleleEvents(num_targets=self.num_targets)])
+        child = CellLineageTree(allele_events_list = [AlleleEvents([event0], num_targets=self.num_targets)])
+        self.topology.add_child(child)
+        for events in [[event0], [event0, event1]]:
+            child.add_child(CellLineageTree(
+                allele_events_list = [AlleleEvents(events, num_targets=self.num_targets)]))
+        self.topology.add_child(CellLineageTree(
+            allele_events_list = [AlleleEvents([event1], num_targets=self.num_targets)]))
+        self.topology.label_node_ids()
+
+    def _fit(self, optimizer, max_iters=100, nan_after_iters=None, save_iter=40):
+        """
+        @param nan_after_iters: if not None, pretend the penalized log likelihood becomes nan after this many adam steps
+        """
+        with tf.Graph().as_default():
+            with tf.Session() as sess:
+                model = CLTLikelihoodModel(
+                        self.topology,
+                        self.bcode_metadata,
+                        sess,
+                        known_params = self.known_params,
+                        target_lams = np.ones(self.num_targets),
+                        trim_long_factor = 0.1 * np.ones(2),
+                        trim_zero_probs = 0.5 * np.ones(4),
+                        trim_short_params = np.ones(2),
+                        trim_long_params = np.ones(2),
+                        insert_zero_prob = np.array([0.5]),
+                        insert_params = np.array([2]),
+                        double_cut_weight = np.array([0.3]),
+                        tot_time = 1)
+                estimator = CLTPenalizedEstimator(
+                        model,
+                        TransitionWrapperMaker(self.topology, self.bcode_metadata),
+                        max_iters)
+                model.initialize_branch_lens(1)
+                if nan_after_iters is not None:
+                    model.sess = NanAfterItersSession(sess, model, nan_after_iters)
+                train_history = estimator.fit(
+                        branch_pen_param = 1,
+                        target_lam_pen_param = 1,
+                        conv_thres = 1e-8,
+                        save_iter = save_iter,
+                        optimizer = optimizer)
+                # The last entry of the train history is at the final model parameters
+                final_pen_log_lik = sess.run(model.smooth_log_lik, feed_dict={
+                    model.branch_pen_param_ph: 1,
+                    model.crazy_pen_param_ph: 0.001,
+                    model.target_lam_pen_param_ph: 1})
+                self.assertTrue(np.isclose(train_history[-1]["pen_log_lik"], final_pen_log_lik))
+                self.assertTrue(np.allclose(
+                    train_history[-1]["var_dict"]["branch_len_inners"],
+                    model.get_vars_as_dict()["branch_len_inners"]))
+                return train_history
+
+    def test_optimizers(self):
+        pen_log_liks = {}
+        for optimizer in OPTIMIZERS:
+            train_history = self._fit(optimizer)
+            self.assertTrue(train_history[-1]["pen_log_lik"] > train_history[0]["pen_log_lik"])
+            pen_log_liks[optimizer] = train_history[-1]["pen_log_lik"][0]
+            if optimizer != "adam":
+                # Every iterate improves on the previous one by more than the relative convergence threshold,
+                # except possibly the last one
+                rel_changes = [
+                    (curr["pen_log_lik"][0] - prev["pen_log_lik"][0])/max(
+                        np.abs(prev["pen_log_lik"][0]), np.abs(curr["pen_log_lik"][0]), 1)
+                    for prev, curr in zip(train_history[:-2], train_history[1:-1])]
+                self.assertTrue(np.all(np.array(rel_changes) > 1e-8))
+
+        # The second-order methods should reach at least as good a solution in the same number of iterations
+        for optimizer in OPTIMIZERS:
+            self.assertTrue(pen_log_liks[optimizer] > pen_log_liks["adam"] - 1e-6)
+
+    def test_adam_nan(self):
+        # The fit stops at the last finite iterate and the model parameters match the last entry of the history
+        # The parameters are only snapshotted every `save_iter` iterations, so check going back to a snapshot
+        # before the last iteration and before the one prior to that
+        for nan_after_iters, save_iter in [(5, 40), (5, 3), (6, 3), (0, 3)]:
+            train_history = self._fit("adam", nan_after_iters=nan_after_iters, save_iter=save_iter)
+            self.assertEqual(len(train_history), nan_after_iters + 1)
+            self.assertTrue(np.all([np.isfinite(iter_info["pen_log_lik"][0]) for iter_info in train_history]))
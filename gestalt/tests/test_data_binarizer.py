@@ -0,0 +1,59 @@
+import unittest
+
+import numpy as np
+
+from allele_events import Event
+from barcode_metadata import BarcodeMetadata
+import data_binarizer
+
+class DataBinarizerTestCase(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.bcode_meta = BarcodeMetadata(num_barcodes=2)
+        self.num_targets = self.bcode_meta.n_targets
+
+    def _create_rand_events(self):
+        """
+        @return list of non-overlapping events on one barcode
+        """
+        cut_sites = self.bcode_meta.abs_cut_sites
+        events = []
+        targ = 0
+        while targ < self.num_targets:
+            if np.random.rand() < 0.4:
+                max_targ = min(targ + int(np.random.choice([0, 0, 2, 4])), self.num_targets - 1)
+                start_pos = cut_sites[targ] - np.random.randint(1, 3)
+                events.append(Event(
+                    start_pos = start_pos,
+                    del_len = cut_sites[max_targ] + 1 - start_pos,
+                    min_target = targ,
+                    max_target = max_targ,
+                    insert_str = ""))
+                targ = max_targ
+            targ += 1
+        return events
+
+    def test_event_matrix(self):
+        processed_seqs = {
+            "seq%d" % idx: [1, [self._create_rand_events() for _ in range(self.bcode_meta.num_barcodes)], None]
+            for idx in range(30)}
+        all_events = [
+                set([evt for seq_data in processed_seqs.values() for evt in seq_data[1][bcode_idx]])
+                for bcode_idx in range(self.bcode_meta.num_barcodes)]
+        event_list = [(bcode_idx, evt) for bcode_idx, evts in enumerate(all_events) for evt in evts]
+        event_dicts = [
+                {evt: evt_idx for evt_idx, (evt_bcode_idx, evt) in enumerate(event_list) if evt_bcode_idx == bcode_idx}
+                for bcode_idx in range(self.bcode_meta.num_barcodes)]
+
+        seq_ids, has_events, hidden_events = data_binarizer.get_event_matrix(processed_seqs, event_dicts)
+        self.assertTrue(np.any(hidden_events))
+        for seq_idx, seq_id in enumerate(seq_ids):
+            seq_events = processed_seqs[seq_id][1]
+            for evt_idx, (bcode_idx, evt) in enumerate(event_list):
+                self.assertEqual(has_events[seq_idx, evt_idx], evt in seq_events[bcode_idx])
+                self.assertEqual(
+                        hidden_events[seq_idx, evt_idx],
+                        any([seq_evt.hides(evt) for seq_evt in seq_events[bcode_idx]]))
+
+        _, _, no_hidden_events = data_binarizer.get_event_matrix(processed_seqs, event_dicts, encode_hidden=False)
+        self.assertFalse(np.any(no_hidden_events))
@@ -0,0 +1,99 @@
+import unittest
+
+import numpy as np
+
+from likelihood_scorer import LikelihoodScorerResult
+from parallel_worker import ActorPool
+import hanging_chad_finder
+
+
+class StubScorer:
+    """
+    Pretends to fit a model whose penalized log likelihood after t iterations is `pen_log_lik_func(t)`
+    """
+    def __init__(self, pen_log_lik_func, fail_at_iter: int = None):
+        self.pen_log_lik_func = pen_log_lik_func
+        self.fail_at_iter = fail_at_iter
+        self.num_iters_done = None
+        self.rung_iters = []
+        self.is_closed = False
+
+    def start_fit(self):
+        self.num_iters_done = 0
+        self.train_history = [self._get_iter_info(-1)]
+
+    def _get_iter_info(self, i):
+        pen_log_lik = np.array([self.pen_log_lik_func(i + 1)])
+        return {"iter": i, "pen_log_lik": pen_log_lik, "log_lik": pen_log_lik}
+
+    def continue_fit(self, num_iters: int):
+        if self.fail_at_iter is not None and self.num_iters_done + num_iters > self.fail_at_iter:
+            raise ValueError("stub failure")
+        for i in range(num_iters):
+            self.num_iters_done += 1
+            self.train_history.append(self._get_iter_info(self.num_iters_done - 1))
+        self.rung_iters.append(num_iters)
+        return LikelihoodScorerResult(
+            {"branch_pen_param": 0, "target_lam_pen_param": 0},
+            {},
+            None,
+            None,
+            list(self.train_history))
+
+    def close_fit(self):
+        self.is_closed = True
+
+
+class HangingChadFinderTestCase(unittest.TestCase):
+    def test_race_survivors(self):
+        scores = {0: -100, 1: -150, 2: -150, 3: -150, 4: -101}
+        rung_pen_log_liks = {
+            # The leader
+            0: [-110, -105, -100],
+            # Far behind and barely improving
+            1: [-151, -150.5, -150],
+            # Far behind but improving fast enough to catch up
+            2: [-190, -170, -150],
+            # Far behind, not improving on average, but noisy
+            3: [-150, -130, -150],
+            # Only slightly behind but not improving
+            4: [-101, -101, -101],
+        }
+        self.assertEqual(
+            hanging_chad_finder.get_race_survivors(scores, rung_pen_log_liks, remaining_iters=10, noise_z=2),
+            [0, 2, 3])
+        # The noisy one drops out if we ask for less slack
+        self.assertEqual(
+            hanging_chad_finder.get_race_survivors(scores, rung_pen_log_liks, remaining_iters=10, noise_z=0.1),
+            [0, 2])
+        # Nobody can catch up without iterations left
+        self.assertEqual(
+            hanging_chad_finder.get_race_survivors(scores, rung_pen_log_liks, remaining_iters=0),
+            [0])
+
+    def test_race_scorers(self):
+        scorers = [
+            # Converges to -100, so it falls behind for good in the third rung
+            StubScorer(lambda t: -100 - 50 * np.exp(-t/5.)),
+            # Stuck far behind
+            StubScorer(lambda t: -300 + 0.01 * t),
+            # Slow start but ends up the best
+            StubScorer(lambda t: -200 + 10 * t),
+            # Fails in the second rung
+            StubScorer(lambda t: -100 - 50 * np.exp(-t/5.), fail_at_iter=8),
+        ]
+        actor_pool = ActorPool(1, None)
+        keep_idxs, results = hanging_chad_finder.race_scorers(scorers, max_iters=20, rung_iters=5, actor_pool=actor_pool)
+        actor_pool.close()
+
+        self.assertEqual(keep_idxs, [2])
+        self.assertEqual(scorers[0].rung_iters, [5, 5, 5])
+        self.assertEqual(scorers[1].rung_iters, [5])
+        self.assertEqual(scorers[3].rung_iters, [5])
+        # The survivor keeps going with the same fit until it has used up the budget
+        self.assertEqual(scorers[2].rung_iters, [5, 5, 5, 5])
+        for scorer in scorers:
+            self.assertTrue(scorer.is_closed)
+        for idx, res in zip(keep_idxs, results):
+            self.assertEqual(len(res.train_history), 21)
+            self.assertEqual(res.pen_log_lik[0], scorers[idx].pen_log_lik_func(20))
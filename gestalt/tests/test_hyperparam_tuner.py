@@ -0,0 +1,34 @@
+import unittest
+
+from hyperparam_tuner import _get_grid_warm_starts, _get_grid_path
+
+class HyperparamTunerTestCase(unittest.TestCase):
+    def _is_neighbor(self, idx, other_idx, grid_shape):
+        i, j = divmod(idx, grid_shape[1])
+        other_i, other_j = divmod(other_idx, grid_shape[1])
+        return idx != other_idx and abs(i - other_i) <= 1 and abs(j - other_j) <= 1
+
+    def test_grid_warm_starts(self):
+        for grid_shape in [(1, 1), (1, 4), (3, 1), (5, 5), (4, 6)]:
+            waves = _get_grid_warm_starts(grid_shape)
+            self.assertEqual(len(waves), (max(grid_shape) + 2) // 2)
+            self.assertEqual(waves[0], [((grid_shape[0] - 1) // 2 * grid_shape[1] + (grid_shape[1] - 1) // 2, None)])
+
+            finished_idxs = set()
+            for wave in waves:
+                for idx, warm_idx in wave:
+                    if warm_idx is None:
+                        continue
+                    # Warm start from a neighbor that was fit in an earlier wave
+                    self.assertIn(warm_idx, finished_idxs)
+                    self.assertTrue(self._is_neighbor(idx, warm_idx, grid_shape))
+                finished_idxs.update([idx for idx, _ in wave])
+            self.assertEqual(finished_idxs, set(range(grid_shape[0] * grid_shape[1])))
+
+    def test_grid_path(self):
+        for grid_shape in [(1, 1), (1, 4), (3, 1), (5, 5), (4, 6)]:
+            grid_path = _get_grid_path(grid_shape)
+            self.assertEqual(sorted(grid_path), list(range(grid_shape[0] * grid_shape[1])))
+            self.assertEqual(grid_path[0], 0)
+            for idx, next_idx in zip(grid_path[:-1], grid_path[1:]):
+                self.assertTrue(self._is_neighbor(idx, next_idx, grid_shape))
@@ -0,0 +1,85 @@
+import unittest
+
+import numpy as np
+
+from parsimony_search import CaminSokalTree, REARRANGEMENTS, get_leaf_bitsets, build_stepwise_tree
+import parsimony_search
+
+class ParsimonySearchTestCase(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+
+    def _create_rand_encodings(self, num_leaves: int, num_events: int):
+        return ["".join(np.random.choice(list("0001?"), num_events)) for _ in range(num_leaves)]
+
+    def _get_all_trees(self, encodings):
+        """
+        @return all rooted bifurcating trees over the leaves
+        """
+        leaf_oks, leaf_has_ones = get_leaf_bitsets(encodings)
+        tree = CaminSokalTree(leaf_oks, leaf_has_ones)
+        trees = [tree]
+        for leaf in range(1, len(encodings)):
+            new_trees = []
+            for tree in trees:
+                for attach_node in tree.get_preorder(tree.root):
+                    new_tree = tree.copy()
+                    new_tree.regraft(leaf, tree.num_leaves + leaf - 1, attach_node)
+                    new_trees.append(new_tree)
+            trees = new_trees
+        return trees
+
+    def test_packed_bitsets(self):
+        for num_events in [0, 1, 8, 13, 70]:
+            encodings = self._create_rand_encodings(5, num_events)
+            event_matrix = np.array(
+                    [[c == "1" for c in encoding] for encoding in encodings],
+                    dtype=bool).reshape((5, num_events))
+            self.assertEqual(
+                    parsimony_search.get_packed_bitsets(event_matrix),
+                    get_leaf_bitsets(encodings)[1])
+
+    def test_regraft_scores(self):
+        for _ in range(20):
+            encodings = self._create_rand_encodings(8, 12)
+            tree = build_stepwise_tree(*get_leaf_bitsets(encodings), np.random.permutation(len(encodings)))
+            score = tree.get_score()
+            states = tree.get_states()
+            self.assertEqual(score, sum([
+                bin(states[node] & ~states[tree.parents[node]]).count("1")
+                for node in range(tree.num_nodes) if node != tree.root]))
+
+            for node in range(tree.num_nodes):
+                if node == tree.root:
+                    continue
+                free_node, sibling = tree.prune(node)
+                pruned_score = tree.get_score()
+                subtree_score = tree.get_subtree_score(node)
+                for delta, attach_node in tree.get_regraft_deltas(node):
+                    new_tree = tree.copy()
+                    new_tree.regraft(node, free_node, attach_node)
+                    self.assertEqual(new_tree.get_score(), pruned_score + subtree_score + delta)
+                for reroot_score, reroot_node in tree.get_reroot_scores(node):
+                    new_tree = tree.copy()
+                    if reroot_node is not None:
+                        new_tree.reroot(node, reroot_node)
+                    self.assertEqual(new_tree.get_subtree_score(node), reroot_score)
+                tree.regraft(node, free_node, sibling)
+                self.assertEqual(tree.get_score(), score)
+
+    def test_search(self):
+        for _ in range(5):
+            encodings = self._create_rand_encodings(6, 10)
+            all_scores = [tree.get_score() for tree in self._get_all_trees(encodings)]
+            best_score = min(all_scores)
+            for rearrangement in REARRANGEMENTS:
+                score, trees = parsimony_search.search_parsimony_trees(
+                        *get_leaf_bitsets(encodings),
+                        seeds=[0, 1],
+                        rearrangement=rearrangement,
+                        max_trees=20)
+                self.assertEqual(score, best_score)
+                self.assertEqual(len(trees), min(20, all_scores.count(best_score)))
+                self.assertEqual(len(set([tree.get_clade_key() for tree in trees])), len(trees))
+                for tree in trees:
+                    self.assertEqual(tree.get_score(), best_score)
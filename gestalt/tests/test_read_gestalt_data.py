@@ -0,0 +1,112 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from barcode_metadata import BarcodeMetadata
+from constants import CONTROL_ORGANS, NUM_BARCODE_V6_TARGETS
+import read_gestalt_data
+from read_gestalt_data import process_events_format7B
+
+class ReadGestaltDataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bcode_meta = BarcodeMetadata()
+        self.scratch_dir = tempfile.mkdtemp()
+        self.target_hdrs = ["target%d" % (i + 1) for i in range(NUM_BARCODE_V6_TARGETS)]
+        no_evts = ["NONE"] * NUM_BARCODE_V6_TARGETS
+        # Two target strings that clean up to the same events
+        self.allele_a = ["5D+16"] + no_evts[1:]
+        self.allele_a_unknown = ["5D+16", "UNKNOWN"] + no_evts[2:]
+        # An inter-target deletion shows up under both targets
+        self.allele_b = ["NONE", "35D+40", "35D+40"] + no_evts[3:]
+        # Rows of organ, target strings, and count. The count is only used by the GSE17 format.
+        self.reads = [
+            ("brain", self.allele_a, 2),
+            ("brain", self.allele_a, 3),
+            ("heart", self.allele_a, 1),
+            (CONTROL_ORGANS[0], self.allele_a, 4),
+            ("brain", self.allele_b, 1),
+            ("brain", self.allele_a_unknown, 6),
+            ("heart", self.allele_b, 2),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir)
+
+    def _write_table(self, file_name, header, rows):
+        file_name = os.path.join(self.scratch_dir, file_name)
+        with open(file_name, "w") as f:
+            for row in [header] + rows:
+                f.write("\t".join(row) + "\n")
+        return file_name
+
+    def _get_expected(self, reads, use_counts: bool, single_state: bool = False):
+        """
+        @return dict mapping (organ, events) to abundance
+        """
+        expected = dict()
+        for organ, target_strs, count in reads:
+            if organ in CONTROL_ORGANS:
+                continue
+            key = (
+                "single_state" if single_state else organ,
+                tuple(process_events_format7B(target_strs, self.bcode_meta, 0)))
+            expected[key] = expected.get(key, 0) + (count if use_counts else 1)
+        return expected
+
+    def _get_parsed(self, obs_list, organ_dict):
+        parsed = dict()
+        for obs in obs_list:
+            key = (organ_dict[str(obs.cell_state)], tuple(obs.allele_events_list[0].events))
+            self.assertNotIn(key, parsed)
+            parsed[key] = obs.abundance
+        return parsed
+
+    def _check_parser(self, file_name, parse_func, reads, use_counts: bool, single_state: bool = False):
+        for max_read in [None, 5, 2]:
+            obs_list, organ_dict = parse_func(file_name, self.bcode_meta, 0, max_read=max_read)
+            self.assertEqual(
+                self._get_parsed(obs_list, organ_dict),
+                self._get_expected(reads[:max_read], use_counts, single_state))
+
+    def test_format7B(self):
+        file_name = self._write_table(
+            "7B.txt",
+            ["organ", "umi"] + self.target_hdrs,
+            [[organ, "umi%d" % i] + target_strs for i, (organ, target_strs, _) in enumerate(self.reads)])
+        obs_list, organ_dict = read_gestalt_data.parse_reads_file_format7B(file_name, self.bcode_meta, 0)
+        # The two target strings for allele a are merged into one observation per organ
+        self.assertEqual(len(obs_list), 4)
+        self.assertEqual(
+            self._get_parsed(obs_list, organ_dict)[("brain", tuple(process_events_format7B(self.allele_a, self.bcode_meta, 0)))],
+            3)
+        self._check_parser(file_name, read_gestalt_data.parse_reads_file_format7B, self.reads, use_counts=False)
+
+    def test_format_GSE17(self):
+        file_name = self._write_table(
+            "GSE17.txt",
+            ["id", "organ", "count", "targets"],
+            [
+                ["read%d" % i, "17_" + organ, str(count), "_".join(target_strs)]
+                for i, (organ, target_strs, count) in enumerate(self.reads)])
+        obs_list, organ_dict = read_gestalt_data.parse_reads_file_format_GSE17(file_name, self.bcode_meta, 0)
+        self.assertEqual(
+            self._get_parsed(obs_list, organ_dict)[("brain", tuple(process_events_format7B(self.allele_a, self.bcode_meta, 0)))],
+            11)
+        self._check_parser(file_name, read_gestalt_data.parse_reads_file_format_GSE17, self.reads, use_counts=True)
+
+    def test_format_GSM(self):
+        # The GSM format has no organs, it filters on the second column instead
+        reads = [r for r in self.reads if r[0] not in CONTROL_ORGANS]
+        rows = [["umi%d" % i, "PASS"] + target_strs for i, (_, target_strs, _) in enumerate(reads)]
+        rows.insert(3, ["umi_fail", "FAIL"] + self.allele_b)
+        reads.insert(3, (CONTROL_ORGANS[0], self.allele_b, 1))
+        file_name = self._write_table("GSM.txt", ["umi", "status"] + self.target_hdrs, rows)
+        obs_list, organ_dict = read_gestalt_data.parse_reads_file_format_GSM(file_name, self.bcode_meta, 0)
+        self.assertEqual(len(obs_list), 2)
+        self._check_parser(
+            file_name,
+            read_gestalt_data.parse_reads_file_format_GSM,
+            reads,
+            use_counts=False,
+            single_state=True)
@@ -1,4 +1,5 @@
 import unittest
+import six
 
 from barcode_metadata import BarcodeMetadata
 from target_status import TargetStatus, TargetDeactTract
@@ -125,3 +126,40 @@ class CollapsedTreeTestCase(unittest.TestCase):
         self.assertEqual(
                 set(all_transitions[TargetStatus(TargetDeactTract(1,1))][TargetStatus(TargetDeactTract(0,2))]),
                 set([TargetTract(0,0,2,2)]))
+
+    def test_bitmask(self):
+        deact_tracts = [
+                TargetDeactTract(0,1),
+                TargetDeactTract(3,3),
+                TargetDeactTract(5,7)]
+        targ_stat = TargetStatus(*deact_tracts)
+        self.assertEqual(targ_stat.bitmask, 0b11101011)
+        self.assertEqual(TargetStatus.from_bitmask(targ_stat.bitmask), targ_stat)
+        self.assertEqual(TargetStatus.from_bitmask(0), TargetStatus())
+        self.assertEqual(targ_stat.num_deact_targets, 6)
+
+        self.assertTrue(TargetStatus(TargetDeactTract(5,6)).is_contained_in(targ_stat))
+        self.assertFalse(TargetStatus(TargetDeactTract(2,3)).is_contained_in(targ_stat))
+
+        binary_statuses = TargetStatus.get_binary_statuses([targ_stat, TargetStatus()], 10)
+        self.assertEqual(binary_statuses.shape, (2, 10))
+        self.assertEqual(binary_statuses[0].tolist(), targ_stat.get_binary_status(10).tolist())
+        self.assertEqual(binary_statuses[0].tolist(), [1,1,0,1,0,1,1,1,0,0])
+        self.assertEqual(binary_statuses[1].tolist(), [0] * 10)
+
+        # Hashing and equality go through the bitmask, including for copies and pickles
+        targ_stat_copy = six.moves.cPickle.loads(six.moves.cPickle.dumps(targ_stat, protocol=2))
+        self.assertEqual(targ_stat_copy.bitmask, targ_stat.bitmask)
+        self.assertEqual(targ_stat_copy, targ_stat)
+        self.assertEqual(hash(targ_stat_copy), hash(targ_stat))
+        self.assertNotEqual(TargetStatus(TargetDeactTract(5,6)), targ_stat)
+        self.assertEqual(len(set([targ_stat, targ_stat_copy, TargetStatus(*deact_tracts)])), 1)
+
+        # Target statuses and equal plain tuples are interchangeable as dict keys
+        targ_stat_tuple = ((0,1), (3,3), (5,7))
+        self.assertEqual(targ_stat, targ_stat_tuple)
+        self.assertEqual(hash(targ_stat), hash(targ_stat_tuple))
+        self.assertEqual({targ_stat_tuple: 1}.get(targ_stat), 1)
+        self.assertEqual({targ_stat: 1}.get(targ_stat_tuple), 1)
+        self.assertEqual({((1,2),): 1}.get(TargetStatus(TargetDeactTract(1,2))), 1)
+        self.assertIsNone({targ_stat_tuple: 1}.get(TargetStatus(TargetDeactTract(5,6))))
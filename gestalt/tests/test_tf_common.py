@@ -2,6 +2,7 @@ import unittest
 
 import numpy as np
 import tensorflow as tf
+import scipy.linalg
 
 import tf_common
 from scipy.optimize import check_grad
@@ -10,6 +11,16 @@ class LikelihoodCalculationTestCase(unittest.TestCase):
     def setUp(self):
         self.g_opt = tf.train.GradientDescentOptimizer(1)
         self.sess = tf.InteractiveSession()
+        # Count the calls to the Frechet derivative fallback of the expm gradient
+        self.num_frechet_calls = 0
+        self.orig_frechet_grad_batch = tf_common._expm_frechet_grad_batch
+        def count_frechet_grad_batch(*args):
+            self.num_frechet_calls += 1
+            return self.orig_frechet_grad_batch(*args)
+        tf_common._expm_frechet_grad_batch = count_frechet_grad_batch
+
+    def tearDown(self):
+        tf_common._expm_frechet_grad_batch = self.orig_frechet_grad_batch
 
     def test_expm_grad(self):
         Q_orig_val = np.array([[5.0, 2.3],[4,6]])
@@ -49,3 +60,168 @@ class LikelihoodCalculationTestCase(unittest.TestCase):
         my_sum_eps = self.sess.run(p_mat_sum)
         approx_grad = (my_sum_eps - my_sum)/eps
         self.assertTrue(np.isclose(approx_grad,  t_grad))
+
+        # The eigenvectors are well-conditioned so the gradient stays in the graph
+        self.assertEqual(self.num_frechet_calls, 0)
+
+    def test_expm_list(self):
+        Q_orig_vals = [
+            np.array([[-5.0, 2.3, 2.7], [0, -6, 6], [0, 0, 0]]),
+            np.array([[-1.0, 1.0], [0, 0]]),
+            np.array([[-3.0, 1.0, 0.5, 1.5], [0, -2, 1, 1], [0, 0, -4, 4], [0, 0, 0, 0]])]
+        t_orig_vals = [0.1, 0.5, 0.3]
+        Qs = [tf.Variable(Q_val, dtype=tf.float64) for Q_val in Q_orig_vals]
+        ts = [tf.Variable(t_val, dtype=tf.float64) for t_val in t_orig_vals]
+
+        p_mats, _ = tf_common.myexpm_list(Qs, ts)
+        p_mat_sum = tf.add_n([tf.reduce_sum(tf.pow(p_mat, 2)) for p_mat in p_mats])
+        p_mat_sum_grads = self.g_opt.compute_gradients(p_mat_sum, var_list=Qs + ts)
+
+        tf.global_variables_initializer().run()
+
+        p_mat_vals, my_grads = self.sess.run([p_mats, p_mat_sum_grads])
+        for Q_val, t_val, p_mat_val in zip(Q_orig_vals, t_orig_vals, p_mat_vals):
+            self.assertTrue(np.allclose(p_mat_val, scipy.linalg.expm(Q_val * t_val)))
+
+        def get_sum(Q_vals, t_vals):
+            return np.sum([
+                np.sum(np.power(scipy.linalg.expm(Q_val * t_val), 2))
+                for Q_val, t_val in zip(Q_vals, t_vals)])
+
+        eps = 1e-6
+        my_sum = get_sum(Q_orig_vals, t_orig_vals)
+        for mat_idx, Q_val in enumerate(Q_orig_vals):
+            Q_grad = my_grads[mat_idx][0]
+            for i in range(Q_val.shape[0]):
+                for j in range(Q_val.shape[1]):
+                    Q_new_vals = [np.copy(Q) for Q in Q_orig_vals]
+                    Q_new_vals[mat_idx][i,j] += eps
+                    approx_grad = (get_sum(Q_new_vals, t_orig_vals) - my_sum)/eps
+                    self.assertTrue(np.isclose(approx_grad, Q_grad[i,j], atol=1e-4))
+
+            t_new_vals = list(t_orig_vals)
+            t_new_vals[mat_idx] += eps
+            approx_grad = (get_sum(Q_orig_vals, t_new_vals) - my_sum)/eps
+            t_grad = my_grads[len(Q_orig_vals) + mat_idx][0]
+            self.assertTrue(np.isclose(approx_grad, t_grad, atol=1e-4))
+
+    def test_expm_list_shared(self):
+        # Each rate matrix is used for multiple times
+        Q_orig_vals = [
+            np.array([[-5.0, 2.3, 2.7], [0, -6, 6], [0, 0, 0]]),
+            np.array([[-1.0, 1.0], [0, 0]])]
+        t_orig_vals = [0.1, 0.5, 0.3, 0.2]
+        Q_idxs = [0, 1, 0, 0]
+        Qs = [tf.Variable(Q_val, dtype=tf.float64) for Q_val in Q_orig_vals]
+        ts = [tf.Variable(t_val, dtype=tf.float64) for t_val in t_orig_vals]
+
+        p_mats, _ = tf_common.myexpm_list(Qs, ts, Q_idxs)
+        p_mat_sum = tf.add_n([tf.reduce_sum(tf.pow(p_mat, 2)) for p_mat in p_mats])
+        p_mat_sum_grads = self.g_opt.compute_gradients(p_mat_sum, var_list=Qs + ts)
+
+        tf.global_variables_initializer().run()
+
+        p_mat_vals, my_grads = self.sess.run([p_mats, p_mat_sum_grads])
+        for Q_idx, t_val, p_mat_val in zip(Q_idxs, t_orig_vals, p_mat_vals):
+            self.assertTrue(np.allclose(p_mat_val, scipy.linalg.expm(Q_orig_vals[Q_idx] * t_val)))
+
+        def get_sum(Q_vals, t_vals):
+            return np.sum([
+                np.sum(np.power(scipy.linalg.expm(Q_vals[Q_idx] * t_val), 2))
+                for Q_idx, t_val in zip(Q_idxs, t_vals)])
+
+        eps = 1e-6
+        my_sum = get_sum(Q_orig_vals, t_orig_vals)
+        for mat_idx, Q_val in enumerate(Q_orig_vals):
+            Q_grad = my_grads[mat_idx][0]
+            for i in range(Q_val.shape[0]):
+                for j in range(Q_val.shape[1]):
+                    Q_new_vals = [np.copy(Q) for Q in Q_orig_vals]
+                    Q_new_vals[mat_idx][i,j] += eps
+                    approx_grad = (get_sum(Q_new_vals, t_orig_vals) - my_sum)/eps
+                    self.assertTrue(np.isclose(approx_grad, Q_grad[i,j], atol=1e-4))
+
+        for t_idx in range(len(t_orig_vals)):
+            t_new_vals = list(t_orig_vals)
+            t_new_vals[t_idx] += eps
+            approx_grad = (get_sum(Q_orig_vals, t_new_vals) - my_sum)/eps
+            t_grad = my_grads[len(Q_orig_vals) + t_idx][0]
+            self.assertTrue(np.isclose(approx_grad, t_grad, atol=1e-4))
+
+    def test_expm_grad_defective(self):
+        # Repeated eigenvalue with only one eigenvector, so the gradient must use the Frechet derivative
+        Q_orig_val = np.array([[-1.0, 1.0, 0], [0, -1.0, 1.0], [0, 0, 0]])
+        t_orig_val = 0.7
+        _, _, _, _, is_well_cond = tf_common._custom_expm_batch(
+                np.expand_dims(Q_orig_val, 0),
+                np.array([t_orig_val]),
+                np.array([0]),
+                np.array([3]))
+        self.assertEqual(is_well_cond[0], 0)
+
+        Q = tf.Variable(Q_orig_val, dtype=tf.float64)
+        t = tf.Variable(t_orig_val, dtype=tf.float64)
+        weights = np.arange(9).reshape((3, 3))
+        p_mat, _, _, _ = tf_common.myexpm(Q, t)
+        p_mat_sum = tf.reduce_sum(p_mat * weights)
+        p_mat_sum_grads = self.g_opt.compute_gradients(p_mat_sum, var_list=[Q, t])
+
+        tf.global_variables_initializer().run()
+        my_grads = self.sess.run(p_mat_sum_grads)
+
+        def get_sum(Q_val, t_val):
+            return np.sum(scipy.linalg.expm(Q_val * t_val) * weights)
+
+        eps = 1e-7
+        my_sum = get_sum(Q_orig_val, t_orig_val)
+        for i in range(3):
+            for j in range(3):
+                Q_new_val = np.copy(Q_orig_val)
+                Q_new_val[i,j] += eps
+                approx_grad = (get_sum(Q_new_val, t_orig_val) - my_sum)/eps
+                self.assertTrue(np.isclose(approx_grad, my_grads[0][0][i,j], atol=1e-5))
+        approx_grad = (get_sum(Q_orig_val, t_orig_val + eps) - my_sum)/eps
+        self.assertTrue(np.isclose(approx_grad, my_grads[1][0], atol=1e-5))
+        self.assertEqual(self.num_frechet_calls, 1)
+
+    def test_expm_grouped_closed_form(self):
+        # The small matrices are computed in closed form, including one with equal diagonal entries
+        # and one where the transition goes from the second state to the first.
+        # Like the rate matrices in the likelihood model, the rows sum to zero and the last state is absorbing
+        A_orig_vals = [
+            np.array([[-5.0, 2.3], [0, -6]]),
+            np.array([[-2.0, 0], [1.5, -2.0]]),
+            np.array([[-1.0]]),
+            np.array([[-3.0, 1.0, 1.0], [0, -2, 1], [0, 0, -1]])]
+        t_orig_vals = [0.1, 0.5, 0.3, 0.2, 0.7, 0.4]
+        Q_idxs = [0, 3, 1, 2, 2, 0]
+        t_groups = [[0, 1, 2], [3, 4], [5]]
+        As = [tf.Variable(A_val, dtype=tf.float64) for A_val in A_orig_vals]
+        ts = [tf.Variable(t_val, dtype=tf.float64) for t_val in t_orig_vals]
+        Qs = []
+        for A, A_val in zip(As, A_orig_vals):
+            masked_A = A * (A_val != 0)
+            Q = tf.concat([masked_A, -tf.reduce_sum(masked_A, axis=1, keepdims=True)], axis=1)
+            Qs.append(tf.concat([Q, tf.zeros([1, A_val.shape[0] + 1], dtype=tf.float64)], axis=0))
+
+        group_p_mats = []
+        grads = []
+        for closed_form_idxs in [set(), {0, 1, 2}]:
+            p_mats, _ = tf_common.myexpm_grouped(Qs, ts, Q_idxs, t_groups, closed_form_idxs)
+            p_mat_sum = tf.add_n([tf.reduce_sum(tf.pow(p_mat, 2)) for p_mat in p_mats])
+            group_p_mats.append(p_mats)
+            grads.append([grad for grad, _ in self.g_opt.compute_gradients(p_mat_sum, var_list=As + ts)])
+
+        tf.global_variables_initializer().run()
+        Q_vals, p_mat_vals, cf_p_mat_vals, grad_vals, cf_grad_vals = self.sess.run([Qs] + group_p_mats + grads)
+        for group, p_mat_val, cf_p_mat_val in zip(t_groups, p_mat_vals, cf_p_mat_vals):
+            for i, t_idx in enumerate(group):
+                Q_val = Q_vals[Q_idxs[t_idx]]
+                size = Q_val.shape[0]
+                self.assertTrue(np.allclose(
+                    cf_p_mat_val[i, :size, :size],
+                    scipy.linalg.expm(Q_val * t_orig_vals[t_idx])))
+                self.assertTrue(np.allclose(cf_p_mat_val[i, size:, size:], np.eye(cf_p_mat_val.shape[1] - size)))
+            self.assertTrue(np.allclose(p_mat_val, cf_p_mat_val))
+        for grad_val, cf_grad_val in zip(grad_vals, cf_grad_vals):
+            self.assertTrue(np.allclose(grad_val, cf_grad_val))
@@ -1,11 +1,12 @@
 import unittest
+import six
 
 from cell_lineage_tree import CellLineageTree
 from barcode_metadata import BarcodeMetadata
-from indel_sets import TargetTract
+from indel_sets import TargetTract, TargetTractTuple
 from allele_events import AlleleEvents, Event
 from target_status import TargetStatus, TargetDeactTract
-from transition_wrapper_maker import TransitionWrapperMaker
+from transition_wrapper_maker import TransitionWrapperMaker, CloseStatesCache
 
 class TransitionWrapperMakerTestCase(unittest.TestCase):
     def setUp(self):
@@ -390,3 +391,64 @@ class TransitionWrapperMakerTestCase(unittest.TestCase):
         self.assertEqual(len(transition_wrap_dict[1][0].states), 2)
         self.assertEqual(len(transition_wrap_dict[2][0].states), 1)
         self.assertEqual(len(transition_wrap_dict[3][0].states), 2)
+
+    def test_close_states_cache(self):
+        num_barcodes = 1
+        bcode_meta = self._create_bcode(num_barcodes)
+
+        topology = CellLineageTree(allele_events_list=[AlleleEvents(num_targets=self.num_targets)])
+        topology.add_feature("node_id", 0)
+
+        child1 = CellLineageTree(allele_events_list=[
+            AlleleEvents([Event(10,10,0,0,"")], num_targets=self.num_targets)])
+        topology.add_child(child1)
+        child1.add_feature("node_id", 1)
+
+        child2 = CellLineageTree(allele_events_list=[
+            AlleleEvents([Event(20,100,0,3,"")], num_targets=self.num_targets)])
+        topology.add_child(child2)
+        child2.add_feature("node_id", 2)
+
+        cache = CloseStatesCache()
+        trans_wrap_maker = TransitionWrapperMaker(topology, bcode_meta, max_extra_steps=1, close_states_cache=cache)
+        transition_wrap_dict = trans_wrap_maker.create_transition_wrappers()
+        cache_size = len(cache)
+        self.assertTrue(cache_size > 0)
+
+        # Making the wrappers again should only use the cached results
+        trans_wrap_maker = TransitionWrapperMaker(topology, bcode_meta, max_extra_steps=1, close_states_cache=cache)
+        cached_transition_wrap_dict = trans_wrap_maker.create_transition_wrappers()
+        self.assertEqual(len(cache), cache_size)
+        for node_id in range(3):
+            self.assertEqual(
+                set(transition_wrap_dict[node_id][0].states),
+                set(cached_transition_wrap_dict[node_id][0].states))
+
+    def test_close_states_cache_bound(self):
+        cache = CloseStatesCache(max_size=2)
+        cache.put("a", [TargetTractTuple()])
+        cache.start_recording()
+        cache.put("b", [])
+        cache.get("a")
+        cache.put("c", [])
+        # "b" was the least recently used
+        self.assertEqual(set(cache.close_states.keys()), set(["a", "c"]))
+        self.assertEqual(set(cache.stop_recording().keys()), set(["b", "c"]))
+        cache.put("d", [])
+        self.assertIsNone(cache.recorded_states)
+
+    def test_pickle_without_process_cache(self):
+        bcode_meta = self._create_bcode(1)
+        topology = CellLineageTree(allele_events_list=[AlleleEvents(num_targets=self.num_targets)])
+        trans_wrap_maker = TransitionWrapperMaker(topology, bcode_meta)
+        process_cache = trans_wrap_maker.close_states_cache
+        process_cache.put("process_cache_key", [])
+        pickled_maker = six.moves.cPickle.dumps(trans_wrap_maker, protocol=2)
+        self.assertNotIn(b"process_cache_key", pickled_maker)
+        self.assertIs(six.moves.cPickle.loads(pickled_maker).close_states_cache, process_cache)
+
+        # Caches passed in explicitly are pickled with the maker
+        own_cache = CloseStatesCache()
+        own_cache.put("key", [])
+        trans_wrap_maker = TransitionWrapperMaker(topology, bcode_meta, close_states_cache=own_cache)
+        self.assertEqual(len(six.moves.cPickle.loads(six.moves.cPickle.dumps(trans_wrap_maker)).close_states_cache), 1)
@@ -0,0 +1,49 @@
+import unittest
+import numpy as np
+from ete3 import TreeNode
+
+from tree_distance import LCAFinder, UnrootRFDistanceMeasurer, RootRFDistanceMeasurer
+
+
+class TreeDistanceTestCase(unittest.TestCase):
+    def _create_tree(self, newick):
+        tree = TreeNode(newick)
+        for leaf in tree:
+            leaf.add_feature("allele_events_list_str", leaf.name)
+        return tree
+
+    def test_lca(self):
+        tree = self._create_tree("((a:1,(b:1,c:2):1):1,(d:1,e:1,f:3):2);")
+        lca_finder = LCAFinder(tree)
+        leaves = tree.get_leaves()
+        leaf_idxs = lca_finder.get_node_idxs(leaves)
+        for i, leaf1 in enumerate(leaves):
+            lca_idxs = lca_finder.get_lca_idxs(np.repeat(leaf_idxs[i], len(leaves)), leaf_idxs)
+            for j, leaf2 in enumerate(leaves):
+                mrca = leaf1.get_common_ancestor(leaf2)
+                self.assertEqual(lca_finder.nodes[lca_idxs[j]], mrca)
+                self.assertTrue(np.isclose(
+                    lca_finder.dist_to_root[leaf_idxs[i]] - lca_finder.dist_to_root[lca_idxs[j]],
+                    leaf1.get_distance(mrca)))
+
+        lca_idx = lca_finder.get_lca_idx_of_set(leaf_idxs[[1, 2]])
+        self.assertEqual(lca_finder.nodes[lca_idx], leaves[1].up)
+        lca_idx = lca_finder.get_lca_idx_of_set(leaf_idxs[[0, 2, 3]])
+        self.assertEqual(lca_finder.nodes[lca_idx], tree)
+
+    def test_rf(self):
+        ref_tree = self._create_tree("((a,(b,c)),((d,e),f));")
+        trees = [
+            self._create_tree("((a,(b,c)),((d,e),f));"),
+            self._create_tree("((a,(b,f)),((d,e),c));"),
+            self._create_tree("((a,b,c),(d,(e,f)));"),
+            self._create_tree("((c,(b,a)),(d,e,f,g));")]
+        for measurer_cls, unrooted_trees in [(UnrootRFDistanceMeasurer, True), (RootRFDistanceMeasurer, False)]:
+            measurer = measurer_cls(ref_tree, None)
+            for tree in trees:
+                ete_rf = ref_tree.robinson_foulds(
+                        tree,
+                        attr_t1="allele_events_list_str",
+                        attr_t2="allele_events_list_str",
+                        unrooted_trees=unrooted_trees)
+                self.assertEqual(measurer.get_rf_dist(tree), (ete_rf[0], ete_rf[1]))
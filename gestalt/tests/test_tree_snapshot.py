@@ -0,0 +1,95 @@
+import unittest
+
+from cell_lineage_tree import CellLineageTree
+from allele_events import AlleleEvents, Event
+from barcode_metadata import BarcodeMetadata
+from tree_snapshot import TreeSnapshot, TreeDiff, Regraft
+import ancestral_events_finder
+
+class TreeSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bcode_meta = BarcodeMetadata()
+        self.num_targets = self.bcode_meta.n_targets
+        cut_sites = self.bcode_meta.abs_cut_sites
+        focal_evts = [
+            Event(
+                start_pos = cut_sites[target] - 1,
+                del_len = 3,
+                min_target = target,
+                max_target = target,
+                insert_str = "")
+            for target in range(self.num_targets)]
+        inter_evt = Event(
+                start_pos = cut_sites[1] - 1,
+                del_len = cut_sites[3] - cut_sites[1] + 3,
+                min_target = 1,
+                max_target = 3,
+                insert_str = "")
+
+        # root -> (A, B, C), (D, (E, F)), G
+        self.tree = self._create_node([])
+        node1 = self.tree.add_child(self._create_node([]))
+        for evts in [[focal_evts[0], focal_evts[2]], [focal_evts[0], focal_evts[5]], [focal_evts[0]]]:
+            node1.add_child(self._create_node(evts))
+        node2 = self.tree.add_child(self._create_node([]))
+        node2.add_child(self._create_node([inter_evt]))
+        node3 = node2.add_child(self._create_node([]))
+        node3.add_child(self._create_node([focal_evts[1], focal_evts[7]]))
+        node3.add_child(self._create_node([focal_evts[7]]))
+        self.tree.add_child(self._create_node([focal_evts[2], focal_evts[5]]))
+        self.tree.label_node_ids()
+
+        ancestral_events_finder.annotate_ancestral_states(self.tree, self.bcode_meta)
+        self.parsimony_score = ancestral_events_finder.get_parsimony_score(self.tree)
+
+    def _create_node(self, evts):
+        return CellLineageTree(allele_events_list=[AlleleEvents(evts, num_targets=self.num_targets)])
+
+    def _get_full_scores(self, regraft):
+        """
+        @return parsimony score and number of collapsible internal branches of the regrafted tree,
+                computed from scratch
+        """
+        tree = self.tree.copy()
+        regraft.apply(tree)
+        ancestral_events_finder.annotate_ancestral_states(tree, self.bcode_meta)
+        parsimony_score = ancestral_events_finder.get_parsimony_score(tree)
+        num_zero_internal = sum([
+            node.dist == 0 and not node.is_leaf() for node in tree.get_descendants()])
+        return parsimony_score, num_zero_internal
+
+    def test_regraft_scores(self):
+        snapshot = TreeSnapshot(self.tree, self.bcode_meta)
+        self.assertEqual(snapshot.parsimony_score, self.parsimony_score)
+
+        for chad in self.tree.get_descendants():
+            chad_idx = snapshot.node_idxs[chad.node_id]
+            nochad_diff = TreeDiff(snapshot)
+            nochad_diff.prune(chad_idx)
+            for attach_node in self.tree.traverse():
+                attach_idx = snapshot.node_idxs[attach_node.node_id]
+                if snapshot.is_descendant(attach_idx, chad_idx) or attach_node is chad.up:
+                    continue
+                for in_branch in [False, True]:
+                    if (in_branch and attach_node.is_root()) or (not in_branch and attach_node.is_leaf()):
+                        continue
+                    regraft_diff = TreeDiff(nochad_diff)
+                    regraft_diff.regraft(chad_idx, attach_idx, in_branch)
+                    regraft = Regraft(chad.node_id, attach_node.node_id, in_branch, [])
+                    self.assertEqual(
+                            (regraft_diff.parsimony_score, regraft_diff.num_zero_internal),
+                            self._get_full_scores(regraft))
+
+        # Base snapshot is untouched by the diffs
+        self.assertEqual(snapshot.parsimony_score, self.parsimony_score)
+
+    def test_get_regrafts(self):
+        snapshot = TreeSnapshot(self.tree, self.bcode_meta)
+        num_regrafts = 0
+        for chad in self.tree.get_descendants():
+            regrafts = snapshot.get_regrafts(chad.node_id)
+            num_regrafts += len(regrafts)
+            for regraft in regrafts:
+                self.assertEqual(self._get_full_scores(regraft), (self.parsimony_score, 0))
+            self.assertTrue(len(snapshot.get_regrafts(chad.node_id, max_regrafts=1)) <= 1)
+        self.assertTrue(num_regrafts > 0)
@@ -0,0 +1,80 @@
+import unittest
+import os
+import tempfile
+
+import numpy as np
+
+from ete3 import TreeNode
+from tuning_checkpoint import TuningCheckpoint, get_hash
+
+
+class CountingWorker:
+    def __init__(self, value):
+        self.value = value
+        self.num_runs = 0
+
+    def get_task_hash(self):
+        return get_hash(self.value)
+
+    def run_worker(self, shared_obj):
+        self.num_runs += 1
+        return [self.value * 2]
+
+
+class TuningCheckpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log_file = os.path.join(self.tmp_dir.name, "checkpoint.pkl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_hash(self):
+        # Insertion order of sets and dicts does not matter
+        self.assertEqual(
+                get_hash({"a": {3, 1, 2}, "b": np.arange(3)}),
+                get_hash({"b": np.arange(3), "a": {1, 2, 3}}))
+        self.assertNotEqual(get_hash({"a": np.arange(3)}), get_hash({"a": np.arange(3) + 1e-10}))
+        self.assertNotEqual(get_hash([1, 2]), get_hash((1, 2)))
+        # Only the contents matter, not which objects are shared (e.g. after pickling and unpickling)
+        shared = [np.ones(2)]
+        self.assertEqual(get_hash([shared, shared]), get_hash([shared, [np.ones(2)]]))
+
+        # Deep trees are fine and the hash depends on the topology
+        tree = TreeNode()
+        node = tree
+        for i in range(2000):
+            node = node.add_child(TreeNode())
+            node.add_feature("node_id", i)
+        other_tree = TreeNode()
+        other_tree.add_child(TreeNode())
+        self.assertEqual(get_hash(tree), get_hash(tree))
+        self.assertNotEqual(get_hash(tree), get_hash(other_tree))
+
+    def test_resume(self):
+        checkpoint = TuningCheckpoint(self.log_file)
+        workers = [CountingWorker(i) for i in range(3)]
+        for worker in workers[:2]:
+            self.assertEqual(checkpoint.run_worker(worker), [worker.value * 2])
+        checkpoint.add_iteration({"iter": 0})
+
+        # Simulate the job dying in the middle of writing a record
+        with open(self.log_file, "ab") as f:
+            f.write(b"\x80\x02(X")
+
+        resumed = TuningCheckpoint(self.log_file, resume=True)
+        self.assertEqual(resumed.iter_states, [{"iter": 0}])
+        new_workers = [CountingWorker(i) for i in range(3)]
+        results = [resumed.run_worker(worker) for worker in new_workers]
+        self.assertEqual(results, [[0], [2], [4]])
+        self.assertEqual([worker.num_runs for worker in new_workers], [0, 0, 1])
+
+        # The log can still be appended to after dropping the partial record
+        resumed.add_iteration({"iter": 1})
+        resumed_again = TuningCheckpoint(self.log_file, resume=True)
+        self.assertEqual(resumed_again.iter_states, [{"iter": 0}, {"iter": 1}])
+        self.assertEqual(len(resumed_again.task_results), 3)
+
+        # Starting over clears the log
+        self.assertEqual(len(TuningCheckpoint(self.log_file).task_results), 0)
+        self.assertEqual(len(TuningCheckpoint(self.log_file, resume=True).task_results), 0)
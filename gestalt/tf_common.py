@@ -59,10 +59,14 @@ def py_func(func, inp, Tout, stateful=True, name=None, grad=None):
     with g.gradient_override_map({"PyFunc": rnd_name}):
         return tf.py_func(func, inp, Tout, stateful=stateful, name=name)
 
-def _custom_expm(x, t):
+# If the condition number of the eigenvectors is larger than this, the gradient of the
+# matrix exponential is calculated using the Frechet derivative instead of the eigendecomposition
+# and the matrix exponential itself is calculated using scipy
+EIGVEC_COND_THRES = 1e6
+
+def _custom_eig(x):
     """
-    My own expm implementation
-    The additional outputs are useful for calculating the gradient later
+    @return eigenvalues, eigenvectors, inverse of the eigenvectors of the matrix `x`
     """
     D, A = np.linalg.eig(x)
     #print("D", D.shape, np.unique(D).size)
@@ -72,103 +76,416 @@ def _custom_expm(x, t):
         print("bad A", A)
         print("bad D", D)
         1/0
-    #res =  np.dot(A, np.dot(
-    #    np.diag(np.exp(
-    #        # Do not allow overflow!
-    #        np.minimum(D * t, 10))),
-    #    A_inv))
+    return D, A, A_inv
+
+def _custom_expm(x, t):
+    """
+    My own expm implementation
+    @return [exp(xt), eigenvectors, inverse eigenvectors, eigenvalues]
+    """
+    D, A, A_inv = _custom_eig(x)
     res = scipy.linalg.expm(x * t)
     return [res, A, A_inv, D]
 
-def _expm_grad(op, grad0, grad1, grad2, grad3):
+def myexpm(Q, t, name=None):
     """
-    @param op: The `expm` `Operation` that we are differentiating, which we can use
-                to find the inputs and outputs of the original op.
-    @param grad[0,1,2,3]: Gradient with respect to each of the outputs of the `expm` op.
+    @param Q: the instantaneous transition matrix
+    @param t: the time
+
+    @return tensorflow object with exp(Qt), eigenvectors, inverse eigenvectors, eigenvalues
+    """
+    with tf.name_scope(name, "Myexpm", [Q, t]) as name:
+        Q_len = Q.shape[0].value
+        if Q_len is None:
+            Q_len = tf.shape(Q)[0]
+        expm_outputs = myexpm_batch(
+                tf.expand_dims(Q, 0),
+                tf.reshape(t, [1]),
+                tf.constant([0], dtype=tf.int32),
+                tf.reshape(Q_len, [1]),
+                name=name)
+        return [output[0] for output in expm_outputs[:4]]
+
+def _custom_expm_batch(Qs, ts, mat_idxs, sizes):
+    """
+    Batched version of expm, where each rate matrix can be exponentiated for many different times.
+    Each rate matrix is only decomposed once: exp(Qt) = A diag(exp(Dt)) A^-1 for all the times t.
 
-    @return the gradient with respect to each input
-            (This will be assuming that only the first output of expm is used
-            and the rest is not used to calculate the final value.)
+    Each matrix in `Qs` is zero-padded to a common size. Only the top-left `sizes[i]` block
+    of the i-th matrix is decomposed. The padded block of each output is set to the identity
+    (for the eigenvectors and the matrix exponential) and zero (for the eigenvalues) so that
+    the padding contributes nothing to the gradient.
 
+    @param Qs: array of shape (num_mats, n, n) with padded instantaneous rate matrices
+    @param ts: array of shape (batch,) with the times
+    @param mat_idxs: array of shape (batch,) with the index of the rate matrix for each time
+    @param sizes: array of shape (num_mats,) with the unpadded size of each rate matrix
 
-    Gradient calculations based on Kalbfleisch (1985)
+    @return [exp(Qs[mat_idxs] * ts), eigenvectors, inverse eigenvectors, eigenvalues,
+            whether the eigenvectors are well-conditioned (1 if so, 0 otherwise)]
     """
+    num_mats, n, _ = Qs.shape
+    A = np.tile(np.eye(n), (num_mats, 1, 1))
+    A_inv = np.tile(np.eye(n), (num_mats, 1, 1))
+    D = np.zeros((num_mats, n))
+    is_well_cond = np.ones(num_mats)
+    for i in range(num_mats):
+        size = sizes[i]
+        D_i, A_i, A_inv_i = _custom_eig(Qs[i, :size, :size])
+        A[i, :size, :size] = A_i
+        A_inv[i, :size, :size] = A_inv_i
+        D[i, :size] = D_i
+        # Cheap estimate of the condition number since we already have the inverse
+        eigvec_cond = np.linalg.norm(A_i, ord=1) * np.linalg.norm(A_inv_i, ord=1)
+        is_well_cond[i] = eigvec_cond < EIGVEC_COND_THRES
+
+    res = np.tile(np.eye(n), (ts.size, 1, 1))
+    for batch_idx, (t, i) in enumerate(zip(ts, mat_idxs)):
+        size = sizes[i]
+        if is_well_cond[i]:
+            # Probabilities cannot be negative -- get rid of rounding errors
+            res[batch_idx, :size, :size] = np.maximum(np.dot(
+                A[i, :size, :size] * np.exp(D[i, :size] * t),
+                A_inv[i, :size, :size]), 0)
+        else:
+            res[batch_idx, :size, :size] = scipy.linalg.expm(Qs[i, :size, :size] * t)
+    return [res, A, A_inv, D, is_well_cond]
+
+def _expm_frechet_grad_batch(Qs, ts, mat_idxs, sizes, grads, is_well_cond):
+    """
+    Gradient of the loss with respect to each ill-conditioned rate matrix, using the Frechet
+    derivative of the matrix exponential (calculated by scipy via the block-triangular formulation).
+    Since <G, L(Qt, dQ t)> = <t L(Q^T t, G), dQ>, the gradient is t L(Q^T t, G), summed over all the times.
+
+    @param grads: array of shape (batch, n, n) with the gradient of the loss wrt each exp(Qt)
+    @param is_well_cond: array of shape (num_mats,), the output of _custom_expm_batch
+
+    @return array of shape (num_mats, n, n) with the gradient wrt Qs for the ill-conditioned
+            matrices, zero for the rest
+    """
+    dL_dQ = np.zeros(Qs.shape)
+    for batch_idx, (t, i) in enumerate(zip(ts, mat_idxs)):
+        if is_well_cond[i]:
+            continue
+        size = sizes[i]
+        dL_dQ[i, :size, :size] += t * scipy.linalg.expm_frechet(
+                Qs[i, :size, :size].T * t,
+                grads[batch_idx, :size, :size],
+                compute_expm=False)
+    return dL_dQ
+
+def _expm_batch_grad(op, grad0, grad1, grad2, grad3, grad4):
+    """
+    Gradient of the batched expm op, also based on Kalbfleisch (1985)
+    This never materializes the n^4 tensor of dP/dQij and stays in float64.
+
+    Derivation, for a single matrix P = A diag(exp(Dt)) A^-1:
+        dP = A ((A^-1 dQ A) * F) A^-1
+        where F_ij = (exp(D_i t) - exp(D_j t))/(D_i - D_j) and F_ii = t exp(D_i t)
+    so
+        dL/dQ = A^-T ((A^T dL/dP A^-T) * F) A^T
+    When a rate matrix is exponentiated for many times, the inner terms are summed before
+    multiplying by the eigenvectors.
+    If the eigenvectors are ill-conditioned (e.g. the rate matrix is nearly defective),
+    we fall back to using the Frechet derivative.
+
+    @return the gradient with respect to each input (none for the matrix indices and sizes)
+    """
+    Qs = op.inputs[0]
+    ts = op.inputs[1]
+    mat_idxs = op.inputs[2]
+    sizes = op.inputs[3]
+    P = op.outputs[0]
     A = op.outputs[1]
     A_inv = op.outputs[2]
     D = op.outputs[3]
-    Q = op.inputs[0]
-    t = op.inputs[1]
-    Q_len = Q.shape[0]
-
-    D_vec = tf.reshape(D, (Q_len, 1), name="D_vec")
-    expDt = tf.exp(D * t, name="expDt")
-    expDt_vec = tf.reshape(expDt, (Q_len, 1))
-    DD_diff = tf.subtract(D_vec, tf.transpose(D_vec), name="DD_diff_raw")
-    # Make sure that the difference matrix doesnt have things exactly equal to zero
-    # Perturb a little bit if that happens.
-    bad_diff_thres = 1e-4
-    bad_diffs = tf.cast(tf.less(tf.abs(DD_diff), bad_diff_thres), dtype=tf.float64)
-    DD_diff = tf.add(
-            DD_diff,
-            tf.multiply(bad_diffs, bad_diff_thres))
-    DD_diff = tf.matrix_set_diag(DD_diff, tf.ones(Q_len, dtype=tf.float64), name="DD_diff_set_diag")
-    t_factor = tf.divide(expDt_vec - tf.transpose(expDt_vec), DD_diff, name="t_factor_raw")
-    t_factor = tf.matrix_set_diag(t_factor, t * expDt, name="t_factor_filled")
-
-    A_inv_col = tf.reshape(tf.transpose(A_inv), (-1, 1))
-    A_row = tf.reshape(A, (1, -1))
-    Gs = tf.matmul(A_inv_col, A_row)
-    Ts = tf.tile(t_factor, multiples=[Q_len, Q_len])
-    Vs = tf.multiply(Gs, Ts)
-
-    # Derivation
-    # dL_dQij = dotproduct(dL/dP, dP/dQij)
-    #         = trace(dL/dP dP/dQij.T)
-    #         = trace(dL/dP Ainv.T Vij.T A.T)
-    #         = trace(A.T dL/dP Ainv.T Vij.T)
-    #         = dotproduct(A.T dL/dP Ainv.T, Vij)
+    is_well_cond = op.outputs[4]
+
+    # Get the eigendecomposition for each time
+    batch_A = tf.gather(A, mat_idxs)
+    batch_A_inv = tf.gather(A_inv, mat_idxs)
+    batch_D = tf.gather(D, mat_idxs)
+    t = tf.reshape(ts, (-1, 1))
+
+    expDt = tf.exp(batch_D * t, name="expDt")
+    D_row = tf.expand_dims(batch_D, 1)
+    D_col = tf.expand_dims(batch_D, 2)
+    expDt_row = tf.expand_dims(expDt, 1)
+    expDt_col = tf.expand_dims(expDt, 2)
+    t_tensor = tf.expand_dims(t, 2)
+    DD_diff = D_col - D_row
+    # For (nearly) repeated eigenvalues, use the limit of the divided difference
+    bad_diff_thres = 1e-8
+    bad_diffs = tf.less(tf.abs(DD_diff), bad_diff_thres)
+    safe_DD_diff = tf.where(bad_diffs, tf.ones_like(DD_diff), DD_diff)
+    t_factor_limit = t_tensor * tf.exp((D_col + D_row) * t_tensor/2)
+    t_factor = tf.where(
+            bad_diffs,
+            t_factor_limit,
+            (expDt_col - expDt_row)/safe_DD_diff,
+            name="t_factor")
+
     sandwicher = tf.matmul(
-            A,
-            tf.matmul(grad0, A_inv, transpose_b=True),
+            batch_A,
+            tf.matmul(grad0, batch_A_inv, transpose_b=True),
+            transpose_a=True)
+    summed_sandwicher = tf.unsorted_segment_sum(
+            sandwicher * t_factor,
+            mat_idxs,
+            num_segments=tf.shape(Qs)[0])
+    eigen_dL_dQ = tf.matmul(
+            A_inv,
+            tf.matmul(summed_sandwicher, A, transpose_b=True),
             transpose_a=True)
-    tiled_sandwicher = tf.tile(sandwicher, multiples=[Q_len, Q_len])
-    sw_Vs = tf.multiply(tiled_sandwicher, Vs)
-    sw_Vs = tf.verify_tensor_all_finite(sw_Vs, "sw vs before cast")
-    # Scaling for numerical overflow issues
-    mean_sw_Vs = tf.reduce_mean(sw_Vs)
-    scaled_sw_Vs = sw_Vs/mean_sw_Vs
-    scaled_sw_Vs = tf.cast(scaled_sw_Vs, tf.float32)
-    scaled_sw_Vs = tf.verify_tensor_all_finite(scaled_sw_Vs, "sw vs after cast")
-    scaled_sw_Vs = tf.expand_dims(tf.expand_dims(scaled_sw_Vs, 0), -1)
-
-    # Calculate the dotproduct using convolutional operators
-    # TODO: unfortunately the conv operator in tensorflow (v1.5) requires float32 instead of 64.
-    #       We're going to lose some precision in the tradeoff for using someone else's code.
-    #       In the future, we can consider implementing this entirely on our own.
-    conv_filter = tf.ones(shape=[Q_len, Q_len], dtype=tf.float32)
-    reshaped_conv_filter = tf.expand_dims(tf.expand_dims(conv_filter, -1), -1)
-    avged = tf.nn.conv2d(scaled_sw_Vs, reshaped_conv_filter, strides=[1, Q_len, Q_len, 1], padding="SAME")
-    # Fixing up after we rescaled
-    dL_dQ = tf.cast(avged[0, :, :, 0], dtype=tf.float64) * mean_sw_Vs
-
-    dP_dt = tf.matmul(A, tf.matmul(
-                tf.diag(D * expDt),
-                A_inv))
-    dL_dt = tf.reduce_sum(tf.multiply(grad0, dP_dt))
-
-    return tf.cast(dL_dQ, tf.float64), dL_dt
 
-def myexpm(Q, t, name=None):
+    def get_mixed_dL_dQ():
+        frechet_dL_dQ = tf.py_func(
+                _expm_frechet_grad_batch,
+                [Qs, ts, mat_idxs, sizes, grad0, is_well_cond],
+                tf.float64,
+                stateful=False)
+        frechet_dL_dQ.set_shape(Qs.shape)
+        return tf.where(
+                tf.cast(is_well_cond, tf.bool),
+                eigen_dL_dQ,
+                frechet_dL_dQ)
+
+    # Only leave the graph for the Frechet derivative if some eigenvectors are ill-conditioned
+    dL_dQ = tf.cond(
+            tf.reduce_all(tf.cast(is_well_cond, tf.bool)),
+            lambda: eigen_dL_dQ,
+            get_mixed_dL_dQ)
+    dL_dQ.set_shape(Qs.shape)
+    dL_dQ = tf.verify_tensor_all_finite(dL_dQ, "batched expm grad problem")
+
+    # dP/dt = QP
+    dL_dt = tf.reduce_sum(tf.multiply(grad0, tf.matmul(tf.gather(Qs, mat_idxs), P)), axis=[1, 2])
+
+    return dL_dQ, dL_dt, None, None
+
+def myexpm_batch(Qs, ts, mat_idxs, sizes, name=None):
     """
-    @param Q: the instantaneous transition matrix
-    @param t: the time
+    @param Qs: stack of zero-padded instantaneous transition matrices, shape (num_mats, n, n)
+    @param ts: the times, shape (batch,)
+    @param mat_idxs: the index of the transition matrix to use for each time, shape (batch,)
+    @param sizes: the unpadded size of each transition matrix, shape (num_mats,)
 
-    @return tensorflow object with exp(Qt)
+    @return tensorflow objects with exp(Qt) for every time in the batch,
+            eigenvectors, inverse eigenvectors, eigenvalues (all padded) of every transition matrix,
+            and whether the eigenvectors are well-conditioned
     """
-    with tf.name_scope(name, "Myexpm", [Q, t]) as name:
-        expm_wrapped_func = py_func(_custom_expm,
-                        [Q, t],
-                        [tf.float64, tf.float64, tf.float64, tf.float64],
+    with tf.name_scope(name, "MyexpmBatch", [Qs, ts, mat_idxs, sizes]) as name:
+        expm_wrapped_func = py_func(_custom_expm_batch,
+                        [Qs, ts, mat_idxs, sizes],
+                        [tf.float64, tf.float64, tf.float64, tf.float64, tf.float64],
                         name=name,
-                        grad=_expm_grad)
+                        grad=_expm_batch_grad)
+        mats_shape = Qs.shape
+        expm_wrapped_func[0].set_shape(ts.shape.concatenate(mats_shape[1:]))
+        expm_wrapped_func[1].set_shape(mats_shape)
+        expm_wrapped_func[2].set_shape(mats_shape)
+        expm_wrapped_func[3].set_shape(mats_shape[:2])
+        expm_wrapped_func[4].set_shape(mats_shape[:1])
         return expm_wrapped_func
+
+def get_padded_size(size):
+    """
+    @return the smallest power of two that is at least `size`
+    """
+    return int(np.power(2, np.ceil(np.log2(max(size, 1)))))
+
+def expm_two_transient(As, ts):
+    """
+    Computes exp(At) in closed form for a batch of 2x2 matrices A that are triangular, i.e. A[0,1] * A[1,0] = 0.
+    A 1x1 matrix can be handled by padding it with zeros.
+
+    The diagonal entries are exp(a t) and exp(d t), where a and d are the diagonal entries of A.
+    The off-diagonal entry is the nonzero off-diagonal entry of A times (exp(a t) - exp(d t))/(a - d).
+    When a is close to d, we use the series t exp((a + d) t/2) (1 + x^2/6) where x = (a - d) t/2 instead,
+    which keeps the value and the gradient accurate.
+
+    @param As: tensor of shape (N, 2, 2)
+    @param ts: tensor of shape (N,)
+
+    @return tensor of shape (N, 2, 2)
+    """
+    a = As[:, 0, 0]
+    d = As[:, 1, 1]
+    exp_a = tf.exp(a * ts)
+    exp_d = tf.exp(d * ts)
+    half_diff = (a - d) * ts/2
+    is_close = tf.abs(half_diff) < 1e-5
+    safe_diff = tf.where(is_close, tf.ones_like(a), a - d)
+    off_diag_factor = tf.where(
+            is_close,
+            ts * tf.exp((a + d) * ts/2) * (1 + tf.square(half_diff)/6),
+            (exp_a - exp_d)/safe_diff)
+    return tf.stack([
+        tf.stack([exp_a, As[:, 0, 1] * off_diag_factor], axis=1),
+        tf.stack([As[:, 1, 0] * off_diag_factor, exp_d], axis=1)], axis=1)
+
+def _expm_closed_form(Q_list, t_list, Q_idxs, closed_form_idxs):
+    """
+    Computes exp(Qt) in closed form for the rate matrices in `closed_form_idxs`, which must be of size
+    at most 3, have rows that sum to zero, have an absorbing last state, and have at most one transition
+    between the other (transient) states.
+    Then exp(Qt) = [[exp(At), 1 - exp(At) 1], [0, 1]], where A is the block for the transient states.
+
+    @return tuple with
+                the indices of the times in `t_list` that use one of the matrices in `closed_form_idxs`,
+                a flattened tensor with [exp(At) for each of these times (padded to 2x2),
+                    the corresponding absorption probabilities, 0, 1] and
+                a function mapping (index of time among these times, row, column) to the index of that entry
+                of exp(Qt) in the flattened tensor
+    """
+    cf_t_idxs = [t_idx for t_idx in range(len(t_list)) if Q_idxs[t_idx] in closed_form_idxs]
+    num_cf = len(cf_t_idxs)
+    As = tf.stack([
+        tf.pad(Q_list[Q_idxs[t_idx]][:-1, :-1], [[0, 3 - int(Q_list[Q_idxs[t_idx]].shape[0])]] * 2)
+        for t_idx in cf_t_idxs])
+    exp_As = expm_two_transient(As, tf.stack([t_list[t_idx] for t_idx in cf_t_idxs]))
+    absorb_probs = 1 - tf.reduce_sum(exp_As, axis=2)
+    flat_probs = tf.concat([
+        tf.reshape(exp_As, [-1]),
+        tf.reshape(absorb_probs, [-1]),
+        tf.constant([0, 1], dtype=exp_As.dtype)], axis=0)
+
+    zero_idx = 6 * num_cf
+    one_idx = zero_idx + 1
+    def get_flat_idx(cf_idx, row, col, size):
+        num_transient = size - 1
+        if row < num_transient and col < num_transient:
+            return 4 * cf_idx + 2 * row + col
+        elif row < num_transient and col == num_transient:
+            return 4 * num_cf + 2 * cf_idx + row
+        elif row == col:
+            # The absorbing state and the padded block
+            return one_idx
+        else:
+            return zero_idx
+    return cf_t_idxs, flat_probs, get_flat_idx
+
+def myexpm_grouped(Q_list, t_list, Q_idxs, t_groups, closed_form_idxs=None, name=None):
+    """
+    Computes exp(Qt) for every time in `t_list` in a small number of batched calls and
+    returns them stacked according to `t_groups`. The matrices in each group are zero-padded
+    to a common size (the next power of two) with the identity in the padded block, so that
+    groups can be processed using batched tensorflow ops.
+    Each rate matrix is decomposed only once per batched call, even if it is used with many times.
+    The matrices in `closed_form_idxs` skip the decomposition and are computed in closed form instead
+    (see `_expm_closed_form` for the requirements on these matrices).
+
+    @param Q_list: list of square tensorflow matrices, each with a known static size
+    @param t_list: list of tensorflow scalars
+    @param Q_idxs: the index of the matrix in `Q_list` to use for each time in `t_list`
+    @param t_groups: list of lists of indices into `t_list`
+    @param closed_form_idxs: set of indices into `Q_list`
+
+    @return tuple of two lists:
+                tensor of shape (len(group), n, n) with the padded exp(Qt) for each group and
+                the eigenvalues for each matrix (ordered the same as `Q_list`)
+    """
+    assert len(Q_idxs) == len(t_list)
+    if closed_form_idxs is None:
+        closed_form_idxs = set()
+    with tf.name_scope(name, "MyexpmGrouped"):
+        sizes = [int(Q.shape[0]) for Q in Q_list]
+        group_sizes = [get_padded_size(max([sizes[Q_idxs[t_idx]] for t_idx in group])) for group in t_groups]
+        buckets = {}
+        for group_idx, group in enumerate(t_groups):
+            if all([Q_idxs[t_idx] in closed_form_idxs for t_idx in group]):
+                continue
+            if group_sizes[group_idx] not in buckets:
+                buckets[group_sizes[group_idx]] = []
+            buckets[group_sizes[group_idx]].append(group_idx)
+
+        # The matrices computed via the eigendecomposition
+        group_pt_matrices = [None] * len(t_groups)
+        Ddiags = [None] * len(Q_list)
+        for bucket_size, group_idxs in buckets.items():
+            t_idxs = [
+                t_idx for group_idx in group_idxs for t_idx in t_groups[group_idx]
+                if Q_idxs[t_idx] not in closed_form_idxs]
+            bucket_mat_idx_dict = dict()
+            for t_idx in t_idxs:
+                if Q_idxs[t_idx] not in bucket_mat_idx_dict:
+                    bucket_mat_idx_dict[Q_idxs[t_idx]] = len(bucket_mat_idx_dict)
+            idxs = sorted(bucket_mat_idx_dict.keys(), key=lambda idx: bucket_mat_idx_dict[idx])
+            padded_Qs = tf.stack([
+                tf.pad(Q_list[idx], [[0, bucket_size - sizes[idx]], [0, bucket_size - sizes[idx]]])
+                for idx in idxs])
+            bucket_ts = tf.stack([t_list[t_idx] for t_idx in t_idxs])
+            bucket_mat_idxs = tf.constant(
+                    [bucket_mat_idx_dict[Q_idxs[t_idx]] for t_idx in t_idxs],
+                    dtype=tf.int32)
+            bucket_sizes = tf.constant([sizes[idx] for idx in idxs], dtype=tf.int32)
+            bucket_pts, _, _, bucket_Ds, _ = myexpm_batch(padded_Qs, bucket_ts, bucket_mat_idxs, bucket_sizes)
+            start_idx = 0
+            for group_idx in group_idxs:
+                group_len = len([t_idx for t_idx in t_groups[group_idx] if Q_idxs[t_idx] not in closed_form_idxs])
+                group_pt_matrices[group_idx] = bucket_pts[start_idx: start_idx + group_len]
+                start_idx += group_len
+            for bucket_mat_idx, idx in enumerate(idxs):
+                Ddiags[idx] = bucket_Ds[bucket_mat_idx, :sizes[idx]]
+
+        if not any([Q_idx in closed_form_idxs for Q_idx in Q_idxs]):
+            return group_pt_matrices, Ddiags
+
+        # The matrices computed in closed form.
+        # Each group is assembled by gathering from the closed form results and the decomposition results
+        cf_t_idxs, cf_flat_probs, get_cf_flat_idx = _expm_closed_form(Q_list, t_list, Q_idxs, closed_form_idxs)
+        cf_idx_dict = {t_idx: cf_idx for cf_idx, t_idx in enumerate(cf_t_idxs)}
+        cf_len = int(cf_flat_probs.shape[0])
+        for group_idx, group in enumerate(t_groups):
+            if all([Q_idxs[t_idx] not in closed_form_idxs for t_idx in group]):
+                continue
+            size = group_sizes[group_idx]
+            gather_idxs = np.zeros((len(group), size, size), dtype=np.int64)
+            num_eig = 0
+            for i, t_idx in enumerate(group):
+                if t_idx in cf_idx_dict:
+                    for row in range(size):
+                        for col in range(size):
+                            gather_idxs[i, row, col] = get_cf_flat_idx(
+                                    cf_idx_dict[t_idx], row, col, sizes[Q_idxs[t_idx]])
+                else:
+                    gather_idxs[i] = cf_len + num_eig * size * size + np.arange(size * size).reshape((size, size))
+                    num_eig += 1
+            source = cf_flat_probs
+            if group_pt_matrices[group_idx] is not None:
+                source = tf.concat([source, tf.reshape(group_pt_matrices[group_idx], [-1])], axis=0)
+            group_pt_matrices[group_idx] = tf.gather(source, gather_idxs)
+        for Q_idx in closed_form_idxs:
+            Ddiags[Q_idx] = tf.diag_part(Q_list[Q_idx])
+        return group_pt_matrices, Ddiags
+
+def myexpm_list(Q_list, t_list, Q_idxs=None, name=None):
+    """
+    Computes exp(Qt) for every pair of rate matrices and times in a small number of
+    batched calls. Matrices are bucketed by size (rounded up to the next power of two)
+    and zero-padded within each bucket so padding never more than doubles a matrix.
+    Each rate matrix is decomposed only once, even if it is used with many times.
+
+    @param Q_list: list of square tensorflow matrices, each with a known static size
+    @param t_list: list of tensorflow scalars
+    @param Q_idxs: the index of the matrix in `Q_list` to use for each time in `t_list`.
+                If None, `Q_list` and `t_list` are paired up elementwise.
+
+    @return tuple of two lists:
+                exp(Qt) for each time (ordered the same as `t_list`) and
+                the eigenvalues for each matrix (ordered the same as `Q_list`)
+    """
+    if Q_idxs is None:
+        assert len(Q_list) == len(t_list)
+        Q_idxs = list(range(len(Q_list)))
+    with tf.name_scope(name, "MyexpmList"):
+        group_pt_matrices, Ddiags = myexpm_grouped(
+                Q_list,
+                t_list,
+                Q_idxs,
+                [[t_idx] for t_idx in range(len(t_list))])
+        pt_matrices = []
+        for Q_idx, group_pt_matrix in zip(Q_idxs, group_pt_matrices):
+            size = int(Q_list[Q_idx].shape[0])
+            pt_matrices.append(group_pt_matrix[0, :size, :size])
+        return pt_matrices, Ddiags
@@ -0,0 +1,168 @@
+from typing import List, Dict
+import numpy as np
+from numpy import ndarray
+
+from target_status import TargetStatus
+from indel_sets import TargetTract
+from transition_wrapper_maker import TransitionWrapper
+
+
+class TransitionMatrixIndices:
+    """
+    Static indices for assembling the instantaneous transition matrix of a single branch.
+
+    The matrix is assembled by gathering values from a parameter vector and scattering them into the matrix,
+    where values that are scattered to the same entry are summed up.
+    """
+    def __init__(
+            self,
+            state_idxs: ndarray,
+            rate_indices: ndarray,
+            rate_param_idxs: ndarray,
+            trim_indices: ndarray,
+            trim_singleton_idxs: ndarray):
+        """
+        @param state_idxs: the index of each state in the transition wrapper (in the wrapper's order)
+                        among all the target statuses
+        @param rate_indices: (row, column) indices into the marginal transition rate matrix
+        @param rate_param_idxs: which element in the vector of rate parameters (see TransitionMatrixIndexer)
+                        to put in the corresponding entry of `rate_indices`
+        @param trim_indices: (row, column) indices into the trim probability matrix
+        @param trim_singleton_idxs: which singleton in the wrapper's ancestral state to get the trim probability
+                        for the corresponding entry in `trim_indices`. The value -1 means more than one
+                        singleton would be introduced (so the trim probability is zero).
+        """
+        self.state_idxs = state_idxs
+        self.rate_indices = rate_indices
+        self.rate_param_idxs = rate_param_idxs
+        self.trim_indices = trim_indices
+        self.trim_singleton_idxs = trim_singleton_idxs
+
+
+class TransitionMatrixIndexer:
+    """
+    Precomputes, using numpy, the indices for assembling the instantaneous transition matrix of each branch
+    so that the likelihood graph only needs a gather and a scatter per matrix.
+
+    The marginal transition rates are gathered from the vector of rate parameters
+        [hazards of all the target tracts, negative hazards away from all the target statuses]
+    where the hazards of the target tracts are ordered according to `target_tract_dict` and the hazards away
+    are ordered according to `target_statuses`.
+    """
+    def __init__(
+            self,
+            targ_stat_transitions_dict: Dict[TargetStatus, Dict[TargetStatus, List[TargetTract]]],
+            target_statuses: List[TargetStatus],
+            target_tract_dict: Dict[TargetTract, int]):
+        """
+        @param targ_stat_transitions_dict: all possible transitions between target statuses
+                                (see TargetStatus.get_all_transitions)
+        @param target_statuses: all the target statuses
+        @param target_tract_dict: maps each target tract to its index among all the target tracts
+        """
+        self.num_target_tracts = len(target_tract_dict)
+        self.target_tract_dict = target_tract_dict
+        self.targ_stat_idx_dict = {targ_stat: i for i, targ_stat in enumerate(target_statuses)}
+        self.targ_stat_bitmasks = np.array([targ_stat.bitmask for targ_stat in target_statuses], dtype=np.int64)
+
+        # Store the transitions in compressed sparse row format:
+        # the target tracts for the transition with index i are
+        # pair_target_tracts[pair_starts[i]:pair_starts[i + 1]]
+        num_statuses = len(target_statuses)
+        self.pair_idxs = -np.ones((num_statuses, num_statuses), dtype=np.int64)
+        pair_target_tracts = []
+        pair_lens = []
+        for start_state, end_state_dict in targ_stat_transitions_dict.items():
+            start_idx = self.targ_stat_idx_dict[start_state]
+            for end_state, target_tracts in end_state_dict.items():
+                self.pair_idxs[start_idx, self.targ_stat_idx_dict[end_state]] = len(pair_lens)
+                pair_lens.append(len(target_tracts))
+                pair_target_tracts += [target_tract_dict[tt] for tt in target_tracts]
+        self.pair_lens = np.array(pair_lens, dtype=np.int64)
+        self.pair_starts = np.concatenate([[0], np.cumsum(self.pair_lens)])
+        self.pair_target_tracts = np.array(pair_target_tracts, dtype=np.int64)
+
+        # Many branches have the same states and singletons, so cache the indices
+        self._cache = dict()
+
+    def get_state_idxs(self, transition_wrapper: TransitionWrapper):
+        """
+        @return numpy array with the index of each state in the transition wrapper among all the target statuses
+        """
+        return np.array(
+                [self.targ_stat_idx_dict[state] for state in transition_wrapper.states],
+                dtype=np.int64)
+
+    @staticmethod
+    def get_key(transition_wrapper: TransitionWrapper):
+        """
+        @return hashable key such that branches with the same key have the same transition matrix
+        """
+        return (tuple(transition_wrapper.states), tuple(transition_wrapper.anc_state.get_singletons()))
+
+    def get_indices(self, transition_wrapper: TransitionWrapper):
+        """
+        @return TransitionMatrixIndices for the transition matrix of the branch with this transition wrapper
+        """
+        key = self.get_key(transition_wrapper)
+        if key not in self._cache:
+            self._cache[key] = self._create_indices(transition_wrapper, list(key[1]))
+        return self._cache[key]
+
+    def _create_indices(self, transition_wrapper: TransitionWrapper, singletons: List):
+        state_idxs = self.get_state_idxs(transition_wrapper)
+        num_states = state_idxs.size
+
+        # Find all possible transitions between the states
+        local_pair_idxs = self.pair_idxs[np.ix_(state_idxs, state_idxs)]
+        start_keys, end_keys = np.nonzero(local_pair_idxs >= 0)
+        pair_idxs = local_pair_idxs[start_keys, end_keys]
+
+        # Expand each transition into the target tracts that can be introduced for that transition
+        pair_lens = self.pair_lens[pair_idxs]
+        term_pairs = np.repeat(np.arange(pair_idxs.size), pair_lens)
+        term_offsets = np.arange(term_pairs.size) - np.repeat(np.cumsum(pair_lens) - pair_lens, pair_lens)
+        term_target_tracts = self.pair_target_tracts[np.repeat(self.pair_starts[pair_idxs], pair_lens) + term_offsets]
+
+        # If a transition can be made by introducing the target tract of a singleton in the ancestral state,
+        # only that particular target tract is allowed. Otherwise any of the target tracts are allowed.
+        is_special_tt = np.zeros(self.num_target_tracts, dtype=bool)
+        for sg in singletons:
+            is_special_tt[self.target_tract_dict[sg.get_target_tract()]] = True
+        is_special_term = is_special_tt[term_target_tracts]
+        num_special_per_pair = np.bincount(term_pairs, weights=is_special_term, minlength=pair_idxs.size)
+        assert np.all(num_special_per_pair <= 1)
+        keep_terms = is_special_term | (num_special_per_pair[term_pairs] == 0)
+
+        # The diagonal is the negative hazard of transitioning away
+        diag_keys = np.arange(num_states)
+        rate_indices = np.concatenate([
+            np.stack([start_keys[term_pairs[keep_terms]], end_keys[term_pairs[keep_terms]]], axis=1),
+            np.stack([diag_keys, diag_keys], axis=1)]).reshape((-1, 2))
+        rate_param_idxs = np.concatenate([
+            term_target_tracts[keep_terms],
+            self.num_target_tracts + state_idxs])
+
+        # Figure out the trim probabilities: a transition involves a trim probability if it introduces the
+        # target tract of exactly one singleton, i.e. it newly deactivates the outermost targets of that singleton
+        bitmasks = self.targ_stat_bitmasks[state_idxs]
+        new_deact_bitmasks = bitmasks[end_keys] & ~bitmasks[start_keys]
+        singleton_bitmasks = np.array(
+                [(1 << sg.min_target) | (1 << sg.max_target) for sg in singletons],
+                dtype=np.int64)
+        assert np.bitwise_or.reduce(singleton_bitmasks, initial=0) == np.sum(singleton_bitmasks)
+        singleton_hits = (new_deact_bitmasks.reshape((-1, 1)) & singleton_bitmasks.reshape((1, -1))) != 0
+        num_singleton_hits = singleton_hits.sum(axis=1)
+        has_trim = num_singleton_hits >= 1
+        trim_indices = np.stack([start_keys[has_trim], end_keys[has_trim]], axis=1).reshape((-1, 2))
+        trim_singleton_idxs = np.where(
+                num_singleton_hits[has_trim] == 1,
+                np.argmax(singleton_hits[has_trim], axis=1) if singletons else 0,
+                -1)
+
+        return TransitionMatrixIndices(
+                state_idxs,
+                rate_indices,
+                rate_param_idxs,
+                trim_indices,
+                trim_singleton_idxs)
@@ -3,7 +3,9 @@ import random
 import logging
 import numpy as np
 import time
+import six
 from queue import Queue, PriorityQueue
+from collections import OrderedDict
 
 from anc_state import AncState
 from cell_lineage_tree import CellLineageTree
@@ -53,6 +55,102 @@ class TransitionWrapper:
             self.leaf_state = anc_state.to_max_target_status()
             assert self.leaf_state in target_statuses
 
+class CloseStatesCache:
+    """
+    Stores the output of TransitionWrapperMaker.get_states_close_by.
+    Most (parent, child) ancestral state pairs show up again when we create transition wrappers
+    for other candidate trees, so we only run the search once per unique set of arguments.
+    Holds at most `max_size` results and drops the least recently used ones first.
+
+    The process-wide cache is not pickled along with TransitionWrapperMakers. Instead, the processes in the
+    parallel worker pool keep their own process-wide cache across the tasks they run, and the results they
+    add are recorded and merged back into the cache of the parent process (see parallel_worker.PoolManager).
+    """
+    def __init__(self, max_size: int = 20000):
+        self.max_size = max_size
+        self.close_states = OrderedDict()
+        # If not None, the results put in the cache since we started recording
+        self.recorded_states = None
+
+    def __len__(self):
+        return len(self.close_states)
+
+    def __contains__(self, key):
+        return key in self.close_states
+
+    def get(self, key):
+        """
+        @return List[TargetTractTuple] that was stored for `key`
+        """
+        self.close_states.move_to_end(key)
+        return list(self.close_states[key])
+
+    def put(self, key, close_target_tract_tuples: List[TargetTractTuple]):
+        self._put(key, tuple(close_target_tract_tuples))
+        if self.recorded_states is not None:
+            self.recorded_states[key] = self.close_states[key]
+
+    def _put(self, key, close_target_tract_tuples):
+        self.close_states[key] = close_target_tract_tuples
+        self.close_states.move_to_end(key)
+        while len(self.close_states) > self.max_size:
+            self.close_states.popitem(last=False)
+
+    def update(self, close_states: Dict):
+        """
+        Merge in results, e.g. the ones recorded by a worker
+        @param close_states: dict from cache key to the stored results
+        """
+        for key, close_target_tract_tuples in close_states.items():
+            self._put(key, close_target_tract_tuples)
+
+    def start_recording(self):
+        self.recorded_states = dict()
+
+    def stop_recording(self):
+        """
+        @return dict with the results put in the cache since `start_recording`
+        """
+        recorded_states = self.recorded_states
+        self.recorded_states = None
+        return recorded_states
+
+    def save(self, file_name: str):
+        with open(file_name, "wb") as f:
+            six.moves.cPickle.dump(self, f, protocol=2)
+
+    @staticmethod
+    def load(file_name: str):
+        with open(file_name, "rb") as f:
+            return six.moves.cPickle.load(f)
+
+    @staticmethod
+    def create_key(
+            n_targets: int,
+            max_steps: int,
+            min_steps_to_sg: int,
+            parent_target_tract_tuples: List[TargetTractTuple],
+            anc_state: AncState,
+            requested_target_status: TargetStatus):
+        """
+        @return hashable key that uniquely determines the output of get_states_close_by
+        """
+        return (
+            n_targets,
+            max_steps,
+            min_steps_to_sg,
+            frozenset(parent_target_tract_tuples),
+            tuple(anc_state.indel_set_list),
+            requested_target_status)
+
+
+# The cache shared by all TransitionWrapperMakers in this process (unless told otherwise)
+_PROCESS_CLOSE_STATES_CACHE = CloseStatesCache()
+
+def get_process_close_states_cache():
+    return _PROCESS_CLOSE_STATES_CACHE
+
+
 class TransitionWrapperMaker:
     """
     This class helps prune the set of states that we need to calculate transition probabilities for.
@@ -62,16 +160,32 @@ class TransitionWrapperMaker:
             tree: CellLineageTree,
             bcode_metadata: BarcodeMetadata,
             max_extra_steps: int = 1,
-            max_sum_states: int = 3000):
+            max_sum_states: int = 3000,
+            close_states_cache: CloseStatesCache = None):
         """
         @param tree: the tree to create transition wrappers for
         @param max_extra_steps: number of extra steps to search for possible ancestral states
+        @param close_states_cache: cache for the states close by. If None, we use the cache shared
+                                by everything in this process.
         """
         self.bcode_meta = bcode_metadata
         self.tree = tree
 
         self.max_extra_steps = max_extra_steps
         self.max_sum_states = max_sum_states
+        self.close_states_cache = close_states_cache if close_states_cache is not None else _PROCESS_CLOSE_STATES_CACHE
+
+    def __getstate__(self):
+        # Don't ship the process-wide cache to other processes, they have their own
+        state = dict(self.__dict__)
+        if self.close_states_cache is _PROCESS_CLOSE_STATES_CACHE:
+            state["close_states_cache"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.close_states_cache is None:
+            self.close_states_cache = _PROCESS_CLOSE_STATES_CACHE
 
     def _get_close_transition_wrapper(
             self,
@@ -165,6 +279,33 @@ class TransitionWrapperMaker:
             anc_state: AncState,
             requested_target_status: TargetStatus):
         """
+        Cached version of _get_states_close_by -- see that function for details
+        """
+        cache_key = CloseStatesCache.create_key(
+                self.bcode_meta.n_targets,
+                max_steps,
+                min_steps_to_sg,
+                parent_target_tract_tuples,
+                anc_state,
+                requested_target_status)
+        if cache_key not in self.close_states_cache:
+            close_target_tract_tuples = self._get_states_close_by(
+                    max_steps,
+                    min_steps_to_sg,
+                    parent_target_tract_tuples,
+                    anc_state,
+                    requested_target_status)
+            self.close_states_cache.put(cache_key, close_target_tract_tuples)
+        return self.close_states_cache.get(cache_key)
+
+    def _get_states_close_by(
+            self,
+            max_steps: int,
+            min_steps_to_sg: int,
+            parent_target_tract_tuples: List[TargetTractTuple],
+            anc_state: AncState,
+            requested_target_status: TargetStatus):
+        """
         @param parent_statuses: the parent target statuses
         @param targ_stat_transitions_dict: dictionary specifying all possible transitions between target statuses
         @param targ_stat_inv_transitions_dict: dictionary specifying all possible inverse/backwards transitions between target statuses
@@ -184,20 +325,18 @@ class TransitionWrapperMaker:
 
         # Pick out states along paths that reach the minimal target status
         # of all possible max parsimony ancestral states within the specified `max_steps`
-        sg_max_inactive_targs = requested_target_status.get_inactive_targets(self.bcode_meta)
         # Maps distance to nodes that we can reach in exactly that distance
         state_to_parents_dict = {}
         state_queue = PriorityQueue()
         for p in parent_target_tract_tuples:
             parent_targ_stat = TargetStatus.from_target_tract_tuple(p)
-            parent_inactive_targs = parent_targ_stat.get_inactive_targets(self.bcode_meta)
-            parent_passed_requested = set(sg_max_inactive_targs) <= set(parent_inactive_targs)
+            parent_passed_requested = requested_target_status.is_contained_in(parent_targ_stat)
             parent_state = (p, parent_passed_requested)
             state_queue.put((0, parent_state))
             state_to_parents_dict[parent_state] = {}
             state_to_parents_dict[parent_state][0] = set()
 
-        max_targets = set(anc_state.to_max_target_status().get_inactive_targets(self.bcode_meta))
+        max_targets_bitmask = anc_state.to_max_target_status().bitmask
         # Find all paths of at most max_steps long where paths are all possible according to `anc_state`
         while not state_queue.empty():
             dist, (state, state_passed_requested) = state_queue.get_nowait()
@@ -205,8 +344,7 @@ class TransitionWrapperMaker:
                 continue
 
             targ_stat = TargetStatus.from_target_tract_tuple(state)
-            active_any_targs = list(sorted(list(
-                max_targets - set(targ_stat.get_inactive_targets(self.bcode_meta)))))
+            active_any_targs = TargetStatus.bitmask_to_targets(max_targets_bitmask & ~targ_stat.bitmask)
             possible_targ_tracts = targ_stat.get_possible_target_tracts(
                     self.bcode_meta,
                     active_any_targs=active_any_targs)
@@ -219,8 +357,7 @@ class TransitionWrapperMaker:
                 new_state_passed_requested = state_passed_requested
                 if not state_passed_requested:
                     new_state_targ_stat = TargetStatus.from_target_tract_tuple(new_state)
-                    new_state_inactive_targs = new_state_targ_stat.get_inactive_targets(self.bcode_meta)
-                    new_state_passed_requested = set(sg_max_inactive_targs) <= set(new_state_inactive_targs)
+                    new_state_passed_requested = requested_target_status.is_contained_in(new_state_targ_stat)
                 child_state = (new_state, new_state_passed_requested)
                 state_queue.put((dist + 1, child_state))
 
@@ -1,18 +1,124 @@
 import os
 import subprocess
 import numpy as np
-from typing import List
+from numpy import ndarray
+from typing import List, Dict
 import random
 import time
 import logging
+import collections
 
 from scipy.stats import spearmanr, kendalltau, pearsonr
+from ete3.coretype.tree import TreeError
 from cell_lineage_tree import CellLineageTree
 from collapsed_tree import _remove_single_child_unobs_nodes
 from constant_paths import RSPR_PATH, BHV_PATH
 import collapsed_tree
 
 
+class LCAFinder:
+    """
+    Finds lowest common ancestors (LCA) of nodes in a tree in constant time per query.
+    The LCA of two nodes is the shallowest node visited in the Euler tour of the tree between the
+    first visits of the two nodes. We find it using a sparse table of range minimums over the tour.
+    Preprocessing is O(n log n) for n nodes.
+    """
+    def __init__(self, tree: CellLineageTree):
+        """
+        @param tree: the tree to find LCAs in. Branch lengths are read from the `dist` attribute.
+        """
+        self.nodes = []
+        self.node_idx_dict = dict()
+        levels = []
+        dist_to_root = []
+        first_visit = []
+        euler_tour = []
+        # Iterative depth-first search so we don't hit recursion limits on deep trees
+        stack = [(tree, 0)]
+        while stack:
+            node, child_pos = stack.pop()
+            if child_pos == 0:
+                self.node_idx_dict[id(node)] = len(self.nodes)
+                first_visit.append(len(euler_tour))
+                levels.append(len(stack))
+                dist_to_root.append(0 if node is tree else dist_to_root[self.node_idx_dict[id(node.up)]] + node.dist)
+                self.nodes.append(node)
+            euler_tour.append(self.node_idx_dict[id(node)])
+            if child_pos < len(node.children):
+                stack.append((node, child_pos + 1))
+                stack.append((node.children[child_pos], 0))
+
+        self.levels = np.array(levels)
+        self.dist_to_root = np.array(dist_to_root, dtype=float)
+        self.first_visit = np.array(first_visit)
+
+        # Row k of the sparse table stores the shallowest node in the tour positions [i, i + 2^k)
+        tour_len = len(euler_tour)
+        num_rows = int(np.floor(np.log2(tour_len))) + 1
+        self.sparse_table = np.zeros((num_rows, tour_len), dtype=int)
+        self.sparse_table[0] = euler_tour
+        for k in range(1, num_rows):
+            half = 2 ** (k - 1)
+            prev_row = self.sparse_table[k - 1]
+            left = prev_row[:tour_len - half]
+            right = prev_row[half:]
+            self.sparse_table[k, :tour_len - half] = np.where(
+                    self.levels[left] <= self.levels[right], left, right)
+
+    def get_node_idxs(self, nodes: List[CellLineageTree]):
+        """
+        @return numpy array with the index of each node in `self.nodes`
+        """
+        return np.array([self.node_idx_dict[id(node)] for node in nodes], dtype=int)
+
+    def _get_range_min(self, start: ndarray, end: ndarray):
+        """
+        @param start: start positions in the euler tour
+        @param end: end positions in the euler tour (inclusive), must be at least `start`
+        @return index of the shallowest node visited in each range
+        """
+        k = np.floor(np.log2(end - start + 1)).astype(int)
+        left = self.sparse_table[k, start]
+        right = self.sparse_table[k, end - 2 ** k + 1]
+        return np.where(self.levels[left] <= self.levels[right], left, right)
+
+    def get_lca_idxs(self, node_idxs1: ndarray, node_idxs2: ndarray):
+        """
+        @return the index of the LCA for each pair of nodes in `node_idxs1` and `node_idxs2`
+        """
+        visits1 = self.first_visit[node_idxs1]
+        visits2 = self.first_visit[node_idxs2]
+        return self._get_range_min(np.minimum(visits1, visits2), np.maximum(visits1, visits2))
+
+    def get_lca_idx_of_set(self, node_idxs: ndarray):
+        """
+        @return the index of the LCA of all the nodes in `node_idxs`
+        """
+        visits = self.first_visit[node_idxs]
+        return self._get_range_min(np.array([np.min(visits)]), np.array([np.max(visits)]))[0]
+
+
+def _get_clade_bitsets(tree: CellLineageTree, attr: str, leaf_idx_dict: Dict[str, int]):
+    """
+    @param leaf_idx_dict: maps the leaf attribute value to its bit position. Leaves not in this dictionary are ignored.
+    @return list with the leaf set below each node in `tree`, encoded as a bitset
+    """
+    clade_bitsets = dict()
+    for node in tree.traverse("postorder"):
+        if node.is_leaf():
+            leaf_val = getattr(node, attr, None)
+            clade_bitsets[node] = (1 << leaf_idx_dict[leaf_val]) if leaf_val in leaf_idx_dict else 0
+        else:
+            bitset = 0
+            for child in node.children:
+                bitset |= clade_bitsets[child]
+            clade_bitsets[node] = bitset
+    return list(clade_bitsets.values())
+
+
+def _popcount(bitset: int):
+    return bin(bitset).count("1")
+
 class TreeDistanceMeasurerAgg:
     """
     Aggregates tree distances
@@ -237,39 +343,97 @@ class TreeDistanceMeasurer:
         return uniq_trees
 
 
-class UnrootRFDistanceMeasurer(TreeDistanceMeasurer):
+class RFDistanceMeasurer(TreeDistanceMeasurer):
     """
-    Robinson foulds distance, unrooted trees
+    Robinson foulds distance, same as the one in ete.
+    Instead of comparing sorted tuples of leaf names, we represent each clade as a bitset over
+    the leaves in the reference tree. The leaf bitsets of the reference tree are only calculated once.
     Returns the fraction of unshared splits of all possible splits.
     """
-    name = "ete_rf_unroot"
+    unrooted_trees = None
+
+    def __init__(
+            self,
+            ref_tree: CellLineageTree,
+            scratch_dir: str,
+            attr: str = "allele_events_list_str"):
+        super(RFDistanceMeasurer, self).__init__(ref_tree, scratch_dir, attr)
+        self.ref_leaf_idx_dict = None
+        if ref_tree is not None:
+            self._init_ref_bitsets()
+
+    def _init_ref_bitsets(self):
+        ref_leaf_vals = [getattr(leaf, self.attr, None) for leaf in self.ref_tree]
+        self.ref_leaf_idx_dict = {leaf_val: idx for idx, leaf_val in enumerate(ref_leaf_vals)}
+        self.ref_dup_leaf_vals = set([
+            leaf_val for leaf_val, count in collections.Counter(ref_leaf_vals).items() if count > 1])
+        self.ref_clade_bitsets = _get_clade_bitsets(self.ref_tree, self.attr, self.ref_leaf_idx_dict)
+
+    def _get_edges(self, clade_bitsets: List[int], common_bitset: int):
+        if self.unrooted_trees:
+            # Each edge is a bipartition. Represent it by the smaller bitset of the two sides
+            edges = set([min(bitset & common_bitset, common_bitset ^ (bitset & common_bitset)) for bitset in clade_bitsets])
+            if common_bitset == 0:
+                edges.discard(0)
+            num_parts = len([
+                e for e in edges if _popcount(e) > 1 and _popcount(common_bitset ^ e) > 1])
+        else:
+            edges = set([bitset & common_bitset for bitset in clade_bitsets])
+            edges.discard(0)
+            num_parts = len([e for e in edges if _popcount(e) > 1]) - 1
+        return edges, num_parts
+
+    def get_rf_dist(self, tree: CellLineageTree):
+        """
+        @return tuple with RF distance and maximum RF distance
+        """
+        if not self.unrooted_trees and (len(self.ref_tree.children) > 2 or len(tree.children) > 2):
+            raise TreeError("Unrooted tree found! You may want to activate the unrooted_trees flag.")
+        if self.ref_leaf_idx_dict is None:
+            self._init_ref_bitsets()
+
+        tree_leaf_vals = [getattr(leaf, self.attr, None) for leaf in tree]
+        common_leaf_vals = set([
+            leaf_val for leaf_val in tree_leaf_vals if leaf_val in self.ref_leaf_idx_dict])
+        if len(self.ref_dup_leaf_vals & common_leaf_vals):
+            raise TreeError('Duplicated items found in source tree')
+        if len([leaf_val for leaf_val in tree_leaf_vals if leaf_val in common_leaf_vals]) > len(common_leaf_vals):
+            raise TreeError('Duplicated items found in reference tree')
+
+        common_bitset = 0
+        for leaf_val in common_leaf_vals:
+            common_bitset |= 1 << self.ref_leaf_idx_dict[leaf_val]
+        ref_edges, ref_num_parts = self._get_edges(self.ref_clade_bitsets, common_bitset)
+        tree_edges, tree_num_parts = self._get_edges(
+                _get_clade_bitsets(tree, self.attr, self.ref_leaf_idx_dict),
+                common_bitset)
+        return len(ref_edges ^ tree_edges), ref_num_parts + tree_num_parts
 
     def get_dist(self, tree):
-        rf_res = self.ref_tree.robinson_foulds(
-                tree,
-                attr_t1=self.attr,
-                attr_t2=self.attr,
-                expand_polytomies=False,
-                unrooted_trees=True)
-        return rf_res[0]/float(rf_res[1])
+        rf, max_rf = self.get_rf_dist(tree)
+        return rf/float(max_rf)
+
+
+class UnrootRFDistanceMeasurer(RFDistanceMeasurer):
+    """
+    Robinson foulds distance, unrooted trees
+    Returns the fraction of unshared splits of all possible splits.
+    """
+    name = "ete_rf_unroot"
+    unrooted_trees = True
 
 
-class RootRFDistanceMeasurer(TreeDistanceMeasurer):
+class RootRFDistanceMeasurer(RFDistanceMeasurer):
     """
     Robinson foulds distance, rooted trees
     Returns the fraction of unshared splits of all possible splits.
     """
     name = "ete_rf_root"
+    unrooted_trees = False
 
     def get_dist(self, tree):
         try:
-            rf_res = self.ref_tree.robinson_foulds(
-                    tree,
-                    attr_t1=self.attr,
-                    attr_t2=self.attr,
-                    expand_polytomies=False,
-                    unrooted_trees=False)
-            return rf_res[0]/float(rf_res[1])
+            return super(RootRFDistanceMeasurer, self).get_dist(tree)
         except Exception as err:
             logging.info("cannot get root RF distance: %s", str(err))
             print("cannot get root RF distance: %s", str(err))
@@ -413,24 +577,35 @@ class MRCADistanceMeasurer(TreeDistanceMeasurer):
     def _get_mrca_matrix(self, tree, perturb=0):
         """
         @return the pairwise MRCA distance matrix for that tree
+                (upper triangular, entry is the distance from the leaf that comes first in `tree`
+                to the MRCA, unless that distance is zero)
         """
         mrca_matrix = np.zeros((self.num_leaves, self.num_leaves))
-        assert len(tree) == self.num_leaves
-        for leaf1 in tree:
-            for leaf2 in tree:
-                leaf1_idx = self.leaf_dict[getattr(leaf1, self.attr)]
-                leaf2_idx = self.leaf_dict[getattr(leaf2, self.attr)]
-                if leaf1_idx == leaf2_idx:
-                    # Instead of distance to itself, set this to be pendant edge length
-                    mrca_matrix[leaf1_idx, leaf2_idx] = leaf1.dist + perturb
-                    continue
-                elif (mrca_matrix[leaf1_idx, leaf2_idx] + mrca_matrix[leaf2_idx, leaf1_idx]) > 0:
-                    # We already filled this distance out
-                    continue
-                mrca = leaf1.get_common_ancestor(leaf2)
-                mrca_dist = leaf1.get_distance(mrca)
-                mrca_matrix[min(leaf1_idx, leaf2_idx), max(leaf1_idx, leaf2_idx)] = mrca_dist + perturb
-                mrca_matrix[max(leaf1_idx, leaf2_idx), min(leaf1_idx, leaf2_idx)] = 0
+        leaves = tree.get_leaves()
+        assert len(leaves) == self.num_leaves
+        lca_finder = LCAFinder(tree)
+        leaf_node_idxs = lca_finder.get_node_idxs(leaves)
+        leaf_matrix_idxs = np.array([self.leaf_dict[getattr(leaf, self.attr)] for leaf in leaves], dtype=int)
+        leaf_dists = lca_finder.dist_to_root[leaf_node_idxs]
+
+        # Instead of distance to itself, set this to be pendant edge length
+        mrca_matrix[leaf_matrix_idxs, leaf_matrix_idxs] = [leaf.dist + perturb for leaf in leaves]
+        for pos in range(self.num_leaves - 1):
+            other_leaf_node_idxs = leaf_node_idxs[pos + 1:]
+            mrca_idxs = lca_finder.get_lca_idxs(
+                    np.repeat(leaf_node_idxs[pos], other_leaf_node_idxs.size),
+                    other_leaf_node_idxs)
+            mrca_dists_to_root = lca_finder.dist_to_root[mrca_idxs]
+            first_leaf_mrca_dists = leaf_dists[pos] - mrca_dists_to_root
+            other_leaf_mrca_dists = leaf_dists[pos + 1:] - mrca_dists_to_root
+            mrca_dists = np.where(
+                    first_leaf_mrca_dists + perturb > 0,
+                    first_leaf_mrca_dists,
+                    other_leaf_mrca_dists) + perturb
+
+            leaf1_idx = leaf_matrix_idxs[pos]
+            leaf2_idxs = leaf_matrix_idxs[pos + 1:]
+            mrca_matrix[np.minimum(leaf1_idx, leaf2_idxs), np.maximum(leaf1_idx, leaf2_idxs)] = mrca_dists
         return mrca_matrix
 
     def get_dist(self, tree, C=0.1):
@@ -510,15 +685,16 @@ class InternalCorrMeasurer(MRCADistanceMeasurer):
         return leaf_groups, node_val
 
     def get_compare_node_distances(self, tree, leaf_groups):
+        lca_finder = LCAFinder(tree)
         leaf_dict = {}
         for leaf in tree:
-            leaf_dict[getattr(leaf, self.attr)] = leaf
+            leaf_dict[getattr(leaf, self.attr)] = lca_finder.node_idx_dict[id(leaf)]
 
         node_val = []
         for leaf_idxs in leaf_groups:
-            tree_mrca = tree.get_common_ancestor([
-                leaf_dict[leaf_key_val] for leaf_key_val in leaf_idxs])
-            node_val.append(tree_mrca.dist_to_root)
+            tree_mrca_idx = lca_finder.get_lca_idx_of_set(np.array([
+                leaf_dict[leaf_key_val] for leaf_key_val in leaf_idxs]))
+            node_val.append(lca_finder.nodes[tree_mrca_idx].dist_to_root)
         return node_val
 
     def get_dist(self, tree):
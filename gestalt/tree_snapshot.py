@@ -0,0 +1,317 @@
+from typing import List
+import logging
+import numpy as np
+
+from cell_lineage_tree import CellLineageTree
+from anc_state import AncState
+from allele_events import AlleleEvents
+from barcode_metadata import BarcodeMetadata
+
+
+class Regraft:
+    """
+    Describes a tree that is obtained by regrafting a subtree, as a diff over the base tree
+    """
+    def __init__(
+            self,
+            chad_id: int,
+            attach_id: int,
+            in_branch: bool,
+            parent_anc_state_list: List[AncState]):
+        """
+        @param chad_id: node id of the root of the subtree to regraft
+        @param attach_id: node id of the node that the subtree is attached to
+        @param in_branch: if True, the subtree is attached to the middle of the branch above `attach_id`,
+                        i.e. parent -- new node -- attach node, subtree.
+                        Otherwise the subtree becomes a child of `attach_id`.
+        @param parent_anc_state_list: the ancestral states of the new parent of the subtree
+        """
+        self.chad_id = chad_id
+        self.attach_id = attach_id
+        self.in_branch = in_branch
+        self.parent_anc_state_list = parent_anc_state_list
+
+    def relabel(self, id_mapping):
+        """
+        @param id_mapping: maps the node ids in the base tree to new node ids
+        @return Regraft for the base tree with relabeled node ids
+        """
+        return Regraft(
+                id_mapping[self.chad_id],
+                id_mapping[self.attach_id],
+                self.in_branch,
+                self.parent_anc_state_list)
+
+    def apply(self, tree: CellLineageTree):
+        """
+        Regrafts the subtree in `tree` (in place). The new node in the middle of a branch gets node id None.
+        @return list of the nodes whose ancestral states need to be recalculated
+                (see hanging_chad_finder._mark_nodes_for_recalc)
+        """
+        chad = tree.search_nodes(node_id=self.chad_id)[0]
+        attach_node = tree.search_nodes(node_id=self.attach_id)[0]
+        nodes_to_update = [chad] + chad.up.get_children()
+        chad.detach()
+        if self.in_branch:
+            new_node = CellLineageTree(
+                    allele_events_list=[
+                        AlleleEvents([], allele_evts.num_targets)
+                        for allele_evts in attach_node.allele_events_list])
+            new_node.add_features(node_id=None)
+            attach_node.up.add_child(new_node)
+            attach_node.detach()
+            new_node.add_child(attach_node)
+            new_node.add_child(chad)
+        else:
+            attach_node.add_child(chad)
+        return nodes_to_update
+
+
+class TreeSnapshot:
+    """
+    Read-only snapshot of a tree that is annotated with ancestral states (see ancestral_events_finder).
+    The topology is stored as parent index arrays over the nodes in preorder. The nodes themselves are shared
+    with the tree rather than copied, so the tree must not be modified while the snapshot is in use.
+
+    Regrafting a subtree only changes the ancestral states along the paths from the old and new attachment
+    points to the root. So we find the parsimony score of a regrafted tree by recomputing the ancestral states
+    along these paths and the parsimony scores of the branches touching them (see TreeDiff), instead of copying
+    the tree and traversing all of its nodes.
+    """
+    def __init__(self, tree: CellLineageTree, bcode_meta: BarcodeMetadata):
+        """
+        @param tree: tree annotated with ancestral states
+        """
+        self.bcode_meta = bcode_meta
+        self.snapshot = self
+        self.nodes = list(tree.traverse("preorder"))
+        self.num_nodes = len(self.nodes)
+        self.node_idxs = {node.node_id: idx for idx, node in enumerate(self.nodes)}
+        assert len(self.node_idxs) == self.num_nodes
+        self.parents = np.array([
+            self.node_idxs[node.up.node_id] if not node.is_root() else -1
+            for node in self.nodes], dtype=int)
+        self.children = [
+            [self.node_idxs[child.node_id] for child in node.children]
+            for node in self.nodes]
+        # The subtree below node i is nodes[i:subtree_ends[i]]
+        self.subtree_ends = np.arange(1, self.num_nodes + 1)
+        for idx in range(self.num_nodes - 1, 0, -1):
+            self.subtree_ends[self.parents[idx]] = max(self.subtree_ends[self.parents[idx]], self.subtree_ends[idx])
+        self.levelorder_idxs = [self.node_idxs[node.node_id] for node in tree.traverse("levelorder")]
+
+        self.anc_state_lists = [node.anc_state_list for node in self.nodes]
+        self.singletons = [get_singletons(anc_state_list) for anc_state_list in self.anc_state_lists]
+        self.branch_scores = np.zeros(self.num_nodes, dtype=int)
+        for idx in range(1, self.num_nodes):
+            self.branch_scores[idx] = get_branch_score(
+                    self.singletons[idx],
+                    self.singletons[self.parents[idx]])
+        self.parsimony_score = int(np.sum(self.branch_scores))
+        self.num_zero_internal = sum([self.is_zero_internal(idx) for idx in range(self.num_nodes)])
+
+    def get_children(self, idx: int):
+        return self.children[idx]
+
+    def get_parent(self, idx: int):
+        return self.parents[idx]
+
+    def get_anc_state_list(self, idx: int):
+        return self.anc_state_lists[idx]
+
+    def get_singletons(self, idx: int):
+        return self.singletons[idx]
+
+    def get_branch_score(self, idx: int):
+        return self.branch_scores[idx]
+
+    def is_zero_internal(self, idx: int):
+        """
+        @return whether the branch above this node is internal and has zero parsimony score (so it can be collapsed)
+        """
+        return self.get_parent(idx) >= 0 and self.get_branch_score(idx) == 0 and len(self.get_children(idx)) > 0
+
+    def is_descendant(self, idx: int, anc_idx: int):
+        return anc_idx <= idx < self.subtree_ends[anc_idx]
+
+    def get_regrafts(
+            self,
+            chad_id: int,
+            max_regrafts: int = None,
+            branch_len_attaches: bool = True):
+        """
+        Finds all the places we can regraft the subtree below `chad_id` to without changing the parsimony score
+        and without introducing internal branches that can be collapsed
+
+        @param max_regrafts: maximum number of regrafts to return
+        @param branch_len_attaches: whether or not to consider regrafting the subtree onto the middle of a branch
+        @return List[Regraft], first the regrafts onto existing nodes and then the regrafts onto branches
+                (each in levelorder of the attachment point)
+        """
+        chad_idx = self.node_idxs[chad_id]
+        old_parent_idx = self.parents[chad_idx]
+        # The tree without the chad is shared by all the regrafts
+        nochad_diff = TreeDiff(self)
+        nochad_diff.prune(chad_idx)
+        old_parent_unifurc = len(nochad_diff.get_children(old_parent_idx)) == 1
+
+        # Only consider nodes that are not descendants of the chad
+        attach_idxs = [idx for idx in self.levelorder_idxs if not self.is_descendant(idx, chad_idx)]
+        options = [(idx, False) for idx in attach_idxs]
+        if branch_len_attaches:
+            options += [(idx, True) for idx in attach_idxs]
+
+        regrafts = []
+        for attach_idx, in_branch in options:
+            if max_regrafts is not None and len(regrafts) >= max_regrafts:
+                break
+            if in_branch:
+                if attach_idx == 0 or (old_parent_unifurc and attach_idx == old_parent_idx):
+                    continue
+            elif len(nochad_diff.get_children(attach_idx)) == 0 or attach_idx == old_parent_idx:
+                continue
+
+            regraft_diff = TreeDiff(nochad_diff)
+            regraft_diff.regraft(chad_idx, attach_idx, in_branch)
+            if regraft_diff.parsimony_score < self.parsimony_score:
+                logging.info(
+                        "We beat MIX (attach chad %d to %s %d): %d< %d",
+                        chad_id,
+                        "branch" if in_branch else "multifurc",
+                        self.nodes[attach_idx].node_id,
+                        regraft_diff.parsimony_score,
+                        self.parsimony_score)
+            if regraft_diff.parsimony_score == self.parsimony_score and regraft_diff.num_zero_internal == 0:
+                regrafts.append(Regraft(
+                    chad_id,
+                    self.nodes[attach_idx].node_id,
+                    in_branch,
+                    regraft_diff.get_anc_state_list(regraft_diff.get_parent(chad_idx))))
+        return regrafts
+
+
+class TreeDiff:
+    """
+    Changes to the topology and ancestral states of a TreeSnapshot, layered on top of
+    the snapshot or another TreeDiff. Only the nodes that changed are stored.
+    """
+    def __init__(self, base):
+        """
+        @param base: TreeSnapshot or TreeDiff
+        """
+        self.base = base
+        self.snapshot = base.snapshot
+        self.children = dict()
+        self.parents = dict()
+        self.anc_state_lists = dict()
+        self.singletons = dict()
+        self.branch_scores = dict()
+        self.parsimony_score = base.parsimony_score
+        self.num_zero_internal = base.num_zero_internal
+
+    def get_children(self, idx: int):
+        return self.children[idx] if idx in self.children else self.base.get_children(idx)
+
+    def get_parent(self, idx: int):
+        return self.parents[idx] if idx in self.parents else self.base.get_parent(idx)
+
+    def get_anc_state_list(self, idx: int):
+        return self.anc_state_lists[idx] if idx in self.anc_state_lists else self.base.get_anc_state_list(idx)
+
+    def get_singletons(self, idx: int):
+        return self.singletons[idx] if idx in self.singletons else self.base.get_singletons(idx)
+
+    def get_branch_score(self, idx: int):
+        return self.branch_scores[idx] if idx in self.branch_scores else self.base.get_branch_score(idx)
+
+    def is_zero_internal(self, idx: int):
+        return self.get_parent(idx) >= 0 and self.get_branch_score(idx) == 0 and len(self.get_children(idx)) > 0
+
+    def prune(self, chad_idx: int):
+        """
+        Detaches the subtree below `chad_idx`
+        """
+        old_parent_idx = self.get_parent(chad_idx)
+        self.children[old_parent_idx] = [idx for idx in self.get_children(old_parent_idx) if idx != chad_idx]
+        self.parents[chad_idx] = -1
+        self._update_path(old_parent_idx, chad_idx)
+
+    def regraft(self, chad_idx: int, attach_idx: int, in_branch: bool):
+        """
+        Attaches the pruned subtree below `chad_idx` (see Regraft).
+        The new node in the middle of a branch gets the index `snapshot.num_nodes`.
+        """
+        assert self.get_parent(chad_idx) == -1
+        if in_branch:
+            new_idx = self.snapshot.num_nodes
+            up_idx = self.get_parent(attach_idx)
+            self.children[up_idx] = [idx for idx in self.get_children(up_idx) if idx != attach_idx] + [new_idx]
+            self.children[new_idx] = [attach_idx, chad_idx]
+            self.parents[new_idx] = up_idx
+            self.parents[attach_idx] = new_idx
+            self.parents[chad_idx] = new_idx
+            self._update_path(new_idx, chad_idx)
+        else:
+            self.children[attach_idx] = self.get_children(attach_idx) + [chad_idx]
+            self.parents[chad_idx] = attach_idx
+            self._update_path(attach_idx, chad_idx)
+
+    def _update_path(self, start_idx: int, chad_idx: int):
+        """
+        Recomputes the ancestral states along the path from `start_idx` to the root (the ancestral state of the
+        root is fixed) until they stop changing, then the parsimony scores of the branches touching the
+        recomputed nodes and the branch above `chad_idx`
+        """
+        path_idxs = []
+        idx = start_idx
+        while idx > 0:
+            path_idxs.append(idx)
+            children = self.get_children(idx)
+            if len(children) == 0:
+                anc_state_list = [
+                    AncState.create_for_observed_allele(evts, self.snapshot.bcode_meta)
+                    for evts in self.snapshot.nodes[idx].allele_events_list]
+            else:
+                # Same as ancestral_events_finder.get_possible_anc_states
+                child_anc_state_lists = [self.get_anc_state_list(child) for child in children]
+                anc_state_list = []
+                for bcode_idx, anc_state in enumerate(child_anc_state_lists[0]):
+                    for child_anc_state_list in child_anc_state_lists[1:]:
+                        anc_state = AncState.intersect(anc_state, child_anc_state_list[bcode_idx])
+                    anc_state_list.append(anc_state)
+            self.anc_state_lists[idx] = anc_state_list
+            self.singletons[idx] = get_singletons(anc_state_list)
+
+            # If the ancestral state did not change, the ancestral states further up do not change either
+            if idx != self.snapshot.num_nodes and all([
+                    new_anc_state.indel_set_list == old_anc_state.indel_set_list
+                    for new_anc_state, old_anc_state in zip(anc_state_list, self.base.get_anc_state_list(idx))]):
+                break
+            idx = self.get_parent(idx)
+
+        changed_idxs = set([chad_idx] + path_idxs)
+        for idx in path_idxs:
+            changed_idxs.update(self.get_children(idx))
+        for idx in changed_idxs:
+            is_new_node = idx == self.snapshot.num_nodes
+            old_branch_score = 0 if is_new_node else self.base.get_branch_score(idx)
+            old_is_zero_internal = False if is_new_node else self.base.is_zero_internal(idx)
+            parent_idx = self.get_parent(idx)
+            self.branch_scores[idx] = get_branch_score(
+                    self.get_singletons(idx),
+                    self.get_singletons(parent_idx)) if parent_idx >= 0 else 0
+            self.parsimony_score += self.branch_scores[idx] - old_branch_score
+            self.num_zero_internal += int(self.is_zero_internal(idx)) - int(old_is_zero_internal)
+
+
+def get_singletons(anc_state_list: List[AncState]):
+    return [set(anc_state.get_singletons()) for anc_state in anc_state_list]
+
+
+def get_branch_score(node_singletons, up_singletons):
+    """
+    @return the number of new singletons introduced along the branch (see ancestral_events_finder.get_parsimony_score)
+    """
+    return sum([
+        len(node_sgs - up_sgs)
+        for node_sgs, up_sgs in zip(node_singletons, up_singletons)])
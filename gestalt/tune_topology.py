@@ -17,10 +17,12 @@ from model_assessor import ModelAssessor
 from tree_distance import BHVDistanceMeasurer, InternalCorrMeasurer
 from transition_wrapper_maker import TransitionWrapperMaker
 from likelihood_scorer import LikelihoodScorer, LikelihoodScorerResult
+from clt_likelihood_estimator import OPTIMIZERS
 from barcode_metadata import BarcodeMetadata
 import hyperparam_tuner
 import hanging_chad_finder
-from common import create_directory, get_randint, save_data, get_init_target_lams, parse_comma_str
+from common import create_directory, get_randint, get_init_target_lams, parse_comma_str
+from tuning_checkpoint import TuningCheckpoint, run_worker
 import file_readers
 import collapsed_tree
 
@@ -69,6 +71,21 @@ def parse_args(args):
         help="""
         Where to output logs
         """)
+    parser.add_argument(
+        '--checkpoint-file',
+        type=str,
+        default=None,
+        help="""
+        Where to log the completed tuning iterations and model fits, so that the run can be resumed.
+        Defaults to the out model file with the suffix `.checkpoint`
+        """)
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help="""
+        Resume from the checkpoint file: skip the tuning iterations and model fits that were already completed.
+        Use the same arguments as the original run.
+        """)
     parser.add_argument(
         '--true-model-file',
         type=str,
@@ -140,6 +157,25 @@ def parse_args(args):
         Maximum number of candidate SPR moves to consider at each iteration
         Note: Hanging chads in the code refer to SPR moves that preserve the parsimony score.
         """)
+    parser.add_argument(
+        '--max-chad-full-fits',
+        type=int,
+        default=None,
+        help="""
+        If specified, first screen the candidate SPR moves by their penalized log likelihood at the
+        warm-start parameters (only recomputing the partial likelihoods affected by the move) and
+        only fit this many of the top-scoring candidates. Otherwise fit all the candidates.
+        """)
+    parser.add_argument(
+        '--chad-rung-iters',
+        type=int,
+        default=None,
+        help="""
+        If specified, race the candidate SPR moves instead of fully fitting all of them:
+        train all the candidates for this many iterations at a time (continuing the same fit in each round)
+        and drop the ones that are statistically behind, so that only the promising candidates are trained
+        for `max-iters`.
+        """)
     parser.add_argument(
             '--max-iters',
             type=int,
@@ -147,6 +183,16 @@ def parse_args(args):
             help="""
             Maximum number of training iterations used when tuning branch lengths and mutation parameters.
             """)
+    parser.add_argument(
+            '--optimizer',
+            type=str,
+            default="adam",
+            choices=OPTIMIZERS,
+            help="""
+            Optimizer for tuning branch lengths and mutation parameters.
+            The quasi-Newton method `lbfgs` typically converges in far fewer iterations than `adam`.
+            `trust-ncg` is a trust-region Newton method.
+            """)
     parser.add_argument(
             '--num-inits',
             type=int,
@@ -237,6 +283,8 @@ def parse_args(args):
     assert all([p > 0 for p in args.target_lam_pen_params])
 
     create_directory(args.out_model_file)
+    if args.checkpoint_file is None:
+        args.checkpoint_file = args.out_model_file + ".checkpoint"
     if args.scratch_dir is None:
         topology_folder = os.path.dirname(args.topology_file)
         args.scratch_dir = os.path.join(topology_folder, "scratch")
@@ -251,6 +299,8 @@ def parse_args(args):
     assert args.num_penalty_tune_iters >= 1
     assert args.tot_time_known
     assert args.num_chad_tune_iters >= args.num_penalty_tune_iters
+    assert args.max_chad_full_fits is None or args.max_chad_full_fits >= 1
+    assert args.chad_rung_iters is None or args.chad_rung_iters >= 1
     return args
 
 
@@ -362,8 +412,10 @@ def fit_multifurc_tree(
         bcode_meta: BarcodeMetadata,
         args,
         param_dict: Dict,
-        assessor: ModelAssessor = None):
+        assessor: ModelAssessor = None,
+        checkpoint: TuningCheckpoint = None):
     """
+    @param checkpoint: if not None, read the fit from this checkpoint if it was already done
     @return LikelihoodScorerResult from fitting model on multifurcating tree
     """
     transition_wrap_maker = TransitionWrapperMaker(
@@ -398,7 +450,7 @@ def fit_multifurc_tree(
         param_dict['branch_len_inners'] = tree_br_len_inners
         param_dict['branch_len_offsets_proportion'] = tree_br_len_offsets
 
-    result = LikelihoodScorer(
+    result = run_worker(LikelihoodScorer(
         get_randint(),
         tree,
         bcode_meta,
@@ -409,7 +461,8 @@ def fit_multifurc_tree(
         known_params=args.known_params,
         scratch_dir=args.scratch_dir,
         use_poisson=args.use_poisson,
-        assessor=assessor).run_worker(None)[0]
+        assessor=assessor,
+        optimizer=args.optimizer), checkpoint)[0]
     return result
 
 def _do_random_rearrange(tree, bcode_meta, num_random_rearrange):
@@ -439,7 +492,7 @@ def _do_random_rearrange(tree, bcode_meta, num_random_rearrange):
         logging.info(str(random_chad))
 
         # Pick random equal parsimony tree
-        new_tree = random.choice(random_chad.possible_full_trees)
+        new_tree = random_chad.get_possible_full_tree(random.randrange(random_chad.num_possible_trees))
 
         # Remove any unifurcations that may have been introduced when we
         # detached the hanging chad
@@ -495,10 +548,28 @@ def main(args=sys.argv[1:]):
 
     # Begin tuning
     st_time = time.time()
+    checkpoint = TuningCheckpoint(args.checkpoint_file, resume=args.resume)
     tuning_history = []
     recent_chads = set()
     num_stable = 0
-    for i in range(args.num_chad_tune_iters):
+    is_done = False
+    best_res = None
+    # Pick up where the checkpointed run left off
+    for iter_state in checkpoint.iter_states:
+        tuning_history.append(iter_state["tuning_history"])
+    if checkpoint.iter_states:
+        last_iter_state = checkpoint.iter_states[-1]
+        tree = last_iter_state["tree"]
+        fit_params = last_iter_state["fit_params"]
+        best_res = last_iter_state["tuning_history"]["best_res"]
+        recent_chads = last_iter_state["recent_chads"]
+        num_stable = last_iter_state["num_stable"]
+        is_done = last_iter_state["is_done"]
+        logging.info("Resuming after iter %d", len(tuning_history) - 1)
+
+    for i in range(len(tuning_history), args.num_chad_tune_iters):
+        if is_done:
+            break
         np.random.seed(args.seed + i + 1)
         random.seed(args.seed + i + 1)
 
@@ -512,7 +583,13 @@ def main(args=sys.argv[1:]):
             else:
                 # Tune penalty params!
                 logging.info("Iter %d: Tuning penalty params", i)
-                penalty_tune_result = hyperparam_tuner.tune(tree, bcode_meta, args, fit_params, assessor)
+                penalty_tune_result = hyperparam_tuner.tune(
+                        tree,
+                        bcode_meta,
+                        args,
+                        fit_params,
+                        assessor,
+                        checkpoint=checkpoint)
                 _, fit_params, best_res = penalty_tune_result.get_best_result()
             logging.info("Iter %d: Best pen param %f %s", i, fit_params["branch_pen_param"], fit_params["target_lam_pen_param"])
 
@@ -532,7 +609,14 @@ def main(args=sys.argv[1:]):
                 "penalty_tune_result": penalty_tune_result,
                 "best_res": best_res,
             })
-            save_data(tuning_history, args.out_model_file)
+            is_done = True
+            checkpoint.add_iteration({
+                "tuning_history": tuning_history[-1],
+                "tree": tree,
+                "fit_params": fit_params,
+                "recent_chads": recent_chads,
+                "num_stable": num_stable,
+                "is_done": is_done})
             logging.info("No hanging chads found")
             break
 
@@ -558,6 +642,7 @@ def main(args=sys.argv[1:]):
             args,
             fit_params,
             assessor,
+            checkpoint=checkpoint,
         )
         tree, fit_params, best_res = chad_tune_result.get_best_result()
         if is_same:
@@ -590,20 +675,31 @@ def main(args=sys.argv[1:]):
             "penalty_tune_result": penalty_tune_result,
             "best_res": best_res,
         })
-        save_data(tuning_history, args.out_model_file)
-        if (num_all_chads is not None and num_stable >= num_all_chads) or num_stable >= args.num_chad_stop:
+        is_done = (num_all_chads is not None and num_stable >= num_all_chads) or num_stable >= args.num_chad_stop
+        # Only append this iteration to the checkpoint rather than re-pickling the entire tuning history
+        checkpoint.add_iteration({
+            "tuning_history": tuning_history[-1],
+            "tree": tree,
+            "fit_params": fit_params,
+            "recent_chads": recent_chads,
+            "num_stable": num_stable,
+            "is_done": is_done})
+        if is_done:
             logging.info("Hanging chad tuner has converged")
             break
 
     logging.info("Done tuning chads!")
     last_chad_res = tuning_history[-1]['chad_tune_result']
     if last_chad_res is None or last_chad_res.num_chad_leaves > 1:
+        # Reseed so that a resumed run creates the same final fit
+        np.random.seed(args.seed + len(tuning_history) + 1)
         final_fit = fit_multifurc_tree(
                 tree,
                 bcode_meta,
                 args,
                 fit_params,
-                assessor)
+                assessor,
+                checkpoint)
     else:
         final_fit = best_res
 
@@ -0,0 +1,199 @@
+"""
+Checkpointing for long tuning runs (see tune_topology.py)
+"""
+import os
+import hashlib
+import logging
+import pickle
+import random
+import six
+import numpy as np
+from ete3 import TreeNode
+
+
+def _update_hash(hasher, obj, active: dict):
+    """
+    Feeds a canonical description of the contents of `obj` into `hasher`.
+    Unlike pickling, the description does not depend on the iteration order of sets and dictionaries
+    or on which objects happen to be shared, so equal objects give the same hash in every process.
+
+    @param active: maps id of the containers and objects that are currently being described to their depth.
+                A reference back to one of these (a cycle) is described by its depth.
+    """
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, np.generic)):
+        hasher.update(repr((type(obj).__name__, obj)).encode())
+        return
+    if id(obj) in active:
+        hasher.update(("cycle%d" % active[id(obj)]).encode())
+        return
+
+    if isinstance(obj, TreeNode):
+        # Walk down the tree iteratively rather than recursing through the child and parent pointers
+        # (trees can be deeper than the recursion limit).
+        # References to nodes in the tree are described by their preorder index.
+        nodes = list(obj.traverse("preorder"))
+        for node_idx, node in enumerate(nodes):
+            active[id(node)] = -node_idx - 1
+        for node in nodes:
+            hasher.update(repr((type(node).__qualname__, len(node.children))).encode())
+            _update_hash(
+                    hasher,
+                    {k: v for k, v in node.__dict__.items() if k not in ("_children", "_up")},
+                    active)
+        for node in nodes:
+            del active[id(node)]
+        return
+
+    active[id(obj)] = len(active)
+    if isinstance(obj, np.ndarray):
+        hasher.update(repr(("ndarray", obj.dtype.str, obj.shape)).encode())
+        if obj.dtype == object:
+            for elem in obj.flatten():
+                _update_hash(hasher, elem, active)
+        else:
+            hasher.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (list, tuple)):
+        hasher.update(repr((type(obj).__name__, len(obj))).encode())
+        for elem in obj:
+            _update_hash(hasher, elem, active)
+    elif isinstance(obj, (set, frozenset)):
+        hasher.update(repr((type(obj).__name__, len(obj))).encode())
+        for elem_hash in sorted([get_hash(elem) for elem in obj]):
+            hasher.update(elem_hash.encode())
+    elif isinstance(obj, dict):
+        hasher.update(repr((type(obj).__name__, len(obj))).encode())
+        for key_hash, key in sorted([(get_hash(key), key) for key in obj.keys()], key=lambda x: x[0]):
+            hasher.update(key_hash.encode())
+            _update_hash(hasher, obj[key], active)
+    elif hasattr(obj, "__dict__"):
+        hasher.update(type(obj).__qualname__.encode())
+        _update_hash(hasher, obj.__dict__, active)
+    else:
+        try:
+            hasher.update(pickle.dumps(obj, protocol=2))
+        except Exception:
+            hasher.update(type(obj).__qualname__.encode())
+    del active[id(obj)]
+
+
+def get_hash(obj):
+    """
+    @return a deterministic hash (hex string) of the contents of `obj`
+    """
+    hasher = hashlib.sha1()
+    _update_hash(hasher, obj, dict())
+    return hasher.hexdigest()
+
+
+class TuningCheckpoint:
+    """
+    Append-only log of the completed work in a tuning run, so that the run can resume after being killed.
+
+    The log stores two kinds of records:
+        ("task", task hash, result): the result of a ParallelWorker, keyed by the hash of all of its inputs
+                (see LikelihoodScorer.get_task_hash). A resumed run recreates the same workers
+                (since the seeds are deterministic) and only reruns the ones without a result.
+        ("iter", iteration index, state): the state of the tuning run after finishing an iteration
+
+    Each record is pickled and appended to the end of the log file, so a checkpoint only writes the new record
+    rather than re-pickling the entire tuning history. If the job was killed while writing a record, the partial
+    record at the end of the file is dropped when the log is read back in.
+    """
+    def __init__(self, log_file: str, resume: bool = False):
+        """
+        @param log_file: file to append the records to
+        @param resume: whether to read in the records from an existing log file.
+                    Otherwise any existing log file is overwritten.
+        """
+        self.log_file = log_file
+        self.task_results = dict()
+        self.iter_states = []
+        if resume and os.path.exists(log_file):
+            self._read_log()
+            logging.info(
+                    "Resuming from checkpoint %s: %d iterations, %d tasks done",
+                    log_file,
+                    len(self.iter_states),
+                    len(self.task_results))
+        else:
+            open(log_file, "wb").close()
+
+    def _read_log(self):
+        good_len = 0
+        with open(self.log_file, "rb") as f:
+            while True:
+                try:
+                    record_type, key, value = six.moves.cPickle.load(f)
+                except EOFError:
+                    break
+                except Exception as e:
+                    logging.info("Dropping partial record at the end of the checkpoint: %s", e)
+                    break
+                good_len = f.tell()
+                if record_type == "task":
+                    self.task_results[key] = value
+                else:
+                    assert key == len(self.iter_states)
+                    self.iter_states.append(value)
+        # Get rid of the partial record so we can keep appending
+        with open(self.log_file, "ab") as f:
+            f.truncate(good_len)
+
+    def _append(self, record):
+        with open(self.log_file, "ab") as f:
+            six.moves.cPickle.dump(record, f, protocol=2)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def get_result(self, task_hash: str):
+        """
+        @return the stored result of the task, None if the task has not finished
+        """
+        return self.task_results.get(task_hash, None)
+
+    def add_result(self, task_hash: str, result):
+        """
+        Stores the result of the task. Failed tasks (the result is None) are not stored
+        so that they are rerun on resume.
+        """
+        if result is None:
+            return
+        self.task_results[task_hash] = result
+        self._append(("task", task_hash, result))
+
+    def run_worker(self, worker):
+        """
+        @return the result of `worker.run_worker`, read from the checkpoint if the worker has already finished
+        """
+        # Hash the worker before running it, in case running it modifies its inputs
+        task_hash = worker.get_task_hash()
+        result = self.get_result(task_hash)
+        if result is not None:
+            logging.info("Loaded %s %s from checkpoint", getattr(worker, "name", ""), task_hash)
+        else:
+            # Workers reseed the random number generators. Restore their state afterwards so that
+            # the workers created later get the same seeds whether or not this worker was skipped.
+            np_random_state = np.random.get_state()
+            random_state = random.getstate()
+            result = worker.run_worker(None)
+            np.random.set_state(np_random_state)
+            random.setstate(random_state)
+            self.add_result(task_hash, result)
+        return result
+
+    def add_iteration(self, state):
+        """
+        Stores the state of the tuning run after finishing the next iteration
+        """
+        self._append(("iter", len(self.iter_states), state))
+        self.iter_states.append(state)
+
+
+def run_worker(worker, checkpoint: TuningCheckpoint = None):
+    """
+    Runs the worker in this process, using the checkpoint if there is one
+    @return the result of `worker.run_worker`
+    """
+    if checkpoint is None:
+        return worker.run_worker(None)
+    return checkpoint.run_worker(worker)